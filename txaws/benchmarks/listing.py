@@ -0,0 +1,111 @@
+# Licenced under the txaws licence available at /LICENSE in the txaws source.
+
+"""
+Benchmark of the memory taken and the time spent parsing bucket listings.
+
+Run it with::
+
+    python -m txaws.benchmarks.listing [ITEMS]
+
+Listings of C{ITEMS} objects, in pages of 1000 like S3 gives them, are
+parsed into:
+
+ - C{items}: a L{BucketItem} and an L{ItemOwner} per object, with its
+   modification date parsed by C{dateutil};
+ - C{columns}: L{BucketItemColumns}, as asked for with C{columnar=True}.
+
+The memory is that of the contents of the listings, every object they refer
+to being counted once.
+"""
+from hashlib import md5
+import sys
+import time
+
+from txaws.credentials import AWSCredentials
+from txaws.s3.client import S3Client
+
+
+PAGE_SIZE = 1000
+
+OWNER = ("<Owner><ID>bcaf1ffd86f41caff1a493dc2ad8c2c281e37522a640e161ca5fb16f"
+         "d081034f</ID><DisplayName>webfile</DisplayName></Owner>")
+
+
+def make_page(first, count):
+    """
+    Return a C{ListBucketResult} document listing C{count} objects, from
+    the C{first} one.
+    """
+    contents = "".join(
+        "<Contents><Key>photos/2006/%08d.jpg</Key>"
+        "<LastModified>2006-01-%02dT12:%02d:%02d.000Z</LastModified>"
+        "<ETag>&quot;%s&quot;</ETag><Size>%d</Size>"
+        "<StorageClass>%s</StorageClass>%s</Contents>" %
+        (index, index % 28 + 1, index // 60 % 60, index % 60,
+         md5(str(index)).hexdigest(), index * 1024,
+         "STANDARD" if index % 10 else "GLACIER", OWNER)
+        for index in range(first, first + count))
+    return ("<?xml version=\"1.0\" encoding=\"UTF-8\"?>\n"
+            "<ListBucketResult xmlns=\"http://s3.amazonaws.com/doc/"
+            "2006-03-01/\"><Name>mybucket</Name><Prefix></Prefix>"
+            "<MaxKeys>%d</MaxKeys><IsTruncated>true</IsTruncated>%s"
+            "</ListBucketResult>" % (PAGE_SIZE, contents))
+
+
+def get_size(obj):
+    """
+    Return the memory taken by C{obj} and by the objects it refers to, each
+    of them counted once.
+    """
+    seen = set()
+    objects = [obj]
+    size = 0
+    while objects:
+        obj = objects.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            objects.extend(obj.keys())
+            objects.extend(obj.values())
+        elif isinstance(obj, (list, tuple)):
+            objects.extend(obj)
+        elif hasattr(obj, "__dict__"):
+            objects.append(obj.__dict__)
+    return size
+
+
+def run_scenario(pages, columnar):
+    """
+    Parse C{pages}.
+
+    @return: The time spent and the contents of the listings.
+    """
+    # The parser alone, without a request.
+    parse = S3Client(AWSCredentials("foo", "bar"))._parse_get_bucket
+    started = time.time()
+    contents = [parse(page, columnar).contents for page in pages]
+    return time.time() - started, contents
+
+
+def report(name, items, elapsed, size):
+    print "%-8s %8d items  parse %6.2f us/item  memory %6.1f bytes/item" % (
+        name, items, elapsed / items * 1e6, float(size) / items)
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    items = 100000
+    if argv:
+        items = int(argv[0])
+    pages = [make_page(first, min(PAGE_SIZE, items - first))
+             for first in range(0, items, PAGE_SIZE)]
+    for name, columnar in (("items", False), ("columns", True)):
+        elapsed, contents = run_scenario(pages, columnar)
+        report(name, items, elapsed, get_size(contents))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+# Licenced under the txaws licence available at /LICENSE in the txaws source.
+
+"""
+Microbenchmark of TLS connection setup against a local stand-in server.
+
+Run it with::
+
+    python -m txaws.benchmarks.tls [CONNECTIONS]
+
+Three ways of making sequential connections are compared:
+
+ - C{cold}: a new L{VerifyingContextFactory} for every connection, which is
+   what L{BaseQuery.get_page} used to do;
+ - C{reused}: a single context shared by all connections, still doing full
+   handshakes;
+ - C{resumed}: a single context resuming the TLS session of the previous
+   connection, as returned by L{get_context_factory}.
+"""
+import sys
+import time
+
+from OpenSSL.crypto import PKey, X509, TYPE_RSA
+
+from twisted.internet import defer, protocol
+from twisted.internet.ssl import CertificateOptions
+
+from txaws.client.ssl import VerifyingContextFactory, get_ca_certs
+from txaws.exception import CertsNotFoundError
+
+
+HOST = "localhost"
+
+
+def make_certificate(common_name, bits=2048):
+    """Return a self-signed C{(key, certificate)} pair for C{common_name}."""
+    key = PKey()
+    key.generate_key(TYPE_RSA, bits)
+    certificate = X509()
+    certificate.get_subject().CN = common_name
+    certificate.set_issuer(certificate.get_subject())
+    certificate.set_serial_number(1)
+    certificate.gmtime_adj_notBefore(0)
+    certificate.gmtime_adj_notAfter(60 * 60 * 24)
+    certificate.set_pubkey(key)
+    certificate.sign(key, "sha256")
+    return key, certificate
+
+
+class Echo(protocol.Protocol):
+
+    def dataReceived(self, data):
+        self.transport.write(data)
+
+
+class Ping(protocol.Protocol):
+    """Send one byte and disconnect once it is echoed back."""
+
+    received = False
+
+    def connectionMade(self):
+        self.transport.write("x")
+
+    def dataReceived(self, data):
+        self.received = True
+        self.transport.loseConnection()
+
+    def connectionLost(self, reason):
+        if self.received:
+            self.factory.done.callback(time.time() - self.factory.started)
+        else:
+            self.factory.done.errback(reason)
+
+
+class PingFactory(protocol.ClientFactory):
+
+    protocol = Ping
+
+    def __init__(self):
+        self.done = defer.Deferred()
+        self.started = time.time()
+
+    def clientConnectionFailed(self, connector, reason):
+        self.done.errback(reason)
+
+
+def get_ca_store(certificate):
+    """
+    Return the system CA certificates plus C{certificate}, so that building a
+    verifying context costs as much as it does against AWS.
+    """
+    try:
+        ca_certs = list(get_ca_certs())
+    except CertsNotFoundError:
+        ca_certs = []
+    return ca_certs + [certificate]
+
+
+@defer.inlineCallbacks
+def run_scenario(reactor, port, get_factory, connections):
+    """
+    Make C{connections} sequential connections, each with the context factory
+    returned by C{get_factory}.
+
+    @return: A C{Deferred} firing with the list of connection times.
+    """
+    timings = []
+    for i in range(connections):
+        factory = PingFactory()
+        reactor.connectSSL("127.0.0.1", port, factory, get_factory())
+        elapsed = yield factory.done
+        timings.append(elapsed)
+    defer.returnValue(timings)
+
+
+def report(name, timings, resumed):
+    mean = sum(timings) / len(timings) * 1000
+    best = min(timings) * 1000
+    print "%-8s %5d connections  mean %7.2f ms  best %7.2f ms  resumed %s" % (
+        name, len(timings), mean, best, resumed)
+
+
+@defer.inlineCallbacks
+def run(reactor, connections):
+    key, certificate = make_certificate(HOST)
+    server_options = CertificateOptions(
+        privateKey=key, certificate=certificate, enableSessions=True)
+    factory = protocol.ServerFactory()
+    factory.protocol = Echo
+    listening = reactor.listenSSL(
+        0, factory, server_options, interface="127.0.0.1")
+    port = listening.getHost().port
+    ca_certs = get_ca_store(certificate)
+    try:
+        timings = yield run_scenario(
+            reactor, port, lambda: VerifyingContextFactory(HOST, ca_certs),
+            connections)
+        report("cold", timings, 0)
+
+        reused = VerifyingContextFactory(HOST, ca_certs)
+        timings = yield run_scenario(
+            reactor, port, lambda: reused, connections)
+        report("reused", timings, 0)
+
+        resumed = VerifyingContextFactory(
+            HOST, ca_certs, session_resumption=True)
+        timings = yield run_scenario(
+            reactor, port, lambda: resumed, connections)
+        report("resumed", timings, resumed.session_cache.resumed)
+    finally:
+        yield listening.stopListening()
+
+
+def main(argv=None):
+    from twisted.internet import reactor
+
+    if argv is None:
+        argv = sys.argv[1:]
+    connections = 100
+    if argv:
+        connections = int(argv[0])
+
+    def stop(result):
+        reactor.stop()
+        return result
+
+    d = defer.maybeDeferred(run, reactor, connections)
+    d.addErrback(lambda failure: failure.printTraceback())
+    d.addBoth(stop)
+    reactor.run()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,18 +1,31 @@
+from copy import copy
+from functools import wraps
+import time
+
 try:
     from xml.etree.ElementTree import ParseError
 except ImportError:
     from xml.parsers.expat import ExpatError as ParseError
 
-from twisted.internet.ssl import ClientContextFactory
+from twisted.internet import defer
+from twisted.python import log
+from twisted.python.failure import Failure
 from twisted.web import http
 from twisted.web.client import HTTPClientFactory
 from twisted.web.error import Error as TwistedWebError
 
+from txaws import util
 from txaws.util import parse
 from txaws.credentials import AWSCredentials
-from txaws.exception import AWSResponseParseError
+from txaws.exception import AWSError, AWSResponseParseError
 from txaws.service import AWSServiceEndpoint
-from txaws.client.ssl import VerifyingContextFactory
+from txaws.client.coalesce import get_single_flight
+from txaws.client.deadline import (
+    DeadlineExceeded, get_deadline, get_latency_tracker, timeout_deferred)
+from txaws.client.ratelimit import get_rate_limiter
+from txaws.client.retry import get_retry_policy
+from txaws.client.ssl import get_context_factory
+from txaws.client.streaming import ProducerBody, get_body_length
 
 
 def error_wrapper(error, errorClass):
@@ -25,7 +38,25 @@ def error_wrapper(error, errorClass):
 
     In the event that an error is not a Twisted web error nor an EC2 one, the
     original exception is raised.
+
+    The error codes found are added to the L{RequestTiming} of the request,
+    if it is timed.
     """
+    timing = getattr(error.value, "timing", None)
+    if not isinstance(timing, RequestTiming) or not timing.claim_parse():
+        return _wrap_error(error, errorClass)
+    try:
+        return _wrap_error(error, errorClass)
+    except AWSError, aws_error:
+        timing.error = aws_error.__class__.__name__
+        timing.error_code = ",".join(
+            error.get("Code", "") for error in aws_error.errors) or None
+        raise
+    finally:
+        timing.finish()
+
+
+def _wrap_error(error, errorClass):
     http_status = 0
     if error.check(TwistedWebError):
         xml_payload = error.value.response
@@ -51,6 +82,247 @@ def error_wrapper(error, errorClass):
         error.raiseException()
 
 
+def get_timing_observers(endpoint):
+    """
+    Return the timing observers of C{endpoint}, or else the ones of its
+    transport.
+    """
+    observers = getattr(endpoint, "timing_observers", None)
+    if not observers:
+        transport = getattr(endpoint, "transport", None)
+        observers = getattr(transport, "timing_observers", None)
+    return observers or []
+
+
+class RequestTiming(object):
+    """
+    Where the time of a request went.
+
+    A timing observer is a callable given a L{RequestTiming} for every
+    request made against an endpoint with observers, see L{SlowRequestLog}.
+    The phases are measured in seconds for the last attempt of the request,
+    and are C{None} when they didn't happen or couldn't be measured: a
+    pooled connection is reused without any C{dns}, C{connect} or C{tls}
+    phase, and requests not sent through an L{HTTPTransport} only have their
+    C{parse}, C{model} and C{total} times.
+
+    @ivar service: The name of the service, like C{"ec2"}.
+    @ivar action: The action of the request.
+    @ivar queue: The time waiting for the scheduler of the transport.
+    @ivar dns: The time looking the host up.
+    @ivar connect: The time opening the TCP connection.
+    @ivar tls: The time of the TLS handshake.
+    @ivar ttfb: The time from sending the request to receiving the response
+        headers, less the TLS handshake.
+    @ivar body: The time receiving the response body.
+    @ivar parse: The time parsing the XML response.
+    @ivar model: The time building the results from the parsed XML.
+    @ivar total: The time from the call to the results, retries included.
+    @ivar attempts: The number of times the request was sent.
+    @ivar request_bytes: The size of the request bodies sent, retries
+        included.
+    @ivar response_bytes: The size of the response bodies received, retries
+        included.
+    @ivar status: The HTTP status of the response, if any.
+    @ivar error: The name of the exception the request failed with, if any.
+    @ivar error_code: The code of the error returned by the service, as
+        parsed by L{AWSError}, if any.
+    """
+
+    PHASES = ("queue", "dns", "connect", "tls", "ttfb", "body", "parse",
+              "model")
+
+    def __init__(self, service, action, method, url, clock, observers=()):
+        self.service = service
+        self.action = action
+        self.method = method
+        self.url = url
+        self.clock = clock
+        self.observers = observers
+        self.started = clock.seconds()
+        self.attempts = 0
+        self.request_bytes = 0
+        self.response_bytes = 0
+        self.status = None
+        self.error = None
+        self.error_code = None
+        self.total = None
+        self.finished = False
+        self._give_up = None
+        for phase in self.PHASES:
+            setattr(self, phase, None)
+
+    def start_attempt(self, request_bytes=0):
+        """
+        Forget the network phases of the previous attempt, if any.
+
+        @param request_bytes: The size of the request body sent.
+        """
+        self.attempts += 1
+        self.request_bytes += request_bytes
+        for phase in ("queue", "dns", "connect", "tls", "ttfb", "body"):
+            setattr(self, phase, None)
+
+    def count_response(self, result):
+        """
+        Add the size of the response body of an attempt, given its result or
+        its failure, to C{response_bytes}.
+
+        @return: C{result}
+        """
+        if isinstance(result, Failure):
+            body = getattr(result.value, "response", None)
+        else:
+            body = result
+        if isinstance(body, str):
+            self.response_bytes += len(body)
+        return result
+
+    def await_parse(self):
+        """
+        Leave it to the parser given the response to finish the record, or
+        finish it without parse times if none is called right away.
+        """
+        self._give_up = self.clock.callLater(0, self.finish)
+
+    def claim_parse(self):
+        """
+        Return whether the record still awaits the parser of the response,
+        in which case the caller finishes it.
+        """
+        give_up, self._give_up = self._give_up, None
+        if give_up is None or not give_up.active():
+            return False
+        give_up.cancel()
+        return True
+
+    def finish(self):
+        """Compute the C{total} time and pass the record to the observers."""
+        if self.finished:
+            return
+        self.finished = True
+        self.total = self.clock.seconds() - self.started
+        for observer in self.observers:
+            try:
+                observer(self)
+            except:
+                log.err(None, "Timing observer %r failed" % (observer,))
+
+    def as_dict(self):
+        """Return the record as a C{dict}."""
+        result = dict((phase, getattr(self, phase)) for phase in self.PHASES)
+        result.update(
+            service=self.service, action=self.action, method=self.method,
+            url=self.url, total=self.total, attempts=self.attempts,
+            request_bytes=self.request_bytes,
+            response_bytes=self.response_bytes, status=self.status,
+            error=self.error, error_code=self.error_code)
+        return result
+
+    def __str__(self):
+        phases = " ".join(
+            "%s=%.3f" % (phase, getattr(self, phase))
+            for phase in self.PHASES if getattr(self, phase) is not None)
+        outcome = self.error_code or self.error or self.status
+        return "%s %s %.3fs (%s) %s attempts=%d %s" % (
+            self.service, self.action, self.total or 0, phases, outcome,
+            self.attempts, self.url)
+
+
+class TimedBody(str):
+    """
+    A response body carrying the L{RequestTiming} of its request.
+
+    Every query gets its own, even when the same body is shared by several
+    queries, so that each parser adds its times to its own request.
+    """
+
+    def __new__(cls, body, timing=None):
+        self = str.__new__(cls, body)
+        self.timing = timing
+        return self
+
+
+def attach_timing(result, timing):
+    """
+    Return C{result}, the body or the L{Failure} of a request, carrying
+    C{timing} for the parser decorated with L{timed_parse}, or for
+    L{error_wrapper}, to finish, or finish C{timing} if there is nothing to
+    parse.
+    """
+    if isinstance(result, Failure):
+        if not getattr(result.value, "response", None):
+            timing.finish()
+            return result
+        # The error may be shared with other queries.
+        value = copy(result.value)
+        value.timing = timing
+        result = Failure(value, result.type, result.getTracebackObject())
+    elif isinstance(result, str):
+        result = TimedBody(result, timing)
+    else:
+        timing.finish()
+        return result
+    timing.await_parse()
+    return result
+
+
+def timed_parse(function):
+    """
+    Decorate a function parsing response bodies, so that the time it takes,
+    split between parsing XML and building the results, is added to the
+    L{RequestTiming} of the request that body came from.
+    """
+
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        for arg in args:
+            if isinstance(arg, TimedBody) and arg.timing.claim_parse():
+                timing = arg.timing
+                break
+        else:
+            return function(*args, **kwargs)
+        parsing = [0]
+
+        def add_parse_time(seconds):
+            parsing[0] += seconds
+
+        util.xml_timers.append(add_parse_time)
+        started = time.time()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            util.xml_timers.pop()
+            elapsed = time.time() - started
+            timing.parse = parsing[0]
+            timing.model = max(0, elapsed - parsing[0])
+            timing.finish()
+
+    return wrapper
+
+
+class SlowRequestLog(object):
+    """
+    A timing observer logging the requests taking longer than C{threshold}
+    seconds, with the time spent in each of their phases.
+
+    @param threshold: The number of seconds above which a request is logged.
+    @param logger: The callable given the log message.
+    """
+
+    def __init__(self, threshold=1.0, logger=None):
+        if logger is None:
+            logger = log.msg
+        self.threshold = threshold
+        self.logger = logger
+        self.count = 0
+
+    def __call__(self, timing):
+        if timing.total is not None and timing.total >= self.threshold:
+            self.count += 1
+            self.logger("Slow request: %s" % (timing,))
+
+
 class BaseClient(object):
     """Create an AWS client.
 
@@ -59,13 +331,33 @@ class BaseClient(object):
     @param query_factory: The class or function that produces a query
         object for making requests to the EC2 service.
     @param parser: A parser object for parsing responses from the EC2 service.
+    @param retry_policy: The L{RetryPolicy} of the queries of this client,
+        overriding the one of the endpoint and its transport.
+    @param rate_limiter: The L{RateLimiter} of the queries of this client,
+        overriding the one of the endpoint and its transport.
+    @param single_flight: The L{SingleFlight} coalescing the identical
+        read-only queries of this client, overriding the one of the endpoint
+        and its transport.
     """
     def __init__(self, creds=None, endpoint=None, query_factory=None,
-                 parser=None):
+                 parser=None, retry_policy=None, rate_limiter=None,
+                 single_flight=None):
         if creds is None:
             creds = AWSCredentials()
         if endpoint is None:
             endpoint = AWSServiceEndpoint()
+        overrides = {"retry_policy": retry_policy,
+                     "rate_limiter": rate_limiter,
+                     "single_flight": single_flight}
+        overrides = dict(
+            (name, value) for name, value in overrides.iteritems()
+            if value is not None)
+        if overrides:
+            # The endpoint may be shared with other clients, see
+            # AWSServiceRegion.
+            endpoint = copy(endpoint)
+            for name, value in overrides.iteritems():
+                setattr(endpoint, name, value)
         self.creds = creds
         self.endpoint = endpoint
         self.query_factory = query_factory
@@ -73,6 +365,17 @@ class BaseClient(object):
 
 
 class BaseQuery(object):
+    """
+    @cvar timeout: The number of seconds each attempt of a request is given,
+        unless a C{timeout} is passed to L{get_page}, or C{None} to wait as
+        long as it takes.
+    @cvar service: The name of the service, as given to the timing observers.
+    @ivar timing: The L{RequestTiming} of the last request, if the endpoint
+        has timing observers.
+    """
+
+    timeout = None
+    service = None
 
     def __init__(self, action=None, creds=None, endpoint=None, reactor=None):
         if not action:
@@ -85,6 +388,7 @@ class BaseQuery(object):
             from twisted.internet import reactor
         self.reactor = reactor
         self.client = None
+        self.timing = None
 
     def get_page(self, url, *args, **kwds):
         """
@@ -92,19 +396,172 @@ class BaseQuery(object):
         factory when we need to. This was copied from the following:
             * twisted.web.client.getPage
             * twisted.web.client._makeGetterFactory
+
+        Failed requests are sent again according to the L{RetryPolicy} of the
+        endpoint, if any, unless their response body is given a C{stream}
+        or their request body is a L{ProducerBody}, and every attempt waits
+        for the L{RateLimiter} of the endpoint, if any.
+
+        If the endpoint has a L{SingleFlight} and this query has a
+        L{get_single_flight_key}, the request is shared with the identical
+        queries in flight.
+
+        Within a L{deadline} block, the request fails with L{DeadlineExceeded}
+        if it isn't done by the deadline. Cancelling the returned C{Deferred}
+        drops the connection of the request.
+
+        If the endpoint has timing observers, they are given the
+        L{RequestTiming} of the request.
+        """
+        observers = get_timing_observers(self.endpoint)
+        if observers:
+            self.timing = RequestTiming(
+                self.service, self.action, kwds.get("method", "GET"), url,
+                self.reactor, observers)
+        scheduler = getattr(self.get_transport(), "scheduler", None)
+        if scheduler is not None and kwds.get("priority") is None:
+            # Retries are sent after a prioritized block is left.
+            kwds["priority"] = scheduler.get_priority(self.action)
+        d = self._share_page(url, *args, **kwds)
+        when = get_deadline()
+        if when is not None:
+            d = timeout_deferred(
+                d, self.reactor, when - self.reactor.seconds(),
+                DeadlineExceeded, "Getting %s missed its deadline." % url)
+        if self.timing is not None:
+            d.addBoth(self._timed, self.timing)
+        return d
+
+    def _timed(self, result, timing):
+        if isinstance(result, Failure):
+            timing.error = result.type.__name__
+            timing.status = getattr(result.value, "status", None)
+        else:
+            timing.status = getattr(self.client, "status", None)
+        # Let the parser, or error_wrapper adding the error code, finish it.
+        return attach_timing(result, timing)
+
+    def _share_page(self, url, *args, **kwds):
+        single_flight = get_single_flight(self.endpoint)
+        if single_flight is not None:
+            key = self.get_single_flight_key(url, **kwds)
+            if key is not None:
+                leader = single_flight.get_leader(key)
+                d = single_flight.run(
+                    key, lambda: self._retry_page(url, *args, **kwds), self)
+                if leader is not None:
+                    d.addCallback(self._follow, leader)
+                return d
+        return self._retry_page(url, *args, **kwds)
+
+    def get_single_flight_key(self, url, **kwds):
         """
-        contextFactory = None
+        Return what identifies this query among the queries in flight, or
+        C{None} if it must not be shared with other queries, which is the
+        default.
+
+        Only read-only queries should be shared, and their key must leave out
+        the parts of the request changing with every query, like timestamps
+        and signatures.
+        """
+        return None
+
+    def _follow(self, result, leader):
+        # Expose the request and response of the query we joined.
+        self.client = leader.client
+        return result
+
+    def _retry_page(self, url, *args, **kwds):
+        policy = get_retry_policy(self.endpoint)
+        if (policy is None or kwds.get("stream") is not None or
+                isinstance(kwds.get("postdata"), ProducerBody)):
+            # A stream can't be given the body of another attempt: whoever
+            # streams a body retries it with a fresh consumer. A producer
+            # body can only be sent once.
+            return self._limit_page(url, *args, **kwds)
+        return policy.run(lambda: self._limit_page(url, *args, **kwds),
+                          kwds.get("method", "GET"), self.action)
+
+    def _limit_page(self, url, *args, **kwds):
+        limiter = get_rate_limiter(self.endpoint)
+        if limiter is None:
+            return self._get_page(url, *args, **kwds)
+        access_key = getattr(self.creds, "access_key", None)
+        return limiter.limit(access_key, self.action,
+                             lambda: self._get_page(url, *args, **kwds))
+
+    def _get_page(self, url, *args, **kwds):
+        tracker = get_latency_tracker(self.endpoint)
+        timeout = kwds.get("timeout") or self.timeout
+        if tracker is not None:
+            timeout = tracker.get_timeout(self.action, timeout)
+        if timeout:
+            kwds["timeout"] = timeout
+        if tracker is not None:
+            started = self.reactor.seconds()
+        d = self._send_page(url, *args, **kwds)
+        if self.timing is not None:
+            d.addBoth(self.timing.count_response)
+        if tracker is None:
+            return d
+
+        def record(result):
+            tracker.record(self.action, self.reactor.seconds() - started)
+            return result
+
+        return d.addCallback(record)
+
+    def _send_page(self, url, *args, **kwds):
+        if self.timing is not None:
+            self.timing.start_attempt(get_body_length(kwds.get("postdata")))
+        transport = self.get_transport()
+        postdata = kwds.get("postdata")
+        if transport is None and (
+                kwds.get("stream") is not None or
+                not (postdata is None or isinstance(postdata, str))):
+            # Only a transport streams request and response bodies: use one
+            # keeping no idle connection.
+            from txaws.client.transport import HTTPTransport
+            transport = HTTPTransport(self.reactor, max_persistent_per_host=0)
+        if transport is not None:
+            kwds["ssl_hostname_verification"] = (
+                self.endpoint.ssl_hostname_verification)
+            kwds.setdefault("action", self.action)
+            if self.timing is not None:
+                kwds["timing"] = self.timing
+            self.client = transport.get_page(url, *args, **kwds)
+            return self.client.deferred
         scheme, host, port, path = parse(url)
         self.client = self.factory(url, *args, **kwds)
         if scheme == "https":
-            if self.endpoint.ssl_hostname_verification:
-                contextFactory = VerifyingContextFactory(host)
-            else:
-                contextFactory = ClientContextFactory()
-            self.reactor.connectSSL(host, port, self.client, contextFactory)
+            contextFactory = get_context_factory(
+                host, self.endpoint.ssl_hostname_verification)
+            connector = self.reactor.connectSSL(
+                host, port, self.client, contextFactory)
         else:
-            self.reactor.connectTCP(host, port, self.client)
-        return self.client.deferred
+            connector = self.reactor.connectTCP(host, port, self.client)
+
+        def cancel(ignored):
+            if connector is not None:
+                connector.disconnect()
+
+        # The deferred of the factory can't be cancelled.
+        d = defer.Deferred(cancel)
+
+        def relay(result):
+            if not d.called:
+                d.callback(result)
+
+        self.client.deferred.addBoth(relay)
+        return d
+
+    def get_transport(self):
+        """
+        Return the L{HTTPTransport} of our endpoint, if it has one.
+
+        When there is no transport, each request opens its own connection.
+        """
+        return getattr(self.endpoint, "transport", None)
 
     def get_request_headers(self, *args, **kwds):
         """
@@ -0,0 +1,122 @@
+# Licenced under the txaws licence available at /LICENSE in the txaws source.
+
+"""
+Single-flight coalescing of identical requests.
+
+When several callers issue the same read request while it is in flight, a
+L{SingleFlight} only lets the first one through and hands each of the others
+its own copy of the result.
+"""
+from copy import deepcopy
+
+from twisted.internet import defer
+from twisted.python.failure import Failure
+
+
+__all__ = ["SingleFlight", "get_single_flight"]
+
+
+def get_single_flight(endpoint):
+    """
+    Return the L{SingleFlight} of C{endpoint}, or else the one of its
+    transport, or C{None} if requests to it are not coalesced.
+    """
+    single_flight = getattr(endpoint, "single_flight", None)
+    if single_flight is None:
+        transport = getattr(endpoint, "transport", None)
+        single_flight = getattr(transport, "single_flight", None)
+    return single_flight
+
+
+class _Flight(object):
+    """A call in flight, and the callers waiting for its result."""
+
+    def __init__(self, leader):
+        self.leader = leader
+        self.waiters = []
+        self.running = None
+
+
+class SingleFlight(object):
+    """
+    Coalesce calls sharing the same key while one of them is in flight.
+
+    @param copy: The function giving each caller its own copy of the result,
+        by default C{copy.deepcopy}.
+    @ivar calls: The number of calls actually made.
+    @ivar coalesced: The number of callers which joined a call in flight.
+    """
+
+    def __init__(self, copy=deepcopy):
+        self.copy = copy
+        self._flights = {}
+        self.calls = 0
+        self.coalesced = 0
+
+    def get_leader(self, key):
+        """
+        Return the C{leader} given for the call in flight for C{key}, or
+        C{None} if there is none.
+        """
+        flight = self._flights.get(key)
+        if flight is not None:
+            return flight.leader
+
+    def run(self, key, call, leader=None):
+        """
+        Call C{call}, unless a call for C{key} is already in flight, in which
+        case wait for its result instead.
+
+        Cancelling the returned C{Deferred} only cancels the call itself once
+        none of its callers are waiting for it anymore.
+
+        @param key: A hashable identifying the call.
+        @param call: A callable returning a C{Deferred}.
+        @param leader: An object to associate with the call, see
+            L{get_leader}.
+        @return: A C{Deferred} firing with a copy of the result of the call.
+        """
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = self._flights[key] = _Flight(leader)
+            self.calls += 1
+            start = True
+        else:
+            self.coalesced += 1
+            start = False
+        d = defer.Deferred(lambda d: self._cancel(key, flight, d))
+        flight.waiters.append(d)
+        if start:
+            flight.running = defer.maybeDeferred(call)
+            flight.running.addBoth(self._done, key, flight)
+        return d
+
+    def _done(self, result, key, flight):
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+        waiters, flight.waiters = flight.waiters, []
+        for i, d in enumerate(waiters):
+            if isinstance(result, Failure):
+                d.errback(result)
+            elif i == 0:
+                d.callback(result)
+            else:
+                d.callback(self.copy(result))
+        if isinstance(result, Failure):
+            # The failure has been handed over to the waiters.
+            return None
+
+    def _cancel(self, key, flight, d):
+        flight.waiters.remove(d)
+        if not flight.waiters:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+            flight.running.cancel()
+
+    def get_stats(self):
+        """
+        Return a C{dict} with the number of C{calls} made, the number of
+        callers C{coalesced} into them, and the calls C{in_flight}.
+        """
+        return {"calls": self.calls, "coalesced": self.coalesced,
+                "in_flight": len(self._flights)}
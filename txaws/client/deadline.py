@@ -0,0 +1,167 @@
+# Licenced under the txaws licence available at /LICENSE in the txaws source.
+
+"""
+Deadlines and adaptive timeouts of requests.
+
+Every attempt of a request is bounded by the C{timeout} of its query, which a
+L{LatencyTracker} can shorten to a multiple of the latencies observed for its
+action, so that a slow endpoint fails fast instead of tying up connections.
+
+Calls made within a L{deadline} block must complete, retries, rate limiting
+and queueing included, before the deadline, or they fail with
+L{DeadlineExceeded}::
+
+    with deadline(5):
+        d = ec2.describe_instances()
+
+Timed out and cancelled requests drop their connection, which never goes back
+to the pool.
+"""
+from contextlib import contextmanager
+
+from twisted.internet import defer
+from twisted.python.failure import Failure
+
+
+__all__ = ["DeadlineExceeded", "LatencyTracker", "deadline", "get_deadline",
+           "get_latency_tracker", "timeout_deferred"]
+
+
+class DeadlineExceeded(defer.TimeoutError):
+    """A call didn't complete before its deadline."""
+
+
+_deadlines = []
+
+
+@contextmanager
+def deadline(seconds, clock=None):
+    """
+    Give the calls made within the C{with} block C{seconds} to complete.
+
+    Nested blocks can only bring the deadline closer.
+
+    @param clock: The reactor giving the current time, which must be the one
+        of the clients.
+    """
+    if clock is None:
+        from twisted.internet import reactor as clock
+    when = clock.seconds() + seconds
+    current = get_deadline()
+    if current is not None:
+        when = min(when, current)
+    _deadlines.append(when)
+    try:
+        yield
+    finally:
+        _deadlines.pop()
+
+
+def get_deadline():
+    """
+    Return the time by which the current calls must complete, or C{None} if
+    they have no deadline.
+    """
+    if _deadlines:
+        return _deadlines[-1]
+
+
+def timeout_deferred(d, clock, timeout, exception_class=defer.TimeoutError,
+                     message=None):
+    """
+    Cancel C{d} if it hasn't fired after C{timeout} seconds, and fail it with
+    C{exception_class} then.
+
+    @return: C{d}
+    """
+    delayed_call = clock.callLater(max(0, timeout), d.cancel)
+
+    def done(result):
+        if delayed_call.active():
+            delayed_call.cancel()
+        elif (isinstance(result, Failure) and
+              result.check(defer.CancelledError)):
+            return Failure(exception_class(
+                message or "Not completed after %s seconds." % timeout))
+        return result
+
+    return d.addBoth(done)
+
+
+def get_latency_tracker(endpoint):
+    """
+    Return the L{LatencyTracker} of C{endpoint}, or else the one of its
+    transport, or C{None} if timeouts aren't adapted to latencies.
+    """
+    tracker = getattr(endpoint, "latency_tracker", None)
+    if tracker is None:
+        transport = getattr(endpoint, "transport", None)
+        tracker = getattr(transport, "latency_tracker", None)
+    return tracker
+
+
+class LatencyTracker(object):
+    """
+    Keep the latencies of the latest requests of each action, and derive
+    their timeout from them.
+
+    @param percentile: The percentile of the latencies the timeout is based
+        on.
+    @param multiplier: How many times the percentile the timeout is.
+    @param window: The number of latencies kept per action.
+    @param min_samples: The number of latencies needed before the timeout of
+        an action is adapted.
+    @param min_timeout: The shortest timeout given to a request, in seconds.
+    """
+
+    def __init__(self, percentile=99, multiplier=3.0, window=200,
+                 min_samples=20, min_timeout=1.0):
+        self.percentile = percentile
+        self.multiplier = multiplier
+        self.window = window
+        self.min_samples = min_samples
+        self.min_timeout = min_timeout
+        self._latencies = {}
+
+    def record(self, action, latency):
+        """Record that a request for C{action} took C{latency} seconds."""
+        latencies = self._latencies.setdefault(action, [])
+        latencies.append(latency)
+        if len(latencies) > self.window:
+            del latencies[0]
+
+    def get_percentile(self, action):
+        """
+        Return the configured percentile of the latencies of C{action}, or
+        C{None} if not enough of them were recorded.
+        """
+        latencies = self._latencies.get(action, ())
+        if len(latencies) < self.min_samples:
+            return None
+        latencies = sorted(latencies)
+        index = int(round((len(latencies) - 1) * self.percentile / 100.0))
+        return latencies[index]
+
+    def get_timeout(self, action, timeout=None):
+        """
+        Return the timeout of a request for C{action}, never longer than
+        C{timeout} when one is given.
+        """
+        percentile = self.get_percentile(action)
+        if percentile is None:
+            return timeout
+        adapted = max(self.min_timeout, percentile * self.multiplier)
+        if timeout:
+            return min(timeout, adapted)
+        return adapted
+
+    def get_stats(self):
+        """
+        Return a C{dict} mapping actions to the number of C{samples} recorded,
+        their C{percentile} and the resulting C{timeout}.
+        """
+        return dict(
+            (action, {"samples": len(latencies),
+                      "percentile": self.get_percentile(action),
+                      "timeout": self.get_timeout(action)})
+            for action, latencies in self._latencies.iteritems())
@@ -0,0 +1,230 @@
+# Licenced under the txaws licence available at /LICENSE in the txaws source.
+
+"""
+Caching of the DNS lookups of the hosts requests are sent to.
+
+Connecting to a host name makes the reactor resolve it for every connection.
+A L{DNSCache} remembers the addresses of each host for their time-to-live,
+looks them up again in the background shortly before they expire, keeps
+serving the last addresses found while the resolver fails, and hands out the
+addresses of a host in turn so that connections are spread over them.
+"""
+import socket
+
+from twisted.internet import defer, threads
+from twisted.internet.abstract import isIPAddress
+from twisted.python import log
+from twisted.python.failure import Failure
+
+
+__all__ = ["DNSCache", "SystemResolver", "NamesResolver"]
+
+
+class SystemResolver(object):
+    """
+    Look up the IPv4 addresses of a host with C{getaddrinfo}, in the thread
+    pool of the reactor.
+
+    The system resolver doesn't tell how long its answers are valid for, so
+    they are all given the same time-to-live.
+
+    @param ttl: The time-to-live given to the addresses found.
+    """
+
+    def __init__(self, reactor=None, ttl=60):
+        if reactor is None:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        self.ttl = ttl
+
+    def lookup(self, host):
+        """
+        Look up C{host}.
+
+        @return: A C{Deferred} firing with a list of C{(address, ttl)} pairs.
+        """
+        d = threads.deferToThreadPool(
+            self.reactor, self.reactor.getThreadPool(), socket.getaddrinfo,
+            host, None, socket.AF_INET, socket.SOCK_STREAM)
+        return d.addCallback(self._got_addresses)
+
+    def _got_addresses(self, results):
+        addresses = []
+        for family, type, proto, name, address in results:
+            if address[0] not in addresses:
+                addresses.append(address[0])
+        return [(address, self.ttl) for address in addresses]
+
+
+class NamesResolver(object):
+    """
+    Look up the A records of a host with C{twisted.names}, using the
+    time-to-live of each record.
+
+    @param resolver: The C{twisted.names} resolver, by default the one
+        configured from the system files.
+    """
+
+    def __init__(self, resolver=None):
+        if resolver is None:
+            from twisted.names import client
+            resolver = client.getResolver()
+        self.resolver = resolver
+
+    def lookup(self, host):
+        """
+        Look up C{host}.
+
+        @return: A C{Deferred} firing with a list of C{(address, ttl)} pairs.
+        """
+        return self.resolver.lookupAddress(host).addCallback(
+            self._got_records)
+
+    def _got_records(self, result):
+        from twisted.names import dns
+        answers, authority, additional = result
+        return [(record.payload.dottedQuad(), record.ttl)
+                for record in answers if record.type == dns.A]
+
+
+class _Entry(object):
+    """The addresses known for a host."""
+
+    def __init__(self, addresses, now, ttl, refresh_ratio):
+        self.addresses = addresses
+        self.expires = now + ttl
+        self.refresh_at = now + ttl * refresh_ratio
+        self.index = 0
+
+    def next_address(self):
+        address = self.addresses[self.index % len(self.addresses)]
+        self.index += 1
+        return address
+
+
+class DNSCache(object):
+    """
+    Cache the addresses of hosts, see the module documentation.
+
+    @param reactor: The reactor giving the current time.
+    @param resolver: The object whose C{lookup(host)} finds the addresses of
+        a host, by default a L{SystemResolver}.
+    @param min_ttl: The minimum number of seconds addresses are kept.
+    @param max_ttl: The maximum number of seconds addresses are kept, however
+        long the resolver says they are valid for.
+    @param refresh_ratio: The fraction of the time-to-live of an entry after
+        which it is looked up again in the background.
+    @param max_stale: For how many seconds after their expiry addresses are
+        still used while the resolver fails.
+    """
+
+    def __init__(self, reactor=None, resolver=None, min_ttl=5, max_ttl=300,
+                 refresh_ratio=0.75, max_stale=3600):
+        if reactor is None:
+            from twisted.internet import reactor
+        if resolver is None:
+            resolver = SystemResolver(reactor)
+        self.reactor = reactor
+        self.resolver = resolver
+        self.min_ttl = min_ttl
+        self.max_ttl = max_ttl
+        self.refresh_ratio = refresh_ratio
+        self.max_stale = max_stale
+        self._entries = {}
+        self._lookups = {}
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.stale = 0
+        self.failures = 0
+
+    def resolve(self, host):
+        """
+        Return one of the addresses of C{host}, in turn.
+
+        @return: A C{Deferred} firing with an IPv4 address.
+        """
+        if isIPAddress(host):
+            return defer.succeed(host)
+        now = self.reactor.seconds()
+        entry = self._entries.get(host)
+        if entry is not None and now < entry.expires:
+            self.hits += 1
+            if now >= entry.refresh_at and host not in self._lookups:
+                self.refreshes += 1
+                self._lookup(host).addErrback(lambda failure: None)
+            return defer.succeed(entry.next_address())
+        self.misses += 1
+        return self._lookup(host).addCallback(
+            lambda entry: entry.next_address())
+
+    def _lookup(self, host):
+        """
+        Look up C{host}, sharing the lookup with the other callers asking for
+        it at the same time.
+
+        @return: A C{Deferred} firing with the new L{_Entry} of C{host}, or
+            the stale one if the lookup failed.
+        """
+        d = defer.Deferred()
+        waiters = self._lookups.get(host)
+        if waiters is not None:
+            waiters.append(d)
+            return d
+        self._lookups[host] = [d]
+        lookup = defer.maybeDeferred(self.resolver.lookup, host)
+        lookup.addCallback(self._got_addresses, host)
+        lookup.addErrback(self._lookup_failed, host)
+        lookup.addBoth(self._notify, host)
+        return d
+
+    def _got_addresses(self, addresses, host):
+        if not addresses:
+            raise socket.gaierror(
+                socket.EAI_NONAME, "No addresses found for %s" % host)
+        ttl = min(record_ttl for address, record_ttl in addresses)
+        ttl = max(self.min_ttl, min(self.max_ttl, ttl))
+        entry = _Entry([address for address, record_ttl in addresses],
+                       self.reactor.seconds(), ttl, self.refresh_ratio)
+        previous = self._entries.get(host)
+        if previous is not None:
+            # Keep rotating from where we were.
+            entry.index = previous.index
+        self._entries[host] = entry
+        return entry
+
+    def _lookup_failed(self, failure, host):
+        self.failures += 1
+        entry = self._entries.get(host)
+        if (entry is None or
+            self.reactor.seconds() >= entry.expires + self.max_stale):
+            return failure
+        log.msg("Looking up %s failed, using its last addresses: %s" % (
+            host, failure.getErrorMessage()))
+        self.stale += 1
+        return entry
+
+    def _notify(self, result, host):
+        waiters = self._lookups.pop(host)
+        for d in waiters:
+            if isinstance(result, Failure):
+                d.errback(result)
+            else:
+                d.callback(result)
+
+    def get_addresses(self, host):
+        """Return the addresses cached for C{host}, if any."""
+        entry = self._entries.get(host)
+        if entry is None:
+            return []
+        return list(entry.addresses)
+
+    def get_stats(self):
+        """
+        Return a C{dict} with the C{hits}, C{misses}, background
+        C{refreshes}, C{stale} answers and lookup C{failures} counters, and
+        the number of C{hosts} cached.
+        """
+        return {"hits": self.hits, "misses": self.misses,
+                "refreshes": self.refreshes, "stale": self.stale,
+                "failures": self.failures, "hosts": len(self._entries)}
@@ -0,0 +1,187 @@
+# Licenced under the txaws licence available at /LICENSE in the txaws source.
+
+"""
+Hashing of big payloads off the reactor thread.
+
+A L{HashingService} computes the digests of strings and files in the thread
+pool of the reactor once they are bigger than its C{threshold}, so that
+hashing a big body doesn't stall the other requests of the process::
+
+    service = get_hashing_service(endpoint)
+    d = service.hash_file(open("backup.tar", "rb"), algorithm="sha256")
+    d.addCallback(lambda digest: digest.hexdigest())
+
+It also computes the I{ETag} S3 gives to objects uploaded in parts, to check
+them without getting them.
+"""
+from hashlib import md5, sha1, sha256
+import mmap
+import os
+
+from twisted.internet import defer
+from twisted.internet.threads import deferToThreadPool
+
+
+__all__ = ["ALGORITHMS", "HashingService", "digest_file",
+           "get_hashing_service", "get_multipart_etag"]
+
+
+# The algorithms digests can be computed with, by name.
+ALGORITHMS = {"md5": md5, "sha1": sha1, "sha256": sha256}
+
+
+def get_hashing_service(endpoint):
+    """
+    Return the L{HashingService} of C{endpoint}, or else the one of its
+    transport, or else the one shared by default.
+    """
+    service = getattr(endpoint, "hashing_service", None)
+    if service is None:
+        transport = getattr(endpoint, "transport", None)
+        service = getattr(transport, "hashing_service", None)
+    if service is None:
+        global _default_service
+        if _default_service is None:
+            _default_service = HashingService()
+        service = _default_service
+    return service
+
+
+_default_service = None
+
+
+def _get_fileno(file):
+    try:
+        return file.fileno()
+    except (AttributeError, IOError, ValueError):
+        return None
+
+
+def _get_length(file, offset, length):
+    if length is None:
+        position = file.tell()
+        file.seek(0, os.SEEK_END)
+        length = file.tell() - offset
+        file.seek(position)
+    return length
+
+
+def _read_section(file, offset, length, chunk_size):
+    """Yield C{length} bytes of C{file} from C{offset}, in chunks."""
+    while length > 0:
+        file.seek(offset)
+        data = file.read(min(chunk_size, length))
+        if not data:
+            break
+        offset += len(data)
+        length -= len(data)
+        yield data
+
+
+def digest_file(file, offset=0, length=None, algorithm="md5",
+                chunk_size=2 ** 20):
+    """
+    Return the digest of C{length} bytes of C{file} from C{offset}, or of the
+    rest of the file.
+
+    This blocks: files with a descriptor are mapped in memory, so that they
+    are hashed without copying them nor moving the position of C{file}, the
+    others are read in chunks.
+
+    @param algorithm: The name of the hash algorithm, see L{ALGORITHMS}.
+    @return: The hash object of the data.
+    """
+    length = _get_length(file, offset, length)
+    digest = ALGORITHMS[algorithm]()
+    fileno = _get_fileno(file)
+    if fileno is not None and length > 0:
+        mapped = mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
+        try:
+            digest.update(buffer(mapped, offset, length))
+        finally:
+            mapped.close()
+    else:
+        for data in _read_section(file, offset, length, chunk_size):
+            digest.update(data)
+    return digest
+
+
+def get_multipart_etag(digests):
+    """
+    Return the I{ETag} S3 gives to an object uploaded in parts, from the
+    MD5 hash objects of the parts.
+    """
+    return '"%s-%d"' % (
+        md5("".join(digest.digest() for digest in digests)).hexdigest(),
+        len(digests))
+
+
+class HashingService(object):
+    """
+    Compute digests in the thread pool of C{reactor}, or right away for data
+    smaller than C{threshold}, for which a thread isn't worth it.
+
+    Files without a descriptor, like C{StringIO}s, are read on the calling
+    thread, since their position is shared, and only hashed in a thread.
+
+    @param threshold: The size, in bytes, from which data is hashed in a
+        thread.
+    @param chunk_size: The size of the chunks files without a descriptor are
+        read in.
+    @ivar threaded: The number of digests computed in a thread.
+    @ivar inline: The number of digests computed right away.
+    """
+
+    def __init__(self, reactor=None, threshold=2 ** 20, chunk_size=2 ** 20):
+        if reactor is None:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        self.threshold = threshold
+        self.chunk_size = chunk_size
+        self.threaded = 0
+        self.inline = 0
+
+    def _run(self, size, function, *args):
+        if size < self.threshold:
+            self.inline += 1
+            return defer.maybeDeferred(function, *args)
+        self.threaded += 1
+        return deferToThreadPool(
+            self.reactor, self.reactor.getThreadPool(), function, *args)
+
+    def hash_string(self, data, algorithm="md5"):
+        """
+        Return a C{Deferred} firing with the hash object of C{data}.
+        """
+        return self._run(len(data), ALGORITHMS[algorithm], data)
+
+    def hash_file(self, file, offset=0, length=None, algorithm="md5"):
+        """
+        Return a C{Deferred} firing with the hash object of C{length} bytes
+        of C{file} from C{offset}, or of the rest of the file, without
+        moving the position of files with a descriptor.
+
+        The file must not change until the C{Deferred} fired.
+        """
+        length = _get_length(file, offset, length)
+        if _get_fileno(file) is None:
+            data = "".join(
+                _read_section(file, offset, length, self.chunk_size))
+            return self.hash_string(data, algorithm)
+        return self._run(
+            length, digest_file, file, offset, length, algorithm,
+            self.chunk_size)
+
+    def get_multipart_etag(self, file, part_size, offset=0, length=None):
+        """
+        Return a C{Deferred} firing with the I{ETag} S3 gives to C{length}
+        bytes of C{file} from C{offset} uploaded in parts of C{part_size}
+        bytes, or to the rest of the file.
+        """
+        length = _get_length(file, offset, length)
+        starts = range(0, length, part_size) or [0]
+        d = defer.gatherResults([
+            self.hash_file(
+                file, offset + start, min(part_size, length - start))
+            for start in starts])
+        return d.addCallback(get_multipart_etag)
@@ -0,0 +1,196 @@
+# Licenced under the txaws licence available at /LICENSE in the txaws source.
+
+"""
+In-process metrics of the requests made to AWS.
+
+A L{MetricsRegistry} is a timing observer, see L{RequestTiming}, counting
+the requests, retries, errors and bytes of every call, and keeping latency
+histograms, per service, action, endpoint and status::
+
+    metrics = MetricsRegistry()
+    region = AWSServiceRegion(creds, timing_observers=[metrics])
+
+The metrics are pulled with L{MetricsRegistry.get_samples}, or scraped in the
+Prometheus text format from a L{MetricsResource}.
+"""
+from bisect import bisect_left
+
+from twisted.web.resource import Resource
+
+from txaws.util import parse
+
+
+__all__ = ["DEFAULT_BUCKETS", "Histogram", "MetricsRegistry",
+           "MetricsResource"]
+
+
+# The upper bounds, in seconds, of the latency histogram buckets.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                   30, 60)
+
+# The labels of the request metrics, in order.
+LABELS = ("service", "action", "endpoint", "status")
+
+
+class Histogram(object):
+    """
+    The distribution of the values observed, in buckets.
+
+    @param buckets: The sorted upper bounds of the buckets.
+    @ivar counts: The number of values falling in each bucket, the last one
+        counting the values above all of the bounds.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def get_cumulative_counts(self):
+        """
+        Return a list of C{(upper_bound, count)} pairs, counting the values up
+        to each bound, the last bound being C{float("inf")}.
+        """
+        result = []
+        total = 0
+        bounds = self.buckets + (float("inf"),)
+        for bound, count in zip(bounds, self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+
+class MetricsRegistry(object):
+    """
+    Counters and latency histograms of the requests it observes.
+
+    Every metric is keyed on the C{service}, C{action}, C{endpoint} (the host
+    and port) and C{status} of the requests, the status being the empty
+    string for requests failing without a response. Errors are also keyed
+    on their C{code}, as parsed by L{AWSError}, or else on the name of the
+    exception.
+
+    @param buckets: The upper bounds, in seconds, of the latency histogram
+        buckets.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.reset()
+
+    def reset(self):
+        """Forget all of the metrics."""
+        self._requests = {}
+        self._retries = {}
+        self._request_bytes = {}
+        self._response_bytes = {}
+        self._errors = {}
+        self._latencies = {}
+
+    def __call__(self, timing):
+        self.record(timing)
+
+    def record(self, timing):
+        """Account for the request timed by C{timing}."""
+        key = self._get_key(timing)
+        self._add(self._requests, key, 1)
+        self._add(self._retries, key, max(0, timing.attempts - 1))
+        self._add(self._request_bytes, key, timing.request_bytes)
+        self._add(self._response_bytes, key, timing.response_bytes)
+        if timing.error is not None:
+            self._add(
+                self._errors, key + (timing.error_code or timing.error,), 1)
+        histogram = self._latencies.get(key)
+        if histogram is None:
+            histogram = self._latencies[key] = Histogram(self.buckets)
+        histogram.observe(timing.total or 0)
+
+    def _get_key(self, timing):
+        endpoint = ""
+        if timing.url:
+            scheme, host, port, path = parse(timing.url)
+            endpoint = "%s:%s" % (host, port)
+        return (timing.service or "", timing.action or "", endpoint,
+                timing.status or "")
+
+    def _add(self, counters, key, value):
+        counters[key] = counters.get(key, 0) + value
+
+    def get_samples(self):
+        """
+        Return all of the metrics as a list of C{(name, labels, value)}
+        tuples, C{labels} being a C{dict}.
+
+        The counters are C{aws_requests_total}, C{aws_retries_total},
+        C{aws_request_bytes_total}, C{aws_response_bytes_total} and
+        C{aws_errors_total}, the latter with an additional C{code} label.
+        The latency histograms are C{aws_request_seconds_bucket}, with an
+        additional C{le} label, C{aws_request_seconds_sum} and
+        C{aws_request_seconds_count}.
+        """
+        samples = []
+        for name, counters in [
+                ("aws_requests_total", self._requests),
+                ("aws_retries_total", self._retries),
+                ("aws_request_bytes_total", self._request_bytes),
+                ("aws_response_bytes_total", self._response_bytes)]:
+            for key, value in sorted(counters.iteritems()):
+                samples.append((name, dict(zip(LABELS, key)), value))
+        for key, value in sorted(self._errors.iteritems()):
+            samples.append(
+                ("aws_errors_total", dict(zip(LABELS + ("code",), key)),
+                 value))
+        for key, histogram in sorted(self._latencies.iteritems()):
+            labels = dict(zip(LABELS, key))
+            for bound, count in histogram.get_cumulative_counts():
+                bucket_labels = dict(labels, le=_format_value(bound))
+                samples.append(
+                    ("aws_request_seconds_bucket", bucket_labels, count))
+            samples.append(("aws_request_seconds_sum", labels, histogram.sum))
+            samples.append(
+                ("aws_request_seconds_count", labels, histogram.count))
+        return samples
+
+    def render(self):
+        """Return the metrics in the Prometheus text exposition format."""
+        lines = []
+        for name, labels, value in self.get_samples():
+            pairs = ",".join(
+                '%s="%s"' % (label, _escape(labels[label]))
+                for label in sorted(labels))
+            lines.append("%s{%s} %s" % (name, pairs, _format_value(value)))
+        return "".join(line + "\n" for line in lines)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace(
+        "\n", "\\n")
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(value)
+
+
+class MetricsResource(Resource):
+    """
+    A resource serving the metrics of a L{MetricsRegistry} to the monitoring
+    agents scraping it.
+    """
+
+    isLeaf = True
+
+    def __init__(self, registry):
+        Resource.__init__(self)
+        self.registry = registry
+
+    def render_GET(self, request):
+        request.setHeader("content-type", "text/plain; version=0.0.4")
+        return self.registry.render()
@@ -0,0 +1,249 @@
+# Licenced under the txaws licence available at /LICENSE in the txaws source.
+
+"""
+Client-side rate limiting of requests per action and per credential.
+
+AWS throttles each API action of an account separately. A L{RateLimiter}
+holds a L{TokenBucket} for every C{(access key, action)} pair and delays
+requests until their bucket has a token, so that a busy client stays just
+under the service limits instead of bouncing off throttling errors.
+"""
+from collections import deque
+
+from twisted.internet import defer
+from twisted.python.failure import Failure
+
+from txaws.client.retry import is_throttled
+
+
+__all__ = ["TokenBucket", "RateLimiter", "get_rate_limiter"]
+
+
+def get_rate_limiter(endpoint):
+    """
+    Return the L{RateLimiter} of C{endpoint}, or else the one of its
+    transport, or C{None} if requests to it are not rate limited.
+    """
+    limiter = getattr(endpoint, "rate_limiter", None)
+    if limiter is None:
+        transport = getattr(endpoint, "transport", None)
+        limiter = getattr(transport, "rate_limiter", None)
+    return limiter
+
+
+class TokenBucket(object):
+    """
+    A token bucket refilled at C{rate} tokens per second, holding up to
+    C{burst} tokens.
+
+    Requests which can't get a token wait in line, in order, until the
+    bucket has been refilled.
+
+    When told the service throttled a request, the bucket slows down to
+    C{decrease} times its current rate, then speeds up again by
+    C{recovery} times its configured rate for every successful request.
+
+    @param clock: The L{IReactorTime} provider used to refill the bucket.
+    @param rate: The number of requests allowed per second.
+    @param burst: The number of requests allowed at once after a quiet
+        period, by default C{rate} rounded up.
+    @param min_rate: The rate the bucket never slows down below, by default
+        a tenth of C{rate}.
+    @param decrease: The factor applied to the rate on throttling.
+    @param recovery: The fraction of C{rate} regained per success.
+    @ivar max_rate: The configured rate.
+    @ivar rate: The current rate.
+    """
+
+    def __init__(self, clock, rate, burst=None, min_rate=None, decrease=0.75,
+                 recovery=0.02):
+        if burst is None:
+            burst = max(1, int(rate + 0.999))
+        if min_rate is None:
+            min_rate = rate / 10.0
+        self.clock = clock
+        self.max_rate = rate
+        self.rate = rate
+        self.min_rate = min_rate
+        self.burst = burst
+        self.decrease = decrease
+        self.recovery = recovery
+        self.tokens = float(burst)
+        self.updated = clock.seconds()
+        self.waiters = deque()
+        self.granted = 0
+        self.delayed = 0
+        self.wait_time = 0.0
+        self.throttled_count = 0
+        self._call = None
+
+    def _refill(self):
+        now = self.clock.seconds()
+        self.tokens = min(
+            self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self):
+        """
+        Take a token from the bucket.
+
+        @return: A C{Deferred} firing with C{None} once a token was taken.
+        """
+        self._refill()
+        if not self.waiters and self.tokens >= 1:
+            self.tokens -= 1
+            self.granted += 1
+            return defer.succeed(None)
+        self.delayed += 1
+        d = defer.Deferred(self._cancel)
+        self.waiters.append((d, self.clock.seconds()))
+        self._schedule()
+        return d
+
+    def _schedule(self):
+        if self.waiters and self._call is None:
+            delay = max(0, (1 - self.tokens) / self.rate)
+            self._call = self.clock.callLater(delay, self._drain)
+
+    def _drain(self):
+        self._call = None
+        self._refill()
+        now = self.clock.seconds()
+        while self.waiters and self.tokens >= 1:
+            self.tokens -= 1
+            self.granted += 1
+            d, queued_at = self.waiters.popleft()
+            self.wait_time += now - queued_at
+            d.callback(None)
+        self._schedule()
+
+    def _cancel(self, d):
+        for waiter in self.waiters:
+            if waiter[0] is d:
+                self.waiters.remove(waiter)
+                break
+        if not self.waiters and self._call is not None:
+            self._call.cancel()
+            self._call = None
+
+    def _set_rate(self, rate):
+        self._refill()
+        self.rate = rate
+        if self._call is not None:
+            self._call.cancel()
+            self._call = None
+        self._schedule()
+
+    def throttled(self):
+        """Slow down, the service throttled one of our requests."""
+        self.throttled_count += 1
+        self._set_rate(max(self.min_rate, self.rate * self.decrease))
+
+    def succeeded(self):
+        """Speed back up towards C{max_rate} after a successful request."""
+        if self.rate < self.max_rate:
+            self._set_rate(min(
+                self.max_rate, self.rate + self.max_rate * self.recovery))
+
+    def get_stats(self):
+        self._refill()
+        return {"rate": self.rate, "tokens": self.tokens,
+                "waiting": len(self.waiters), "granted": self.granted,
+                "delayed": self.delayed, "wait_time": self.wait_time,
+                "throttled": self.throttled_count}
+
+
+class RateLimiter(object):
+    """
+    Rate limit requests per action and per credential.
+
+    Every access key gets its own L{TokenBucket} for every action, since
+    that's how AWS applies its limits.
+
+    @param reactor: The reactor used to refill the buckets.
+    @param rates: A C{dict} mapping action names, or C{(access_key, action)}
+        pairs for credential specific rates, to the number of requests
+        allowed per second. S3 actions are the HTTP methods.
+    @param default_rate: The rate of the other actions, by default they
+        aren't limited.
+    @param burst: The C{burst} of the buckets, see L{TokenBucket}.
+    """
+
+    def __init__(self, reactor=None, rates=None, default_rate=None,
+                 burst=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        if rates is None:
+            rates = {}
+        self.rates = rates
+        self.default_rate = default_rate
+        self.burst = burst
+        self._buckets = {}
+
+    def get_rate(self, access_key, action):
+        """Return the rate of C{action} for C{access_key}, or C{None}."""
+        rate = self.rates.get((access_key, action))
+        if rate is None:
+            rate = self.rates.get(action, self.default_rate)
+        return rate
+
+    def get_bucket(self, access_key, action):
+        """
+        Return the L{TokenBucket} of C{action} for C{access_key}, or C{None}
+        if it isn't rate limited.
+        """
+        key = (access_key, action)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            rate = self.get_rate(access_key, action)
+            if rate is None:
+                return None
+            bucket = TokenBucket(self.reactor, rate, self.burst)
+            self._buckets[key] = bucket
+        return bucket
+
+    def acquire(self, access_key, action):
+        """
+        Wait for a token for C{action}.
+
+        @return: A C{Deferred} firing with C{None} once the request can be
+            sent.
+        """
+        bucket = self.get_bucket(access_key, action)
+        if bucket is None:
+            return defer.succeed(None)
+        return bucket.acquire()
+
+    def limit(self, access_key, action, call):
+        """
+        Call C{call} once a token for C{action} is available, and adjust the
+        rate to its outcome: throttling errors slow the bucket down, successes
+        speed it back up.
+
+        @return: A C{Deferred} firing with the result of C{call}.
+        """
+        bucket = self.get_bucket(access_key, action)
+        if bucket is None:
+            return defer.maybeDeferred(call)
+
+        def record(result):
+            if not isinstance(result, Failure):
+                bucket.succeeded()
+            elif is_throttled(result):
+                bucket.throttled()
+            return result
+
+        d = bucket.acquire()
+        d.addCallback(lambda ignored: call())
+        return d.addBoth(record)
+
+    def get_stats(self):
+        """
+        Return a C{dict} mapping C{(access_key, action)} pairs to the
+        statistics of their bucket: the current C{rate}, the C{tokens}
+        available, the requests C{waiting}, C{granted} and C{delayed} so far,
+        the total C{wait_time} and the number of C{throttled} responses.
+        """
+        return dict((key, bucket.get_stats())
+                    for key, bucket in self._buckets.iteritems())
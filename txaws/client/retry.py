@@ -0,0 +1,312 @@
+# Licenced under the txaws licence available at /LICENSE in the txaws source.
+
+"""
+Automatic retries of failed requests.
+
+A L{RetryPolicy} decides whether a failed request is worth sending again,
+waits a decorrelated-jitter backoff delay, and draws each retry from a
+L{RetryBudget} shared by all of the requests using the policy, so that a
+service outage doesn't get amplified by every caller retrying at once.
+"""
+import random
+import re
+
+from twisted.internet import defer, error
+from twisted.web._newclient import RequestNotSent, ResponseFailed
+
+from txaws.client.streaming import StreamInterrupted
+
+
+__all__ = ["RetryBudget", "RetryPolicy", "get_retry_policy", "is_throttled"]
+
+
+THROTTLING_CODES = frozenset([
+    "Throttling", "ThrottlingException", "ThrottledException",
+    "RequestThrottled", "RequestThrottledException", "RequestLimitExceeded",
+    "SlowDown", "TooManyRequestsException", "BandwidthLimitExceeded",
+    "ProvisionedThroughputExceededException"])
+TRANSIENT_CODES = frozenset([
+    "InternalError", "InternalFailure", "ServiceUnavailable",
+    "RequestTimeout"])
+TRANSIENT_STATUSES = frozenset([429, 500, 502, 503, 504])
+IDEMPOTENT_METHODS = frozenset(["GET", "HEAD", "PUT", "DELETE", "OPTIONS"])
+IDEMPOTENT_ACTION_PREFIXES = ("Describe", "Get", "List")
+
+# Failures happening before the request could reach the server: safe to
+# retry whatever the request is.
+NOT_SENT_ERRORS = (error.ConnectError, error.DNSLookupError, RequestNotSent)
+# Failures after the request may have been processed: only retried for
+# idempotent requests.
+CONNECTION_ERRORS = (error.ConnectionClosed, ResponseFailed)
+
+_ERROR_CODE = re.compile(r"<Code>\s*([^<\s]+)\s*</Code>")
+
+
+def get_retry_policy(endpoint):
+    """
+    Return the L{RetryPolicy} of C{endpoint}, or else the one of its
+    transport, or C{None} if requests to it are not retried.
+    """
+    policy = getattr(endpoint, "retry_policy", None)
+    if policy is None:
+        transport = getattr(endpoint, "transport", None)
+        policy = getattr(transport, "retry_policy", None)
+    return policy
+
+
+def get_error_code(response):
+    """Return the AWS error code in the C{response} body, if any."""
+    if not response:
+        return None
+    match = _ERROR_CODE.search(response)
+    if match is not None:
+        return match.group(1)
+
+
+def is_throttled(failure):
+    """
+    Return whether C{failure} is the service asking us to slow down: a
+    throttling error code, or a C{429} or C{503} response.
+    """
+    value = failure.value
+    status = getattr(value, "status", None)
+    if status is None:
+        return False
+    if get_error_code(getattr(value, "response", None)) in THROTTLING_CODES:
+        return True
+    return str(status) in ("429", "503")
+
+
+class RetryBudget(object):
+    """
+    A pool of tokens paying for retries.
+
+    Every retry withdraws tokens, which are only slowly refunded by successful
+    requests. While the service is healthy the budget stays full; when most
+    requests fail it runs dry and failures are returned straight away instead
+    of multiplying the load.
+
+    @param capacity: The maximum, and initial, number of tokens.
+    @param retry_cost: The tokens withdrawn for a retry.
+    @param timeout_cost: The tokens withdrawn for retrying a timeout or a
+        connection failure, which are costlier for the service.
+    @param success_refund: The tokens refunded by a request succeeding on its
+        first attempt. A request succeeding after retries refunds what its
+        retries cost instead.
+    """
+
+    def __init__(self, capacity=500, retry_cost=5, timeout_cost=10,
+                 success_refund=1):
+        self.capacity = capacity
+        self.retry_cost = retry_cost
+        self.timeout_cost = timeout_cost
+        self.success_refund = success_refund
+        self.available = capacity
+
+    def withdraw(self, timeout=False):
+        """
+        Take the cost of a retry from the budget.
+
+        @return: The number of tokens withdrawn, or C{0} if the budget can't
+            afford the retry.
+        """
+        cost = self.retry_cost
+        if timeout:
+            cost = self.timeout_cost
+        if cost > self.available:
+            return 0
+        self.available -= cost
+        return cost
+
+    def deposit(self, tokens=None):
+        """Refund C{tokens}, by default the C{success_refund}."""
+        if tokens is None:
+            tokens = self.success_refund
+        self.available = min(self.capacity, self.available + tokens)
+
+
+class _RetryingCall(object):
+    """The attempts of a single request made under a L{RetryPolicy}."""
+
+    def __init__(self, policy, call, method, action):
+        self.policy = policy
+        self.call = call
+        self.method = method
+        self.action = action
+        self.attempts = 0
+        self.delay = policy.base_delay
+        self.withdrawn = 0
+        self.current = None
+        self.delayed_call = None
+        self.cancelled = False
+        self.deferred = defer.Deferred(self._cancel)
+
+    def attempt(self):
+        self.delayed_call = None
+        self.attempts += 1
+        self.current = defer.maybeDeferred(self.call)
+        self.current.addCallbacks(self._succeeded, self._failed)
+
+    def _succeeded(self, result):
+        self.current = None
+        self.policy.budget.deposit(self.withdrawn or None)
+        self.deferred.callback(result)
+
+    def _failed(self, failure):
+        self.current = None
+        if self.cancelled:
+            return
+        policy = self.policy
+        reason = policy.get_retry_reason(failure, self.method, self.action)
+        if reason is None:
+            self.deferred.errback(failure)
+            return
+        if self.attempts >= policy.max_attempts:
+            policy.exhausted += 1
+            self.deferred.errback(failure)
+            return
+        cost = policy.budget.withdraw(reason in ("timeout", "connection"))
+        if not cost:
+            policy.budget_exhausted += 1
+            self.deferred.errback(failure)
+            return
+        self.withdrawn += cost
+        self.delay = policy.get_delay(self.delay)
+        policy.record_retry(self.action, self.attempts, self.delay, reason)
+        self.delayed_call = policy.reactor.callLater(self.delay, self.attempt)
+
+    def _cancel(self, deferred):
+        self.cancelled = True
+        if self.delayed_call is not None:
+            self.delayed_call.cancel()
+            self.delayed_call = None
+        elif self.current is not None:
+            self.current.cancel()
+
+
+class RetryPolicy(object):
+    """
+    Decide which failed requests are retried, and when.
+
+    Throttling errors, 5xx responses and failures to connect are retried for
+    any request. Timeouts and connections lost after the request was sent are
+    only retried for idempotent requests: those using an idempotent HTTP
+    method, as S3 does, or whose action name starts with C{Describe}, C{Get}
+    or C{List}, since EC2 and SQS send every action with the same method.
+
+    @param reactor: The reactor used to wait between attempts.
+    @param max_attempts: The maximum number of attempts of a request,
+        including the first one.
+    @param base_delay: The minimum delay before a retry, in seconds.
+    @param max_delay: The maximum delay before a retry, in seconds.
+    @param budget: The L{RetryBudget} paying for retries, by default a new
+        one owned by this policy.
+    @param idempotent_actions: Additional action names safe to send twice.
+    @param observer: An optional callable called with the action, the number
+        of attempts so far, the delay and the reason of every retry.
+    @ivar retries: The number of retries made, per reason.
+    @ivar exhausted: The number of requests failing after C{max_attempts}.
+    @ivar budget_exhausted: The number of requests not retried because the
+        budget ran out.
+    """
+
+    def __init__(self, reactor=None, max_attempts=4, base_delay=0.05,
+                 max_delay=20, budget=None, idempotent_actions=(),
+                 observer=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        if budget is None:
+            budget = RetryBudget()
+        self.budget = budget
+        self.idempotent_actions = frozenset(idempotent_actions)
+        self.observer = observer
+        self.retries = {}
+        self.exhausted = 0
+        self.budget_exhausted = 0
+
+    def is_idempotent(self, method, action):
+        """Return whether a request can safely be sent more than once."""
+        if action in self.idempotent_actions:
+            return True
+        if action is None or action == method:
+            return method in IDEMPOTENT_METHODS
+        return action.startswith(IDEMPOTENT_ACTION_PREFIXES)
+
+    def get_retry_reason(self, failure, method="GET", action=None):
+        """
+        Return why the failed request should be retried, one of
+        C{"throttled"}, C{"transient"}, C{"connection"} or C{"timeout"}, or
+        C{None} if it shouldn't.
+
+        Error responses are recognized from any exception carrying the HTTP
+        C{status} and the C{response} body, like L{TwistedWebError}. A
+        L{StreamInterrupted} body is judged by what interrupted it, for the
+        callers sending the request again with a new consumer.
+        """
+        if failure.check(StreamInterrupted):
+            failure = failure.value.reason
+        value = failure.value
+        status = getattr(value, "status", None)
+        if status is not None:
+            if is_throttled(failure):
+                return "throttled"
+            code = get_error_code(getattr(value, "response", None))
+            if code in TRANSIENT_CODES:
+                return "transient"
+            try:
+                status = int(status)
+            except ValueError:
+                return None
+            if status in TRANSIENT_STATUSES:
+                return "transient"
+            return None
+        if failure.check(*NOT_SENT_ERRORS):
+            return "connection"
+        if not self.is_idempotent(method, action):
+            return None
+        if failure.check(defer.TimeoutError):
+            return "timeout"
+        if failure.check(*CONNECTION_ERRORS):
+            return "connection"
+        return None
+
+    def get_delay(self, previous):
+        """
+        Return the delay before the next retry, given the C{previous} one,
+        with decorrelated jitter: a random delay between C{base_delay} and
+        three times the previous one, capped at C{max_delay}.
+        """
+        upper = max(self.base_delay, previous * 3)
+        return min(self.max_delay, random.uniform(self.base_delay, upper))
+
+    def record_retry(self, action, attempts, delay, reason):
+        self.retries[reason] = self.retries.get(reason, 0) + 1
+        if self.observer is not None:
+            self.observer(action, attempts, delay, reason)
+
+    def run(self, call, method="GET", action=None):
+        """
+        Call C{call} until its C{Deferred} succeeds, fails with an error not
+        worth retrying, or the attempts or the budget run out.
+
+        @return: A C{Deferred} firing with the result of the last attempt.
+        """
+        retrying = _RetryingCall(self, call, method, action)
+        retrying.attempt()
+        return retrying.deferred
+
+    def get_stats(self):
+        """
+        Return a C{dict} with the C{retries} per reason, their C{total}, the
+        C{exhausted} and C{budget_exhausted} counts and the C{budget} tokens
+        left.
+        """
+        return {"retries": dict(self.retries),
+                "total": sum(self.retries.itervalues()),
+                "exhausted": self.exhausted,
+                "budget_exhausted": self.budget_exhausted,
+                "budget": self.budget.available}
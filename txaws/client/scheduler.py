@@ -0,0 +1,240 @@
+# Licenced under the txaws licence available at /LICENSE in the txaws source.
+
+"""
+Per-endpoint concurrency limits and priority lanes for outgoing requests.
+
+A L{RequestScheduler} sits in front of the L{HTTPTransport}: every request is
+started only once the number of requests in flight to its endpoint, and for
+its action, is below the configured limits.  Requests which have to wait are
+queued in priority lanes, so that interactive calls overtake bulk work.
+"""
+from collections import deque
+from contextlib import contextmanager
+
+from twisted.internet import defer
+
+from txaws.util import parse
+
+
+__all__ = ["INTERACTIVE", "NORMAL", "BULK", "RequestScheduler",
+           "get_endpoint_key"]
+
+
+INTERACTIVE = 0
+NORMAL = 1
+BULK = 2
+LANE_NAMES = {INTERACTIVE: "interactive", NORMAL: "normal", BULK: "bulk"}
+
+
+def get_endpoint_key(url):
+    """Return the C{scheme://host:port} string identifying an endpoint."""
+    scheme, host, port, path = parse(url)
+    return "%s://%s:%d" % (scheme, host, port)
+
+
+class _Waiter(object):
+    """A request waiting for, or holding, a slot of a L{RequestScheduler}."""
+
+    def __init__(self, call, endpoint, action, priority, queued_at):
+        self.call = call
+        self.endpoint = endpoint
+        self.action = action
+        self.priority = priority
+        self.queued_at = queued_at
+        self.running = None
+        self.deferred = None
+
+
+class RequestScheduler(object):
+    """
+    Limit the number of requests in flight per endpoint and per action.
+
+    @param reactor: The reactor used to measure the time spent queuing.
+    @param max_per_endpoint: The maximum number of requests in flight to a
+        single endpoint, or C{None} for no limit.
+    @param max_per_action: The maximum number of requests in flight to a
+        single endpoint for a single action. Either an C{int} applying to all
+        actions, a C{dict} mapping action names to limits, or C{None} for no
+        limit.
+    @param action_priorities: A C{dict} mapping action names to the priority
+        lane, one of L{INTERACTIVE}, L{NORMAL} or L{BULK}, their requests
+        use by default.
+    @param default_priority: The lane of actions not in C{action_priorities}.
+    """
+
+    def __init__(self, reactor=None, max_per_endpoint=None,
+                 max_per_action=None, action_priorities=None,
+                 default_priority=NORMAL):
+        if reactor is None:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        self.max_per_endpoint = max_per_endpoint
+        self.max_per_action = max_per_action
+        if action_priorities is None:
+            action_priorities = {}
+        self.action_priorities = action_priorities
+        self.default_priority = default_priority
+        self._priority = None
+        self._queues = {}
+        self._in_flight = {}
+        self._in_flight_actions = {}
+        self.max_queued = 0
+        self.wait_times = dict(
+            (lane, {"count": 0, "total": 0.0, "max": 0.0})
+            for lane in LANE_NAMES)
+
+    @contextmanager
+    def prioritized(self, priority):
+        """
+        Use C{priority} for the requests issued within the C{with} block.
+
+        Queries send their request as soon as they are submitted, so this
+        applies to client calls made in the block, e.g.::
+
+            with scheduler.prioritized(INTERACTIVE):
+                d = ec2.describe_instances()
+
+        Queries keep the lane they were submitted in for their retries,
+        which are sent after the block is left.
+        """
+        previous = self._priority
+        self._priority = priority
+        try:
+            yield
+        finally:
+            self._priority = previous
+
+    def get_priority(self, action):
+        """Return the lane a request for C{action} goes to."""
+        if self._priority is not None:
+            return self._priority
+        return self.action_priorities.get(action, self.default_priority)
+
+    def get_action_limit(self, action):
+        if isinstance(self.max_per_action, dict):
+            return self.max_per_action.get(action)
+        return self.max_per_action
+
+    def schedule(self, call, endpoint, action=None, priority=None):
+        """
+        Run C{call} as soon as the limits allow it.
+
+        @param call: A callable starting the request and returning a
+            C{Deferred} which fires when it is complete.
+        @param endpoint: The key of the endpoint the request goes to, see
+            L{get_endpoint_key}.
+        @param action: The name of the action of the request.
+        @param priority: The lane of the request, by default as returned by
+            L{get_priority}.
+        @return: A C{Deferred} firing with the result of C{call}.
+        """
+        if priority is None:
+            priority = self.get_priority(action)
+        waiter = _Waiter(call, endpoint, action, priority,
+                         self.reactor.seconds())
+        waiter.deferred = defer.Deferred(lambda d: self._cancel(waiter))
+        lanes = self._queues.get(endpoint)
+        if lanes is None:
+            lanes = self._queues[endpoint] = dict(
+                (lane, deque()) for lane in LANE_NAMES)
+        lanes[priority].append(waiter)
+        self._dispatch(endpoint)
+        self.max_queued = max(self.max_queued, self.get_queued())
+        return waiter.deferred
+
+    def _can_run(self, waiter):
+        endpoint_limit = self.max_per_endpoint
+        if (endpoint_limit is not None and
+            self._in_flight.get(waiter.endpoint, 0) >= endpoint_limit):
+            return False
+        action_limit = self.get_action_limit(waiter.action)
+        key = (waiter.endpoint, waiter.action)
+        if (action_limit is not None and
+            self._in_flight_actions.get(key, 0) >= action_limit):
+            return False
+        return True
+
+    def _dispatch(self, endpoint):
+        lanes = self._queues.get(endpoint)
+        if lanes is None:
+            return
+        for lane in sorted(lanes):
+            queue = lanes[lane]
+            for waiter in list(queue):
+                if waiter.running is not None or waiter.deferred.called:
+                    # Run, or cancelled, by the dispatch of a call which
+                    # completed right away.
+                    continue
+                if (self.max_per_endpoint is not None and
+                    self._in_flight.get(endpoint, 0) >=
+                    self.max_per_endpoint):
+                    return
+                if self._can_run(waiter):
+                    queue.remove(waiter)
+                    self._run(waiter)
+
+    def _run(self, waiter):
+        wait_time = self.reactor.seconds() - waiter.queued_at
+        stats = self.wait_times[waiter.priority]
+        stats["count"] += 1
+        stats["total"] += wait_time
+        stats["max"] = max(stats["max"], wait_time)
+        key = (waiter.endpoint, waiter.action)
+        self._in_flight[waiter.endpoint] = (
+            self._in_flight.get(waiter.endpoint, 0) + 1)
+        self._in_flight_actions[key] = self._in_flight_actions.get(key, 0) + 1
+        waiter.running = defer.maybeDeferred(waiter.call)
+        waiter.running.addBoth(self._release, waiter)
+        waiter.running.chainDeferred(waiter.deferred)
+        # The next calls start once the result was given.
+        waiter.running.addCallback(
+            lambda ignored: self._dispatch(waiter.endpoint))
+
+    def _release(self, result, waiter):
+        key = (waiter.endpoint, waiter.action)
+        self._in_flight[waiter.endpoint] -= 1
+        if not self._in_flight[waiter.endpoint]:
+            del self._in_flight[waiter.endpoint]
+        self._in_flight_actions[key] -= 1
+        if not self._in_flight_actions[key]:
+            del self._in_flight_actions[key]
+        return result
+
+    def _cancel(self, waiter):
+        if waiter.running is not None:
+            waiter.running.cancel()
+        else:
+            self._queues[waiter.endpoint][waiter.priority].remove(waiter)
+
+    def get_queued(self, endpoint=None):
+        """Return the number of queued requests, for C{endpoint} or in all."""
+        if endpoint is not None:
+            lanes = self._queues.get(endpoint, {})
+            return sum(len(queue) for queue in lanes.itervalues())
+        return sum(self.get_queued(endpoint) for endpoint in self._queues)
+
+    def get_in_flight(self, endpoint=None):
+        """Return the number of requests in flight, to C{endpoint} or all."""
+        if endpoint is not None:
+            return self._in_flight.get(endpoint, 0)
+        return sum(self._in_flight.itervalues())
+
+    def get_stats(self):
+        """
+        Return a C{dict} with the current C{in_flight} and C{queued} request
+        counts, the C{max_queued} depth seen so far, the same figures per
+        endpoint in C{endpoints}, and the C{count}, C{total} and C{max} time
+        spent queuing for each lane in C{wait_time}.
+        """
+        endpoints = {}
+        for endpoint in set(self._queues) | set(self._in_flight):
+            endpoints[endpoint] = {
+                "in_flight": self.get_in_flight(endpoint),
+                "queued": self.get_queued(endpoint)}
+        wait_time = dict((LANE_NAMES[lane], dict(stats))
+                         for lane, stats in self.wait_times.iteritems())
+        return {"in_flight": self.get_in_flight(),
+                "queued": self.get_queued(),
+                "max_queued": self.max_queued,
+                "endpoints": endpoints,
+                "wait_time": wait_time}
@@ -0,0 +1,399 @@
+# Licenced under the txaws licence available at /LICENSE in the txaws source.
+
+"""
+Rate and concurrency limits shared by the processes of a host.
+
+A L{RateLimiter} only sees the requests of its own process. When several
+worker processes use the same AWS account, they can instead share a single
+L{LimitServer} listening on a Unix socket: each process uses a
+L{SharedRateLimiter} wherever it would use a L{RateLimiter}, and every
+request first asks the server for a token of its action and for one of the
+slots of its access key.
+
+The server can be run with::
+
+    python -m txaws.client.sharedlimit SOCKET --rate DescribeInstances=10
+
+If the server can't be reached, requests fall back to the local limiter given
+to L{SharedRateLimiter}, if any, or else go out unlimited.
+"""
+import sys
+from optparse import OptionParser
+
+from twisted.internet import defer
+from twisted.internet.protocol import ClientCreator, ServerFactory
+from twisted.protocols import amp
+from twisted.python import log
+from twisted.python.failure import Failure
+
+from txaws.client.ratelimit import RateLimiter
+from txaws.client.retry import is_throttled
+
+
+__all__ = ["LimitServer", "SharedRateLimiter", "listen"]
+
+
+class Acquire(amp.Command):
+    """Wait for a token of C{action} and a slot of C{access_key}."""
+
+    arguments = [("access_key", amp.Unicode()), ("action", amp.Unicode())]
+    response = []
+
+
+class Release(amp.Command):
+    """
+    Give back the slot taken by L{Acquire}, and report the outcome, if the
+    request was sent at all.
+    """
+
+    arguments = [("access_key", amp.Unicode()), ("action", amp.Unicode()),
+                 ("throttled", amp.Boolean(optional=True))]
+    requiresAnswer = False
+
+
+class GetStats(amp.Command):
+
+    arguments = []
+    response = [
+        ("buckets", amp.AmpList([
+            ("access_key", amp.Unicode()), ("action", amp.Unicode()),
+            ("rate", amp.Float()), ("tokens", amp.Float()),
+            ("waiting", amp.Integer()), ("granted", amp.Integer()),
+            ("delayed", amp.Integer()), ("wait_time", amp.Float()),
+            ("throttled", amp.Integer())])),
+        ("in_flight", amp.AmpList([
+            ("access_key", amp.Unicode()), ("count", amp.Integer())]))]
+
+
+def _encode(value):
+    if value is None:
+        return u""
+    return value.decode("utf-8")
+
+
+def _decode(value):
+    if not value:
+        return None
+    return value.encode("utf-8")
+
+
+class LimitServer(object):
+    """
+    The limits shared by all the processes connected to a server.
+
+    @param limiter: The L{RateLimiter} holding the token buckets.
+    @param max_in_flight: The maximum number of requests in flight per access
+        key, across all processes, or C{None} for no limit.
+    """
+
+    def __init__(self, limiter, max_in_flight=None):
+        self.limiter = limiter
+        self.max_in_flight = max_in_flight
+        self._slots = {}
+
+    def _get_slots(self, access_key):
+        slots = self._slots.get(access_key)
+        if slots is None:
+            slots = self._slots[access_key] = defer.DeferredSemaphore(
+                self.max_in_flight)
+        return slots
+
+    def acquire(self, access_key, action):
+        d = self.limiter.acquire(access_key, action)
+        if self.max_in_flight is not None:
+            d.addCallback(
+                lambda ignored: self._get_slots(access_key).acquire())
+        return d.addCallback(lambda ignored: None)
+
+    def release(self, access_key, action, throttled=None):
+        if self.max_in_flight is not None:
+            self._get_slots(access_key).release()
+        if throttled is None:
+            return
+        bucket = self.limiter.get_bucket(access_key, action)
+        if bucket is not None:
+            if throttled:
+                bucket.throttled()
+            else:
+                bucket.succeeded()
+
+    def get_in_flight(self):
+        """Return a C{dict} mapping access keys to requests in flight."""
+        return dict((access_key, self.max_in_flight - slots.tokens)
+                    for access_key, slots in self._slots.iteritems())
+
+
+class LimitServerProtocol(amp.AMP):
+    """
+    The server side of a connection from a L{SharedRateLimiter}.
+
+    Slots still held by a process when it disconnects are released.
+    """
+
+    def __init__(self, server):
+        amp.AMP.__init__(self)
+        self.server = server
+        self.held = {}
+        self.connected = True
+
+    @Acquire.responder
+    def acquire(self, access_key, action):
+        access_key, action = _decode(access_key), _decode(action)
+
+        def acquired(ignored):
+            if not self.connected:
+                self.server.release(access_key, action)
+                return {}
+            key = (access_key, action)
+            self.held[key] = self.held.get(key, 0) + 1
+            return {}
+
+        return self.server.acquire(access_key, action).addCallback(acquired)
+
+    @Release.responder
+    def release(self, access_key, action, throttled):
+        access_key, action = _decode(access_key), _decode(action)
+        key = (access_key, action)
+        if self.held.get(key):
+            self.held[key] -= 1
+            self.server.release(access_key, action, throttled)
+        return {}
+
+    @GetStats.responder
+    def get_stats(self):
+        buckets = []
+        for (access_key, action), stats in (
+                self.server.limiter.get_stats().iteritems()):
+            stats = dict(stats, access_key=_encode(access_key),
+                         action=_encode(action))
+            buckets.append(stats)
+        in_flight = [
+            {"access_key": _encode(access_key), "count": count}
+            for access_key, count in self.server.get_in_flight().iteritems()]
+        return {"buckets": buckets, "in_flight": in_flight}
+
+    def connectionLost(self, reason):
+        self.connected = False
+        amp.AMP.connectionLost(self, reason)
+        held, self.held = self.held, {}
+        for (access_key, action), count in held.iteritems():
+            for i in range(count):
+                self.server.release(access_key, action)
+
+
+class LimitServerFactory(ServerFactory):
+
+    def __init__(self, server):
+        self.server = server
+
+    def buildProtocol(self, addr):
+        return LimitServerProtocol(self.server)
+
+
+def listen(reactor, path, limiter, max_in_flight=None):
+    """
+    Serve the limits of C{limiter} and C{max_in_flight} on the Unix socket
+    C{path}.
+
+    @return: The listening port.
+    """
+    server = LimitServer(limiter, max_in_flight)
+    return reactor.listenUNIX(path, LimitServerFactory(server))
+
+
+class _LimitClientProtocol(amp.AMP):
+
+    def __init__(self, limiter):
+        amp.AMP.__init__(self)
+        self.limiter = limiter
+
+    def connectionLost(self, reason):
+        amp.AMP.connectionLost(self, reason)
+        self.limiter._disconnected(self)
+
+
+class SharedRateLimiter(object):
+    """
+    A L{RateLimiter} replacement asking a L{LimitServer} for permission.
+
+    @param path: The path of the Unix socket of the server.
+    @param reactor: The reactor to connect with.
+    @param fallback: The L{RateLimiter} used while the server can't be
+        reached, by default requests are not limited then.
+    """
+
+    def __init__(self, path, reactor=None, fallback=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self.path = path
+        self.reactor = reactor
+        self.fallback = fallback
+        self._protocol = None
+        self._waiters = []
+
+    def _connect(self):
+        if self._protocol is not None:
+            return defer.succeed(self._protocol)
+        d = defer.Deferred()
+        self._waiters.append(d)
+        if len(self._waiters) == 1:
+            creator = ClientCreator(self.reactor, _LimitClientProtocol, self)
+            creator.connectUNIX(self.path).addBoth(self._connected)
+        return d
+
+    def _connected(self, result):
+        waiters, self._waiters = self._waiters, []
+        if isinstance(result, Failure):
+            for d in waiters:
+                d.errback(result)
+        else:
+            self._protocol = result
+            for d in waiters:
+                d.callback(result)
+
+    def _disconnected(self, protocol):
+        if self._protocol is protocol:
+            self._protocol = None
+
+    def _call_remote(self, command, **kwargs):
+        d = self._connect()
+        return d.addCallback(
+            lambda protocol: protocol.callRemote(command, **kwargs))
+
+    def acquire(self, access_key, action):
+        """
+        Wait for the server to let a request for C{action} go.
+
+        @return: A C{Deferred} firing with C{True} once the server granted a
+            token and a slot, which must be given back with L{release}, or
+            with C{False} when the server couldn't be reached and the
+            fallback limiter, if any, granted the request instead. If it is
+            cancelled while waiting for the server, a grant arriving later
+            is given back straight away.
+        """
+        d = defer.Deferred()
+
+        def granted(ignored):
+            if d.called:
+                self.release(access_key, action, None)
+            else:
+                d.callback(True)
+
+        def failed(failure):
+            if not d.called:
+                d.errback(failure)
+
+        remote = self._call_remote(
+            Acquire, access_key=_encode(access_key), action=_encode(action))
+        remote.addCallbacks(granted, failed)
+        d.addErrback(self._use_fallback, access_key, action)
+        return d
+
+    def _use_fallback(self, failure, access_key, action):
+        if failure.check(defer.CancelledError):
+            return failure
+        log.msg("Rate limit server %s unavailable: %s" % (
+            self.path, failure.getErrorMessage()))
+        if self.fallback is None:
+            return False
+        return self.fallback.acquire(access_key, action).addCallback(
+            lambda ignored: False)
+
+    def release(self, access_key, action, throttled=False):
+        """Give back the slot of a request, and report whether it was
+        throttled, or nothing if C{throttled} is C{None}."""
+        if self._protocol is not None:
+            self._protocol.callRemote(
+                Release, access_key=_encode(access_key),
+                action=_encode(action), throttled=throttled)
+
+    def limit(self, access_key, action, call):
+        """
+        Call C{call} once the server allows it, see L{RateLimiter.limit}.
+        """
+
+        def acquired(shared):
+            d = defer.maybeDeferred(call)
+            if shared:
+                d.addBoth(release)
+            return d
+
+        def release(result):
+            throttled = (isinstance(result, Failure) and is_throttled(result))
+            self.release(access_key, action, throttled)
+            return result
+
+        return self.acquire(access_key, action).addCallback(acquired)
+
+    def get_stats(self):
+        """
+        Ask the server for its statistics.
+
+        @return: A C{Deferred} firing with a C{dict} with the C{buckets}
+            statistics, keyed by C{(access_key, action)} pairs like
+            L{RateLimiter.get_stats}, and the requests C{in_flight} per access
+            key.
+        """
+
+        def convert(response):
+            buckets = {}
+            for stats in response["buckets"]:
+                key = (_decode(stats.pop("access_key")),
+                       _decode(stats.pop("action")))
+                buckets[key] = stats
+            in_flight = dict(
+                (_decode(item["access_key"]), item["count"])
+                for item in response["in_flight"])
+            return {"buckets": buckets, "in_flight": in_flight}
+
+        return self._call_remote(GetStats).addCallback(convert)
+
+    def close(self):
+        """Disconnect from the server."""
+        if self._protocol is not None:
+            self._protocol.transport.loseConnection()
+
+
+def parse_options(arguments):
+    parser = OptionParser(
+        "%prog SOCKET [--rate ACTION=RATE ...] [--default-rate RATE] "
+        "[--max-in-flight COUNT]")
+    parser.add_option(
+        "--rate", dest="rates", action="append", default=[],
+        help="requests per second allowed for an action, per access key")
+    parser.add_option(
+        "--default-rate", dest="default_rate", type="float",
+        help="requests per second allowed for the other actions")
+    parser.add_option(
+        "--burst", dest="burst", type="int",
+        help="requests allowed at once after a quiet period")
+    parser.add_option(
+        "--max-in-flight", dest="max_in_flight", type="int",
+        help="requests in flight allowed per access key")
+    options, args = parser.parse_args(arguments)
+    if len(args) != 1:
+        parser.error("the path of the socket must be supplied")
+    rates = {}
+    for rate in options.rates:
+        action, _, value = rate.partition("=")
+        try:
+            rates[action] = float(value)
+        except ValueError:
+            parser.error("invalid rate %r, expected ACTION=RATE" % rate)
+    return args[0], rates, options
+
+
+def main(arguments=None):
+    from twisted.internet import reactor
+
+    if arguments is None:
+        arguments = sys.argv[1:]
+    path, rates, options = parse_options(arguments)
+    limiter = RateLimiter(reactor, rates, options.default_rate, options.burst)
+    log.startLogging(sys.stdout)
+    listen(reactor, path, limiter, options.max_in_flight)
+    reactor.run()
+
+
+if __name__ == "__main__":
+    main()
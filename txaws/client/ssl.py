@@ -1,17 +1,20 @@
+from collections import OrderedDict
 from glob import glob
 import os
 import re
 import sys
+import time
 
 from OpenSSL import SSL
 from OpenSSL.crypto import load_certificate, FILETYPE_PEM
 
-from twisted.internet.ssl import CertificateOptions
+from twisted.internet.ssl import CertificateOptions, ClientContextFactory
 
 from txaws import exception
 
 
-__all__ = ["VerifyingContextFactory", "get_ca_certs"]
+__all__ = ["VerifyingContextFactory", "ResumingClientContextFactory",
+           "SessionCache", "get_ca_certs", "get_context_factory"]
 
 
 # Multiple defaults are supported; just add more paths, separated by colons.
@@ -29,11 +32,14 @@ class VerifyingContextFactory(CertificateOptions):
     validity.
     """
 
-    def __init__(self, host, caCerts=None):
+    def __init__(self, host, caCerts=None, session_resumption=False):
         if caCerts is None:
             caCerts = get_global_ca_certs()
         CertificateOptions.__init__(self, verify=True, caCerts=caCerts)
         self.host = host
+        self.session_cache = None
+        if session_resumption:
+            self.session_cache = SessionCache()
 
     def _dnsname_match(self, dn, host):
         pats = []
@@ -80,9 +86,139 @@ class VerifyingContextFactory(CertificateOptions):
         context.set_verify(
             SSL.VERIFY_PEER | SSL.VERIFY_FAIL_IF_NO_PEER_CERT,
             self.verify_callback)
+        if self.session_cache is not None:
+            self.session_cache.install(context)
         return context
 
 
+class ResumingClientContextFactory(ClientContextFactory):
+    """
+    A L{ClientContextFactory} which builds its context only once, and
+    optionally resumes TLS sessions on that context.
+    """
+
+    _context = None
+
+    def __init__(self, session_resumption=True):
+        self.session_cache = None
+        if session_resumption:
+            self.session_cache = SessionCache()
+
+    def getContext(self):
+        if self._context is None:
+            self._context = ClientContextFactory.getContext(self)
+            if self.session_cache is not None:
+                self.session_cache.install(self._context)
+        return self._context
+
+
+def _session_reused(connection):
+    """
+    Tell whether the handshake of C{connection} resumed a session, or return
+    C{None} if pyOpenSSL doesn't let us find out.
+    """
+    try:
+        from OpenSSL._util import lib
+        return bool(lib.SSL_session_reused(connection._ssl))
+    except (ImportError, AttributeError):
+        return None
+
+
+class SessionCache(object):
+    """
+    Remember the last TLS session negotiated through a client context, and
+    offer it again on the next connections so that they skip the full
+    handshake.
+
+    This needs C{Connection.set_session}, available in pyOpenSSL 0.14 and
+    later; with older versions connections simply do full handshakes.
+
+    @ivar session: The session offered to new connections, if any.
+    @ivar handshakes: The number of completed handshakes.
+    @ivar resumed: The number of those handshakes which resumed a session.
+    """
+
+    def __init__(self):
+        self.session = None
+        self.handshakes = 0
+        self.resumed = 0
+
+    def install(self, context):
+        """Enable session resumption for connections made with C{context}."""
+        if getattr(SSL.Connection, "set_session", None) is None:
+            return
+        context.set_session_cache_mode(SSL.SESS_CACHE_CLIENT)
+        context.set_info_callback(self.info_callback)
+
+    def info_callback(self, connection, where, ret):
+        if where & SSL.SSL_CB_HANDSHAKE_START:
+            connection.handshake_started = time.time()
+            if self.session is not None:
+                try:
+                    connection.set_session(self.session)
+                except SSL.Error:
+                    # The connection is renegotiating, or the session can't
+                    # be used with it: do a full handshake.
+                    pass
+        elif where & SSL.SSL_CB_HANDSHAKE_DONE:
+            connection.handshake_done = time.time()
+            self.handshakes += 1
+            if _session_reused(connection):
+                self.resumed += 1
+            self.session = connection.get_session()
+
+
+def get_handshake_times(connection):
+    """
+    Return when the TLS handshake of C{connection} started and completed, as
+    recorded by L{SessionCache}, or C{None} if it wasn't.
+    """
+    started = getattr(connection, "handshake_started", None)
+    done = getattr(connection, "handshake_done", None)
+    if started is None or done is None:
+        return None
+    return started, done
+
+
+# The context factories by host and verification mode, the least recently
+# used first. Virtual-host buckets make for any number of hosts.
+_context_factories = OrderedDict()
+_CONTEXT_FACTORIES_SIZE = 256
+
+
+def get_context_factory(host, ssl_hostname_verification=False):
+    """
+    Return the shared context factory for connections to C{host}.
+
+    There is one factory per host and verification mode, so the SSL context,
+    and its CA store, are built only once, and TLS sessions are resumed on
+    reconnects.  A verifying factory is rebuilt if the global CA certificates
+    have changed since it was created.  Only the factories of the hosts
+    connected to most recently are kept.
+
+    @param host: The host name the connections are made to.
+    @param ssl_hostname_verification: Whether or not to verify the hostname
+        of the server certificate.
+    @return: A L{VerifyingContextFactory} or a L{ResumingClientContextFactory}.
+    """
+    key = (host, bool(ssl_hostname_verification))
+    factory = _context_factories.pop(key, None)
+    if ssl_hostname_verification:
+        if factory is None or factory.caCerts is not get_global_ca_certs():
+            factory = VerifyingContextFactory(host, session_resumption=True)
+    elif factory is None:
+        factory = ResumingClientContextFactory()
+    if len(_context_factories) >= _CONTEXT_FACTORIES_SIZE:
+        _context_factories.popitem(last=False)
+    _context_factories[key] = factory
+    return factory
+
+
+def clear_context_factories():
+    """Forget all the context factories built by L{get_context_factory}."""
+    _context_factories.clear()
+
+
 def get_ca_certs():
     """
     Retrieve a list of CAs at either the DEFAULT_CERTS_PATH or the env
@@ -0,0 +1,351 @@
+# Licenced under the txaws licence available at /LICENSE in the txaws source.
+
+"""
+Streaming of request and response bodies.
+
+A request sent through an L{HTTPTransport} with a C{stream} writes its
+response body to that L{IConsumer} as it arrives instead of collecting it.
+The consumer is given a streaming producer, and pausing it pauses the
+connection, so that a slow consumer never has more than a socket buffer of
+data waiting for it.
+
+L{get_consumer} adapts files and callables to consumers, and L{MD5Consumer}
+hashes the data it passes on.
+
+Request bodies too big to be held in memory are sent from a L{FileBody} or a
+L{ProducerBody} given as the C{postdata} of a request, which reads them as
+the connection can take them.
+"""
+from base64 import b64encode
+from hashlib import md5
+import os
+
+from zope.interface import implementer
+
+from twisted.internet import defer
+from twisted.internet.interfaces import IConsumer
+from twisted.web.client import FileBodyProducer
+from twisted.web.iweb import IBodyProducer, UNKNOWN_LENGTH
+
+from txaws.client.hashing import get_hashing_service
+
+
+__all__ = ["CallbackConsumer", "FileBody", "FileConsumer", "FileSection",
+           "MD5Consumer", "ProducerBody", "StreamInterrupted", "get_body",
+           "get_body_length", "get_consumer", "get_file_body", "get_flush"]
+
+
+class StreamInterrupted(Exception):
+    """
+    A response body failed after part of it was written to its consumer.
+
+    Such a request is never retried into the same consumer, which already
+    has the beginning of the body, but can be sent again with a new one.
+
+    @ivar written: The number of bytes written to the consumer.
+    @ivar reason: The L{Failure} which interrupted the body.
+    """
+
+    def __init__(self, written, reason):
+        Exception.__init__(
+            self, "Response body interrupted after %d bytes: %s" %
+            (written, reason.getErrorMessage()))
+        self.written = written
+        self.reason = reason
+
+
+@implementer(IConsumer)
+class FileConsumer(object):
+    """
+    A consumer writing to a file, which is assumed to always keep up.
+
+    @ivar offset: The position to write the data from, if any. Every write
+        seeks the file first then, so that several consumers can write to
+        sections of the same file in turn.
+    """
+
+    def __init__(self, file, offset=None):
+        self.file = file
+        self.offset = offset
+        self.producer = None
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+
+    def unregisterProducer(self):
+        self.producer = None
+
+    def write(self, data):
+        if self.offset is not None:
+            self.file.seek(self.offset)
+            self.offset += len(data)
+        self.file.write(data)
+
+    def flush(self):
+        """
+        Return a C{Deferred} firing once everything written was handled.
+        """
+        return defer.succeed(None)
+
+
+@implementer(IConsumer)
+class CallbackConsumer(object):
+    """
+    A consumer calling C{callback} with every chunk of data.
+
+    When C{callback} returns a C{Deferred}, the producer is paused until it
+    fires, and the next chunks are only given to C{callback} after it. If it
+    fails, or C{callback} raises an exception, the producer is stopped.
+
+    @ivar failure: The L{Failure} of C{callback}, if any.
+    """
+
+    def __init__(self, callback):
+        self.callback = callback
+        self.producer = None
+        self.failure = None
+        self._pending = None
+        self._queue = []
+        self._flush_waiters = []
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+
+    def unregisterProducer(self):
+        self.producer = None
+
+    def write(self, data):
+        if self.failure is not None:
+            return
+        self._queue.append(data)
+        if self._pending is None:
+            self._drain(None)
+            if self._pending is not None and self.producer is not None:
+                self.producer.pauseProducing()
+
+    def _drain(self, ignored):
+        self._pending = None
+        while self._queue and self.failure is None:
+            d = defer.maybeDeferred(self.callback, self._queue.pop(0))
+            d.addErrback(self._failed)
+            if not d.called:
+                self._pending = d
+                d.addCallback(self._drained)
+                return
+        del self._queue[:]
+        waiters, self._flush_waiters = self._flush_waiters, []
+        for waiter in waiters:
+            waiter.callback(None)
+
+    def _drained(self, ignored):
+        self._drain(None)
+        if (self._pending is None and self.producer is not None and
+                self.failure is None):
+            self.producer.resumeProducing()
+
+    def _failed(self, failure):
+        self.failure = failure
+        if self.producer is not None:
+            self.producer.stopProducing()
+
+    def flush(self):
+        """
+        Return a C{Deferred} firing once C{callback} handled everything
+        written, or failing like it.
+        """
+        if self._pending is not None:
+            d = defer.Deferred()
+            self._flush_waiters.append(d)
+        else:
+            d = defer.succeed(None)
+
+        def check(ignored):
+            if self.failure is not None:
+                return self.failure
+
+        return d.addCallback(check)
+
+
+@implementer(IConsumer)
+class MD5Consumer(object):
+    """
+    A consumer computing the MD5 digest of the data it passes on to
+    C{consumer}, without keeping it.
+    """
+
+    def __init__(self, consumer):
+        self.consumer = consumer
+        self.md5 = md5()
+        self.length = 0
+
+    def registerProducer(self, producer, streaming):
+        self.consumer.registerProducer(producer, streaming)
+
+    def unregisterProducer(self):
+        self.consumer.unregisterProducer()
+
+    def write(self, data):
+        self.md5.update(data)
+        self.length += len(data)
+        self.consumer.write(data)
+
+    def hexdigest(self):
+        return self.md5.hexdigest()
+
+    def flush(self):
+        return get_flush(self.consumer)
+
+
+def get_flush(consumer):
+    """
+    Return a C{Deferred} firing once C{consumer} handled everything written
+    to it, or failing if it couldn't.
+    """
+    flush = getattr(consumer, "flush", None)
+    if flush is None:
+        return defer.succeed(None)
+    return flush()
+
+
+def get_consumer(target):
+    """
+    Return an L{IConsumer} writing to C{target}: an L{IConsumer}, a file-like
+    object with a C{write} method, or a callable given each chunk of data.
+    """
+    if IConsumer.providedBy(target):
+        return target
+    if hasattr(target, "write"):
+        return FileConsumer(target)
+    if callable(target):
+        return CallbackConsumer(target)
+    raise TypeError("Can't stream to %r." % (target,))
+
+
+class FileSection(object):
+    """
+    A read-only file-like view of C{length} bytes of C{file} from C{offset}.
+
+    Every read seeks C{file} first, so that several sections of a file can
+    be read in turn, and closing a section leaves C{file} open.
+    """
+
+    def __init__(self, file, offset, length):
+        self.file = file
+        self.offset = offset
+        self.length = length
+        self.position = 0
+
+    def read(self, size=-1):
+        left = self.length - self.position
+        if size < 0 or size > left:
+            size = left
+        if size <= 0:
+            return ""
+        self.file.seek(self.offset + self.position)
+        data = self.file.read(size)
+        self.position += len(data)
+        return data
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.position
+        elif whence == os.SEEK_END:
+            offset += self.length
+        self.position = max(0, min(offset, self.length))
+
+    def tell(self):
+        return self.position
+
+    def close(self):
+        pass
+
+
+class FileBody(object):
+    """
+    A request body sent from C{length} bytes of C{file} from C{offset}, read
+    in chunks as the connection takes them.
+
+    A new producer is made for every attempt of the request, so that it can
+    be retried.
+
+    @ivar md5: The base64 encoded MD5 digest of the body, for its
+        C{Content-MD5} header, or C{None} if it isn't known.
+    """
+
+    def __init__(self, file, offset=0, length=None, md5=None):
+        if length is None:
+            file.seek(0, os.SEEK_END)
+            length = file.tell() - offset
+        self.file = file
+        self.offset = offset
+        self.length = length
+        self.md5 = md5
+
+    def get_producer(self):
+        """Return a new L{IBodyProducer} of the body."""
+        return FileBodyProducer(
+            FileSection(self.file, self.offset, self.length))
+
+
+class ProducerBody(object):
+    """
+    A request body sent from an L{IBodyProducer}, which can only be sent
+    once.
+
+    @ivar md5: The base64 encoded MD5 digest of the body, if known.
+    """
+
+    def __init__(self, producer, md5=None):
+        if producer.length is UNKNOWN_LENGTH:
+            raise ValueError("The length of the body must be known.")
+        self.producer = producer
+        self.length = producer.length
+        self.md5 = md5
+
+    def get_producer(self):
+        producer, self.producer = self.producer, None
+        if producer is None:
+            raise ValueError("The body producer was already used.")
+        return producer
+
+
+def get_body_length(body):
+    """Return the length of a request body, a string or a body object."""
+    if body is None:
+        return 0
+    if isinstance(body, str):
+        return len(body)
+    return body.length
+
+
+def get_body(source, service=None):
+    """
+    Return a C{Deferred} firing with a request body sending C{source}, an
+    L{IBodyProducer} or a file object, sent from its current position.
+
+    The MD5 digest of a file is computed beforehand, see L{get_file_body}.
+    """
+    if IBodyProducer.providedBy(source):
+        return defer.succeed(ProducerBody(source))
+    return get_file_body(source, source.tell(), service=service)
+
+
+def get_file_body(file, offset=0, length=None, service=None):
+    """
+    Return a C{Deferred} firing with the L{FileBody} of C{length} bytes of
+    C{file} from C{offset}, or of the rest of the file, with its MD5 digest.
+
+    The digest is computed by C{service}, by default the shared
+    L{HashingService}: big files with a descriptor are hashed in a thread,
+    without moving their position, so that other sections of the file can
+    be sent meanwhile.
+    """
+    if length is None:
+        file.seek(0, os.SEEK_END)
+        length = file.tell() - offset
+    if service is None:
+        service = get_hashing_service(None)
+    d = service.hash_file(file, offset, length)
+    return d.addCallback(
+        lambda digest: FileBody(
+            file, offset, length, b64encode(digest.digest())))
@@ -0,0 +1,137 @@
+from twisted.internet.defer import CancelledError, Deferred, succeed
+
+from txaws.client.base import BaseQuery
+from txaws.client.coalesce import SingleFlight, get_single_flight
+from txaws.service import AWSServiceEndpoint
+from txaws.testing.base import TXAWSTestCase
+
+
+class SingleFlightTestCase(TXAWSTestCase):
+
+    def setUp(self):
+        super(SingleFlightTestCase, self).setUp()
+        self.single_flight = SingleFlight()
+        self.calls = []
+
+    def make_call(self):
+        d = Deferred()
+
+        def call():
+            self.calls.append(d)
+            return d
+
+        return call
+
+    def test_coalesce(self):
+        """
+        Callers arriving while a call is in flight share its result, each
+        with their own copy.
+        """
+        results = []
+        call = self.make_call()
+        for i in range(3):
+            self.single_flight.run("key", call).addCallback(results.append)
+        self.assertEqual(1, len(self.calls))
+        self.calls[0].callback({"instances": ["i-1"]})
+        self.assertEqual([{"instances": ["i-1"]}] * 3, results)
+        self.assertNotIdentical(results[0], results[1])
+        self.assertNotIdentical(results[1]["instances"],
+                                results[2]["instances"])
+        self.assertEqual({"calls": 1, "coalesced": 2, "in_flight": 0},
+                         self.single_flight.get_stats())
+
+    def test_different_keys(self):
+        self.single_flight.run("key1", self.make_call())
+        self.single_flight.run("key2", self.make_call())
+        self.assertEqual(2, len(self.calls))
+
+    def test_sequential_calls(self):
+        """
+        Calls are only coalesced while in flight, results are not cached.
+        """
+        self.single_flight.run("key", lambda: succeed("first"))
+        d = self.single_flight.run("key", lambda: succeed("second"))
+        self.assertEqual(2, self.single_flight.get_stats()["calls"])
+        return d.addCallback(self.assertEqual, "second")
+
+    def test_failure(self):
+        call = self.make_call()
+        first = self.single_flight.run("key", call)
+        second = self.single_flight.run("key", call)
+        self.calls[0].errback(ValueError("failed"))
+        self.assertFailure(first, ValueError)
+        return self.assertFailure(second, ValueError)
+
+    def test_leader(self):
+        self.single_flight.run("key", self.make_call(), "leader")
+        self.assertEqual("leader", self.single_flight.get_leader("key"))
+        self.assertIdentical(None, self.single_flight.get_leader("other"))
+
+    def test_cancel(self):
+        """
+        The call is only cancelled once all of its callers cancelled.
+        """
+        call = self.make_call()
+        first = self.single_flight.run("key", call)
+        second = self.single_flight.run("key", call)
+        first.cancel()
+        self.assertFalse(self.calls[0].called)
+        second.cancel()
+        self.assertTrue(self.calls[0].called)
+        self.assertEqual(0, self.single_flight.get_stats()["in_flight"])
+        self.assertFailure(first, CancelledError)
+        return self.assertFailure(second, CancelledError)
+
+
+class BaseQuerySingleFlightTestCase(TXAWSTestCase):
+
+    def test_get_single_flight(self):
+        single_flight = SingleFlight()
+        endpoint = AWSServiceEndpoint(single_flight=single_flight)
+        self.assertIdentical(single_flight, get_single_flight(endpoint))
+        self.assertIdentical(None, get_single_flight(AWSServiceEndpoint()))
+
+    def test_get_page(self):
+        """
+        Queries with the same key share their request, and the ones which
+        joined it expose its client.
+        """
+        pages = []
+
+        class Query(BaseQuery):
+
+            def get_single_flight_key(self, url, **kwds):
+                return url
+
+            def _retry_page(self, url, *args, **kwds):
+                self.client = "client"
+                d = Deferred()
+                pages.append(d)
+                return d
+
+        endpoint = AWSServiceEndpoint(single_flight=SingleFlight())
+        first = Query("action", "creds", endpoint)
+        second = Query("action", "creds", endpoint)
+        first.get_page("http://host/")
+        d = second.get_page("http://host/")
+        self.assertEqual(1, len(pages))
+        pages[0].callback("body")
+        self.assertEqual("client", second.client)
+        return d.addCallback(self.assertEqual, "body")
+
+    def test_no_key(self):
+        """
+        By default, queries are not shared.
+        """
+        calls = []
+
+        class Query(BaseQuery):
+
+            def _retry_page(self, url, *args, **kwds):
+                calls.append(url)
+                return Deferred()
+
+        endpoint = AWSServiceEndpoint(single_flight=SingleFlight())
+        Query("action", "creds", endpoint).get_page("http://host/")
+        Query("action", "creds", endpoint).get_page("http://host/")
+        self.assertEqual(2, len(calls))
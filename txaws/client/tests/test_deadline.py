@@ -0,0 +1,232 @@
+from twisted.internet import reactor
+from twisted.internet.defer import (
+    CancelledError, Deferred, TimeoutError, succeed)
+from twisted.internet.task import Clock, deferLater
+from twisted.protocols.policies import WrappingFactory
+from twisted.web import server
+
+from txaws.client.base import BaseQuery
+from txaws.client.deadline import (
+    DeadlineExceeded, LatencyTracker, deadline, get_deadline,
+    get_latency_tracker, timeout_deferred)
+from txaws.client.scheduler import RequestScheduler
+from txaws.client.tests.test_transport import EchoResource
+from txaws.client.transport import HTTPTransport
+from txaws.service import AWSServiceEndpoint
+from txaws.sqs.connection import SQSConnection
+from txaws.testing.base import TXAWSTestCase
+
+
+class TimeoutDeferredTestCase(TXAWSTestCase):
+
+    def setUp(self):
+        super(TimeoutDeferredTestCase, self).setUp()
+        self.clock = Clock()
+        self.cancelled = []
+        self.d = Deferred(self.cancelled.append)
+
+    def test_timeout(self):
+        d = timeout_deferred(self.d, self.clock, 5)
+        self.clock.advance(5)
+        self.assertEqual([self.d], self.cancelled)
+        return self.assertFailure(d, TimeoutError)
+
+    def test_result(self):
+        d = timeout_deferred(self.d, self.clock, 5)
+        self.d.callback("result")
+        self.assertEqual([], self.clock.getDelayedCalls())
+        return d.addCallback(self.assertEqual, "result")
+
+    def test_cancelled(self):
+        """
+        A C{Deferred} cancelled before its timeout still fails with
+        L{CancelledError}.
+        """
+        d = timeout_deferred(self.d, self.clock, 5)
+        d.cancel()
+        self.assertEqual([], self.clock.getDelayedCalls())
+        return self.assertFailure(d, CancelledError)
+
+
+class DeadlineTestCase(TXAWSTestCase):
+
+    def test_deadline(self):
+        clock = Clock()
+        clock.advance(100)
+        self.assertIdentical(None, get_deadline())
+        with deadline(10, clock):
+            self.assertEqual(110, get_deadline())
+            with deadline(30, clock):
+                self.assertEqual(110, get_deadline())
+            with deadline(5, clock):
+                self.assertEqual(105, get_deadline())
+        self.assertIdentical(None, get_deadline())
+
+    def test_query_deadline(self):
+        """
+        A query made within a L{deadline} block fails with
+        L{DeadlineExceeded} once the deadline passed, cancelling its request.
+        """
+        clock = Clock()
+        cancelled = []
+
+        class Query(BaseQuery):
+
+            def _retry_page(self, url, *args, **kwds):
+                return Deferred(cancelled.append)
+
+        query = Query("action", "creds", AWSServiceEndpoint(), clock)
+        with deadline(5, clock):
+            d = query.get_page("http://host/")
+        clock.advance(4)
+        self.assertEqual([], cancelled)
+        clock.advance(1)
+        self.assertEqual(1, len(cancelled))
+        return self.assertFailure(d, DeadlineExceeded)
+
+
+class LatencyTrackerTestCase(TXAWSTestCase):
+
+    def test_get_timeout(self):
+        tracker = LatencyTracker(
+            percentile=90, multiplier=2, min_samples=10, min_timeout=0.5)
+        for i in range(9):
+            tracker.record("DescribeInstances", 1)
+        self.assertIdentical(None, tracker.get_percentile("DescribeInstances"))
+        self.assertEqual(30, tracker.get_timeout("DescribeInstances", 30))
+        tracker.record("DescribeInstances", 3)
+        self.assertEqual(1, tracker.get_percentile("DescribeInstances"))
+        self.assertEqual(2, tracker.get_timeout("DescribeInstances", 30))
+        self.assertEqual(1, tracker.get_timeout("DescribeInstances", 1))
+        self.assertEqual(
+            {"DescribeInstances": {"samples": 10, "percentile": 1,
+                                   "timeout": 2}},
+            tracker.get_stats())
+
+    def test_min_timeout(self):
+        tracker = LatencyTracker(min_samples=1, min_timeout=0.5)
+        tracker.record("GET", 0.01)
+        self.assertEqual(0.5, tracker.get_timeout("GET"))
+
+    def test_window(self):
+        tracker = LatencyTracker(window=2, min_samples=1, percentile=100)
+        for latency in [5, 1, 1]:
+            tracker.record("GET", latency)
+        self.assertEqual(1, tracker.get_percentile("GET"))
+
+    def test_query_timeout(self):
+        """
+        Queries give each attempt the timeout derived from the latencies
+        observed for their action, and record their latency.
+        """
+        tracker = LatencyTracker(min_samples=1, multiplier=2)
+        tracker.record("DescribeInstances", 2)
+        timeouts = []
+
+        class Query(BaseQuery):
+
+            timeout = 30
+
+            def _send_page(self, url, *args, **kwds):
+                timeouts.append(kwds["timeout"])
+                return succeed("body")
+
+        endpoint = AWSServiceEndpoint(latency_tracker=tracker)
+        self.assertIdentical(tracker, get_latency_tracker(endpoint))
+        query = Query("DescribeInstances", "creds", endpoint, Clock())
+        query.get_page("http://host/")
+        self.assertEqual([4], timeouts)
+        self.assertEqual(
+            2, tracker.get_stats()["DescribeInstances"]["samples"])
+
+
+class CancellationTestCase(TXAWSTestCase):
+
+    def setUp(self):
+        super(CancellationTestCase, self).setUp()
+        self.wrapper = WrappingFactory(
+            server.Site(EchoResource(), timeout=None))
+        self.port = reactor.listenTCP(0, self.wrapper, interface="127.0.0.1")
+        self.addCleanup(self.port.stopListening)
+        self.url = "http://127.0.0.1:%d/hang" % self.port.getHost().port
+        self.trickle_url = (
+            "http://127.0.0.1:%d/trickle" % self.port.getHost().port)
+        self.transport = HTTPTransport()
+        self.addCleanup(self.transport.close)
+
+    def wait_for_server(self):
+        return deferLater(reactor, 0.05, lambda: None)
+
+    def check_dropped(self, ignored):
+        self.assertEqual({}, self.wrapper.protocols)
+        self.assertEqual(0, self.transport.pool.get_idle_count())
+        self.assertEqual(0, self.transport.scheduler.get_stats()["in_flight"])
+
+    def test_cancel_page(self):
+        """
+        Cancelling a request sent through a transport drops its connection
+        and frees its scheduler slot.
+        """
+        page = self.transport.get_page(self.url)
+        self.assertFailure(page.deferred, CancelledError)
+        d = self.wait_for_server()
+        d.addCallback(lambda ignored: page.deferred.cancel())
+        d.addCallback(lambda ignored: page.deferred)
+        d.addCallback(lambda ignored: self.wait_for_server())
+        return d.addCallback(self.check_dropped)
+
+    def test_cancel_agent_request(self):
+        agent = self.transport.get_agent()
+        request = agent.request("GET", self.url)
+        self.assertFailure(request, CancelledError)
+        d = self.wait_for_server()
+        d.addCallback(lambda ignored: request.cancel())
+        d.addCallback(lambda ignored: request)
+        d.addCallback(lambda ignored: self.wait_for_server())
+        return d.addCallback(self.check_dropped)
+
+    def test_cancel_sqs_body(self):
+        """
+        Cancelling an SQS call while its response body is received drops its
+        connection.
+        """
+        connection = SQSConnection(
+            "127.0.0.1", agent=self.transport.get_agent())
+        d = connection.call(self.trickle_url, action="ReceiveMessage")
+        self.assertFailure(d, CancelledError)
+        waited = self.wait_for_server()
+        waited.addCallback(lambda ignored: d.cancel())
+        waited.addCallback(lambda ignored: d)
+        waited.addCallback(lambda ignored: self.wait_for_server())
+        return waited.addCallback(self.check_dropped)
+
+    def test_sqs_timeout_not_while_queued(self):
+        """
+        The C{timeout} of an SQS call only starts once the scheduler lets it
+        go, so it isn't spent waiting for a saturated endpoint.
+        """
+        scheduler = RequestScheduler(reactor, max_per_endpoint=1)
+        connection = SQSConnection(
+            "127.0.0.1", agent=self.transport.get_agent(),
+            scheduler=scheduler)
+        connection.timeout = 0.05
+        hanging = connection.call(self.url, action="ReceiveMessage")
+        queued = connection.call(
+            self.url.replace("hang", "file"), action="ReceiveMessage")
+
+        def check_queued(result):
+            self.assertEqual("GET::None", result)
+            return self.assertFailure(hanging, TimeoutError)
+
+        return queued.addCallback(check_queued)
+
+    def test_query_deadline(self):
+        """
+        A query missing its deadline drops its connection.
+        """
+        endpoint = AWSServiceEndpoint(transport=self.transport)
+        with deadline(0.1):
+            d = BaseQuery("action", "creds", endpoint).get_page(self.url)
+        d = self.assertFailure(d, DeadlineExceeded)
+        d.addCallback(lambda ignored: self.wait_for_server())
+        return d.addCallback(self.check_dropped)
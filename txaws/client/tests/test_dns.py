@@ -0,0 +1,132 @@
+import socket
+
+from twisted.internet.defer import Deferred, fail, succeed
+from twisted.internet.task import Clock
+
+from txaws.client.dns import DNSCache, NamesResolver, SystemResolver
+from txaws.testing.base import TXAWSTestCase
+
+
+class FakeResolver(object):
+
+    def __init__(self, addresses):
+        self.addresses = addresses
+        self.lookups = []
+        self.pending = None
+
+    def lookup(self, host):
+        self.lookups.append(host)
+        if self.pending is not None:
+            return self.pending
+        if self.addresses is None:
+            return fail(socket.gaierror(socket.EAI_AGAIN, "Try again"))
+        return succeed(self.addresses)
+
+
+class DNSCacheTestCase(TXAWSTestCase):
+
+    def setUp(self):
+        super(DNSCacheTestCase, self).setUp()
+        self.clock = Clock()
+        self.resolver = FakeResolver([("10.0.0.1", 60)])
+        self.cache = DNSCache(self.clock, self.resolver)
+
+    def resolve(self, host="example.com"):
+        results = []
+        self.cache.resolve(host).addBoth(results.append)
+        return results[0]
+
+    def test_cached(self):
+        self.assertEqual("10.0.0.1", self.resolve())
+        self.clock.advance(30)
+        self.assertEqual("10.0.0.1", self.resolve())
+        self.assertEqual(["example.com"], self.resolver.lookups)
+        stats = self.cache.get_stats()
+        self.assertEqual(1, stats["hits"])
+        self.assertEqual(1, stats["misses"])
+
+    def test_ip_address(self):
+        self.assertEqual("127.0.0.1", self.resolve("127.0.0.1"))
+        self.assertEqual([], self.resolver.lookups)
+
+    def test_rotation(self):
+        """
+        The addresses of a host are handed out in turn.
+        """
+        self.resolver.addresses = [("10.0.0.1", 60), ("10.0.0.2", 60)]
+        self.assertEqual(
+            ["10.0.0.1", "10.0.0.2", "10.0.0.1"],
+            [self.resolve() for i in range(3)])
+
+    def test_ttl(self):
+        """
+        Entries expire after the shortest time-to-live of their records,
+        within the bounds of the cache.
+        """
+        self.resolver.addresses = [("10.0.0.1", 20), ("10.0.0.2", 3600)]
+        self.resolve()
+        self.assertEqual(20, self.cache._entries["example.com"].expires)
+        self.resolver.addresses = [("10.0.0.1", 0)]
+        self.resolve("other.com")
+        self.assertEqual(5, self.cache._entries["other.com"].expires)
+
+    def test_background_refresh(self):
+        """
+        Once most of its time-to-live has passed, an entry is still used but
+        looked up again in the background.
+        """
+        self.resolve()
+        self.clock.advance(50)
+        self.resolver.addresses = [("10.0.0.2", 60)]
+        self.assertEqual("10.0.0.1", self.resolve())
+        self.assertEqual(2, len(self.resolver.lookups))
+        self.assertEqual(["10.0.0.2"], self.cache.get_addresses("example.com"))
+        self.assertEqual(1, self.cache.get_stats()["refreshes"])
+
+    def test_serve_stale(self):
+        """
+        While the resolver fails, the last addresses found keep being used,
+        for a while.
+        """
+        self.resolve()
+        self.resolver.addresses = None
+        self.clock.advance(120)
+        self.assertEqual("10.0.0.1", self.resolve())
+        self.assertEqual(1, self.cache.get_stats()["stale"])
+        self.clock.advance(3600)
+        self.assertTrue(
+            isinstance(self.resolve().value, socket.gaierror))
+        self.assertEqual(2, self.cache.get_stats()["failures"])
+
+    def test_concurrent_lookups(self):
+        self.resolver.pending = Deferred()
+        results = []
+        self.cache.resolve("example.com").addCallback(results.append)
+        self.cache.resolve("example.com").addCallback(results.append)
+        self.resolver.pending.callback([("10.0.0.1", 60)])
+        self.assertEqual(["10.0.0.1", "10.0.0.1"], results)
+        self.assertEqual(1, len(self.resolver.lookups))
+
+
+class ResolverTestCase(TXAWSTestCase):
+
+    def test_system_resolver(self):
+        d = SystemResolver(ttl=10).lookup("localhost")
+        return d.addCallback(
+            lambda addresses: self.assertIn(("127.0.0.1", 10), addresses))
+
+    def test_names_resolver(self):
+        from twisted.names import dns
+
+        class Resolver(object):
+
+            def lookupAddress(self, host):
+                answers = [
+                    dns.RRHeader(host, dns.CNAME, ttl=300,
+                                 payload=dns.Record_CNAME("alias")),
+                    dns.RRHeader("alias", dns.A, ttl=30,
+                                 payload=dns.Record_A("10.0.0.1", 30))]
+                return succeed((answers, [], []))
+
+        d = NamesResolver(Resolver()).lookup("example.com")
+        return d.addCallback(self.assertEqual, [("10.0.0.1", 30)])
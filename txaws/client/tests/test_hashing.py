@@ -0,0 +1,114 @@
+from StringIO import StringIO
+from hashlib import md5
+
+from txaws.client.hashing import (
+    HashingService, digest_file, get_hashing_service, get_multipart_etag)
+from txaws.client.transport import HTTPTransport
+from txaws.service import AWSServiceEndpoint
+from txaws.testing.base import TXAWSTestCase
+
+
+class DigestFileTestCase(TXAWSTestCase):
+
+    def test_digest_file(self):
+        """
+        Files are hashed from an offset, whether they have a descriptor or
+        not.
+        """
+        path = self.mktemp()
+        with open(path, "wb") as f:
+            f.write("skippedfoobar")
+        with open(path, "rb") as f:
+            self.assertEqual(
+                "3858f62230ac3c915f300c664312c63f",
+                digest_file(f, 7).hexdigest())
+            self.assertEqual(0, f.tell())
+        self.assertEqual(
+            "3858f62230ac3c915f300c664312c63f",
+            digest_file(StringIO("skippedfoobarbaz"), 7, 6,
+                        chunk_size=4).hexdigest())
+        self.assertEqual(
+            "c3ab8ff13720e8ad9047dd39466b3c8974e592c2fa383d4a3960714caef0c4f2",
+            digest_file(StringIO("foobar"), algorithm="sha256").hexdigest())
+
+    def test_multipart_etag(self):
+        digests = [md5("foo"), md5("bar")]
+        self.assertEqual(
+            '"%s-2"' % md5(digests[0].digest() +
+                           digests[1].digest()).hexdigest(),
+            get_multipart_etag(digests))
+
+
+class HashingServiceTestCase(TXAWSTestCase):
+
+    def setUp(self):
+        super(HashingServiceTestCase, self).setUp()
+        self.service = HashingService(threshold=4)
+
+    def test_hash_string(self):
+        """
+        Strings smaller than the threshold are hashed right away, the others
+        in a thread.
+        """
+        d = self.service.hash_string("foo")
+        self.assertEqual(1, self.service.inline)
+        d.addCallback(
+            lambda digest: self.assertEqual(md5("foo").hexdigest(),
+                                            digest.hexdigest()))
+        d.addCallback(
+            lambda ignored: self.service.hash_string("foobar", "sha1"))
+
+        def check(digest):
+            self.assertEqual("8843d7f92416211de9ebb963ff4ce28125932878",
+                             digest.hexdigest())
+            self.assertEqual(1, self.service.threaded)
+
+        return d.addCallback(check)
+
+    def test_hash_file(self):
+        """
+        Files with a descriptor are hashed in a thread without moving their
+        position, in-memory ones are read first.
+        """
+        path = self.mktemp()
+        with open(path, "wb") as f:
+            f.write("skippedfoobar")
+        f = open(path, "rb")
+        self.addCleanup(f.close)
+        d = self.service.hash_file(f, 7)
+
+        def check(digest):
+            self.assertEqual(md5("foobar").hexdigest(), digest.hexdigest())
+            self.assertEqual(1, self.service.threaded)
+            return self.service.hash_file(StringIO("skippedfoobar"), 7, 3)
+
+        d.addCallback(check)
+        return d.addCallback(
+            lambda digest: self.assertEqual(md5("foo").hexdigest(),
+                                            digest.hexdigest()))
+
+    def test_get_multipart_etag(self):
+        """
+        The I{ETag} of an object uploaded in parts is computed from the
+        digests of its parts.
+        """
+        d = self.service.get_multipart_etag(StringIO("xfoobarbaz"), 4, 1)
+        return d.addCallback(
+            self.assertEqual,
+            get_multipart_etag([md5("foob"), md5("arba"), md5("z")]))
+
+    def test_get_hashing_service(self):
+        """
+        The service of an endpoint is preferred to the one of its transport,
+        and the one shared by default is used when neither has one.
+        """
+        transport = HTTPTransport(hashing_service=self.service)
+        self.addCleanup(transport.close)
+        endpoint = AWSServiceEndpoint(transport=transport)
+        self.assertIdentical(self.service, get_hashing_service(endpoint))
+        endpoint.hashing_service = other = HashingService()
+        self.assertIdentical(other, get_hashing_service(endpoint))
+        default = get_hashing_service(None)
+        self.assertTrue(isinstance(default, HashingService))
+        self.assertIdentical(
+            default, get_hashing_service(AWSServiceEndpoint()))
@@ -0,0 +1,151 @@
+from twisted.internet.defer import fail
+from twisted.internet.task import Clock
+from twisted.web.error import Error as TwistedWebError
+from twisted.web.test.test_web import DummyRequest
+
+from txaws.client.base import BaseQuery, RequestTiming, error_wrapper
+from txaws.client.metrics import Histogram, MetricsRegistry, MetricsResource
+from txaws.client.retry import RetryPolicy
+from txaws.s3.exception import S3Error
+from txaws.service import AWSServiceEndpoint
+from txaws.testing import payload
+from txaws.testing.base import TXAWSTestCase
+
+
+class HistogramTestCase(TXAWSTestCase):
+
+    def test_observe(self):
+        histogram = Histogram([1, 2])
+        for value in [0.5, 1, 1.5, 3]:
+            histogram.observe(value)
+        self.assertEqual(
+            [(1, 2), (2, 3), (float("inf"), 4)],
+            histogram.get_cumulative_counts())
+        self.assertEqual(6, histogram.sum)
+        self.assertEqual(4, histogram.count)
+
+
+class MetricsRegistryTestCase(TXAWSTestCase):
+
+    def setUp(self):
+        super(MetricsRegistryTestCase, self).setUp()
+        self.clock = Clock()
+        self.registry = MetricsRegistry(buckets=[1])
+
+    def record(self, seconds=0.5, status="200", attempts=1, error=None,
+               error_code=None):
+        timing = RequestTiming(
+            "ec2", "DescribeInstances", "GET", "https://ec2.aws/?a=b",
+            self.clock)
+        for i in range(attempts):
+            timing.start_attempt(10)
+        timing.response_bytes = 100
+        timing.status = status
+        timing.error = error
+        timing.error_code = error_code
+        self.clock.advance(seconds)
+        timing.finish()
+        self.registry(timing)
+
+    def get_value(self, name, **labels):
+        for sample_name, sample_labels, value in self.registry.get_samples():
+            if sample_name == name and all(
+                    sample_labels[key] == value_
+                    for key, value_ in labels.iteritems()):
+                return value
+
+    def test_counters(self):
+        self.record()
+        self.record(attempts=3)
+        labels = {"service": "ec2", "action": "DescribeInstances",
+                  "endpoint": "ec2.aws:443", "status": "200"}
+        self.assertEqual(2, self.get_value("aws_requests_total", **labels))
+        self.assertEqual(2, self.get_value("aws_retries_total", **labels))
+        self.assertEqual(
+            40, self.get_value("aws_request_bytes_total", **labels))
+        self.assertEqual(
+            200, self.get_value("aws_response_bytes_total", **labels))
+
+    def test_errors(self):
+        self.record(status="400", error="EC2Error",
+                    error_code="InvalidInstanceID.NotFound")
+        self.record(status=None, error="ConnectionRefusedError")
+        self.assertEqual(
+            1, self.get_value("aws_errors_total", status="400",
+                              code="InvalidInstanceID.NotFound"))
+        self.assertEqual(
+            1, self.get_value("aws_errors_total", status="",
+                              code="ConnectionRefusedError"))
+
+    def test_latency_histogram(self):
+        self.record(0.5)
+        self.record(2)
+        self.assertEqual(
+            1, self.get_value("aws_request_seconds_bucket", le="1"))
+        self.assertEqual(
+            2, self.get_value("aws_request_seconds_bucket", le="+Inf"))
+        self.assertEqual(2.5, self.get_value("aws_request_seconds_sum"))
+        self.assertEqual(2, self.get_value("aws_request_seconds_count"))
+
+    def test_render(self):
+        self.record()
+        lines = self.registry.render().splitlines()
+        self.assertIn(
+            'aws_requests_total{action="DescribeInstances",'
+            'endpoint="ec2.aws:443",service="ec2",status="200"} 1', lines)
+        self.assertIn(
+            'aws_request_seconds_bucket{action="DescribeInstances",'
+            'endpoint="ec2.aws:443",le="+Inf",service="ec2",status="200"} 1',
+            lines)
+
+    def test_reset(self):
+        self.record()
+        self.registry.reset()
+        self.assertEqual([], self.registry.get_samples())
+
+    def test_resource(self):
+        self.record()
+        request = DummyRequest([""])
+        body = MetricsResource(self.registry).render_GET(request)
+        self.assertEqual(self.registry.render(), body)
+        self.assertEqual(
+            "text/plain; version=0.0.4",
+            request.outgoingHeaders["content-type"])
+
+    def test_query(self):
+        """
+        Queries against an endpoint observed by a registry are accounted
+        for, retries and the error codes parsed from the responses included.
+        """
+        results = [
+            fail(TwistedWebError("503", "Service Unavailable", "busy")),
+            fail(TwistedWebError(
+                "403", "Forbidden", payload.sample_s3_signature_mismatch))]
+
+        class Query(BaseQuery):
+
+            service = "s3"
+
+            def _send_page(self, url, *args, **kwds):
+                self.timing.start_attempt(len(kwds.get("postdata") or ""))
+                return results.pop(0)
+
+        endpoint = AWSServiceEndpoint(
+            retry_policy=RetryPolicy(self.clock, max_attempts=2),
+            timing_observers=[self.registry])
+        query = Query("PUT", "creds", endpoint, self.clock)
+        d = query.get_page(
+            "https://s3.aws/bucket", method="PUT", postdata="data")
+        d.addErrback(error_wrapper, S3Error)
+        self.clock.advance(1)
+        self.assertEqual(
+            1, self.get_value("aws_retries_total", service="s3"))
+        self.assertEqual(
+            8, self.get_value("aws_request_bytes_total", service="s3"))
+        self.assertEqual(
+            4 + len(payload.sample_s3_signature_mismatch),
+            self.get_value("aws_response_bytes_total", service="s3"))
+        self.assertEqual(
+            1, self.get_value("aws_errors_total", status="403",
+                              code="SignatureDoesNotMatch"))
+        return self.assertFailure(d, S3Error)
@@ -0,0 +1,166 @@
+from twisted.internet.defer import CancelledError, fail, succeed
+from twisted.internet.task import Clock
+from twisted.python.failure import Failure
+from twisted.web.error import Error as TwistedWebError
+
+from txaws.client.base import BaseQuery
+from txaws.client.ratelimit import RateLimiter, TokenBucket, get_rate_limiter
+from txaws.credentials import AWSCredentials
+from txaws.service import AWSServiceEndpoint
+from txaws.testing.base import TXAWSTestCase
+
+
+class TokenBucketTestCase(TXAWSTestCase):
+
+    def setUp(self):
+        super(TokenBucketTestCase, self).setUp()
+        self.clock = Clock()
+        self.granted = []
+
+    def acquire(self, bucket, name):
+        d = bucket.acquire()
+        d.addCallback(lambda ignored: self.granted.append(name))
+        return d
+
+    def test_burst(self):
+        """
+        Up to C{burst} tokens are granted straight away, the following ones
+        at C{rate} per second, in order.
+        """
+        bucket = TokenBucket(self.clock, rate=2, burst=2)
+        for name in "abcd":
+            self.acquire(bucket, name)
+        self.assertEqual(["a", "b"], self.granted)
+        self.clock.advance(0.5)
+        self.assertEqual(["a", "b", "c"], self.granted)
+        self.clock.advance(0.5)
+        self.assertEqual(["a", "b", "c", "d"], self.granted)
+        stats = bucket.get_stats()
+        self.assertEqual(4, stats["granted"])
+        self.assertEqual(2, stats["delayed"])
+        self.assertEqual(1.5, stats["wait_time"])
+        self.assertEqual(0, stats["waiting"])
+
+    def test_refill(self):
+        bucket = TokenBucket(self.clock, rate=10, burst=5)
+        for i in range(5):
+            bucket.acquire()
+        self.clock.advance(100)
+        self.assertEqual(5, bucket.get_stats()["tokens"])
+
+    def test_cancel(self):
+        bucket = TokenBucket(self.clock, rate=1)
+        self.acquire(bucket, "a")
+        d = self.acquire(bucket, "b")
+        d.cancel()
+        self.assertEqual([], self.clock.getDelayedCalls())
+        self.clock.advance(1)
+        self.assertEqual(["a"], self.granted)
+        return self.assertFailure(d, CancelledError)
+
+    def test_throttled(self):
+        """
+        Throttling slows the bucket down, and successes bring it back up to
+        its configured rate.
+        """
+        bucket = TokenBucket(self.clock, rate=10, decrease=0.5, recovery=0.1)
+        bucket.throttled()
+        self.assertEqual(5, bucket.rate)
+        bucket.throttled()
+        bucket.throttled()
+        bucket.throttled()
+        self.assertEqual(1, bucket.rate)
+        for i in range(20):
+            bucket.succeeded()
+        self.assertEqual(10, bucket.rate)
+        self.assertEqual(4, bucket.get_stats()["throttled"])
+
+
+class RateLimiterTestCase(TXAWSTestCase):
+
+    def setUp(self):
+        super(RateLimiterTestCase, self).setUp()
+        self.clock = Clock()
+
+    def test_get_rate(self):
+        limiter = RateLimiter(
+            self.clock, rates={"DescribeInstances": 5,
+                               ("key2", "DescribeInstances"): 1},
+            default_rate=20)
+        self.assertEqual(5, limiter.get_rate("key1", "DescribeInstances"))
+        self.assertEqual(1, limiter.get_rate("key2", "DescribeInstances"))
+        self.assertEqual(20, limiter.get_rate("key1", "RunInstances"))
+
+    def test_unlimited_action(self):
+        limiter = RateLimiter(self.clock, rates={"SendMessage": 1})
+        self.assertIdentical(None, limiter.get_bucket("key", "ListQueues"))
+        self.assertTrue(limiter.acquire("key", "ListQueues").called)
+        self.assertEqual({}, limiter.get_stats())
+
+    def test_buckets_per_credential(self):
+        limiter = RateLimiter(self.clock, rates={"SendMessage": 1})
+        self.assertTrue(limiter.acquire("key1", "SendMessage").called)
+        self.assertTrue(limiter.acquire("key2", "SendMessage").called)
+        self.assertFalse(limiter.acquire("key1", "SendMessage").called)
+        self.assertEqual(
+            [("key1", "SendMessage"), ("key2", "SendMessage")],
+            sorted(limiter.get_stats()))
+
+    def test_limit(self):
+        """
+        L{RateLimiter.limit} defers calls until a token is available, and
+        slows down when they are throttled.
+        """
+        limiter = RateLimiter(self.clock, rates={"GET": 1})
+        throttled = Failure(TwistedWebError(
+            "503", "Slow Down", "<Error><Code>SlowDown</Code></Error>"))
+        calls = []
+
+        def call():
+            calls.append(None)
+            return fail(throttled)
+
+        d1 = limiter.limit("key", "GET", call)
+        d2 = limiter.limit("key", "GET", lambda: succeed("result"))
+        self.assertEqual(1, len(calls))
+        self.assertFalse(d2.called)
+        self.assertEqual(0.75, limiter.get_bucket("key", "GET").rate)
+        self.clock.advance(1 / 0.75)
+        d2.addCallback(self.assertEqual, "result")
+        self.assertFailure(d1, TwistedWebError)
+        return d2
+
+
+class QueryRateLimitTestCase(TXAWSTestCase):
+
+    def test_get_rate_limiter(self):
+        limiter = RateLimiter()
+        self.assertIdentical(
+            limiter, get_rate_limiter(AWSServiceEndpoint(rate_limiter=limiter)))
+        self.assertIdentical(None, get_rate_limiter(AWSServiceEndpoint()))
+
+    def test_query_waits_for_token(self):
+        """
+        L{BaseQuery.get_page} only sends the request once the rate limiter of
+        the endpoint allows it.
+        """
+        clock = Clock()
+        limiter = RateLimiter(clock, rates={"DescribeInstances": 1})
+        endpoint = AWSServiceEndpoint(
+            "http://endpoint/", rate_limiter=limiter)
+        sent = []
+
+        class Query(BaseQuery):
+
+            def _get_page(self, url, *args, **kwds):
+                sent.append(url)
+                return succeed("body")
+
+        creds = AWSCredentials("key", "secret")
+        Query("DescribeInstances", creds, endpoint).get_page("http://a/")
+        Query("DescribeInstances", creds, endpoint).get_page("http://b/")
+        self.assertEqual(["http://a/"], sent)
+        clock.advance(1)
+        self.assertEqual(["http://a/", "http://b/"], sent)
+        self.assertEqual(
+            1, limiter.get_stats()[("key", "DescribeInstances")]["delayed"])
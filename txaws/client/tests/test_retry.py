@@ -0,0 +1,249 @@
+from twisted.internet.defer import (
+    CancelledError, Deferred, TimeoutError, fail, succeed)
+from twisted.internet.error import ConnectionLost, ConnectionRefusedError
+from twisted.internet.task import Clock
+from twisted.python.failure import Failure
+from twisted.web.error import Error as TwistedWebError
+
+from txaws.client.base import BaseClient
+from txaws.client.retry import (
+    RetryBudget, RetryPolicy, get_error_code, get_retry_policy)
+from txaws.client.streaming import StreamInterrupted
+from txaws.credentials import AWSCredentials
+from txaws.service import AWSServiceEndpoint
+from txaws.sqs.errors import ResponseError
+from txaws.testing.base import TXAWSTestCase
+
+
+THROTTLED = ("<Response><Errors><Error><Code>RequestLimitExceeded</Code>"
+             "<Message>Request limit exceeded.</Message></Error></Errors>"
+             "</Response>")
+
+
+def web_error(status, body=""):
+    return Failure(TwistedWebError(str(status), "", body))
+
+
+class RetryBudgetTestCase(TXAWSTestCase):
+
+    def test_withdraw(self):
+        budget = RetryBudget(capacity=12, retry_cost=5, timeout_cost=10)
+        self.assertEqual(5, budget.withdraw())
+        self.assertEqual(0, budget.withdraw(timeout=True))
+        self.assertEqual(5, budget.withdraw())
+        self.assertEqual(0, budget.withdraw())
+        self.assertEqual(2, budget.available)
+
+    def test_deposit(self):
+        budget = RetryBudget(capacity=10, success_refund=1)
+        budget.withdraw()
+        budget.deposit()
+        self.assertEqual(6, budget.available)
+        budget.deposit(20)
+        self.assertEqual(10, budget.available)
+
+
+class RetryPolicyTestCase(TXAWSTestCase):
+
+    def setUp(self):
+        super(RetryPolicyTestCase, self).setUp()
+        self.clock = Clock()
+        self.policy = RetryPolicy(self.clock)
+
+    def test_get_error_code(self):
+        self.assertEqual("RequestLimitExceeded", get_error_code(THROTTLED))
+        self.assertEqual(None, get_error_code("<Error/>"))
+        self.assertEqual(None, get_error_code(None))
+
+    def test_throttling_is_retried(self):
+        self.assertEqual("throttled", self.policy.get_retry_reason(
+            web_error(400, THROTTLED), "GET", "RunInstances"))
+        self.assertEqual("throttled", self.policy.get_retry_reason(
+            web_error(503), "PUT", "PUT"))
+
+    def test_server_errors_are_retried(self):
+        self.assertEqual("transient", self.policy.get_retry_reason(
+            web_error(500), "GET", "RunInstances"))
+        self.assertEqual("transient", self.policy.get_retry_reason(
+            web_error(400, "<Error><Code>RequestTimeout</Code></Error>"),
+            "PUT", "PUT"))
+
+    def test_client_errors_are_not_retried(self):
+        self.assertEqual(None, self.policy.get_retry_reason(
+            web_error(400, "<Error><Code>InvalidAMIID.NotFound</Code></Error>"),
+            "GET", "DescribeImages"))
+        self.assertEqual(None, self.policy.get_retry_reason(
+            web_error(404), "GET", "GET"))
+
+    def test_sqs_errors(self):
+        """
+        SQS L{ResponseError}s are classified like other error responses.
+        """
+        error = ResponseError(
+            "<ErrorResponse><Error><Type>Sender</Type>"
+            "<Code>Throttling</Code><Message>Slow down</Message></Error>"
+            "</ErrorResponse>", 400)
+        self.assertEqual("throttled", self.policy.get_retry_reason(
+            Failure(error), "GET", "SendMessage"))
+
+    def test_connection_errors(self):
+        """
+        Failures to connect are retried for any request, lost connections and
+        timeouts only for idempotent ones.
+        """
+        policy = self.policy
+        refused = Failure(ConnectionRefusedError())
+        lost = Failure(ConnectionLost())
+        timeout = Failure(TimeoutError())
+        self.assertEqual(
+            "connection", policy.get_retry_reason(refused, "POST", "POST"))
+        self.assertEqual(
+            "connection", policy.get_retry_reason(lost, "GET", "GET"))
+        self.assertEqual(None, policy.get_retry_reason(lost, "POST", "POST"))
+        self.assertEqual("connection", policy.get_retry_reason(
+            lost, "GET", "DescribeInstances"))
+        self.assertEqual(None, policy.get_retry_reason(
+            lost, "GET", "RunInstances"))
+        self.assertEqual("timeout", policy.get_retry_reason(
+            timeout, "GET", "GetQueueUrl"))
+        self.assertEqual(None, policy.get_retry_reason(
+            timeout, "GET", "SendMessage"))
+        self.assertEqual(None, policy.get_retry_reason(
+            Failure(ValueError()), "GET", "GET"))
+
+    def test_stream_interrupted(self):
+        """
+        An interrupted response body is retried like what interrupted it.
+        """
+        timeout = Failure(StreamInterrupted(10, Failure(TimeoutError())))
+        self.assertEqual("timeout", self.policy.get_retry_reason(
+            timeout, "GET", "GET"))
+        self.assertEqual(None, self.policy.get_retry_reason(
+            Failure(StreamInterrupted(10, Failure(ValueError()))), "GET",
+            "GET"))
+
+    def test_idempotent_actions(self):
+        policy = RetryPolicy(self.clock, idempotent_actions=["DeleteMessage"])
+        self.assertTrue(policy.is_idempotent("GET", "DeleteMessage"))
+        self.assertFalse(policy.is_idempotent("GET", "SendMessage"))
+
+    def test_get_delay(self):
+        """
+        Delays are drawn between C{base_delay} and three times the previous
+        delay, within C{max_delay}.
+        """
+        policy = RetryPolicy(self.clock, base_delay=1, max_delay=10)
+        delay = 1
+        for i in range(100):
+            new_delay = policy.get_delay(delay)
+            self.assertTrue(1 <= new_delay <= min(10, delay * 3))
+            delay = new_delay
+
+    def make_call(self, *results):
+        """
+        Return a call returning each of C{results} in turn, failures as failed
+        C{Deferred}s.
+        """
+        results = list(results)
+        self.calls = 0
+
+        def call():
+            self.calls += 1
+            result = results.pop(0)
+            if isinstance(result, Failure):
+                return fail(result)
+            return succeed(result)
+
+        return call
+
+    def test_run_retries_until_success(self):
+        retries = []
+        self.policy.observer = lambda *args: retries.append(args)
+        d = self.policy.run(
+            self.make_call(web_error(503), web_error(500), "body"),
+            "GET", "DescribeInstances")
+        self.assertEqual(1, self.calls)
+        self.clock.advance(self.policy.max_delay)
+        self.clock.advance(self.policy.max_delay)
+        self.assertEqual(3, self.calls)
+        self.assertEqual([1, 2], [args[1] for args in retries])
+        self.assertEqual(["throttled", "transient"],
+                         [args[3] for args in retries])
+        stats = self.policy.get_stats()
+        self.assertEqual({"throttled": 1, "transient": 1}, stats["retries"])
+        self.assertEqual(2, stats["total"])
+        self.assertEqual(500, stats["budget"])
+        return d.addCallback(self.assertEqual, "body")
+
+    def test_run_not_retryable(self):
+        d = self.policy.run(self.make_call(web_error(403), "body"))
+        self.assertEqual(1, self.calls)
+        return self.assertFailure(d, TwistedWebError)
+
+    def test_run_max_attempts(self):
+        policy = RetryPolicy(self.clock, max_attempts=2)
+        d = policy.run(self.make_call(web_error(500), web_error(502)))
+        self.clock.advance(policy.max_delay)
+        self.assertEqual(2, self.calls)
+        self.assertEqual(1, policy.get_stats()["exhausted"])
+        return self.assertFailure(d, TwistedWebError)
+
+    def test_run_budget_exhausted(self):
+        """
+        Once the budget is spent, failures are not retried anymore.
+        """
+        policy = RetryPolicy(self.clock, budget=RetryBudget(capacity=5))
+        d = policy.run(self.make_call(web_error(500), web_error(500)))
+        self.clock.advance(policy.max_delay)
+        self.assertEqual(2, self.calls)
+        self.assertEqual(0, policy.budget.available)
+        self.assertEqual(1, policy.get_stats()["budget_exhausted"])
+        return self.assertFailure(d, TwistedWebError)
+
+    def test_cancel_while_waiting(self):
+        d = self.policy.run(self.make_call(web_error(500), "body"))
+        d.cancel()
+        self.assertEqual([], self.clock.getDelayedCalls())
+        return self.assertFailure(d, CancelledError)
+
+    def test_cancel_attempt(self):
+        attempt = Deferred()
+        d = self.policy.run(lambda: attempt)
+        d.cancel()
+        self.assertTrue(attempt.called)
+        self.assertEqual([], self.clock.getDelayedCalls())
+        return self.assertFailure(d, CancelledError)
+
+
+class GetRetryPolicyTestCase(TXAWSTestCase):
+
+    def test_endpoint_policy(self):
+        policy = RetryPolicy()
+        endpoint = AWSServiceEndpoint(retry_policy=policy)
+        self.assertIdentical(policy, get_retry_policy(endpoint))
+
+    def test_transport_policy(self):
+
+        class Transport(object):
+            retry_policy = RetryPolicy()
+
+        endpoint = AWSServiceEndpoint(transport=Transport())
+        self.assertIdentical(
+            Transport.retry_policy, get_retry_policy(endpoint))
+
+    def test_no_policy(self):
+        self.assertIdentical(None, get_retry_policy(AWSServiceEndpoint()))
+        self.assertIdentical(None, get_retry_policy("http://endpoint"))
+
+    def test_client_policy(self):
+        """
+        A client given a retry policy uses it without changing the endpoint
+        it shares with other clients.
+        """
+        policy = RetryPolicy()
+        endpoint = AWSServiceEndpoint("http://endpoint/")
+        client = BaseClient(AWSCredentials("foo", "bar"), endpoint,
+                            retry_policy=policy)
+        self.assertIdentical(policy, get_retry_policy(client.endpoint))
+        self.assertEqual("endpoint", client.endpoint.get_host())
+        self.assertIdentical(None, endpoint.retry_policy)
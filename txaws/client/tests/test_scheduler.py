@@ -0,0 +1,199 @@
+from twisted.internet.defer import CancelledError, Deferred, fail, succeed
+from twisted.internet.task import Clock
+from twisted.web.error import Error as TwistedWebError
+
+from txaws.client.base import BaseQuery
+from txaws.client.retry import RetryPolicy
+from txaws.client.scheduler import (
+    BULK, INTERACTIVE, NORMAL, RequestScheduler, get_endpoint_key)
+from txaws.service import AWSServiceEndpoint
+from txaws.testing.base import TXAWSTestCase
+
+
+class RequestSchedulerTestCase(TXAWSTestCase):
+
+    def setUp(self):
+        super(RequestSchedulerTestCase, self).setUp()
+        self.clock = Clock()
+        self.started = []
+
+    def make_call(self, name):
+        """
+        Return a call recording C{name} when started, and the C{Deferred}
+        completing it.
+        """
+        d = Deferred()
+
+        def call():
+            self.started.append(name)
+            return d
+
+        return call, d
+
+    def test_get_endpoint_key(self):
+        self.assertEqual("https://ec2.amazonaws.com:443",
+                         get_endpoint_key("https://ec2.amazonaws.com/?a=b"))
+        self.assertEqual("http://localhost:8080",
+                         get_endpoint_key("http://localhost:8080/path"))
+
+    def test_no_limits(self):
+        scheduler = RequestScheduler(self.clock)
+        results = []
+        for name in ("a", "b", "c"):
+            call, d = self.make_call(name)
+            scheduler.schedule(call, "ep", "Action").addCallback(
+                results.append)
+            d.callback(name)
+        self.assertEqual(["a", "b", "c"], self.started)
+        self.assertEqual(["a", "b", "c"], results)
+        self.assertEqual(0, scheduler.get_in_flight())
+
+    def test_max_per_endpoint(self):
+        """
+        Requests beyond C{max_per_endpoint} wait for a slot to free up, while
+        other endpoints are not affected.
+        """
+        scheduler = RequestScheduler(self.clock, max_per_endpoint=1)
+        call1, d1 = self.make_call("a1")
+        call2, d2 = self.make_call("a2")
+        call3, d3 = self.make_call("b1")
+        scheduler.schedule(call1, "a")
+        scheduler.schedule(call2, "a")
+        scheduler.schedule(call3, "b")
+        self.assertEqual(["a1", "b1"], self.started)
+        self.assertEqual(1, scheduler.get_queued("a"))
+        d1.callback(None)
+        self.assertEqual(["a1", "b1", "a2"], self.started)
+        self.assertEqual(0, scheduler.get_queued())
+
+    def test_failure_releases_slot(self):
+        scheduler = RequestScheduler(self.clock, max_per_endpoint=1)
+        call1, d1 = self.make_call("1")
+        call2, d2 = self.make_call("2")
+        failed = scheduler.schedule(call1, "ep")
+        scheduler.schedule(call2, "ep")
+        d1.errback(ValueError())
+        self.assertEqual(["1", "2"], self.started)
+        return self.assertFailure(failed, ValueError)
+
+    def test_max_per_action(self):
+        """
+        An action at its limit doesn't hold up the other actions queued for
+        the same endpoint.
+        """
+        scheduler = RequestScheduler(
+            self.clock, max_per_endpoint=3, max_per_action={"PUT": 1})
+        for name, action in [("put1", "PUT"), ("put2", "PUT"),
+                             ("get1", "GET"), ("get2", "GET")]:
+            scheduler.schedule(self.make_call(name)[0], "ep", action)
+        self.assertEqual(["put1", "get1", "get2"], self.started)
+        self.assertEqual(1, scheduler.get_queued())
+
+    def test_priority_lanes(self):
+        """
+        Queued interactive requests start before normal ones, which start
+        before bulk ones, whatever the order they were scheduled in.
+        """
+        scheduler = RequestScheduler(
+            self.clock, max_per_endpoint=1,
+            action_priorities={"DescribeInstances": INTERACTIVE})
+        first, first_done = self.make_call("first")
+        scheduler.schedule(first, "ep")
+        scheduler.schedule(self.make_call("bulk")[0], "ep", priority=BULK)
+        scheduler.schedule(self.make_call("normal")[0], "ep", "RunInstances")
+        scheduler.schedule(
+            self.make_call("interactive")[0], "ep", "DescribeInstances")
+        first_done.callback(None)
+        self.assertEqual(["first", "interactive"], self.started)
+
+    def test_prioritized(self):
+        scheduler = RequestScheduler(self.clock)
+        self.assertEqual(NORMAL, scheduler.get_priority("Action"))
+        with scheduler.prioritized(BULK):
+            self.assertEqual(BULK, scheduler.get_priority("Action"))
+        self.assertEqual(NORMAL, scheduler.get_priority("Action"))
+
+    def test_synchronous_calls(self):
+        """
+        Queued calls completing right away start the next ones, each of them
+        once.
+        """
+        scheduler = RequestScheduler(self.clock, max_per_endpoint=1)
+        call, d = self.make_call("first")
+        scheduler.schedule(call, "ep")
+        results = []
+        for name in ("a", "b", "c"):
+            scheduler.schedule(
+                lambda name=name: succeed(name), "ep").addCallback(
+                    results.append)
+        d.callback(None)
+        self.assertEqual(["a", "b", "c"], results)
+        self.assertEqual(0, scheduler.get_queued())
+        self.assertEqual(0, scheduler.get_in_flight())
+
+    def test_cancel_queued(self):
+        scheduler = RequestScheduler(self.clock, max_per_endpoint=1)
+        call1, d1 = self.make_call("1")
+        scheduler.schedule(call1, "ep")
+        queued = scheduler.schedule(self.make_call("2")[0], "ep")
+        queued.cancel()
+        self.assertEqual(0, scheduler.get_queued())
+        d1.callback(None)
+        self.assertEqual(["1"], self.started)
+        return self.assertFailure(queued, CancelledError)
+
+    def test_stats(self):
+        scheduler = RequestScheduler(self.clock, max_per_endpoint=1)
+        call1, d1 = self.make_call("1")
+        scheduler.schedule(call1, "ep")
+        scheduler.schedule(self.make_call("2")[0], "ep", priority=BULK)
+        self.clock.advance(2.5)
+        stats = scheduler.get_stats()
+        self.assertEqual(1, stats["in_flight"])
+        self.assertEqual(1, stats["queued"])
+        self.assertEqual({"ep": {"in_flight": 1, "queued": 1}},
+                         stats["endpoints"])
+        d1.callback(None)
+        stats = scheduler.get_stats()
+        self.assertEqual(0, stats["queued"])
+        self.assertEqual(1, stats["max_queued"])
+        self.assertEqual({"count": 1, "total": 0.0, "max": 0.0},
+                         stats["wait_time"]["normal"])
+        self.assertEqual({"count": 1, "total": 2.5, "max": 2.5},
+                         stats["wait_time"]["bulk"])
+        self.assertEqual({"count": 0, "total": 0.0, "max": 0.0},
+                         stats["wait_time"]["interactive"])
+
+
+class QueryPriorityTestCase(TXAWSTestCase):
+
+    def test_retry_keeps_priority(self):
+        """
+        Queries sent again by the retry policy keep the lane they were
+        submitted in, after the L{RequestScheduler.prioritized} block.
+        """
+        clock = Clock()
+        priorities = []
+        responses = [fail(TwistedWebError("500", "", "")), succeed("body")]
+
+        class Page(object):
+
+            def __init__(self, deferred):
+                self.deferred = deferred
+
+        class Transport(object):
+            scheduler = RequestScheduler(clock)
+            retry_policy = RetryPolicy(clock)
+
+            def get_page(self, url, priority=None, **kwds):
+                priorities.append(priority)
+                return Page(responses.pop(0))
+
+        transport = Transport()
+        query = BaseQuery("Action", None, AWSServiceEndpoint(
+            "http://endpoint/", transport=transport), reactor=clock)
+        with transport.scheduler.prioritized(BULK):
+            d = query.get_page("http://endpoint/")
+        clock.advance(transport.retry_policy.max_delay)
+        self.assertEqual([BULK, BULK], priorities)
+        return d.addCallback(self.assertEqual, "body")
@@ -0,0 +1,312 @@
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from twisted.internet import reactor
+from twisted.internet.defer import (
+    CancelledError, Deferred, fail, gatherResults, succeed)
+from twisted.internet.protocol import ProcessProtocol
+from twisted.internet.task import Clock, deferLater
+from twisted.python.failure import Failure
+from twisted.web import server
+from twisted.web.error import Error as TwistedWebError
+from twisted.web.resource import Resource
+
+import txaws
+from txaws.client.ratelimit import RateLimiter
+from txaws.client.sharedlimit import SharedRateLimiter, listen, parse_options
+from txaws.testing.base import TXAWSTestCase
+
+
+class SharedRateLimiterTestCase(TXAWSTestCase):
+
+    def setUp(self):
+        super(SharedRateLimiterTestCase, self).setUp()
+        # Unix socket paths are limited in length, so don't use mktemp().
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, "limits")
+        self.clock = Clock()
+
+    def listen(self, rates=None, max_in_flight=None):
+        limiter = RateLimiter(self.clock, rates)
+        port = listen(reactor, self.path, limiter, max_in_flight)
+        self.addCleanup(port.stopListening)
+        return limiter
+
+    def make_limiter(self, **kwargs):
+        limiter = SharedRateLimiter(self.path, **kwargs)
+        self.addCleanup(limiter.close)
+        return limiter
+
+    def wait(self):
+        """Give the server a chance to process what was sent to it."""
+        return deferLater(reactor, 0.05, lambda: None)
+
+    def test_rate_shared(self):
+        """
+        Limiters connected to the same server share its token buckets.
+        """
+        self.listen({"SendMessage": 1})
+        granted = []
+        first = self.make_limiter().acquire("key", "SendMessage")
+        second = self.make_limiter().acquire("key", "SendMessage")
+        second.addCallback(granted.append)
+
+        def check_first(result):
+            self.assertTrue(result)
+            return self.wait()
+
+        def check_second(ignored):
+            self.assertEqual([], granted)
+            self.clock.advance(1)
+            return second.addCallback(lambda ignored: granted)
+
+        first.addCallback(check_first)
+        first.addCallback(check_second)
+        return first.addCallback(self.assertEqual, [True])
+
+    def test_max_in_flight(self):
+        """
+        A request only starts once the requests of the other processes leave
+        it a slot.
+        """
+        self.listen(max_in_flight=1)
+        pending = Deferred()
+        calls = []
+
+        def call(name, result):
+            calls.append(name)
+            return result
+
+        first = self.make_limiter().limit(
+            "key", "GET", lambda: call("first", pending))
+        second = self.make_limiter().limit(
+            "key", "GET", lambda: call("second", succeed("done")))
+
+        def check_waiting(ignored):
+            self.assertEqual(["first"], calls)
+            pending.callback("first done")
+            return gatherResults([first, second])
+
+        d = self.wait().addCallback(check_waiting)
+        return d.addCallback(self.assertEqual, ["first done", "done"])
+
+    def test_disconnect_releases_slots(self):
+        self.listen(max_in_flight=1)
+        first = self.make_limiter()
+        second = self.make_limiter()
+
+        def disconnect(ignored):
+            first.close()
+            return second.acquire("key", "GET")
+
+        return first.acquire("key", "GET").addCallback(disconnect)
+
+    def test_cancel_pending(self):
+        """
+        Cancelling a request waiting for a slot means it is never made, and
+        the slot granted later is given back.
+        """
+        self.listen(max_in_flight=1)
+        first = self.make_limiter()
+        second = self.make_limiter()
+        calls = []
+        pending = []
+
+        def request(ignored):
+            pending.append(second.limit(
+                "key", "GET", lambda: calls.append("second")))
+            return self.wait()
+
+        def cancel(ignored):
+            pending[0].cancel()
+            return self.assertFailure(pending[0], CancelledError)
+
+        def release(ignored):
+            first.release("key", "GET")
+            return self.wait()
+
+        def check_stats(stats):
+            self.assertEqual([], calls)
+            self.assertEqual({"key": 0}, stats["in_flight"])
+
+        d = first.acquire("key", "GET")
+        d.addCallback(request)
+        d.addCallback(cancel)
+        d.addCallback(release)
+        d.addCallback(lambda ignored: second.get_stats())
+        return d.addCallback(check_stats)
+
+    def test_throttling_reported(self):
+        """
+        Throttled requests slow down the bucket on the server.
+        """
+        server_limiter = self.listen({"GET": 10})
+        limiter = self.make_limiter()
+        throttled = Failure(TwistedWebError(
+            "503", "Slow Down", "<Error><Code>SlowDown</Code></Error>"))
+        d = limiter.limit("key", "GET", lambda: fail(throttled))
+        d = self.assertFailure(d, TwistedWebError)
+        d.addCallback(lambda ignored: self.wait())
+
+        def check_rate(ignored):
+            bucket = server_limiter.get_bucket("key", "GET")
+            self.assertEqual(7.5, bucket.rate)
+
+        return d.addCallback(check_rate)
+
+    def test_get_stats(self):
+        self.listen({"SendMessage": 5}, max_in_flight=3)
+        limiter = self.make_limiter()
+
+        def check_stats(stats):
+            bucket = stats["buckets"][("key", "SendMessage")]
+            self.assertEqual(5, bucket["rate"])
+            self.assertEqual(1, bucket["granted"])
+            self.assertEqual({"key": 1}, stats["in_flight"])
+
+        d = limiter.acquire("key", "SendMessage")
+        d.addCallback(lambda ignored: limiter.get_stats())
+        return d.addCallback(check_stats)
+
+    def test_fallback(self):
+        """
+        Without a server, requests go through the fallback limiter.
+        """
+        fallback = RateLimiter(self.clock, {"GET": 1})
+        limiter = self.make_limiter(fallback=fallback)
+
+        def check_fallback(result):
+            self.assertEqual("result", result)
+            self.assertEqual(
+                1, fallback.get_stats()[("key", "GET")]["granted"])
+
+        d = limiter.limit("key", "GET", lambda: succeed("result"))
+        return d.addCallback(check_fallback)
+
+    def test_no_fallback(self):
+        d = self.make_limiter().acquire("key", "GET")
+        return d.addCallback(self.assertFalse)
+
+    def test_parse_options(self):
+        path, rates, options = parse_options(
+            ["/tmp/socket", "--rate", "DescribeInstances=10",
+             "--rate", "SendMessage=2.5", "--max-in-flight", "4"])
+        self.assertEqual("/tmp/socket", path)
+        self.assertEqual({"DescribeInstances": 10, "SendMessage": 2.5}, rates)
+        self.assertEqual(4, options.max_in_flight)
+        self.assertIdentical(None, options.default_rate)
+
+
+WORKER = """
+import sys
+
+from twisted.internet import defer, reactor
+
+from txaws.client.base import BaseQuery
+from txaws.client.sharedlimit import SharedRateLimiter
+from txaws.credentials import AWSCredentials
+from txaws.service import AWSServiceEndpoint
+
+path, url, count = sys.argv[1], sys.argv[2], int(sys.argv[3])
+endpoint = AWSServiceEndpoint(url, rate_limiter=SharedRateLimiter(path))
+creds = AWSCredentials("key", "secret")
+
+
+def run():
+    d = defer.gatherResults([
+        BaseQuery("DescribeInstances", creds, endpoint).get_page(url)
+        for i in range(count)])
+    d.addErrback(lambda failure: failure.printTraceback(sys.stderr))
+    d.addBoth(lambda ignored: reactor.stop())
+
+reactor.callWhenRunning(run)
+reactor.run()
+"""
+
+
+class StandInResource(Resource):
+    """Record when requests arrive, and how many are in flight at once."""
+
+    isLeaf = True
+
+    def __init__(self):
+        Resource.__init__(self)
+        self.times = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def render(self, request):
+        self.times.append(time.time())
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+        def finish():
+            self.in_flight -= 1
+            request.write("<DescribeInstancesResponse/>")
+            request.finish()
+
+        reactor.callLater(0.01, finish)
+        return server.NOT_DONE_YET
+
+
+class WorkerProtocol(ProcessProtocol):
+
+    def __init__(self):
+        self.ended = Deferred()
+        self.errors = []
+
+    def errReceived(self, data):
+        self.errors.append(data)
+
+    def processEnded(self, reason):
+        self.ended.callback("".join(self.errors))
+
+
+class MultiProcessTestCase(TXAWSTestCase):
+
+    def setUp(self):
+        super(MultiProcessTestCase, self).setUp()
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, "limits")
+        self.resource = StandInResource()
+        site = server.Site(self.resource, timeout=None)
+        port = reactor.listenTCP(0, site, interface="127.0.0.1")
+        self.addCleanup(port.stopListening)
+        self.url = "http://127.0.0.1:%d/" % port.getHost().port
+
+    def spawn_worker(self, count):
+        protocol = WorkerProtocol()
+        env = dict(os.environ)
+        env["PYTHONPATH"] = os.path.dirname(os.path.dirname(txaws.__file__))
+        reactor.spawnProcess(
+            protocol, sys.executable,
+            [sys.executable, "-W", "ignore", "-c", WORKER, self.path,
+             self.url, str(count)],
+            env=env)
+        return protocol.ended
+
+    def test_workers_share_limits(self):
+        """
+        Requests of several processes against a stand-in endpoint respect the
+        rate and concurrency limits of their shared server.
+        """
+        rate = 20.0
+        limiter = RateLimiter(reactor, {"DescribeInstances": rate}, burst=1)
+        port = listen(reactor, self.path, limiter, max_in_flight=1)
+        self.addCleanup(port.stopListening)
+
+        def check_requests(errors):
+            self.assertEqual(["", "", ""], errors)
+            times = self.resource.times
+            self.assertEqual(12, len(times))
+            # Leave some slack for the first token, granted right away.
+            self.assertTrue(times[-1] - times[0] >= 10 / rate)
+            self.assertEqual(1, self.resource.max_in_flight)
+
+        d = gatherResults([self.spawn_worker(4) for i in range(3)])
+        return d.addCallback(check_requests)
@@ -1,12 +1,17 @@
 import os
 import tempfile
 
-from OpenSSL.crypto import dump_certificate, load_certificate, FILETYPE_PEM
+from OpenSSL.crypto import (
+    PKey, X509, TYPE_RSA, dump_certificate, load_certificate, FILETYPE_PEM)
+from OpenSSL import SSL
 from OpenSSL.SSL import Error as SSLError
 from OpenSSL.version import __version__ as pyopenssl_version
 
 from twisted.internet import reactor
-from twisted.internet.ssl import DefaultOpenSSLContextFactory
+from twisted.internet.defer import Deferred
+from twisted.internet.protocol import ClientFactory, Protocol, ServerFactory
+from twisted.internet.ssl import (
+    CertificateOptions, DefaultOpenSSLContextFactory)
 from twisted.protocols.policies import WrappingFactory
 from twisted.python import log
 from twisted.python.filepath import FilePath
@@ -197,3 +202,136 @@ class CertsFilesTestCase(TXAWSTestCase):
             self.no_certs_dir, self.one_cert_dir)
         certs = ssl.get_ca_certs()
         self.assertEqual(len(certs), 1)
+
+
+class Ping(Protocol):
+    """Send one byte and disconnect once the server echoes it back."""
+
+    def connectionMade(self):
+        self.transport.write("x")
+
+    received = False
+
+    def dataReceived(self, data):
+        self.received = True
+        self.transport.loseConnection()
+
+    def connectionLost(self, reason):
+        if self.received:
+            self.factory.done.callback(None)
+        else:
+            self.factory.done.errback(reason)
+
+
+class PingFactory(ClientFactory):
+
+    protocol = Ping
+
+    def __init__(self):
+        self.done = Deferred()
+
+    def clientConnectionFailed(self, connector, reason):
+        self.done.errback(reason)
+
+
+class Echo(Protocol):
+
+    def dataReceived(self, data):
+        self.transport.write(data)
+
+
+class ContextFactoryCacheTestCase(TXAWSTestCase):
+
+    def setUp(self):
+        super(ContextFactoryCacheTestCase, self).setUp()
+        self.addCleanup(ssl.clear_context_factories)
+        self.certs = [makeCertificate(O="Test Certificate", CN="cn")[1]]
+        self.patch(ssl, "_ca_certs", self.certs)
+
+    def test_get_context_factory_is_cached(self):
+        """
+        L{ssl.get_context_factory} returns the same factory, and so the same
+        context, for a given host and verification mode.
+        """
+        factory = ssl.get_context_factory("example.com", True)
+        self.assertTrue(isinstance(factory, ssl.VerifyingContextFactory))
+        self.assertEqual("example.com", factory.host)
+        self.assertIdentical(
+            factory, ssl.get_context_factory("example.com", True))
+        self.assertIdentical(factory.getContext(), factory.getContext())
+        self.assertNotIdentical(
+            factory, ssl.get_context_factory("example.org", True))
+
+    def test_get_context_factory_without_verification(self):
+        factory = ssl.get_context_factory("example.com", False)
+        self.assertTrue(
+            isinstance(factory, ssl.ResumingClientContextFactory))
+        self.assertIdentical(
+            factory, ssl.get_context_factory("example.com", False))
+        self.assertIdentical(factory.getContext(), factory.getContext())
+
+    def test_get_context_factory_bounded(self):
+        """
+        Only the factories of the hosts connected to most recently are kept.
+        """
+        self.patch(ssl, "_CONTEXT_FACTORIES_SIZE", 2)
+        first = ssl.get_context_factory("a.example.com")
+        second = ssl.get_context_factory("b.example.com")
+        self.assertIdentical(first, ssl.get_context_factory("a.example.com"))
+        ssl.get_context_factory("c.example.com")
+        self.assertEqual(2, len(ssl._context_factories))
+        self.assertIdentical(first, ssl.get_context_factory("a.example.com"))
+        self.assertNotIdentical(
+            second, ssl.get_context_factory("b.example.com"))
+
+    def test_get_context_factory_ca_certs_changed(self):
+        """
+        A verifying factory is rebuilt when the global CA certificates change.
+        """
+        factory = ssl.get_context_factory("example.com", True)
+        self.patch(ssl, "_ca_certs", list(self.certs))
+        self.assertNotIdentical(
+            factory, ssl.get_context_factory("example.com", True))
+
+    def test_session_resumption(self):
+        """
+        Connections made with a L{ssl.ResumingClientContextFactory} resume the
+        TLS session negotiated by the previous one.
+        """
+        key = PKey()
+        key.generate_key(TYPE_RSA, 2048)
+        certificate = X509()
+        certificate.get_subject().CN = "localhost"
+        certificate.set_issuer(certificate.get_subject())
+        certificate.set_serial_number(1)
+        certificate.gmtime_adj_notBefore(0)
+        certificate.gmtime_adj_notAfter(60 * 60)
+        certificate.set_pubkey(key)
+        certificate.sign(key, "sha256")
+        server_factory = ServerFactory()
+        server_factory.protocol = Echo
+        port = reactor.listenSSL(
+            0, server_factory,
+            CertificateOptions(privateKey=key, certificate=certificate),
+            interface="127.0.0.1")
+        self.addCleanup(port.stopListening)
+        context_factory = ssl.ResumingClientContextFactory()
+
+        def connect(ignored=None):
+            factory = PingFactory()
+            reactor.connectSSL("127.0.0.1", port.getHost().port, factory,
+                               context_factory)
+            return factory.done
+
+        def check_resumed(ignored):
+            cache = context_factory.session_cache
+            self.assertEqual(2, cache.handshakes)
+            self.assertEqual(1, cache.resumed)
+
+        d = connect()
+        d.addCallback(connect)
+        return d.addCallback(check_resumed)
+
+    if getattr(SSL.Connection, "set_session", None) is None:
+        test_session_resumption.skip = (
+            "TLS session resumption not supported by older PyOpenSSL")
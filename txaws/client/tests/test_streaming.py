@@ -0,0 +1,385 @@
+from StringIO import StringIO
+
+from zope.interface import implementer
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, TimeoutError
+from twisted.internet.interfaces import IConsumer
+from twisted.internet.task import deferLater
+from twisted.protocols.policies import WrappingFactory
+from twisted.web import server
+from twisted.web.client import FileBodyProducer
+from twisted.web.resource import Resource
+
+from txaws.client.base import BaseQuery
+from txaws.client.retry import RetryPolicy
+from txaws.client.streaming import (
+    CallbackConsumer, FileBody, FileConsumer, FileSection, MD5Consumer,
+    ProducerBody, StreamInterrupted, get_body, get_consumer)
+from txaws.client.transport import HTTPTransport
+from txaws.service import AWSServiceEndpoint
+from txaws.testing.base import TXAWSTestCase
+
+
+class FakeProducer(object):
+
+    def __init__(self):
+        self.events = []
+
+    def pauseProducing(self):
+        self.events.append("pause")
+
+    def resumeProducing(self):
+        self.events.append("resume")
+
+    def stopProducing(self):
+        self.events.append("stop")
+
+
+class CallbackConsumerTestCase(TXAWSTestCase):
+
+    def setUp(self):
+        super(CallbackConsumerTestCase, self).setUp()
+        self.chunks = []
+        self.pending = []
+        self.producer = FakeProducer()
+
+    def callback(self, data):
+        self.chunks.append(data)
+        d = Deferred()
+        self.pending.append(d)
+        return d
+
+    def test_backpressure(self):
+        """
+        The producer is paused while the C{Deferred} returned by the callback
+        hasn't fired, and the chunks written meanwhile wait for it.
+        """
+        consumer = CallbackConsumer(self.callback)
+        consumer.registerProducer(self.producer, True)
+        consumer.write("a")
+        consumer.write("b")
+        self.assertEqual(["a"], self.chunks)
+        self.assertEqual(["pause"], self.producer.events)
+        flushed = []
+        consumer.flush().addCallback(flushed.append)
+        self.pending[0].callback(None)
+        self.assertEqual(["a", "b"], self.chunks)
+        self.assertEqual(["pause"], self.producer.events)
+        self.assertEqual([], flushed)
+        self.pending[1].callback(None)
+        self.assertEqual(["pause", "resume"], self.producer.events)
+        self.assertEqual([None], flushed)
+
+    def test_synchronous(self):
+        consumer = CallbackConsumer(self.chunks.append)
+        consumer.registerProducer(self.producer, True)
+        consumer.write("a")
+        consumer.write("b")
+        self.assertEqual(["a", "b"], self.chunks)
+        self.assertEqual([], self.producer.events)
+
+    def test_failure(self):
+        """
+        The producer is stopped when the callback fails, and the failure is
+        given by L{CallbackConsumer.flush}.
+        """
+        consumer = CallbackConsumer(lambda data: 1 / 0)
+        consumer.registerProducer(self.producer, True)
+        consumer.write("a")
+        consumer.write("b")
+        self.assertEqual(["stop"], self.producer.events)
+        return self.assertFailure(consumer.flush(), ZeroDivisionError)
+
+
+class GetConsumerTestCase(TXAWSTestCase):
+
+    def test_get_consumer(self):
+
+        @implementer(IConsumer)
+        class Consumer(object):
+            pass
+
+        consumer = Consumer()
+        self.assertIdentical(consumer, get_consumer(consumer))
+        self.assertTrue(isinstance(get_consumer(StringIO()), FileConsumer))
+        self.assertTrue(
+            isinstance(get_consumer(lambda data: None), CallbackConsumer))
+        self.assertRaises(TypeError, get_consumer, 1)
+
+    def test_file_consumer_offset(self):
+        """
+        Consumers with an offset write to their own section of a file.
+        """
+        output = StringIO("." * 6)
+        first = FileConsumer(output, 0)
+        second = FileConsumer(output, 3)
+        first.write("a")
+        second.write("de")
+        first.write("bc")
+        second.write("f")
+        self.assertEqual("abcdef", output.getvalue())
+
+    def test_md5_consumer(self):
+        output = StringIO()
+        consumer = MD5Consumer(FileConsumer(output))
+        consumer.write("foo")
+        consumer.write("bar")
+        self.assertEqual("foobar", output.getvalue())
+        self.assertEqual(6, consumer.length)
+        self.assertEqual("3858f62230ac3c915f300c664312c63f",
+                         consumer.hexdigest())
+
+
+class RequestBodyTestCase(TXAWSTestCase):
+
+    def test_file_section(self):
+        """
+        Sections of a file are read in turn, without closing the file.
+        """
+        data = StringIO("0123456789")
+        first = FileSection(data, 2, 3)
+        second = FileSection(data, 6, 10)
+        self.assertEqual("2", first.read(1))
+        self.assertEqual("678", second.read(3))
+        self.assertEqual("34", first.read())
+        self.assertEqual("", first.read())
+        first.seek(1)
+        self.assertEqual("34", first.read(10))
+        self.assertEqual("9", second.read())
+        first.close()
+        self.assertFalse(data.closed)
+
+    def test_file_body(self):
+        """
+        A L{FileBody} gives a new producer for every attempt.
+        """
+        body = FileBody(StringIO("0123456789"), 4)
+        self.assertEqual(6, body.length)
+        for attempt in range(2):
+            output = StringIO()
+            producer = body.get_producer()
+            self.assertEqual(6, producer.length)
+            d = producer.startProducing(FileConsumer(output))
+            d.addCallback(
+                lambda ignored: self.assertEqual("456789", output.getvalue()))
+        return d
+
+    def test_producer_body(self):
+        producer = FileBodyProducer(StringIO("data"))
+        body = ProducerBody(producer)
+        self.assertEqual(4, body.length)
+        self.assertIdentical(producer, body.get_producer())
+        self.assertRaises(ValueError, body.get_producer)
+
+    def test_get_body(self):
+        """
+        The MD5 digest of a file is computed before sending it.
+        """
+        d = get_body(StringIO("foobar"))
+
+        def check(body):
+            self.assertEqual(6, body.length)
+            self.assertEqual("OFj2IjCsPJFfMAxmQxLGPw==", body.md5)
+
+        return d.addCallback(check)
+
+
+class ChunkedResource(Resource):
+    """
+    Write C{count} chunks of C{size} bytes, one per reactor iteration, or only
+    half of them before dropping the connection for C{/broken}, or before
+    stalling for C{/stalled}.
+    """
+
+    isLeaf = True
+
+    def __init__(self, count=20, size=16384):
+        Resource.__init__(self)
+        self.count = count
+        self.size = size
+        self.requests = 0
+
+    def render_GET(self, request):
+        self.requests += 1
+        if request.postpath == ["missing"]:
+            request.setResponseCode(404)
+            return "<Error><Code>NoSuchKey</Code></Error>"
+        request.setHeader("content-length", str(self.count * self.size))
+        broken = request.postpath == ["broken"]
+        stalled = request.postpath == ["stalled"]
+
+        def write(index):
+            if broken and index == self.count // 2:
+                request.transport.loseConnection()
+            elif stalled and index == self.count // 2:
+                return
+            elif index == self.count:
+                request.finish()
+            else:
+                request.write(chr(ord("a") + index % 26) * self.size)
+                reactor.callLater(0, write, index + 1)
+
+        write(0)
+        return server.NOT_DONE_YET
+
+
+class TransportStreamingTestCase(TXAWSTestCase):
+
+    def setUp(self):
+        super(TransportStreamingTestCase, self).setUp()
+        self.resource = ChunkedResource()
+        self.wrapper = WrappingFactory(
+            server.Site(self.resource, timeout=None))
+        self.port = reactor.listenTCP(0, self.wrapper, interface="127.0.0.1")
+        self.addCleanup(self.port.stopListening)
+        self.portno = self.port.getHost().port
+        self.transport = HTTPTransport()
+        self.addCleanup(self.transport.close)
+
+    def tearDown(self):
+        for protocol in self.wrapper.protocols.keys():
+            protocol.transport.loseConnection()
+
+    def get_url(self, path="object"):
+        return "http://127.0.0.1:%d/%s" % (self.portno, path)
+
+    def test_stream(self):
+        output = StringIO()
+        page = self.transport.get_page(
+            self.get_url(), stream=FileConsumer(output))
+
+        def check(result):
+            self.assertIdentical(None, result)
+            self.assertEqual(20 * 16384, len(output.getvalue()))
+            self.assertEqual("a" * 16384, output.getvalue()[:16384])
+
+        return page.deferred.addCallback(check)
+
+    def test_backpressure(self):
+        """
+        A slow consumer pauses the connection, and the connection then goes
+        back to the pool working for the next request.
+        """
+
+        @implementer(IConsumer)
+        class SlowConsumer(object):
+
+            def __init__(self):
+                self.chunks = []
+                self.pauses = 0
+
+            def registerProducer(self, producer, streaming):
+                self.producer = producer
+
+            def unregisterProducer(self):
+                self.producer = None
+
+            def write(self, data):
+                self.chunks.append(data)
+                self.pauses += 1
+                producer = self.producer
+                producer.pauseProducing()
+                reactor.callLater(0.001, producer.resumeProducing)
+
+        consumer = SlowConsumer()
+        page = self.transport.get_page(self.get_url(), stream=consumer)
+
+        def check(ignored):
+            self.assertEqual(20 * 16384, len("".join(consumer.chunks)))
+            self.assertTrue(consumer.pauses > 0)
+            self.assertEqual(1, self.transport.pool.get_idle_count())
+            output = StringIO()
+            page = self.transport.get_page(
+                self.get_url(), stream=FileConsumer(output))
+            return page.deferred.addCallback(
+                lambda ignored: self.assertEqual(
+                    20 * 16384, len(output.getvalue())))
+
+        return page.deferred.addCallback(check)
+
+    def test_callback_consumer(self):
+        chunks = []
+
+        def slow(data):
+            chunks.append(data)
+            return deferLater(reactor, 0.001, lambda: None)
+
+        consumer = CallbackConsumer(slow)
+        page = self.transport.get_page(self.get_url(), stream=consumer)
+        page.deferred.addCallback(lambda ignored: consumer.flush())
+        return page.deferred.addCallback(
+            lambda ignored: self.assertEqual(
+                20 * 16384, len("".join(chunks))))
+
+    def test_interrupted(self):
+        """
+        A body failing after some of it was streamed fails with
+        L{StreamInterrupted}, which is not retried.
+        """
+        output = StringIO()
+        page = self.transport.get_page(
+            self.get_url("broken"), stream=FileConsumer(output))
+        d = self.assertFailure(page.deferred, StreamInterrupted)
+
+        def check(error):
+            self.assertEqual(len(output.getvalue()), error.written)
+            self.assertEqual(10 * 16384, error.written)
+
+        return d.addCallback(check)
+
+    def test_stalled_not_retried(self):
+        """
+        A body timing out after some of it was streamed fails with
+        L{StreamInterrupted}, and isn't sent again into the same consumer by
+        the retry policy of the endpoint.
+        """
+        self.transport.retry_policy = RetryPolicy(base_delay=0, max_delay=0)
+        output = StringIO()
+        endpoint = AWSServiceEndpoint(transport=self.transport)
+        query = BaseQuery("GET", "creds", endpoint)
+        d = query.get_page(
+            self.get_url("stalled"), timeout=0.2,
+            stream=FileConsumer(output))
+        d = self.assertFailure(d, StreamInterrupted)
+
+        def check(error):
+            self.assertEqual(1, self.resource.requests)
+            self.assertEqual(10 * 16384, error.written)
+            self.assertEqual(10 * 16384, len(output.getvalue()))
+            self.assertTrue(error.reason.check(TimeoutError))
+
+        return d.addCallback(check)
+
+    def test_error_not_streamed(self):
+        """
+        The body of an error response is collected rather than streamed.
+        """
+        output = StringIO()
+        endpoint = AWSServiceEndpoint(transport=self.transport)
+        query = BaseQuery("GET", "creds", endpoint)
+        d = query.get_page(
+            self.get_url("missing"), stream=FileConsumer(output))
+
+        def check(error):
+            self.assertEqual("", output.getvalue())
+            self.assertIn("NoSuchKey", error.response)
+
+        return self.assertFailure(d, Exception).addCallback(check)
+
+    def test_without_transport(self):
+        """
+        Queries against an endpoint without a transport stream their body
+        through a transport keeping no idle connection.
+        """
+        output = StringIO()
+        query = BaseQuery("GET", "creds", AWSServiceEndpoint())
+        d = query.get_page(self.get_url(), stream=FileConsumer(output))
+
+        def check(result):
+            self.assertIdentical(None, result)
+            self.assertEqual(20 * 16384, len(output.getvalue()))
+            # Let the connection close.
+            return deferLater(reactor, 0.01, lambda: None)
+
+        return d.addCallback(check)
@@ -0,0 +1,260 @@
+from twisted.internet import reactor
+from twisted.internet.defer import fail, succeed
+from twisted.internet.task import Clock
+from twisted.protocols.policies import WrappingFactory
+from twisted.web import server
+from twisted.web.error import Error as TwistedWebError
+
+from txaws.client.base import (
+    BaseQuery, RequestTiming, SlowRequestLog, attach_timing, error_wrapper,
+    get_timing_observers, timed_parse)
+from txaws.client.dns import DNSCache
+from txaws.client.tests.test_transport import EchoResource
+from txaws.client.transport import HTTPTransport
+from txaws.s3.exception import S3Error
+from txaws.service import AWSServiceEndpoint
+from txaws.testing import payload
+from txaws.testing.base import TXAWSTestCase
+from txaws.util import XML
+
+
+@timed_parse
+def parse_echo(xml_bytes):
+    return XML("<Echo>%s</Echo>" % xml_bytes).text
+
+
+class RequestTimingTestCase(TXAWSTestCase):
+
+    def setUp(self):
+        super(RequestTimingTestCase, self).setUp()
+        self.clock = Clock()
+        self.timings = []
+        self.timing = RequestTiming(
+            "ec2", "DescribeInstances", "GET", "http://host/", self.clock,
+            [self.timings.append])
+
+    def test_finish(self):
+        self.clock.advance(2)
+        self.timing.ttfb = 1.5
+        self.timing.status = "200"
+        self.timing.finish()
+        self.timing.finish()
+        self.assertEqual([self.timing], self.timings)
+        self.assertEqual(2, self.timing.total)
+        record = self.timing.as_dict()
+        self.assertEqual(1.5, record["ttfb"])
+        self.assertIdentical(None, record["dns"])
+        self.assertEqual("DescribeInstances", record["action"])
+        self.assertEqual(
+            "ec2 DescribeInstances 2.000s (ttfb=1.500) 200 attempts=0 "
+            "http://host/", str(self.timing))
+
+    def test_failing_observer(self):
+        """
+        An observer raising an exception doesn't keep the others from being
+        given the record.
+        """
+        self.timing.observers = [lambda timing: 1 / 0, self.timings.append]
+        self.timing.finish()
+        self.assertEqual([self.timing], self.timings)
+        self.assertEqual(1, len(self.flushLoggedErrors(ZeroDivisionError)))
+
+    def test_timed_parse(self):
+        """
+        The time a parser decorated with L{timed_parse} takes with a response
+        body is split between parsing XML and building the results.
+        """
+        body = attach_timing("body", self.timing)
+        self.assertEqual("body", parse_echo(body))
+        self.assertEqual([self.timing], self.timings)
+        self.assertTrue(self.timing.parse > 0)
+        self.assertTrue(self.timing.model >= 0)
+        self.assertEqual([], self.clock.getDelayedCalls())
+
+    def test_not_parsed(self):
+        """
+        A response body nobody parses right away is timed without parse
+        times.
+        """
+        body = attach_timing("body", self.timing)
+        self.assertEqual([], self.timings)
+        self.clock.advance(0)
+        self.assertEqual([self.timing], self.timings)
+        self.assertIdentical(None, self.timing.parse)
+        self.assertEqual("body", parse_echo(body))
+
+    def test_shared_body(self):
+        """
+        The requests given the same body each have their own parse times.
+        """
+        other = RequestTiming(
+            "ec2", "DescribeInstances", "GET", "http://host/", self.clock,
+            [self.timings.append])
+        body = "body"
+        first = attach_timing(body, self.timing)
+        second = attach_timing(body, other)
+        self.assertEqual("body", parse_echo(second))
+        self.assertEqual([other], self.timings)
+        self.assertEqual("body", parse_echo(first))
+        self.assertEqual([other, self.timing], self.timings)
+        self.assertTrue(self.timing.parse > 0)
+        self.assertEqual([], self.clock.getDelayedCalls())
+
+    def test_nothing_to_parse(self):
+        """
+        A request without a body to parse, like a streamed one, is finished
+        right away.
+        """
+        self.assertIdentical(None, attach_timing(None, self.timing))
+        self.assertEqual([self.timing], self.timings)
+
+
+class SlowRequestLogTestCase(TXAWSTestCase):
+
+    def test_threshold(self):
+        messages = []
+        observer = SlowRequestLog(threshold=1, logger=messages.append)
+        clock = Clock()
+        for seconds in [0.5, 1.5]:
+            timing = RequestTiming(
+                "s3", "GET", "GET", "http://host/", clock, [observer])
+            clock.advance(seconds)
+            timing.finish()
+        self.assertEqual(1, observer.count)
+        self.assertEqual(
+            ["Slow request: s3 GET 1.500s () None attempts=0 http://host/"],
+            messages)
+
+
+class QueryTimingTestCase(TXAWSTestCase):
+
+    def setUp(self):
+        super(QueryTimingTestCase, self).setUp()
+        self.timings = []
+        self.endpoint = AWSServiceEndpoint(
+            timing_observers=[self.timings.append])
+
+    def make_query(self, result):
+
+        class Query(BaseQuery):
+
+            service = "test"
+
+            def _send_page(self, url, *args, **kwds):
+                self.timing.start_attempt(len(kwds.get("postdata") or ""))
+                return result
+
+        return Query("Action", "creds", self.endpoint, Clock())
+
+    def test_get_timing_observers(self):
+        self.assertEqual([self.timings.append],
+                         get_timing_observers(self.endpoint))
+        transport = HTTPTransport(timing_observers=[self.timings.append])
+        endpoint = AWSServiceEndpoint(transport=transport)
+        self.assertEqual([self.timings.append],
+                         get_timing_observers(endpoint))
+        self.assertEqual([], get_timing_observers(AWSServiceEndpoint()))
+
+    def test_query(self):
+        query = self.make_query(succeed("body"))
+        d = query.get_page("http://host/")
+        d.addCallback(parse_echo)
+        self.assertEqual([query.timing], self.timings)
+        self.assertEqual("test", query.timing.service)
+        self.assertEqual("Action", query.timing.action)
+        self.assertEqual(1, query.timing.attempts)
+        self.assertIdentical(None, query.timing.error)
+        self.assertTrue(query.timing.parse > 0)
+
+    def test_failed_query(self):
+        """
+        The code of the error returned by the service is added by
+        L{error_wrapper}.
+        """
+        query = self.make_query(
+            fail(TwistedWebError("404", "Not Found", payload.sample_s3_signature_mismatch)))
+        d = query.get_page("http://host/", postdata="data")
+        d.addErrback(error_wrapper, S3Error)
+        self.assertEqual([query.timing], self.timings)
+        self.assertEqual("S3Error", query.timing.error)
+        self.assertEqual("SignatureDoesNotMatch", query.timing.error_code)
+        self.assertEqual("404", query.timing.status)
+        self.assertEqual(4, query.timing.request_bytes)
+        self.assertEqual(
+            len(payload.sample_s3_signature_mismatch), query.timing.response_bytes)
+        return self.assertFailure(d, S3Error)
+
+    def test_failed_without_body(self):
+        query = self.make_query(fail(ValueError()))
+        d = query.get_page("http://host/")
+        self.assertEqual([query.timing], self.timings)
+        self.assertEqual("ValueError", query.timing.error)
+        return self.assertFailure(d, ValueError)
+
+
+class TransportTimingTestCase(TXAWSTestCase):
+
+    def setUp(self):
+        super(TransportTimingTestCase, self).setUp()
+        self.wrapper = WrappingFactory(
+            server.Site(EchoResource(), timeout=None))
+        self.port = reactor.listenTCP(0, self.wrapper, interface="127.0.0.1")
+        self.addCleanup(self.port.stopListening)
+        self.portno = self.port.getHost().port
+        self.timings = []
+
+    def make_query(self, **kwargs):
+        transport = HTTPTransport(
+            timing_observers=[self.timings.append], **kwargs)
+        self.addCleanup(transport.close)
+        endpoint = AWSServiceEndpoint(transport=transport)
+        return BaseQuery("Action", "creds", endpoint)
+
+    def get_page(self, query, host="127.0.0.1"):
+        d = query.get_page("http://%s:%d/file" % (host, self.portno))
+        return d.addCallback(parse_echo)
+
+    def test_phases(self):
+        """
+        The phases of a request sent through a transport are timed, the time
+        connecting only when a new connection is opened.
+        """
+        query = self.make_query()
+
+        def check_first(body):
+            self.assertEqual("GET::None", body)
+            timing = self.timings[-1]
+            self.assertEqual("200", timing.status)
+            for phase in ["queue", "connect", "ttfb", "body", "parse",
+                          "model"]:
+                self.assertTrue(getattr(timing, phase) >= 0, phase)
+            self.assertIdentical(None, timing.dns)
+            self.assertIdentical(None, timing.tls)
+            self.assertTrue(timing.total >= timing.ttfb + timing.connect)
+            return self.get_page(
+                BaseQuery("Action", "creds", query.endpoint))
+
+        def check_reused(body):
+            self.assertEqual(2, len(self.timings))
+            timing = self.timings[-1]
+            self.assertIdentical(None, timing.connect)
+            self.assertTrue(timing.ttfb >= 0)
+
+        d = self.get_page(query)
+        d.addCallback(check_first)
+        return d.addCallback(check_reused)
+
+    def test_dns(self):
+
+        class Resolver(object):
+
+            def lookup(self, host):
+                return succeed([("127.0.0.1", 60)])
+
+        query = self.make_query(dns_cache=DNSCache(resolver=Resolver()))
+
+        def check(body):
+            self.assertTrue(self.timings[-1].dns >= 0)
+            self.assertTrue(self.timings[-1].connect >= 0)
+
+        return self.get_page(query, "example.invalid").addCallback(check)
@@ -0,0 +1,403 @@
+from StringIO import StringIO
+
+from twisted.internet import reactor
+from twisted.internet.defer import TimeoutError, gatherResults, succeed
+from twisted.protocols.policies import WrappingFactory
+from twisted.web import server
+from twisted.web.client import FileBodyProducer
+from twisted.web.error import Error as TwistedWebError
+from twisted.web.resource import Resource
+
+from txaws.client.base import BaseQuery
+from txaws.client.dns import DNSCache
+from txaws.client.retry import RetryPolicy
+from txaws.client.scheduler import RequestScheduler
+from txaws.client.streaming import ProducerBody
+from txaws.client.transport import HTTPTransport
+from txaws.credentials import AWSCredentials
+from txaws.service import AWSServiceEndpoint, AWSServiceRegion
+from txaws.testing.base import TXAWSTestCase
+
+
+class EchoResource(Resource):
+    """
+    Reply with the method, the body and the C{Content-Length} of the request.
+    """
+
+    isLeaf = True
+
+    def __init__(self):
+        Resource.__init__(self)
+        self.failures = 0
+
+    def render(self, request):
+        if request.postpath == ["flaky"] and self.failures < 2:
+            self.failures += 1
+            request.setResponseCode(503)
+            return "<Error><Code>SlowDown</Code></Error>"
+        if request.postpath == ["missing"]:
+            request.setResponseCode(404)
+            return "<Error><Code>NoSuchKey</Code></Error>"
+        if request.postpath == ["hang"]:
+            return server.NOT_DONE_YET
+        if request.postpath == ["trickle"]:
+            request.write("<Response>")
+            return server.NOT_DONE_YET
+        request.setHeader("x-amz-request-id", "abc")
+        return "%s:%s:%s" % (request.method, request.content.read(),
+                             request.getHeader("content-length"))
+
+
+class TransportTestCase(TXAWSTestCase):
+
+    def setUp(self):
+        super(TransportTestCase, self).setUp()
+        self.site = server.Site(EchoResource(), timeout=None)
+        self.wrapper = WrappingFactory(self.site)
+        self.port = reactor.listenTCP(0, self.wrapper, interface="127.0.0.1")
+        self.portno = self.port.getHost().port
+        self.transport = self.make_transport()
+
+    def make_transport(self, **kwargs):
+        transport = HTTPTransport(**kwargs)
+        self.addCleanup(transport.close)
+        return transport
+
+    def tearDown(self):
+        for proto in self.wrapper.protocols.keys():
+            proto.transport.loseConnection()
+        return self.port.stopListening()
+
+    def _get_url(self, path):
+        return "http://127.0.0.1:%d/%s" % (self.portno, path)
+
+    def test_get_page(self):
+        page = self.transport.get_page(self._get_url("file"))
+        page.deferred.addCallback(self.assertEqual, "GET::None")
+        return page.deferred
+
+    def test_get_page_with_postdata(self):
+        page = self.transport.get_page(
+            self._get_url("file"), method="PUT", postdata="data",
+            headers={"Content-Length": 4})
+        page.deferred.addCallback(self.assertEqual, "PUT:data:4")
+        return page.deferred
+
+    def test_get_page_with_empty_postdata(self):
+        """
+        An empty body is sent with an explicit C{Content-Length} of zero.
+        """
+        page = self.transport.get_page(
+            self._get_url("file"), method="PUT", postdata="")
+        page.deferred.addCallback(self.assertEqual, "PUT::0")
+        return page.deferred
+
+    def test_head(self):
+        """
+        A I{HEAD} request fires with an empty body, and the connection is
+        kept for the next request.
+        """
+        page = self.transport.get_page(self._get_url("file"), method="HEAD")
+
+        def check(body):
+            self.assertEqual("", body)
+            self.assertEqual("200", page.status)
+            return self.transport.get_page(self._get_url("file")).deferred
+
+        page.deferred.addCallback(check)
+        return page.deferred.addCallback(self.assertEqual, "GET::None")
+
+    def test_response_headers(self):
+
+        def check_headers(ignored):
+            self.assertEqual("200", page.status)
+            self.assertEqual(["abc"], page.response_headers["x-amz-request-id"])
+
+        page = self.transport.get_page(self._get_url("file"))
+        return page.deferred.addCallback(check_headers)
+
+    def test_error_status(self):
+        """
+        A response status other than 200, 201 or 202 fails with a
+        L{TwistedWebError} carrying the response body, like
+        L{HTTPClientFactory} does.
+        """
+
+        def check_error(error):
+            self.assertEqual("404", error.status)
+            self.assertEqual(
+                "<Error><Code>NoSuchKey</Code></Error>", error.response)
+
+        page = self.transport.get_page(self._get_url("missing"))
+        d = self.assertFailure(page.deferred, TwistedWebError)
+        return d.addCallback(check_error)
+
+    def test_dns_cache(self):
+        """
+        With a L{DNSCache}, connections go to the addresses it found for the
+        host, which is still the one sent in the I{Host} header.
+        """
+
+        class Resolver(object):
+
+            def lookup(self, host):
+                return succeed([("127.0.0.1", 60)])
+
+        dns_cache = DNSCache(resolver=Resolver())
+        transport = self.make_transport(dns_cache=dns_cache)
+        page = transport.get_page(
+            "http://example.invalid:%d/file" % self.portno)
+
+        def check(body):
+            self.assertEqual("GET::None", body)
+            self.assertEqual(1, dns_cache.get_stats()["misses"])
+
+        return page.deferred.addCallback(check)
+
+    def test_connection_reused(self):
+        """
+        Sequential requests to the same host share a single connection.
+        """
+
+        def second_request(ignored):
+            page = self.transport.get_page(self._get_url("file"))
+            return page.deferred
+
+        def check_stats(ignored):
+            stats = self.transport.get_stats()
+            self.assertEqual(1, stats["hits"])
+            self.assertEqual(1, stats["misses"])
+            self.assertEqual(1, stats["idle"])
+            self.assertEqual(0, stats["evictions"])
+            self.assertEqual(1, len(self.wrapper.protocols))
+
+        page = self.transport.get_page(self._get_url("file"))
+        page.deferred.addCallback(second_request)
+        return page.deferred.addCallback(check_stats)
+
+    def test_max_persistent_per_host(self):
+        """
+        Idle connections beyond C{max_persistent_per_host} are closed and
+        counted as evictions.
+        """
+        transport = self.make_transport(max_persistent_per_host=1)
+
+        def check_stats(ignored):
+            stats = transport.get_stats()
+            self.assertEqual(2, stats["misses"])
+            self.assertEqual(1, stats["idle"])
+            self.assertEqual(1, stats["evictions"])
+
+        d = gatherResults([
+            transport.get_page(self._get_url("file")).deferred,
+            transport.get_page(self._get_url("file")).deferred])
+        return d.addCallback(check_stats)
+
+    def test_preconnect(self):
+
+        def check_preconnected(ignored):
+            self.assertEqual(2, self.transport.get_stats()["idle"])
+            page = self.transport.get_page(self._get_url("file"))
+            return page.deferred
+
+        def check_stats(ignored):
+            stats = self.transport.get_stats()
+            self.assertEqual(1, stats["hits"])
+            self.assertEqual(0, stats["misses"])
+
+        d = self.transport.preconnect(self._get_url(""), count=5)
+        d.addCallback(check_preconnected)
+        return d.addCallback(check_stats)
+
+    def test_timeout(self):
+        """
+        A request not answered within C{timeout} seconds fails with a
+        L{TimeoutError}, and its connection is not returned to the pool.
+        """
+
+        def check_stats(ignored):
+            self.assertEqual(0, self.transport.get_stats()["idle"])
+
+        page = self.transport.get_page(self._get_url("hang"), timeout=0.01)
+        d = self.assertFailure(page.deferred, TimeoutError)
+        return d.addCallback(check_stats)
+
+    def test_scheduler_limits_requests(self):
+        """
+        Requests beyond the limits of the scheduler of the transport wait
+        for the previous ones to complete.
+        """
+        scheduler = RequestScheduler(reactor, max_per_endpoint=1)
+        transport = self.make_transport(scheduler=scheduler)
+
+        def check_stats(ignored):
+            stats = scheduler.get_stats()
+            self.assertEqual(1, stats["max_queued"])
+            self.assertEqual(0, stats["in_flight"])
+            self.assertEqual(1, transport.get_stats()["misses"])
+
+        pages = [transport.get_page(self._get_url("file"), action="GET"),
+                 transport.get_page(self._get_url("file"), action="GET")]
+        self.assertEqual(1, scheduler.get_queued())
+        d = gatherResults([page.deferred for page in pages])
+        return d.addCallback(check_stats)
+
+    def test_timeout_not_while_queued(self):
+        """
+        The C{timeout} of a request only starts once the scheduler lets it
+        go, so it isn't spent waiting for a saturated endpoint.
+        """
+        scheduler = RequestScheduler(reactor, max_per_endpoint=1)
+        transport = self.make_transport(scheduler=scheduler)
+        hanging = transport.get_page(self._get_url("hang"), timeout=0.05)
+        queued = transport.get_page(self._get_url("file"), timeout=0.01)
+
+        def check_queued(result):
+            self.assertEqual("GET::None", result)
+            return self.assertFailure(hanging.deferred, TimeoutError)
+
+        return queued.deferred.addCallback(check_queued)
+
+    def test_base_query_retries(self):
+        """
+        L{BaseQuery.get_page} sends requests failing with a retryable error
+        again, following the retry policy of the transport.
+        """
+        policy = RetryPolicy(base_delay=0.001, max_delay=0.01)
+        transport = self.make_transport(retry_policy=policy)
+        endpoint = AWSServiceEndpoint(self._get_url(""), transport=transport)
+        query = BaseQuery("GET", "creds", endpoint)
+
+        def check_retries(result):
+            self.assertEqual("GET::None", result)
+            self.assertEqual({"throttled": 2}, policy.get_stats()["retries"])
+
+        d = query.get_page(self._get_url("flaky"), method="GET")
+        return d.addCallback(check_retries)
+
+    def test_producer_body_not_retried(self):
+        """
+        A request sending a L{ProducerBody}, which can only be sent once,
+        fails with its retryable error rather than being sent again.
+        """
+        policy = RetryPolicy(base_delay=0.001, max_delay=0.01)
+        transport = self.make_transport(retry_policy=policy)
+        endpoint = AWSServiceEndpoint(self._get_url(""), transport=transport)
+        query = BaseQuery("PUT", "creds", endpoint)
+        body = ProducerBody(FileBodyProducer(StringIO("data")))
+
+        def check_error(error):
+            self.assertEqual("503", error.status)
+            self.assertEqual(1, self.site.resource.failures)
+            self.assertEqual({}, policy.get_stats()["retries"])
+
+        d = query.get_page(
+            self._get_url("flaky"), method="PUT", postdata=body)
+        return self.assertFailure(d, TwistedWebError).addCallback(check_error)
+
+    def test_base_query_uses_endpoint_transport(self):
+        """
+        L{BaseQuery.get_page} sends requests through the transport of its
+        endpoint, and still exposes the request and response headers.
+        """
+        endpoint = AWSServiceEndpoint(
+            self._get_url(""), transport=self.transport)
+        query = BaseQuery("an action", "creds", endpoint)
+
+        def check_query(result):
+            self.assertEqual("GET::None", result)
+            self.assertEqual({"x-amz-date": "now"},
+                             query.get_request_headers())
+            self.assertEqual(
+                ["abc"], query.get_response_headers()["x-amz-request-id"])
+            self.assertEqual(1, self.transport.get_stats()["misses"])
+
+        d = query.get_page(self._get_url("file"),
+                           headers={"x-amz-date": "now"})
+        return d.addCallback(check_query)
+
+
+class RegionTransportTestCase(TXAWSTestCase):
+
+    def setUp(self):
+        super(RegionTransportTestCase, self).setUp()
+        self.creds = AWSCredentials("foo", "bar")
+
+    def test_region_owns_transport(self):
+        """
+        The endpoints, and therefore the clients, of a region share the
+        transport of the region.
+        """
+        region = AWSServiceRegion(creds=self.creds, max_persistent_per_host=5)
+        self.assertEqual(5, region.transport.pool.maxPersistentPerHost)
+        self.assertIdentical(region.transport, region.ec2_endpoint.transport)
+        self.assertIdentical(region.transport, region.s3_endpoint.transport)
+        self.assertIdentical(region.transport, region.sqs_endpoint.transport)
+        self.assertIdentical(
+            region.transport, region.get_ec2_client().endpoint.transport)
+
+    def test_region_retry_policy(self):
+        """
+        The default transport of a region retries failed requests, unless
+        given another policy.
+        """
+        region = AWSServiceRegion(creds=self.creds)
+        self.assertIsInstance(region.transport.retry_policy, RetryPolicy)
+        policy = RetryPolicy(max_attempts=2)
+        region = AWSServiceRegion(creds=self.creds, retry_policy=policy)
+        self.assertIdentical(policy, region.transport.retry_policy)
+        client = region.get_sqs_client()
+        self.assertIdentical(policy, client.query_factory.retry_policy)
+
+    def test_region_dns_cache(self):
+        region = AWSServiceRegion(creds=self.creds)
+        self.assertIsInstance(region.transport.dns_cache, DNSCache)
+        agent = region.transport.get_agent()
+        self.assertIdentical(region.transport.dns_cache, agent.dns_cache)
+
+    def test_region_with_transport(self):
+        transport = HTTPTransport()
+        region = AWSServiceRegion(creds=self.creds, transport=transport)
+        self.assertIdentical(transport, region.transport)
+        self.assertEqual(
+            {"hits": 0, "misses": 0, "idle": 0, "evictions": 0},
+            region.get_pool_stats())
+
+    def test_region_with_scheduler(self):
+        """
+        The scheduler given to a region gates the requests of all of its
+        clients, SQS included.
+        """
+        scheduler = RequestScheduler(max_per_endpoint=4)
+        region = AWSServiceRegion(creds=self.creds, scheduler=scheduler)
+        self.assertIdentical(scheduler, region.transport.scheduler)
+        client = region.get_sqs_client()
+        self.assertIdentical(scheduler, client.query_factory.scheduler)
+
+    def test_region_preconnect(self):
+        calls = []
+
+        class FakeTransport(HTTPTransport):
+
+            def preconnect(self, url, count=1,
+                           ssl_hostname_verification=False):
+                calls.append((url, count))
+                return HTTPTransport.preconnect(self, url, 0)
+
+        AWSServiceRegion(creds=self.creds, ec2_uri="http://ec2/",
+                         s3_uri="http://s3/", transport=FakeTransport(),
+                         preconnect=2)
+        self.assertEqual(
+            [("http://ec2/", 2), ("http://s3/", 2),
+             ("https://sqs.us-east-1.amazonaws.com/", 2)],
+            calls)
+
+    def test_sqs_client_uses_region_agent(self):
+        region = AWSServiceRegion(creds=self.creds)
+        client = region.get_sqs_client()
+        self.assertIdentical(
+            region.transport.get_agent(ssl_hostname_verification=True),
+            client.query_factory.agent)
+        queue = client.get_queue("123", "queue")
+        self.assertIdentical(client.query_factory.agent,
+                             queue.query_factory.agent)
@@ -0,0 +1,850 @@
+# Licenced under the txaws licence available at /LICENSE in the txaws source.
+
+"""
+A persistent HTTP transport shared by the clients of an L{AWSServiceRegion}.
+
+L{BaseQuery.get_page} normally builds a new L{HTTPClientFactory} for every
+request, so each call pays for a fresh TCP connect and TLS handshake.  When an
+endpoint carries an L{HTTPTransport}, requests instead go through an
+L{Agent} backed by a shared L{ConnectionPool} which keeps idle connections
+alive per host.
+"""
+from zope.interface import implementer
+
+from twisted.internet import defer
+from twisted.internet.endpoints import SSL4ClientEndpoint, TCP4ClientEndpoint
+from twisted.internet.interfaces import IPushProducer
+from twisted.internet.protocol import Protocol
+from twisted.python.failure import Failure
+from twisted.web import http
+from twisted.web.client import (
+    Agent, HTTPConnectionPool, ResponseDone, _parse,
+    _RetryingHTTP11ClientProtocol)
+from twisted.web.error import Error as TwistedWebError, SchemeNotSupported
+from twisted.web.http_headers import Headers
+from twisted.web.iweb import IBodyProducer
+from twisted.web._newclient import Request
+
+from txaws.client.scheduler import RequestScheduler, get_endpoint_key
+from txaws.client.ssl import get_context_factory, get_handshake_times
+from txaws.client.streaming import StreamInterrupted
+
+
+__all__ = ["ConnectionPool", "PooledAgent", "PageRequest", "HTTPTransport",
+           "ResolvingEndpoint"]
+
+
+@implementer(IBodyProducer)
+class StringBodyProducer(object):
+    """
+    An L{IBodyProducer} writing an in-memory string in one go.
+
+    Unlike L{FileBodyProducer}, an empty string still produces an explicit
+    C{Content-Length: 0}, which S3 requires for empty C{PUT}s.
+    """
+
+    def __init__(self, data):
+        self.data = data
+        self.length = len(data)
+
+    def startProducing(self, consumer):
+        consumer.write(self.data)
+        return defer.succeed(None)
+
+    def pauseProducing(self):
+        pass
+
+    def resumeProducing(self):
+        pass
+
+    def stopProducing(self):
+        pass
+
+
+@implementer(IBodyProducer)
+class _TouchingBodyProducer(object):
+    """
+    An L{IBodyProducer} passing on the body of C{producer}, and giving its
+    L{PageRequest} more time with every chunk of it written, so that a long
+    upload only times out when it stalls.
+    """
+
+    def __init__(self, producer, page):
+        self.producer = producer
+        self.page = page
+        self.length = producer.length
+
+    def startProducing(self, consumer):
+        return self.producer.startProducing(
+            _TouchingConsumer(consumer, self.page))
+
+    def pauseProducing(self):
+        self.producer.pauseProducing()
+
+    def resumeProducing(self):
+        self.producer.resumeProducing()
+
+    def stopProducing(self):
+        self.producer.stopProducing()
+
+
+class _TouchingConsumer(object):
+
+    def __init__(self, consumer, page):
+        self.consumer = consumer
+        self.page = page
+
+    def write(self, data):
+        self.page.touch()
+        self.consumer.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.consumer, name)
+
+
+class WebContextFactory(object):
+    """
+    A web context factory, as used by L{Agent}, which optionally checks the
+    hostname of the server certificate with L{VerifyingContextFactory}.
+
+    Contexts come from L{get_context_factory}, so they are shared with every
+    other connection to the same host and resume TLS sessions.
+
+    @param ssl_hostname_verification: Whether or not to verify the hostname.
+    """
+
+    def __init__(self, ssl_hostname_verification=False):
+        self.ssl_hostname_verification = ssl_hostname_verification
+
+    def getContext(self, hostname, port):
+        return get_context_factory(
+            hostname, self.ssl_hostname_verification).getContext()
+
+
+class ConnectionPool(HTTPConnectionPool):
+    """
+    A L{HTTPConnectionPool} that keeps usage statistics.
+
+    @param max_persistent_per_host: The maximum number of idle connections
+        kept alive for each host.
+    @param cached_connection_timeout: The number of seconds an idle connection
+        stays open before it is closed.
+
+    @ivar hits: Number of requests served by an idle pooled connection.
+    @ivar misses: Number of requests which had to open a new connection.
+    @ivar evictions: Number of idle connections closed by the pool, either
+        because they timed out, went stale or exceeded the per host maximum.
+    """
+
+    def __init__(self, reactor, max_persistent_per_host=2,
+                 cached_connection_timeout=240):
+        HTTPConnectionPool.__init__(self, reactor, persistent=True)
+        self.maxPersistentPerHost = max_persistent_per_host
+        self.cachedConnectionTimeout = cached_connection_timeout
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def getConnection(self, key, endpoint):
+        connections = self._connections.get(key)
+        while connections:
+            connection = connections.pop(0)
+            self._timeouts.pop(connection).cancel()
+            if connection.state == "QUIESCENT":
+                self.hits += 1
+                if self.retryAutomatically:
+                    newConnection = lambda: self._newConnection(key, endpoint)
+                    connection = _RetryingHTTP11ClientProtocol(
+                        connection, newConnection)
+                return defer.succeed(connection)
+            self.evictions += 1
+        self.misses += 1
+        return self._newConnection(key, endpoint)
+
+    def _putConnection(self, key, connection):
+        if connection.state == "QUIESCENT":
+            # The consumer of a streamed body may have paused the connection
+            # while handling its last chunk.
+            connection.transport.resumeProducing()
+        if not self.maxPersistentPerHost:
+            connection.transport.loseConnection()
+            return
+        connections = self._connections.get(key, [])
+        if (connection.state == "QUIESCENT" and
+            len(connections) >= self.maxPersistentPerHost):
+            self.evictions += 1
+        HTTPConnectionPool._putConnection(self, key, connection)
+
+    def _removeConnection(self, key, connection):
+        self.evictions += 1
+        HTTPConnectionPool._removeConnection(self, key, connection)
+
+    def preconnect(self, key, endpoint, count=1):
+        """
+        Open up to C{count} new connections and park them in the pool.
+
+        The number of idle connections for C{key} never goes beyond
+        C{maxPersistentPerHost}.
+
+        @return: A C{Deferred} firing once all the connections are open.
+        """
+        idle = len(self._connections.get(key, []))
+        count = max(0, min(count, self.maxPersistentPerHost - idle))
+        deferreds = []
+        for i in range(count):
+            d = self._newConnection(key, endpoint)
+            d.addCallback(lambda connection: self._putConnection(
+                key, connection))
+            deferreds.append(d)
+        return defer.gatherResults(deferreds)
+
+    def get_idle_count(self):
+        """Return the number of idle connections currently in the pool."""
+        return sum(len(connections)
+                   for connections in self._connections.itervalues())
+
+    def get_stats(self):
+        """
+        Return a C{dict} with the C{hits}, C{misses}, C{idle} and
+        C{evictions} counters of this pool.
+        """
+        return {"hits": self.hits, "misses": self.misses,
+                "idle": self.get_idle_count(), "evictions": self.evictions}
+
+
+class ResolvingEndpoint(object):
+    """
+    A client endpoint looking up its host in a L{DNSCache} before connecting
+    to one of its addresses.
+
+    @param make_endpoint: A callable returning the endpoint connecting to the
+        address it is given.
+    @ivar timing: The L{RequestTiming} the lookup time is recorded in, if any.
+    """
+
+    def __init__(self, dns_cache, host, make_endpoint):
+        self.dns_cache = dns_cache
+        self.host = host
+        self.make_endpoint = make_endpoint
+        self.timing = None
+
+    def connect(self, protocolFactory):
+        clock = self.dns_cache.reactor
+        started = clock.seconds()
+
+        def resolved(address):
+            if self.timing is not None:
+                self.timing.dns = clock.seconds() - started
+            return self.make_endpoint(address).connect(protocolFactory)
+
+        return self.dns_cache.resolve(self.host).addCallback(resolved)
+
+
+class TimedEndpoint(object):
+    """
+    A client endpoint recording in a L{RequestTiming} how long connecting
+    took, less the time looking the host up.
+    """
+
+    def __init__(self, clock, endpoint, timing):
+        self.clock = clock
+        self.endpoint = endpoint
+        self.timing = timing
+
+    def connect(self, protocolFactory):
+        started = self.clock.seconds()
+
+        def connected(protocol):
+            self.timing.connect = (
+                self.clock.seconds() - started - (self.timing.dns or 0))
+            return protocol
+
+        return self.endpoint.connect(protocolFactory).addCallback(connected)
+
+
+class PooledAgent(Agent):
+    """
+    An L{Agent} sharing a L{ConnectionPool} with other agents.
+
+    Connections are keyed on the SSL hostname verification mode as well as on
+    the scheme, host and port, so that a connection opened without checking
+    the certificate is never handed to a request that asked for it.
+
+    @param dns_cache: The L{DNSCache} resolving the hosts connected to, or
+        C{None} to let the reactor resolve them for every connection.
+    """
+
+    def __init__(self, reactor, pool, ssl_hostname_verification=False,
+                 dns_cache=None):
+        Agent.__init__(
+            self, reactor,
+            contextFactory=WebContextFactory(ssl_hostname_verification),
+            pool=pool)
+        self.ssl_hostname_verification = ssl_hostname_verification
+        self.dns_cache = dns_cache
+
+    def _getEndpoint(self, scheme, host, port):
+        if self.dns_cache is None:
+            return Agent._getEndpoint(self, scheme, host, port)
+        kwargs = {}
+        if self._connectTimeout is not None:
+            kwargs["timeout"] = self._connectTimeout
+        kwargs["bindAddress"] = self._bindAddress
+        if scheme == "http":
+            make_endpoint = lambda address: TCP4ClientEndpoint(
+                self._reactor, address, port, **kwargs)
+        elif scheme == "https":
+            # The certificate is still checked against the host name.
+            make_endpoint = lambda address: SSL4ClientEndpoint(
+                self._reactor, address, port,
+                self._wrapContextFactory(host, port), **kwargs)
+        else:
+            raise SchemeNotSupported("Unsupported scheme: %r" % (scheme,))
+        return ResolvingEndpoint(self.dns_cache, host, make_endpoint)
+
+    def _get_key(self, parsed_uri):
+        return (parsed_uri.scheme, parsed_uri.host, parsed_uri.port,
+                self.ssl_hostname_verification)
+
+    def _get_timed_endpoint(self, parsed_uri, timing):
+        endpoint = self._getEndpoint(
+            parsed_uri.scheme, parsed_uri.host, parsed_uri.port)
+        if timing is not None:
+            if isinstance(endpoint, ResolvingEndpoint):
+                endpoint.timing = timing
+            endpoint = TimedEndpoint(self._reactor, endpoint, timing)
+        return endpoint
+
+    def get_connection(self, uri, timing=None):
+        """
+        Get a connection, pooled or new, suitable for requesting C{uri}.
+
+        @param timing: The L{RequestTiming} the time looking the host up and
+            connecting is recorded in, if a new connection is opened.
+        @return: A C{Deferred} firing with the connection protocol.
+        """
+        parsed_uri = _parse(uri)
+        try:
+            endpoint = self._get_timed_endpoint(parsed_uri, timing)
+        except SchemeNotSupported:
+            return defer.fail(Failure())
+        return self._pool.getConnection(self._get_key(parsed_uri), endpoint)
+
+    def preconnect(self, uri, count=1):
+        """Pre-open up to C{count} idle connections for C{uri}."""
+        parsed_uri = _parse(uri)
+        endpoint = self._getEndpoint(
+            parsed_uri.scheme, parsed_uri.host, parsed_uri.port)
+        return self._pool.preconnect(
+            self._get_key(parsed_uri), endpoint, count)
+
+    def get_host_value(self, uri):
+        """Return the value of the I{Host} header to use for C{uri}."""
+        parsed_uri = _parse(uri)
+        return self._computeHostValue(
+            parsed_uri.scheme, parsed_uri.host, parsed_uri.port)
+
+    def _requestWithEndpoint(self, key, endpoint, method, parsedURI,
+                             headers, bodyProducer, requestPath):
+        # Like Agent._requestWithEndpoint, but cancelling the request drops
+        # its connection rather than letting it go back to the pool.
+        if headers is None:
+            headers = Headers()
+        if not headers.hasHeader("host"):
+            headers = headers.copy()
+            headers.addRawHeader("host", self._computeHostValue(
+                parsedURI.scheme, parsedURI.host, parsedURI.port))
+        connections = []
+
+        def cancel(ignored):
+            connecting.cancel()
+            for connection in connections:
+                if isinstance(connection, _RetryingHTTP11ClientProtocol):
+                    connection = connection._clientProtocol
+                if connection.state != "CONNECTION_LOST":
+                    connection.abort()
+
+        def connected(connection):
+            connections.append(connection)
+            return connection.request(
+                Request(method, requestPath, headers, bodyProducer,
+                        persistent=self._pool.persistent))
+
+        connecting = self._pool.getConnection(key, endpoint)
+        connecting.addCallback(connected)
+        d = defer.Deferred(cancel)
+
+        def relay(result):
+            if not d.called:
+                d.callback(result)
+
+        connecting.addBoth(relay)
+        return d
+
+    def request(self, method, uri, headers=None, bodyProducer=None,
+                timing=None):
+        """
+        Like L{Agent.request}, recording the time looking the host up and
+        connecting in C{timing}, if given.
+        """
+        parsed_uri = _parse(uri)
+        try:
+            endpoint = self._get_timed_endpoint(parsed_uri, timing)
+        except SchemeNotSupported:
+            return defer.fail(Failure())
+        return self._requestWithEndpoint(
+            self._get_key(parsed_uri), endpoint, method, parsed_uri, headers,
+            bodyProducer, parsed_uri.path)
+
+
+class _BodyCollector(Protocol):
+    """Accumulate a response body and fire C{finished} with it."""
+
+    def __init__(self, finished):
+        self.finished = finished
+        self.data = []
+
+    def dataReceived(self, data):
+        self.data.append(data)
+
+    def connectionLost(self, reason):
+        if reason.check(ResponseDone, http.PotentialDataLoss):
+            self.finished.callback("".join(self.data))
+        else:
+            self.finished.errback(reason)
+
+
+def _get_handle(connection):
+    """
+    Return the handle of the transport of C{connection}: the TLS connection
+    of an HTTPS connection.
+    """
+    if isinstance(connection, _RetryingHTTP11ClientProtocol):
+        connection = connection._clientProtocol
+    transport = getattr(connection, "transport", None)
+    if transport is not None:
+        return transport.getHandle()
+
+
+@implementer(IPushProducer)
+class _BodyStreamer(Protocol):
+    """
+    Write a response body to the C{stream} of a L{PageRequest} as it arrives,
+    and fire C{finished} with C{None} once it is complete.
+
+    The stream pausing us pauses the connection, as well as the timeout of
+    the request, which otherwise fails if no data arrives for that long.
+    """
+
+    def __init__(self, finished, page):
+        self.finished = finished
+        self.page = page
+        self.stream = page.stream
+        self.written = 0
+
+    def connectionMade(self):
+        self.stream.registerProducer(self, True)
+
+    def dataReceived(self, data):
+        self.written += len(data)
+        self.page.streamed = self.written
+        if self.page.timing is not None:
+            self.page.timing.response_bytes += len(data)
+        self.page.touch()
+        self.stream.write(data)
+
+    def pauseProducing(self):
+        self.page.stop_timer()
+        self.transport.pauseProducing()
+
+    def resumeProducing(self):
+        self.page.touch()
+        self.transport.resumeProducing()
+
+    def stopProducing(self):
+        self.transport.stopProducing()
+
+    def connectionLost(self, reason):
+        self.stream.unregisterProducer()
+        if reason.check(ResponseDone, http.PotentialDataLoss):
+            self.finished.callback(None)
+        elif self.written:
+            self.finished.errback(StreamInterrupted(self.written, reason))
+        else:
+            self.finished.errback(reason)
+
+
+class PageRequest(object):
+    """
+    A single request sent through an L{HTTPTransport}.
+
+    This exposes the same attributes as L{HTTPClientFactory}, so that a
+    L{BaseQuery} can use either of them as its C{client}.
+
+    @ivar deferred: A C{Deferred} firing with the response body for a C{200},
+        C{201}, C{202}, C{204} or C{206} response, or failing with a
+        L{TwistedWebError} otherwise. Cancelling it drops the connection of
+        the request.
+    @ivar headers: The C{dict} of request headers.
+    @ivar response_headers: A C{dict} mapping lower case header names to
+        lists of values, once the response has been received.
+    @ivar connection: The connection protocol used to send the request.
+    @ivar queued: Whether the request is still waiting for the scheduler of
+        the transport to let it go.
+    @ivar timing: The L{RequestTiming} the phases of the request are
+        recorded in, if any.
+    @ivar stream: The L{IConsumer} a successful response body is written to
+        as it arrives, in which case C{deferred} fires with C{None} and the
+        C{timeout} only bounds the time without any data arriving.
+    @ivar streamed: The number of bytes of the response body written to the
+        C{stream} so far.
+    """
+
+    def __init__(self, url, method="GET", postdata=None, headers=None,
+                 timeout=0, timing=None, stream=None):
+        self.url = url
+        self.method = method
+        self.postdata = postdata
+        if headers is None:
+            headers = {}
+        self.headers = headers
+        self.timeout = timeout
+        self.version = None
+        self.status = None
+        self.message = None
+        self.response_headers = None
+        self.connection = None
+        self.finished = False
+        self.queued = True
+        self.timing = timing
+        self.stream = stream
+        self.streamed = 0
+        self._times = {}
+        self._reactor = None
+        self._timeout_call = None
+        self._finish_waiters = []
+        self.deferred = defer.Deferred(self._cancel)
+
+    def start_timer(self, reactor):
+        """Fail the request if it doesn't complete in C{timeout} seconds."""
+        self._reactor = reactor
+        if self.timeout:
+            self._timeout_call = reactor.callLater(
+                self.timeout, self._timed_out)
+
+    def stop_timer(self):
+        if self._timeout_call is not None:
+            self._timeout_call.cancel()
+            self._timeout_call = None
+
+    def touch(self):
+        """Give the request C{timeout} more seconds, from now on."""
+        if self._timeout_call is not None:
+            self._timeout_call.reset(self.timeout)
+        elif self._reactor is not None and not self.finished:
+            self.start_timer(self._reactor)
+
+    def _timed_out(self):
+        self._timeout_call = None
+        reason = Failure(defer.TimeoutError(
+            "Getting %s took longer than %s seconds." %
+            (self.url, self.timeout)))
+        if self.streamed:
+            # The stream already has the beginning of the body.
+            reason = Failure(StreamInterrupted(self.streamed, reason))
+        self.fail(reason)
+        self.abort()
+
+    def get_request_headers(self, host):
+        """
+        Build the L{Headers} to send.
+
+        C{Content-Length} is left to the body producer, so that it is never
+        sent twice.
+        """
+        headers = Headers()
+        for name, value in self.headers.iteritems():
+            if name.lower() == "content-length":
+                continue
+            headers.addRawHeader(name, str(value))
+        if not headers.hasHeader("host"):
+            headers.addRawHeader("host", host)
+        return headers
+
+    def mark(self, event, clock):
+        """Note the time of C{event}, if the request is timed."""
+        if self.timing is not None:
+            self._times[event] = clock.seconds()
+
+    def get_phase(self, start, end):
+        """Return the time between two events noted by L{mark}."""
+        return self._times[end] - self._times[start]
+
+    def get_body_producer(self):
+        """
+        Return the L{IBodyProducer} of the request body, the C{postdata}
+        string or body object, see L{txaws.client.streaming}.
+        """
+        if self.postdata is None:
+            return None
+        if isinstance(self.postdata, str):
+            return StringBodyProducer(self.postdata)
+        return _TouchingBodyProducer(self.postdata.get_producer(), self)
+
+    def got_response(self, response):
+        self.version = "%s/%d.%d" % response.version
+        self.status = str(response.code)
+        self.message = response.phrase
+        self.response_headers = dict(
+            (name.lower(), values)
+            for name, values in response.headers.getAllRawHeaders())
+
+    def got_body(self, body):
+        if self.status in ("200", "201", "202", "204", "206"):
+            self.succeed(body)
+        else:
+            self.fail(Failure(TwistedWebError(
+                self.status, self.message, body)))
+
+    def succeed(self, result):
+        if not self.finished:
+            self._finish()
+            self.deferred.callback(result)
+
+    def fail(self, reason):
+        if not self.finished:
+            self._finish()
+            self.deferred.errback(reason)
+
+    def _cancel(self, deferred):
+        # Leave the scheduler queue or free the slot, and drop the
+        # connection.
+        if not self.finished:
+            self._finish()
+            self.abort()
+
+    def notify_finish(self):
+        """
+        Return a C{Deferred} firing with C{None} once the request succeeded or
+        failed, without touching the result of C{deferred}.
+        """
+        if self.finished:
+            return defer.succeed(None)
+        d = defer.Deferred()
+        self._finish_waiters.append(d)
+        return d
+
+    def _finish(self):
+        self.finished = True
+        self.stop_timer()
+        waiters, self._finish_waiters = self._finish_waiters, []
+        for d in waiters:
+            d.callback(None)
+
+    def abort(self):
+        """
+        Drop the connection, if any, so that it never goes back to the pool.
+        """
+        connection = self.connection
+        if isinstance(connection, _RetryingHTTP11ClientProtocol):
+            connection = connection._clientProtocol
+        if connection is not None and connection.state != "CONNECTION_LOST":
+            connection.abort()
+
+
+class HTTPTransport(object):
+    """
+    A connection-reusing HTTP transport.
+
+    One transport is typically owned by an L{AWSServiceRegion} and shared by
+    all of the endpoints, and therefore clients, it creates.
+
+    @param reactor: The reactor to use, by default the global one.
+    @param max_persistent_per_host: The maximum number of idle connections
+        kept alive for each host.
+    @param cached_connection_timeout: The number of seconds an idle connection
+        stays open before it is closed.
+    @param scheduler: The L{RequestScheduler} limiting the requests in
+        flight, by default one without limits.
+    @param retry_policy: The L{RetryPolicy} of the queries sent through this
+        transport, or C{None} to not retry them. The transport itself never
+        retries: L{BaseQuery} and L{SQSConnection} apply the policy.
+    @param rate_limiter: The L{RateLimiter} of the queries sent through this
+        transport, or C{None} to not limit their rate. Like the retry policy,
+        it is applied by the queries.
+    @param single_flight: The L{SingleFlight} coalescing identical read-only
+        queries sent through this transport, or C{None} to not coalesce them.
+    @param dns_cache: The L{DNSCache} resolving the hosts connected to, or
+        C{None} to let the reactor resolve them for every connection.
+    @param latency_tracker: The L{LatencyTracker} adapting the timeouts of
+        the queries sent through this transport, or C{None} to keep their
+        timeouts as they are.
+    @param timing_observers: The callables given the L{RequestTiming} of
+        every query sent through this transport, see L{SlowRequestLog}.
+    @param hashing_service: The L{HashingService} computing the digests of
+        big request bodies, by default the shared one.
+    """
+
+    def __init__(self, reactor=None, max_persistent_per_host=2,
+                 cached_connection_timeout=240, scheduler=None,
+                 retry_policy=None, rate_limiter=None, single_flight=None,
+                 dns_cache=None, latency_tracker=None, timing_observers=None,
+                 hashing_service=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        if scheduler is None:
+            scheduler = RequestScheduler(reactor)
+        self.scheduler = scheduler
+        self.retry_policy = retry_policy
+        self.rate_limiter = rate_limiter
+        self.single_flight = single_flight
+        self.dns_cache = dns_cache
+        self.latency_tracker = latency_tracker
+        if timing_observers is None:
+            timing_observers = []
+        self.timing_observers = timing_observers
+        self.hashing_service = hashing_service
+        self.pool = ConnectionPool(
+            reactor, max_persistent_per_host, cached_connection_timeout)
+        self._agents = {}
+
+    def get_agent(self, ssl_hostname_verification=False):
+        """
+        Return the L{PooledAgent} for the given verification mode.
+
+        This can be used directly by code, like L{SQSConnection}, which talks
+        to an L{Agent} rather than going through L{BaseQuery.get_page}.
+        """
+        agent = self._agents.get(ssl_hostname_verification)
+        if agent is None:
+            agent = PooledAgent(
+                self.reactor, self.pool, ssl_hostname_verification,
+                self.dns_cache)
+            self._agents[ssl_hostname_verification] = agent
+        return agent
+
+    def get_page(self, url, method="GET", postdata=None, headers=None,
+                 timeout=0, ssl_hostname_verification=False, action=None,
+                 priority=None, timing=None, stream=None):
+        """
+        Send a request, once the scheduler allows it, and collect the response
+        body.
+
+        The C{timeout} only starts once the scheduler lets the request go,
+        L{txaws.client.deadline.deadline} bounds the time spent queued too.
+
+        @param action: The action name the scheduler limits the request by.
+        @param priority: The scheduler lane of the request, by default the
+            one of C{action}.
+        @param timing: The L{RequestTiming} the phases of the request are
+            recorded in, if any.
+        @param stream: The L{IConsumer} to write a successful response body
+            to as it arrives, instead of collecting it.
+        @return: The L{PageRequest} for the call, whose C{deferred} fires with
+            the body, or with C{None} once it was streamed.
+        """
+        page = PageRequest(
+            url, method, postdata, headers, timeout, timing, stream)
+        page.mark("queued", self.reactor)
+        agent = self.get_agent(ssl_hostname_verification)
+        scheduled = self.scheduler.schedule(
+            lambda: self._start(page, agent), get_endpoint_key(url), action,
+            priority)
+        scheduled.addErrback(lambda failure: failure.trap(defer.CancelledError))
+
+        def cancel_queued(ignored):
+            # A request cancelled in the queue must not take a slot later.
+            if page.queued:
+                scheduled.cancel()
+
+        page.notify_finish().addCallback(cancel_queued)
+        return page
+
+    def _start(self, page, agent):
+        page.queued = False
+        page.start_timer(self.reactor)
+        page.mark("started", self.reactor)
+        if page.timing is not None:
+            page.timing.queue = page.get_phase("queued", "started")
+        d = agent.get_connection(page.url, page.timing)
+        d.addCallback(self._send, page, agent)
+        d.addCallback(self._receive, page)
+        d.addErrback(page.fail)
+        return page.notify_finish()
+
+    def _send(self, connection, page, agent):
+        page.connection = connection
+        if page.finished:
+            # The request timed out while we were connecting.
+            page.abort()
+            return
+        request = Request(
+            page.method, _parse(page.url).path,
+            page.get_request_headers(agent.get_host_value(page.url)),
+            page.get_body_producer(), persistent=True)
+        page.mark("sent", self.reactor)
+        return connection.request(request)
+
+    def _receive(self, response, page):
+        if response is None:
+            return
+        page.mark("received", self.reactor)
+        if page.timing is not None:
+            self._time_response(page)
+        page.got_response(response)
+        finished = defer.Deferred()
+        if response.code in http.NO_BODY_CODES or page.method == "HEAD":
+            # Twisted never ends the body of such responses.
+            finished.callback("")
+        elif page.stream is not None and page.status in ("200", "206"):
+            response.deliverBody(_BodyStreamer(finished, page))
+        else:
+            response.deliverBody(_BodyCollector(finished))
+        if page.timing is not None:
+            finished.addCallback(self._time_body, page)
+        return finished.addCallback(page.got_body)
+
+    def _time_response(self, page):
+        timing = page.timing
+        timing.ttfb = page.get_phase("sent", "received")
+        handshake = None
+        if timing.connect is not None:
+            # Only a new connection has a handshake to account for.
+            handshake = get_handshake_times(_get_handle(page.connection))
+        if handshake is not None:
+            started, done = handshake
+            timing.tls = done - started
+            # The handshake overlaps the sending of the request.
+            timing.ttfb -= max(0, done - max(started, page._times["sent"]))
+
+    def _time_body(self, body, page):
+        page.mark("done", self.reactor)
+        page.timing.body = page.get_phase("received", "done")
+        return body
+
+    def preconnect(self, url, count=1, ssl_hostname_verification=False):
+        """
+        Open up to C{count} idle connections to the host of C{url} ahead of
+        the first request.
+
+        @return: A C{Deferred} firing once the connections are open.
+        """
+        agent = self.get_agent(ssl_hostname_verification)
+        return agent.preconnect(url, count)
+
+    def get_stats(self):
+        """
+        Return the connection pool statistics, see L{ConnectionPool}.
+
+        The scheduler statistics are returned by C{scheduler.get_stats()}.
+        """
+        return self.pool.get_stats()
+
+    def close(self):
+        """
+        Close all idle connections.
+
+        @return: A C{Deferred} firing when they are all closed.
+        """
+        return self.pool.closeCachedConnections()
@@ -0,0 +1,211 @@
+# Licenced under the txaws licence available at /LICENSE in the txaws source.
+
+"""
+Caching of EC2 C{Describe*} responses.
+
+A L{DescribeCache} keeps the responses of C{Describe*} queries for a short
+time, so that polling the state of the same resources doesn't send a request
+every time. The calls changing resources drop the cached responses they
+affect.
+
+Responses are cached as the bodies returned by EC2, and parsed again for
+every query, so that callers never share the objects they are given.
+"""
+from collections import OrderedDict
+
+from twisted.internet import defer
+
+
+__all__ = ["DescribeCache", "DEFAULT_TTLS", "INVALIDATIONS"]
+
+
+# How many seconds the responses of each action are kept by default.
+DEFAULT_TTLS = {
+    "DescribeInstances": 5,
+    "DescribeVolumes": 5,
+    "DescribeSnapshots": 10,
+    "DescribeAddresses": 10,
+    "DescribeSecurityGroups": 10,
+    "DescribeKeyPairs": 30,
+    "DescribeAvailabilityZones": 300,
+    }
+
+# The cached actions whose responses are changed by each action. Actions not
+# listed here drop the whole cache, unless they are C{Describe*} ones.
+INVALIDATIONS = {
+    "RunInstances": ["DescribeInstances"],
+    "TerminateInstances": [
+        "DescribeInstances", "DescribeVolumes", "DescribeAddresses"],
+    "CreateSecurityGroup": ["DescribeSecurityGroups"],
+    "DeleteSecurityGroup": ["DescribeSecurityGroups"],
+    "AuthorizeSecurityGroupIngress": ["DescribeSecurityGroups"],
+    "RevokeSecurityGroupIngress": ["DescribeSecurityGroups"],
+    "CreateVolume": ["DescribeVolumes"],
+    "DeleteVolume": ["DescribeVolumes"],
+    "AttachVolume": ["DescribeVolumes", "DescribeInstances"],
+    "CreateSnapshot": ["DescribeSnapshots"],
+    "DeleteSnapshot": ["DescribeSnapshots"],
+    "CreateKeyPair": ["DescribeKeyPairs"],
+    "DeleteKeyPair": ["DescribeKeyPairs"],
+    "ImportKeyPair": ["DescribeKeyPairs"],
+    "AllocateAddress": ["DescribeAddresses"],
+    "ReleaseAddress": ["DescribeAddresses"],
+    "AssociateAddress": ["DescribeAddresses", "DescribeInstances"],
+    "DisassociateAddress": ["DescribeAddresses", "DescribeInstances"],
+    }
+
+
+class DescribeCache(object):
+    """
+    A bounded cache of EC2 responses, expiring after a time-to-live per
+    action.
+
+    @param reactor: The reactor giving the current time.
+    @param ttls: A C{dict} mapping the actions to cache to the number of
+        seconds their responses are kept, updating L{DEFAULT_TTLS}. An action
+        mapped to C{None} isn't cached.
+    @param max_size: The number of responses kept, the least recently used
+        ones are dropped beyond it.
+    @param invalidations: A C{dict} mapping actions to the cached actions they
+        affect, updating L{INVALIDATIONS}.
+    @ivar hits: The number of queries answered from the cache.
+    @ivar misses: The number of cacheable queries sent to EC2.
+    """
+
+    def __init__(self, reactor=None, ttls=None, max_size=1000,
+                 invalidations=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        self.ttls = dict(DEFAULT_TTLS)
+        if ttls:
+            self.ttls.update(ttls)
+        self.max_size = max_size
+        self.invalidations = dict(INVALIDATIONS)
+        if invalidations:
+            self.invalidations.update(invalidations)
+        self._entries = OrderedDict()
+        # Bumped by every invalidation of an action, so that a response
+        # requested before it isn't cached after it.
+        self._generations = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidated = 0
+        self._action_stats = {}
+
+    def get_ttl(self, action):
+        """
+        Return for how long the responses of C{action} are kept, or C{None} if
+        they aren't cached.
+        """
+        return self.ttls.get(action)
+
+    def _count(self, action, name):
+        stats = self._action_stats.setdefault(
+            action, {"hits": 0, "misses": 0})
+        stats[name] += 1
+        setattr(self, name, getattr(self, name) + 1)
+
+    def get(self, key):
+        """
+        Return the response cached for C{key}, or C{None} if there is none or
+        it expired.
+        """
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return None
+        expires, action, body = entry
+        if expires <= self.reactor.seconds():
+            return None
+        # Move it to the most recently used end.
+        self._entries[key] = entry
+        return body
+
+    def put(self, key, action, body):
+        """Cache C{body} as the response of C{action} for C{key}."""
+        ttl = self.get_ttl(action)
+        if ttl is None:
+            return
+        self._entries.pop(key, None)
+        self._entries[key] = (self.reactor.seconds() + ttl, action, body)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, actions=None):
+        """
+        Drop the cached responses of C{actions}, or of all actions if
+        C{None}.
+        """
+        if actions is None:
+            actions = set(self.ttls)
+            actions.update(action for expires, action, body
+                           in self._entries.itervalues())
+        actions = set(actions)
+        for action in actions:
+            self._generations[action] = self._generations.get(action, 0) + 1
+        for key, (expires, action, body) in self._entries.items():
+            if action in actions:
+                del self._entries[key]
+                self.invalidated += 1
+
+    def get_invalidated_actions(self, action):
+        """
+        Return the cached actions affected by C{action}, or C{None} if all of
+        them are.
+        """
+        if action.startswith("Describe"):
+            return []
+        return self.invalidations.get(action)
+
+    def run(self, query, call):
+        """
+        Answer C{query} from the cache, or else call C{call} and cache its
+        result.
+
+        Once C{call} returns for a query changing resources, whether it
+        succeeded or not, the responses it affects are dropped.
+
+        @param query: The L{Query} being submitted.
+        @param call: A callable sending the query and returning a C{Deferred}
+            firing with the response body.
+        """
+        action = query.action
+        if self.get_ttl(action) is None:
+            d = call()
+            actions = self.get_invalidated_actions(action)
+            if actions != []:
+                d.addBoth(self._invalidate_after, actions)
+            return d
+        key = query.get_cache_key()
+        body = self.get(key)
+        if body is not None:
+            self._count(action, "hits")
+            return defer.succeed(body)
+        self._count(action, "misses")
+        generation = self._generations.get(action, 0)
+        d = call()
+        d.addCallback(self._store, key, action, generation)
+        return d
+
+    def _store(self, body, key, action, generation):
+        if self._generations.get(action, 0) == generation:
+            self.put(key, action, body)
+        return body
+
+    def _invalidate_after(self, result, actions):
+        self.invalidate(actions)
+        return result
+
+    def get_stats(self):
+        """
+        Return a C{dict} with the C{hits}, C{misses}, C{evictions} and
+        C{invalidated} counts, the C{size} of the cache, and the C{hits} and
+        C{misses} per action under C{actions}.
+        """
+        return {"hits": self.hits, "misses": self.misses,
+                "evictions": self.evictions, "invalidated": self.invalidated,
+                "size": len(self._entries),
+                "actions": dict((action, dict(stats)) for action, stats
+                                in self._action_stats.iteritems())}
@@ -5,34 +5,50 @@
 
 """EC2 client support."""
 
-from datetime import datetime
+from copy import copy
 from urllib import quote
 from base64 import b64encode
 
 from txaws import version
-from txaws.client.base import BaseClient, BaseQuery, error_wrapper
+from txaws.client.base import (
+    BaseClient, BaseQuery, error_wrapper, timed_parse)
 from txaws.ec2 import model
 from txaws.ec2.exception import EC2Error
-from txaws.util import iso8601time, XML
+from txaws.util import iso8601time, parse_iso8601, XML
 
 
 __all__ = ["EC2Client", "Query", "Parser"]
 
 
+def _parse_time(text):
+    """Parse an EC2 date into a naive C{datetime} in UTC, to the second."""
+    return parse_iso8601(text).replace(tzinfo=None, microsecond=0)
+
+
 def ec2_error_wrapper(error):
     error_wrapper(error, EC2Error)
 
 
 class EC2Client(BaseClient):
-    """A client for EC2."""
+    """A client for EC2.
+
+    @param cache: The L{DescribeCache} answering the C{Describe*} queries of
+        this client, overriding the one of the endpoint.
+    """
 
     def __init__(self, creds=None, endpoint=None, query_factory=None,
-                 parser=None):
+                 parser=None, retry_policy=None, rate_limiter=None,
+                 single_flight=None, cache=None):
         if query_factory is None:
             query_factory = Query
         if parser is None:
             parser = Parser()
-        super(EC2Client, self).__init__(creds, endpoint, query_factory, parser)
+        super(EC2Client, self).__init__(
+            creds, endpoint, query_factory, parser, retry_policy,
+            rate_limiter, single_flight)
+        if cache is not None:
+            self.endpoint = copy(self.endpoint)
+            self.endpoint.cache = cache
 
     def describe_instances(self, *instance_ids):
         """Describe current instances."""
@@ -575,6 +591,7 @@ class Parser(object):
             kernel_id, ramdisk_id, reservation=reservation)
         return instance
 
+    @timed_parse
     def describe_instances(self, xml_bytes):
         """
         Parse the reservations XML payload that is returned from an AWS
@@ -615,6 +632,7 @@ class Parser(object):
             results.extend(instances)
         return results
 
+    @timed_parse
     def run_instances(self, xml_bytes):
         """
         Parse the reservations XML payload that is returned from an AWS
@@ -638,6 +656,7 @@ class Parser(object):
         instances = self.instances_set(root, reservation)
         return instances
 
+    @timed_parse
     def terminate_instances(self, xml_bytes):
         """Parse the XML returned by the C{TerminateInstances} function.
 
@@ -660,6 +679,7 @@ class Parser(object):
                 result.append((instanceId, previousState, currentState))
         return result
 
+    @timed_parse
     def describe_security_groups(self, xml_bytes):
         """Parse the XML returned by the C{DescribeSecurityGroups} function.
 
@@ -714,6 +734,7 @@ class Parser(object):
             result.append(security_group)
         return result
 
+    @timed_parse
     def truth_return(self, xml_bytes):
         """Parse the XML for a truth value.
 
@@ -723,6 +744,7 @@ class Parser(object):
         root = XML(xml_bytes)
         return root.findtext("return") == "true"
 
+    @timed_parse
     def describe_volumes(self, xml_bytes):
         """Parse the XML returned by the C{DescribeVolumes} function.
 
@@ -741,8 +763,7 @@ class Parser(object):
             availability_zone = volume_data.findtext("availabilityZone")
             status = volume_data.findtext("status")
             create_time = volume_data.findtext("createTime")
-            create_time = datetime.strptime(
-                create_time[:19], "%Y-%m-%dT%H:%M:%S")
+            create_time = _parse_time(create_time)
             volume = model.Volume(
                 volume_id, size, status, create_time, availability_zone,
                 snapshot_id)
@@ -752,13 +773,13 @@ class Parser(object):
                 device = attachment_data.findtext("device")
                 status = attachment_data.findtext("status")
                 attach_time = attachment_data.findtext("attachTime")
-                attach_time = datetime.strptime(
-                    attach_time[:19], "%Y-%m-%dT%H:%M:%S")
+                attach_time = _parse_time(attach_time)
                 attachment = model.Attachment(
                     instance_id, device, status, attach_time)
                 volume.attachments.append(attachment)
         return result
 
+    @timed_parse
     def create_volume(self, xml_bytes):
         """Parse the XML returned by the C{CreateVolume} function.
 
@@ -773,13 +794,13 @@ class Parser(object):
         availability_zone = root.findtext("availabilityZone")
         status = root.findtext("status")
         create_time = root.findtext("createTime")
-        create_time = datetime.strptime(
-            create_time[:19], "%Y-%m-%dT%H:%M:%S")
+        create_time = _parse_time(create_time)
         volume = model.Volume(
             volume_id, size, status, create_time, availability_zone,
             snapshot_id)
         return volume
 
+    @timed_parse
     def snapshots(self, xml_bytes):
         """Parse the XML returned by the C{DescribeSnapshots} function.
 
@@ -797,8 +818,7 @@ class Parser(object):
             volume_id = snapshot_data.findtext("volumeId")
             status = snapshot_data.findtext("status")
             start_time = snapshot_data.findtext("startTime")
-            start_time = datetime.strptime(
-                start_time[:19], "%Y-%m-%dT%H:%M:%S")
+            start_time = _parse_time(start_time)
             progress = snapshot_data.findtext("progress")[:-1]
             progress = float(progress or "0") / 100.
             snapshot = model.Snapshot(
@@ -806,6 +826,7 @@ class Parser(object):
             result.append(snapshot)
         return result
 
+    @timed_parse
     def create_snapshot(self, xml_bytes):
         """Parse the XML returned by the C{CreateSnapshot} function.
 
@@ -820,13 +841,13 @@ class Parser(object):
         volume_id = root.findtext("volumeId")
         status = root.findtext("status")
         start_time = root.findtext("startTime")
-        start_time = datetime.strptime(
-            start_time[:19], "%Y-%m-%dT%H:%M:%S")
+        start_time = _parse_time(start_time)
         progress = root.findtext("progress")[:-1]
         progress = float(progress or "0") / 100.
         return model.Snapshot(
             snapshot_id, volume_id, status, start_time, progress)
 
+    @timed_parse
     def attach_volume(self, xml_bytes):
         """Parse the XML returned by the C{AttachVolume} function.
 
@@ -839,10 +860,10 @@ class Parser(object):
         root = XML(xml_bytes)
         status = root.findtext("status")
         attach_time = root.findtext("attachTime")
-        attach_time = datetime.strptime(
-            attach_time[:19], "%Y-%m-%dT%H:%M:%S")
+        attach_time = _parse_time(attach_time)
         return {"status": status, "attach_time": attach_time}
 
+    @timed_parse
     def describe_keypairs(self, xml_bytes):
         """Parse the XML returned by the C{DescribeKeyPairs} function.
 
@@ -861,6 +882,7 @@ class Parser(object):
             results.append(model.Keypair(key_name, key_fingerprint))
         return results
 
+    @timed_parse
     def create_keypair(self, xml_bytes):
         """Parse the XML returned by the C{CreateKeyPair} function.
 
@@ -874,6 +896,7 @@ class Parser(object):
         key_material = keypair_data.findtext("keyMaterial")
         return model.Keypair(key_name, key_fingerprint, key_material)
 
+    @timed_parse
     def import_keypair(self, xml_bytes, key_material):
         """Extract the key name and the fingerprint from the result.
 
@@ -885,6 +908,7 @@ class Parser(object):
         key_fingerprint = keypair_data.findtext("keyFingerprint")
         return model.Keypair(key_name, key_fingerprint, key_material)
 
+    @timed_parse
     def allocate_address(self, xml_bytes):
         """Parse the XML returned by the C{AllocateAddress} function.
 
@@ -894,6 +918,7 @@ class Parser(object):
         address_data = XML(xml_bytes)
         return address_data.findtext("publicIp")
 
+    @timed_parse
     def describe_addresses(self, xml_bytes):
         """Parse the XML returned by the C{DescribeAddresses} function.
 
@@ -909,6 +934,7 @@ class Parser(object):
             results.append((address, instance_id))
         return results
 
+    @timed_parse
     def describe_availability_zones(self, xml_bytes):
         """Parse the XML returned by the C{DescribeAvailibilityZones} function.
 
@@ -931,6 +957,7 @@ class Query(BaseQuery):
     """A query that may be submitted to EC2."""
 
     timeout = 30
+    service = "ec2"
 
     def __init__(self, other_params=None, time_tuple=None, api_version=None,
                  *args, **kwargs):
@@ -990,9 +1017,30 @@ class Query(BaseQuery):
             kwargs["headers"] = headers
         if self.timeout:
             kwargs["timeout"] = self.timeout
-        d = self.get_page(url, **kwargs)
+        cache = getattr(self.endpoint, "cache", None)
+        if cache is not None:
+            d = cache.run(self, lambda: self.get_page(url, **kwargs))
+        else:
+            d = self.get_page(url, **kwargs)
         return d.addErrback(ec2_error_wrapper)
 
+    def get_cache_key(self):
+        """
+        Return what identifies the response of this query: its credentials,
+        endpoint and parameters, leaving out the timestamp and signature.
+        """
+        params = tuple(sorted(
+            (key, value) for key, value in self.params.iteritems()
+            if key not in ("Timestamp", "Expires", "Signature")))
+        return (self.creds.access_key, self.endpoint.get_uri(), self.action,
+                params)
+
+    def get_single_flight_key(self, url, **kwds):
+        """Share C{Describe*} queries with the same L{get_cache_key}."""
+        if not self.action.startswith("Describe"):
+            return None
+        return self.get_cache_key()
+
 
 class Signature(object):
     """Compute EC2-compliant signatures for requests.
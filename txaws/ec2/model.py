@@ -5,6 +5,8 @@
 
 """EC2 client support."""
 
+from txaws.util import parse_iso8601
+
 
 class Reservation(object):
     """An Amazon EC2 Reservation.
@@ -68,6 +70,13 @@ class Instance(object):
         self.ramdisk_id = ramdisk_id
         self.reservation = reservation
 
+    @property
+    def launch_date(self):
+        """The C{launch_time} as a C{datetime} in UTC, if known."""
+        if self.launch_time:
+            return parse_iso8601(self.launch_time)
+        return None
+
 
 class SecurityGroup(object):
     """An EC2 security group.
@@ -0,0 +1,142 @@
+from twisted.internet.defer import Deferred, succeed
+from twisted.internet.task import Clock
+
+from txaws.credentials import AWSCredentials
+from txaws.ec2 import client
+from txaws.ec2.cache import DescribeCache
+from txaws.service import AWSServiceEndpoint, EC2_ENDPOINT_US
+from txaws.testing import payload
+from txaws.testing.base import TXAWSTestCase
+
+
+class StubQuery(object):
+
+    def __init__(self, action, key=None):
+        self.action = action
+        self.key = key
+
+    def get_cache_key(self):
+        return self.key
+
+
+class DescribeCacheTestCase(TXAWSTestCase):
+
+    def setUp(self):
+        super(DescribeCacheTestCase, self).setUp()
+        self.clock = Clock()
+        self.cache = DescribeCache(self.clock)
+        self.calls = []
+
+    def submit(self, action, key=None, body="body"):
+        def call():
+            self.calls.append(action)
+            return succeed(body)
+
+        results = []
+        d = self.cache.run(StubQuery(action, key), call)
+        d.addCallback(results.append)
+        return results[0]
+
+    def test_hit(self):
+        self.assertEqual("body", self.submit("DescribeInstances", "a"))
+        self.assertEqual("body", self.submit("DescribeInstances", "a"))
+        self.assertEqual(["DescribeInstances"], self.calls)
+        self.submit("DescribeInstances", "b")
+        stats = self.cache.get_stats()
+        self.assertEqual(1, stats["hits"])
+        self.assertEqual(2, stats["misses"])
+        self.assertEqual(
+            {"hits": 1, "misses": 2}, stats["actions"]["DescribeInstances"])
+
+    def test_ttl(self):
+        self.cache = DescribeCache(
+            self.clock, ttls={"DescribeInstances": 10, "DescribeVolumes": None})
+        self.submit("DescribeInstances", "a")
+        self.clock.advance(9)
+        self.submit("DescribeInstances", "a")
+        self.assertEqual(1, len(self.calls))
+        self.clock.advance(1)
+        self.submit("DescribeInstances", "a")
+        self.assertEqual(2, len(self.calls))
+        self.submit("DescribeVolumes", "b")
+        self.submit("DescribeVolumes", "b")
+        self.assertEqual(4, len(self.calls))
+
+    def test_lru(self):
+        """
+        Beyond its size, the cache drops the least recently used responses.
+        """
+        self.cache = DescribeCache(self.clock, max_size=2)
+        self.submit("DescribeInstances", "a")
+        self.submit("DescribeInstances", "b")
+        self.submit("DescribeInstances", "a")
+        self.submit("DescribeInstances", "c")
+        self.assertIdentical(None, self.cache.get("b"))
+        self.assertEqual("body", self.cache.get("a"))
+        self.assertEqual(1, self.cache.get_stats()["evictions"])
+
+    def test_invalidation(self):
+        """
+        Calls changing resources drop the responses they affect.
+        """
+        self.submit("DescribeInstances", "a")
+        self.submit("DescribeKeyPairs", "b")
+        self.submit("TerminateInstances")
+        self.assertIdentical(None, self.cache.get("a"))
+        self.assertEqual("body", self.cache.get("b"))
+        self.assertEqual(1, self.cache.get_stats()["invalidated"])
+
+    def test_unknown_action_invalidates_all(self):
+        self.submit("DescribeInstances", "a")
+        self.submit("DescribeKeyPairs", "b")
+        self.submit("RebootInstances")
+        self.assertEqual(0, self.cache.get_stats()["size"])
+
+    def test_invalidation_while_in_flight(self):
+        """
+        A response requested before an invalidation isn't cached, since it
+        may not reflect the change.
+        """
+        pending = Deferred()
+        self.cache.run(StubQuery("DescribeVolumes", "a"), lambda: pending)
+        self.submit("CreateVolume")
+        pending.callback("stale")
+        self.assertIdentical(None, self.cache.get("a"))
+
+
+class EC2ClientCacheTestCase(TXAWSTestCase):
+
+    def test_describe_cached(self):
+        """
+        L{EC2Client} answers repeated C{Describe*} calls from its cache, with
+        newly parsed results, until a call changes the resources.
+        """
+        sent = []
+
+        class Query(client.Query):
+
+            def get_page(self, url, *args, **kwds):
+                sent.append(self.action)
+                if self.action == "DescribeInstances":
+                    return succeed(payload.sample_describe_instances_result)
+                return succeed(payload.sample_terminate_instances_result)
+
+        cache = DescribeCache(Clock())
+        ec2 = client.EC2Client(
+            creds=AWSCredentials("foo", "bar"),
+            endpoint=AWSServiceEndpoint(uri=EC2_ENDPOINT_US),
+            query_factory=Query, cache=cache)
+        results = []
+        ec2.describe_instances().addCallback(results.append)
+        ec2.describe_instances().addCallback(results.append)
+        self.assertEqual(["DescribeInstances"], sent)
+        self.assertEqual(results[0][0].instance_id, results[1][0].instance_id)
+        self.assertNotIdentical(results[0][0], results[1][0])
+        ec2.terminate_instances("i-1234")
+        ec2.describe_instances()
+        self.assertEqual(
+            ["DescribeInstances", "TerminateInstances", "DescribeInstances"],
+            sent)
+        self.assertEqual(
+            {"hits": 1, "misses": 2}, cache.get_stats()["actions"][
+                "DescribeInstances"])
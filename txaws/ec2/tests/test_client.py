@@ -6,8 +6,10 @@
 from datetime import datetime
 import os
 
+from dateutil.tz import tzutc
+
 from twisted.internet import reactor
-from twisted.internet.defer import succeed, fail
+from twisted.internet.defer import Deferred, fail, gatherResults, succeed
 from twisted.internet.error import ConnectionRefusedError
 from twisted.python.failure import Failure
 from twisted.python.filepath import FilePath
@@ -15,6 +17,7 @@ from twisted.web import server, static, util
 from twisted.web.error import Error as TwistedWebError
 from twisted.protocols.policies import WrappingFactory
 
+from txaws.client.coalesce import SingleFlight
 from txaws.util import iso8601time
 from txaws.credentials import AWSCredentials
 from txaws.ec2 import client
@@ -188,6 +191,9 @@ class EC2ClientInstancesTestCase(TXAWSTestCase):
         self.assertEquals(instance.key_name, "keyname")
         self.assertEquals(instance.ami_launch_index, "0")
         self.assertEquals(instance.launch_time, "2009-04-27T02:23:18.000Z")
+        self.assertEquals(
+            instance.launch_date,
+            datetime(2009, 4, 27, 2, 23, 18, tzinfo=tzutc()))
         self.assertEquals(instance.placement, "us-east-1c")
         self.assertEquals(instance.product_codes, ["774F4FF8"])
         self.assertEquals(instance.kernel_id, "aki-b51cf9dc")
@@ -1723,6 +1729,65 @@ class QueryTestCase(TXAWSTestCase):
         d.addCallback(check_error)
         return d
 
+    def test_single_flight_key(self):
+        """
+        C{Describe*} queries differing only by their timestamp share the same
+        single-flight key, other actions aren't shared.
+        """
+        first = client.Query(
+            action="DescribeInstances", creds=self.creds,
+            endpoint=self.endpoint,
+            time_tuple=(2009, 8, 15, 13, 14, 15, 0, 0, 0))
+        second = client.Query(
+            action="DescribeInstances", creds=self.creds,
+            endpoint=self.endpoint,
+            time_tuple=(2009, 8, 15, 13, 14, 16, 0, 0, 0))
+        first.sign()
+        second.sign()
+        self.assertEqual(first.get_single_flight_key("url"),
+                         second.get_single_flight_key("url"))
+        other = client.Query(
+            action="DescribeInstances", creds=self.creds,
+            endpoint=self.endpoint, other_params={"InstanceId.1": "i-1"})
+        self.assertNotEqual(first.get_single_flight_key("url"),
+                            other.get_single_flight_key("url"))
+        query = client.Query(
+            action="TerminateInstances", creds=self.creds,
+            endpoint=self.endpoint)
+        self.assertIdentical(None, query.get_single_flight_key("url"))
+
+    def test_single_flight(self):
+        """
+        Identical C{Describe*} calls in flight share a single request, and
+        each caller gets its own parsed result.
+        """
+        pages = []
+
+        class StubQuery(client.Query):
+
+            def _retry_page(self, url, *args, **kwds):
+                d = Deferred()
+                pages.append(d)
+                return d
+
+        ec2 = client.EC2Client(
+            creds=self.creds, endpoint=self.endpoint, query_factory=StubQuery,
+            single_flight=SingleFlight())
+        first = ec2.describe_instances()
+        second = ec2.describe_instances()
+        self.assertEqual(1, len(pages))
+        pages[0].callback(payload.sample_describe_instances_result)
+
+        def check_results(results):
+            self.assertEqual(
+                ["i-abcdef01"], [i.instance_id for i in results[0]])
+            self.assertEqual(
+                ["i-abcdef01"], [i.instance_id for i in results[1]])
+            self.assertNotIdentical(results[0][0], results[1][0])
+
+        d = gatherResults([first, second])
+        return d.addCallback(check_results)
+
 
 class SignatureTestCase(TXAWSTestCase):
 
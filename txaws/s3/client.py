@@ -12,21 +12,57 @@ API stability: unstable.
 Various API-incompatible changes are planned in order to expose missing
 functionality in this wrapper.
 """
+from StringIO import StringIO
+from base64 import b64encode
 import mimetypes
+import re
+from urllib import quote
+from xml.sax.saxutils import escape
 
+from twisted.internet.defer import succeed
+from twisted.python.failure import Failure
 from twisted.web.http import datetimeToString
 
-from dateutil.parser import parse as parseTime
-
-from txaws.client.base import BaseClient, BaseQuery, error_wrapper
+from txaws.client.base import (
+    BaseClient, BaseQuery, error_wrapper, timed_parse)
+from txaws.client.hashing import get_hashing_service
+from txaws.client.streaming import (
+    FileBody, MD5Consumer, get_body, get_body_length, get_consumer,
+    get_flush)
 from txaws.s3.acls import AccessControlPolicy
 from txaws.s3.model import (
-    Bucket, BucketItem, BucketListing, ItemOwner, LifecycleConfiguration,
-    LifecycleConfigurationRule, NotificationConfiguration, RequestPayment,
-    VersioningConfiguration, WebsiteConfiguration)
-from txaws.s3.exception import S3Error
+    Bucket, BucketItem, BucketItemColumns, BucketListing, DeleteResult,
+    FileChunk, ItemOwner,
+    LifecycleConfiguration, LifecycleConfigurationRule,
+    MultipartCompletionResponse, MultipartInitiationResponse,
+    MultipartUploadItem,
+    NotificationConfiguration, RequestPayment, VersioningConfiguration,
+    WebsiteConfiguration)
+from txaws.s3.exception import ChecksumError, S3Error
 from txaws.service import AWSServiceEndpoint, S3_ENDPOINT
-from txaws.util import XML, calculate_md5
+from txaws.util import (
+    XML, calculate_md5, parse_iso8601, parse_iso8601_timestamp)
+
+
+# The query parameters naming a sub-resource, which are part of the string
+# to sign.
+_SUB_RESOURCES = frozenset([
+    "acl", "delete", "lifecycle", "location", "logging", "notification",
+    "partNumber", "policy", "requestPayment", "torrent", "uploadId",
+    "uploads", "versionId", "versioning", "versions", "website"])
+
+# The ETag of objects uploaded in one piece without KMS encryption.
+_MD5_ETAG = re.compile("^[0-9a-fA-F]{32}$")
+
+# The most objects a multi-object delete can delete.
+MAX_DELETE_KEYS = 1000
+
+
+def _quote(value):
+    """Quote a query parameter value, encoding C{unicode} as UTF-8."""
+    if isinstance(value, unicode):
+        value = value.encode("utf-8")
+    return quote(str(value), safe="")
 
 
 def s3_error_wrapper(error):
@@ -74,10 +110,13 @@ class URLContext(object):
 class S3Client(BaseClient):
     """A client for S3."""
 
-    def __init__(self, creds=None, endpoint=None, query_factory=None):
+    def __init__(self, creds=None, endpoint=None, query_factory=None,
+                 retry_policy=None, rate_limiter=None, single_flight=None):
         if query_factory is None:
             query_factory = Query
-        super(S3Client, self).__init__(creds, endpoint, query_factory)
+        super(S3Client, self).__init__(
+            creds, endpoint, query_factory, retry_policy=retry_policy,
+            rate_limiter=rate_limiter, single_flight=single_flight)
 
     def list_buckets(self):
         """
@@ -91,6 +130,7 @@ class S3Client(BaseClient):
         d = query.submit()
         return d.addCallback(self._parse_list_buckets)
 
+    @timed_parse
     def _parse_list_buckets(self, xml_bytes):
         """
         Parse XML bucket list response.
@@ -100,7 +140,7 @@ class S3Client(BaseClient):
         for bucket_data in root.find("Buckets"):
             name = bucket_data.findtext("Name")
             date_text = bucket_data.findtext("CreationDate")
-            date_time = parseTime(date_text)
+            date_time = parse_iso8601(date_text)
             bucket = Bucket(name, date_time)
             buckets.append(bucket)
         return buckets
@@ -125,45 +165,135 @@ class S3Client(BaseClient):
             bucket=bucket)
         return query.submit()
 
-    def get_bucket(self, bucket):
+    def get_bucket(self, bucket, marker=None, prefix=None, max_keys=None,
+                   delimiter=None, columnar=False):
         """
-        Get a list of all the objects in a bucket.
+        Get a list of the objects in a bucket.
+
+        S3 lists at most C{max_keys} objects, 1000 by default, per request:
+        the listing is truncated when there are more of them, and its
+        C{next_marker} is the C{marker} of the next page.
+
+        @param marker: The key the listing starts after, if any.
+        @param prefix: The prefix of the keys listed, if any.
+        @param max_keys: The largest number of keys listed, if any.
+        @param delimiter: The string keys are rolled up at into the
+            C{common_prefixes} of the listing, after the prefix, if any.
+        @param columnar: Whether the contents of the listing are kept in
+            L{BucketItemColumns}, which is faster and takes less memory.
+        @return: A C{Deferred} that will fire with a L{BucketListing}.
         """
+        return self._get_bucket(bucket, [
+            ("marker", marker), ("prefix", prefix), ("max-keys", max_keys),
+            ("delimiter", delimiter)], columnar)
+
+    def list_objects(self, bucket, continuation_token=None, prefix=None,
+                     max_keys=None, delimiter=None, start_after=None,
+                     fetch_owner=False, columnar=False):
+        """
+        Get a list of the objects in a bucket with I{ListObjectsV2}.
+
+        Unlike L{get_bucket}, pages are followed with an opaque
+        C{next_continuation_token}, and the owners of the objects are left
+        out unless C{fetch_owner} is true, which makes the listings smaller.
+
+        @param continuation_token: The C{next_continuation_token} of the
+            previous page, if any.
+        @param start_after: The key the listing starts after, for its first
+            page.
+        @param columnar: Whether the contents of the listing are kept in
+            L{BucketItemColumns}.
+        @return: A C{Deferred} that will fire with a L{BucketListing}, the
+            C{owner} of the items of which is C{None} unless C{fetch_owner}
+            is true.
+        """
+        return self._get_bucket(bucket, [
+            ("list-type", 2), ("continuation-token", continuation_token),
+            ("prefix", prefix), ("max-keys", max_keys),
+            ("delimiter", delimiter), ("start-after", start_after),
+            ("fetch-owner", "true" if fetch_owner else None)], columnar)
+
+    def _get_bucket(self, bucket, parameters, columnar):
+        kwargs = {}
+        parameters = [
+            "%s=%s" % (name, _quote(value))
+            for name, value in parameters if value is not None]
+        if parameters:
+            kwargs["object_name"] = "?" + "&".join(parameters)
         query = self.query_factory(
             action="GET", creds=self.creds, endpoint=self.endpoint,
-            bucket=bucket)
+            bucket=bucket, **kwargs)
         d = query.submit()
-        return d.addCallback(self._parse_get_bucket)
+        return d.addCallback(self._parse_get_bucket, columnar)
 
-    def _parse_get_bucket(self, xml_bytes):
+    @timed_parse
+    def _parse_get_bucket(self, xml_bytes, columnar=False):
         root = XML(xml_bytes)
         name = root.findtext("Name")
         prefix = root.findtext("Prefix")
         marker = root.findtext("Marker")
         max_keys = root.findtext("MaxKeys")
         is_truncated = root.findtext("IsTruncated")
-        contents = []
+        if columnar:
+            contents = self._parse_bucket_item_columns(root)
+        else:
+            contents = self._parse_bucket_items(root)
 
+        common_prefixes = []
+        for prefix_data in root.findall("CommonPrefixes"):
+            common_prefixes.append(prefix_data.findtext("Prefix"))
+
+        next_marker = None
+        next_continuation_token = None
+        if is_truncated == "true":
+            next_continuation_token = root.findtext("NextContinuationToken")
+            # S3 only gives the next marker when there is a delimiter,
+            # otherwise it is the last key.
+            next_marker = root.findtext("NextMarker")
+            if next_marker is None and contents:
+                next_marker = contents[-1].key
+
+        return BucketListing(name, prefix, marker, max_keys, is_truncated,
+                             contents, common_prefixes, next_marker,
+                             next_continuation_token)
+
+    def _parse_bucket_items(self, root):
+        contents = []
         for content_data in root.findall("Contents"):
             key = content_data.findtext("Key")
             date_text = content_data.findtext("LastModified")
-            modification_date = parseTime(date_text)
+            modification_date = parse_iso8601(date_text)
             etag = content_data.findtext("ETag")
             size = content_data.findtext("Size")
             storage_class = content_data.findtext("StorageClass")
-            owner_id = content_data.findtext("Owner/ID")
-            owner_display_name = content_data.findtext("Owner/DisplayName")
-            owner = ItemOwner(owner_id, owner_display_name)
+            owner = None
+            if content_data.find("Owner") is not None:
+                owner_id = content_data.findtext("Owner/ID")
+                owner_display_name = content_data.findtext(
+                    "Owner/DisplayName")
+                owner = ItemOwner(owner_id, owner_display_name)
             content_item = BucketItem(key, modification_date, etag, size,
                                       storage_class, owner)
             contents.append(content_item)
+        return contents
 
-        common_prefixes = []
-        for prefix_data in root.findall("CommonPrefixes"):
-            common_prefixes.append(prefix_data.text)
-
-        return BucketListing(name, prefix, marker, max_keys, is_truncated,
-                             contents, common_prefixes)
+    def _parse_bucket_item_columns(self, root):
+        columns = BucketItemColumns()
+        for content_data in root.findall("Contents"):
+            owner_id = owner_display_name = None
+            owner_data = content_data.find("Owner")
+            if owner_data is not None:
+                owner_id = owner_data.findtext("ID")
+                owner_display_name = owner_data.findtext("DisplayName")
+            columns.append(
+                content_data.findtext("Key"),
+                parse_iso8601_timestamp(
+                    content_data.findtext("LastModified")),
+                content_data.findtext("ETag"),
+                int(content_data.findtext("Size")),
+                content_data.findtext("StorageClass"), owner_id,
+                owner_display_name)
+        return columns
 
     def get_bucket_location(self, bucket):
         """
@@ -178,6 +308,7 @@ class S3Client(BaseClient):
         d = query.submit()
         return d.addCallback(self._parse_bucket_location)
 
+    @timed_parse
     def _parse_bucket_location(self, xml_bytes):
         """Parse a C{LocationConstraint} XML document."""
         root = XML(xml_bytes)
@@ -196,6 +327,7 @@ class S3Client(BaseClient):
             bucket=bucket, object_name='?lifecycle')
         return query.submit().addCallback(self._parse_lifecycle_config)
 
+    @timed_parse
     def _parse_lifecycle_config(self, xml_bytes):
         """Parse a C{LifecycleConfiguration} XML document."""
         root = XML(xml_bytes)
@@ -224,6 +356,7 @@ class S3Client(BaseClient):
             bucket=bucket, object_name='?website')
         return query.submit().addCallback(self._parse_website_config)
 
+    @timed_parse
     def _parse_website_config(self, xml_bytes):
         """Parse a C{WebsiteConfiguration} XML document."""
         root = XML(xml_bytes)
@@ -245,6 +378,7 @@ class S3Client(BaseClient):
             bucket=bucket, object_name='?notification')
         return query.submit().addCallback(self._parse_notification_config)
 
+    @timed_parse
     def _parse_notification_config(self, xml_bytes):
         """Parse a C{NotificationConfiguration} XML document."""
         root = XML(xml_bytes)
@@ -265,6 +399,7 @@ class S3Client(BaseClient):
             bucket=bucket, object_name='?versioning')
         return query.submit().addCallback(self._parse_versioning_config)
 
+    @timed_parse
     def _parse_versioning_config(self, xml_bytes):
         """Parse a C{VersioningConfiguration} XML document."""
         root = XML(xml_bytes)
@@ -292,6 +427,7 @@ class S3Client(BaseClient):
             bucket=bucket, object_name='?acl', data=data)
         return query.submit().addCallback(self._parse_acl)
 
+    @timed_parse
     def _parse_acl(self, xml_bytes):
         """
         Parse an C{AccessControlPolicy} XML document and convert it into an
@@ -299,21 +435,70 @@ class S3Client(BaseClient):
         """
         return AccessControlPolicy.from_xml(xml_bytes)
 
-    def put_object(self, bucket, object_name, data, content_type=None,
-                   metadata={}, amz_headers={}):
+    def put_object(self, bucket, object_name, data=None, content_type=None,
+                   metadata={}, amz_headers={}, filename=None):
         """
         Put an object in a bucket.
 
         An existing object with the same name will be replaced.
 
+        Data given as a file or a producer is sent as the connection takes
+        it, without being read in memory. The MD5 digest of a file is
+        computed beforehand, for the C{Content-MD5} header, so that the file
+        is read twice from its current position to its end: it must not
+        change in between. Big strings and files are hashed off the reactor
+        thread, see L{HashingService}.
+
         @param bucket: The name of the bucket.
         @param object: The name of the object.
-        @param data: The data to write.
+        @param data: The data to write: a string, a file object, an
+            L{IBodyProducer} of known length or a body object like a
+            L{FileBody}.
         @param content_type: The type of data being written.
         @param metadata: A C{dict} used to build C{x-amz-meta-*} headers.
         @param amz_headers: A C{dict} used to build C{x-amz-*} headers.
+        @param filename: The name of a file to write, instead of C{data}.
         @return: A C{Deferred} that will fire with the result of request.
         """
+        if filename is not None:
+            data = open(filename, "rb")
+        elif data is None:
+            data = ""
+        d = self._get_body(data)
+        d.addCallback(
+            lambda body: self._put_object(
+                bucket, object_name, body, content_type, metadata,
+                amz_headers))
+        if filename is not None:
+
+            def close(result):
+                data.close()
+                return result
+
+            d.addBoth(close)
+        return d
+
+    def _get_body(self, data):
+        """
+        Return a C{Deferred} firing with the request body sending C{data},
+        once the MD5 digest of big strings and files was computed by the
+        L{HashingService} of the endpoint.
+        """
+        if hasattr(data, "get_producer"):
+            return succeed(data)
+        service = get_hashing_service(self.endpoint)
+        if not isinstance(data, str):
+            return get_body(data, service)
+        if len(data) < service.threshold:
+            # Hashed while signing.
+            return succeed(data)
+        d = service.hash_string(data)
+        return d.addCallback(
+            lambda digest: FileBody(
+                StringIO(data), 0, len(data), b64encode(digest.digest())))
+
+    def _put_object(self, bucket, object_name, data, content_type, metadata,
+                    amz_headers):
         query = self.query_factory(
             action="PUT", creds=self.creds, endpoint=self.endpoint,
             bucket=bucket, object_name=object_name, data=data,
@@ -356,6 +541,64 @@ class S3Client(BaseClient):
             bucket=bucket, object_name=object_name)
         return query.submit()
 
+    def get_object_stream(self, bucket, object_name, target,
+                          verify_md5=True, byte_range=None, if_match=None):
+        """
+        Get an object from a bucket, writing it to C{target} as it arrives.
+
+        The connection is paused while C{target} can't keep up, so that the
+        object is never held in memory.
+
+        @param target: An L{IConsumer}, a file-like object or a callable given
+            each chunk of data, which can return a C{Deferred} to be given
+            the next chunk only after it fired, see L{get_consumer}.
+        @param verify_md5: Whether to check the MD5 digest of the data
+            against the I{ETag} of the object, when it is one: it isn't for
+            multipart uploads nor for objects encrypted with KMS keys.
+        @param byte_range: The offsets of the first and last bytes to get,
+            if not the whole object, which then isn't checked against its
+            I{ETag}.
+        @param if_match: The I{ETag} the object must have, if any, for the
+            request to fail with a C{PreconditionFailed} L{S3Error} if it was
+            replaced.
+        @return: A C{Deferred} firing with the response headers once all of
+            the data was handled by C{target}, or failing with
+            L{ChecksumError} if it doesn't match the I{ETag}.
+        """
+        consumer = MD5Consumer(get_consumer(target))
+        headers = {}
+        if byte_range is not None:
+            headers["Range"] = "bytes=%d-%d" % byte_range
+            verify_md5 = False
+        if if_match is not None:
+            headers["If-Match"] = if_match
+        query = self.query_factory(
+            action="GET", creds=self.creds, endpoint=self.endpoint,
+            bucket=bucket, object_name=object_name, headers=headers)
+        d = query.submit(stream=consumer)
+
+        def flush(result):
+            # The target's own failure is more telling than the aborted
+            # connection it caused.
+            flushed = get_flush(consumer)
+            if isinstance(result, Failure):
+                flushed.addCallback(lambda ignored: result)
+            return flushed
+
+        def verify(ignored):
+            headers = query.get_response_headers()
+            etag = headers.get("etag", [""])[0].strip('"')
+            if verify_md5 and _MD5_ETAG.match(etag):
+                digest = consumer.hexdigest()
+                if digest != etag.lower():
+                    raise ChecksumError(
+                        "MD5 of %s/%s is %s, not its ETag %s." %
+                        (bucket, object_name, digest, etag))
+            return headers
+
+        d.addBoth(flush)
+        return d.addCallback(verify)
+
     def head_object(self, bucket, object_name):
         """
         Retrieve object metadata only.
@@ -377,6 +620,241 @@ class S3Client(BaseClient):
             bucket=bucket, object_name=object_name)
         return query.submit()
 
+    def delete_objects(self, bucket, object_names, quiet=False):
+        """
+        Delete several objects from a bucket in a single request.
+
+        See L{txaws.s3.transfer.TransferManager.delete_objects} to delete
+        any number of objects.
+
+        @param object_names: The names of the objects, no more than
+            L{MAX_DELETE_KEYS} of them.
+        @param quiet: Whether S3 leaves out the objects deleted from its
+            response, reporting only the errors.
+        @return: A C{Deferred} that will fire with a L{DeleteResult}.
+        """
+        if len(object_names) > MAX_DELETE_KEYS:
+            raise ValueError(
+                "No more than %d objects can be deleted at once." %
+                MAX_DELETE_KEYS)
+        data = "".join(
+            ["<Delete>"] + (["<Quiet>true</Quiet>"] if quiet else []) +
+            ["<Object><Key>%s</Key></Object>" % escape(
+                name.encode("utf-8") if isinstance(name, unicode) else name)
+             for name in object_names] +
+            ["</Delete>"])
+        query = self.query_factory(
+            action="POST", creds=self.creds, endpoint=self.endpoint,
+            bucket=bucket, object_name="?delete", data=data)
+        d = query.submit()
+        return d.addCallback(self._parse_delete_objects)
+
+    @timed_parse
+    def _parse_delete_objects(self, xml_bytes):
+        return DeleteResult.from_xml(xml_bytes)
+
+    def init_multipart_upload(self, bucket, object_name, content_type=None,
+                              metadata={}, amz_headers={}):
+        """
+        Initiate the upload of an object in several parts.
+
+        See L{txaws.s3.transfer.TransferManager} to upload whole files.
+
+        @param content_type: The type of the object.
+        @param metadata: A C{dict} used to build C{x-amz-meta-*} headers.
+        @param amz_headers: A C{dict} used to build C{x-amz-*} headers.
+        @return: A C{Deferred} that will fire with a
+            L{MultipartInitiationResponse}.
+        """
+        if content_type is None:
+            content_type = mimetypes.guess_type(object_name, strict=False)[0]
+        query = self.query_factory(
+            action="POST", creds=self.creds, endpoint=self.endpoint,
+            bucket=bucket, object_name="%s?uploads" % object_name,
+            content_type=content_type, metadata=metadata,
+            amz_headers=amz_headers)
+        d = query.submit()
+        return d.addCallback(self._parse_init_multipart_upload)
+
+    @timed_parse
+    def _parse_init_multipart_upload(self, xml_bytes):
+        return MultipartInitiationResponse.from_xml(xml_bytes)
+
+    def upload_part(self, bucket, object_name, upload_id, part_number, data):
+        """
+        Upload a part of an object.
+
+        Every part but the last one must be at least 5 MB long.
+
+        @param upload_id: The ID of the upload, as given by
+            L{init_multipart_upload}.
+        @param part_number: The number of the part, from 1 to 10000.
+        @param data: The data of the part: a string, a file object or a body
+            object like a L{FileBody}. Big strings and files are hashed off
+            the reactor thread.
+        @return: A C{Deferred} that will fire with the L{FileChunk} of the
+            part.
+        """
+        d = self._get_body(data)
+        return d.addCallback(
+            self._upload_part, bucket, object_name, upload_id, part_number)
+
+    def _upload_part(self, data, bucket, object_name, upload_id,
+                     part_number):
+        query = self.query_factory(
+            action="PUT", creds=self.creds, endpoint=self.endpoint,
+            bucket=bucket, object_name="%s?partNumber=%d&uploadId=%s" % (
+                object_name, part_number, upload_id),
+            data=data)
+        d = query.submit()
+
+        def get_chunk(ignored):
+            headers = query.get_response_headers()
+            return FileChunk(part_number, headers.get("etag", [None])[0],
+                             get_body_length(data))
+
+        return d.addCallback(get_chunk)
+
+    def complete_multipart_upload(self, bucket, object_name, upload_id,
+                                  parts):
+        """
+        Assemble an object from its uploaded parts.
+
+        @param parts: The L{FileChunk}s of the parts.
+        @return: A C{Deferred} that will fire with a
+            L{MultipartCompletionResponse}.
+        """
+        data = "".join(
+            ["<CompleteMultipartUpload>"] +
+            ["<Part><PartNumber>%d</PartNumber><ETag>%s</ETag></Part>" %
+             (part.part_number, escape(part.etag))
+             for part in sorted(parts, key=lambda part: part.part_number)] +
+            ["</CompleteMultipartUpload>"])
+        query = self.query_factory(
+            action="POST", creds=self.creds, endpoint=self.endpoint,
+            bucket=bucket, object_name="%s?uploadId=%s" % (
+                object_name, upload_id),
+            data=data)
+        d = query.submit()
+        return d.addCallback(self._parse_complete_multipart_upload)
+
+    @timed_parse
+    def _parse_complete_multipart_upload(self, xml_bytes):
+        # S3 can fail to assemble the object after it started sending a
+        # successful response.
+        if XML(xml_bytes).tag == "Error":
+            raise S3Error(xml_bytes, "200")
+        return MultipartCompletionResponse.from_xml(xml_bytes)
+
+    def list_parts(self, bucket, object_name, upload_id):
+        """
+        List the parts uploaded so far for an upload.
+
+        @return: A C{Deferred} that will fire with the L{FileChunk}s of all
+            of the parts, as many requests being made as S3 needs to list
+            them.
+        """
+        return self._list_parts(bucket, object_name, upload_id, None, [])
+
+    def _list_parts(self, bucket, object_name, upload_id, marker, chunks):
+        path = "%s?uploadId=%s" % (object_name, upload_id)
+        if marker is not None:
+            path += "&part-number-marker=%s" % (marker,)
+        query = self.query_factory(
+            action="GET", creds=self.creds, endpoint=self.endpoint,
+            bucket=bucket, object_name=path)
+        d = query.submit()
+        d.addCallback(self._parse_list_parts)
+
+        def next_page(result):
+            page, next_marker = result
+            chunks.extend(page)
+            if next_marker is None:
+                return chunks
+            return self._list_parts(
+                bucket, object_name, upload_id, next_marker, chunks)
+
+        return d.addCallback(next_page)
+
+    @timed_parse
+    def _parse_list_parts(self, xml_bytes):
+        """
+        Parse a C{ListPartsResult} XML document into the L{FileChunk}s it
+        lists and the marker of the next page, if any.
+        """
+        root = XML(xml_bytes)
+        chunks = [
+            FileChunk(int(part.findtext("PartNumber")), part.findtext("ETag"),
+                      int(part.findtext("Size")))
+            for part in root.findall("Part")]
+        next_marker = None
+        if root.findtext("IsTruncated") == "true":
+            next_marker = root.findtext("NextPartNumberMarker")
+        return chunks, next_marker
+
+    def list_multipart_uploads(self, bucket, prefix=None):
+        """
+        List the uploads in progress of the objects of a bucket.
+
+        @param prefix: The prefix of the names of the objects, if any.
+        @return: A C{Deferred} that will fire with the
+            L{MultipartUploadItem}s of all of the uploads.
+        """
+        return self._list_multipart_uploads(bucket, prefix, None, [])
+
+    def _list_multipart_uploads(self, bucket, prefix, markers, uploads):
+        object_name = "?uploads"
+        if prefix:
+            object_name += "&prefix=%s" % quote(prefix, safe="")
+        if markers is not None:
+            object_name += "&key-marker=%s&upload-id-marker=%s" % (
+                quote(markers[0], safe=""), quote(markers[1], safe=""))
+        query = self.query_factory(
+            action="GET", creds=self.creds, endpoint=self.endpoint,
+            bucket=bucket, object_name=object_name)
+        d = query.submit()
+        d.addCallback(self._parse_list_multipart_uploads)
+
+        def next_page(result):
+            page, next_markers = result
+            uploads.extend(page)
+            if next_markers is None:
+                return uploads
+            return self._list_multipart_uploads(
+                bucket, prefix, next_markers, uploads)
+
+        return d.addCallback(next_page)
+
+    @timed_parse
+    def _parse_list_multipart_uploads(self, xml_bytes):
+        """
+        Parse a C{ListMultipartUploadsResult} XML document into the
+        L{MultipartUploadItem}s it lists and the markers of the next page,
+        if any.
+        """
+        root = XML(xml_bytes)
+        uploads = [
+            MultipartUploadItem(
+                upload.findtext("Key"), upload.findtext("UploadId"),
+                parse_iso8601(upload.findtext("Initiated")))
+            for upload in root.findall("Upload")]
+        next_markers = None
+        if root.findtext("IsTruncated") == "true":
+            next_markers = (root.findtext("NextKeyMarker"),
+                            root.findtext("NextUploadIdMarker"))
+        return uploads, next_markers
+
+    def abort_multipart_upload(self, bucket, object_name, upload_id):
+        """
+        Abort the upload of an object in several parts, deleting the parts
+        uploaded so far.
+        """
+        query = self.query_factory(
+            action="DELETE", creds=self.creds, endpoint=self.endpoint,
+            bucket=bucket, object_name="%s?uploadId=%s" % (
+                object_name, upload_id))
+        return query.submit()
+
     def put_object_acl(self, bucket, object_name, access_control_policy):
         """
         Set access control policy on an object.
@@ -422,6 +900,7 @@ class S3Client(BaseClient):
             bucket=bucket, object_name="?requestPayment")
         return query.submit().addCallback(self._parse_get_request_payment)
 
+    @timed_parse
     def _parse_get_request_payment(self, xml_bytes):
         """
         Parse a C{RequestPaymentConfiguration} XML document and extract the
@@ -433,9 +912,12 @@ class S3Client(BaseClient):
 class Query(BaseQuery):
     """A query for submission to the S3 service."""
 
+    timeout = 300
+    service = "s3"
+
     def __init__(self, bucket=None, object_name=None, data="",
-                 content_type=None, metadata={}, amz_headers={}, *args,
-                 **kwargs):
+                 content_type=None, metadata={}, amz_headers={},
+                 headers={}, *args, **kwargs):
         super(Query, self).__init__(*args, **kwargs)
         self.bucket = bucket
         self.object_name = object_name
@@ -443,6 +925,7 @@ class Query(BaseQuery):
         self.content_type = content_type
         self.metadata = metadata
         self.amz_headers = amz_headers
+        self.headers = headers
         self.date = datetimeToString()
         if not self.endpoint or not self.endpoint.host:
             self.endpoint = AWSServiceEndpoint(S3_ENDPOINT)
@@ -463,13 +946,21 @@ class Query(BaseQuery):
         """
         Build the list of headers needed in order to perform S3 operations.
         """
-        headers = {"Content-Length": len(self.data),
-                   "Content-MD5": calculate_md5(self.data),
-                   "Date": self.date}
+        if isinstance(self.data, str):
+            headers = {"Content-Length": len(self.data),
+                       "Content-MD5": calculate_md5(self.data),
+                       "Date": self.date}
+        else:
+            # A body object, see txaws.client.streaming.
+            headers = {"Content-Length": self.data.length, "Date": self.date}
+            if self.data.md5 is not None:
+                headers["Content-MD5"] = self.data.md5
         for key, value in self.metadata.iteritems():
             headers["x-amz-meta-" + key] = value
         for key, value in self.amz_headers.iteritems():
             headers["x-amz-" + key] = value
+        # Headers which aren't signed, like Range.
+        headers.update(self.headers)
         # Before we check if the content type is set, let's see if we can set
         # it by guessing the the mimetype.
         self.set_content_type()
@@ -497,6 +988,8 @@ class Query(BaseQuery):
     def get_canonicalized_resource(self):
         """
         Get an S3 resource path.
+
+        Of the query string, only the sub-resources are signed.
         """
         path = "/"
         if self.bucket is not None:
@@ -507,6 +1000,12 @@ class Query(BaseQuery):
             path += self.object_name
         elif self.bucket is not None and not path.endswith("/"):
             path += "/"
+        path, _, query = path.partition("?")
+        parameters = sorted(
+            parameter for parameter in query.split("&")
+            if parameter.partition("=")[0] in _SUB_RESOURCES)
+        if parameters:
+            path += "?" + "&".join(parameters)
         return path
 
     def sign(self, headers):
@@ -519,15 +1018,37 @@ class Query(BaseQuery):
                 self.get_canonicalized_resource())
         return self.creds.sign(text, hash_type="sha1")
 
-    def submit(self, url_context=None):
+    def submit(self, url_context=None, stream=None):
         """Submit this query.
 
+        @param stream: The L{IConsumer} the response body is written to as it
+            arrives, instead of being collected.
         @return: A deferred from get_page
         """
         if not url_context:
             url_context = URLContext(
                 self.endpoint, self.bucket, self.object_name)
+        kwds = {}
+        if stream is not None:
+            kwds["stream"] = stream
         d = self.get_page(
             url_context.get_url(), method=self.action, postdata=self.data,
-            headers=self.get_headers())
+            headers=self.get_headers(), **kwds)
         return d.addErrback(s3_error_wrapper)
+
+    def get_single_flight_key(self, url, headers=None, stream=None, **kwds):
+        """
+        Share C{GET} and C{HEAD} queries for the same URL with the same
+        credentials and headers, leaving out the date and signature.
+
+        Streamed bodies are never shared.
+        """
+        if self.action not in ("GET", "HEAD") or stream is not None:
+            return None
+        if headers is None:
+            headers = {}
+        headers = tuple(sorted(
+            (name, value) for name, value in headers.iteritems()
+            if name not in ("Date", "Authorization")))
+        access_key = getattr(self.creds, "access_key", None)
+        return (access_key, self.action, url, headers)
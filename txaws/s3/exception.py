@@ -19,3 +19,9 @@ class S3Error(AWSError):
 
     def get_error_message(self, *args, **kwargs):
         return super(S3Error, self).get_error_messages(*args, **kwargs)
+
+
+class ChecksumError(Exception):
+    """
+    The data received from S3 doesn't match the checksum S3 gave for it.
+    """
@@ -0,0 +1,374 @@
+# Licenced under the txaws licence available at /LICENSE in the txaws source.
+
+"""
+Listing of buckets too big for a single request.
+
+A L{BucketIterator} follows the markers of a listing from page to page,
+getting the next page while the current one is processed::
+
+    def show(item):
+        print item.key, item.size
+
+    d = BucketIterator(S3Client(creds), "mybucket", prefix="logs/").for_each(
+        show)
+
+Since every page depends on the marker of the previous one, a
+L{ShardedLister} splits the keys of a big bucket into shards listed
+concurrently instead.
+"""
+from bisect import bisect_right
+from operator import itemgetter
+
+from twisted.internet import defer
+from twisted.python.failure import Failure
+
+
+__all__ = ["BucketIterator", "ShardedLister"]
+
+
+def _give(items, callback):
+    """
+    Call C{callback} with every one of C{items} in turn, waiting for the
+    C{Deferred} it returns, if any, before the next one.
+
+    @return: A C{Deferred} firing once every item was given, or C{None} if
+        C{callback} returned no C{Deferred}.
+    """
+    items = iter(items)
+    waited = False
+    for item in items:
+        result = callback(item)
+        if not isinstance(result, defer.Deferred):
+            continue
+        waited = True
+        outcome = []
+        result.addBoth(outcome.append)
+        if not outcome:
+            # Only chain the rest onto a Deferred still pending, rather than
+            # recursing for every one which already fired.
+            result.addCallback(lambda ignored: outcome.pop())
+            return result.addCallback(
+                lambda ignored: _give(items, callback))
+        if isinstance(outcome[0], Failure):
+            return defer.fail(outcome[0])
+    if waited:
+        return defer.succeed(None)
+    return None
+
+
+def _unwrap_first_error(failure):
+    if failure.check(defer.FirstError):
+        return failure.value.subFailure
+    return failure
+
+
+class BucketIterator(object):
+    """
+    Iterate over the pages of the listing of a bucket, in key order.
+
+    Once a page was given, the next one is requested right away, so that it
+    is on its way while the page is processed. A page failing to be got
+    can be asked for again.
+
+    @param client: The L{S3Client} listing the bucket.
+    @param prefix: The prefix of the keys listed, if any.
+    @param delimiter: The string keys are rolled up at into the
+        C{common_prefixes} of the pages, after the prefix, if any.
+    @param max_keys: The largest number of keys per page, if any.
+    @param marker: The key the listing starts after, if any.
+    @param end: The last key listed, if any.
+    @param version: C{1} to list with I{ListObjects}, or C{2} with
+        I{ListObjectsV2}, which leaves out the owners of the objects unless
+        C{fetch_owner} is true.
+    @param columnar: Whether the contents of the pages are kept in
+        L{BucketItemColumns}, which takes less memory.
+    @ivar pages: The number of pages got.
+    """
+
+    def __init__(self, client, bucket, prefix=None, delimiter=None,
+                 max_keys=None, marker=None, end=None, version=1,
+                 fetch_owner=False, columnar=False):
+        if version not in (1, 2):
+            raise ValueError("Unknown listing version %r." % (version,))
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix
+        self.delimiter = delimiter
+        self.max_keys = max_keys
+        self.marker = marker
+        self.end = end
+        self.version = version
+        self.fetch_owner = fetch_owner
+        self.columnar = columnar
+        self.pages = 0
+        self._token = None
+        self._done = False
+        self._next = None
+        self._current = None
+
+    def _list(self):
+        if self.version == 1:
+            return self.client.get_bucket(
+                self.bucket, self.marker, self.prefix, self.max_keys,
+                self.delimiter, self.columnar)
+        return self.client.list_objects(
+            self.bucket, self._token, self.prefix, self.max_keys,
+            self.delimiter, self.marker if self._token is None else None,
+            self.fetch_owner, self.columnar)
+
+    def next_page(self):
+        """
+        Get the next page.
+
+        @return: A C{Deferred} firing with the next L{BucketListing}, or with
+            C{None} once all of them were given.
+        """
+        if self._current is not None and not self._current.called:
+            raise ValueError("The previous page wasn't got yet.")
+        if self._next is not None:
+            d, self._next = self._next, None
+        elif self._done:
+            return defer.succeed(None)
+        else:
+            d = self._list()
+        self._current = d.addCallback(self._got_page)
+        return d
+
+    def _got_page(self, listing):
+        self.pages += 1
+        if self.version == 1:
+            self.marker = listing.next_marker
+            self._done = self.marker is None
+        else:
+            self._token = listing.next_continuation_token
+            self._done = self._token is None
+        if self.end is not None:
+            self._trim(listing)
+        if not self._done:
+            self._next = self._list()
+        return listing
+
+    def _trim(self, listing):
+        """
+        Drop the keys and prefixes of C{listing} beyond C{end}, and stop
+        once it reached it.
+        """
+        contents = listing.contents
+        keys = getattr(contents, "keys", None)
+        if keys is None:
+            keys = [item.key for item in contents]
+        last = max(keys[-1:] + listing.common_prefixes[-1:] or [None])
+        if last >= self.end:
+            self._done = True
+            listing.contents = contents[:bisect_right(keys, self.end)]
+            listing.common_prefixes = [
+                prefix for prefix in listing.common_prefixes
+                if prefix <= self.end]
+
+    def for_each(self, callback):
+        """
+        Call C{callback} with every L{BucketItem} listed, in turn, waiting
+        for the C{Deferred} it returns, if any, before the next one.
+
+        @return: A C{Deferred} firing with C{None} once every item was given.
+        """
+
+        def process(listing):
+            if listing is None:
+                return None
+            d = _give(listing.contents, callback)
+            if d is None:
+                return self.next_page().addCallback(process)
+            d.addCallback(lambda ignored: self.next_page())
+            return d.addCallback(process)
+
+        return self.next_page().addCallback(process)
+
+
+class ShardedLister(object):
+    """
+    List the keys of a bucket in shards listed concurrently.
+
+    The keys are split either at C{boundaries}, or else at the common
+    prefixes found listing the bucket with C{delimiter}, the shards being
+    split further at the common prefixes found in them down to C{depth}
+    levels. The keys found on the way are given as they are found.
+
+    @param client: The L{S3Client} listing the bucket.
+    @param prefix: The prefix of the keys listed, if any.
+    @param delimiter: The string the keys are split at.
+    @param depth: The number of levels of common prefixes the keys are
+        split at.
+    @param boundaries: The keys the bucket is split at, if any, every shard
+        listing the keys greater than a boundary and not greater than the
+        next one.
+    @param concurrency: The largest number of listings in progress at once.
+    @param ordered: Whether items are given in key order. Then the items of
+        a shard are kept until those of the shards before it were given,
+        no more than C{concurrency} shards being listed ahead of them.
+    @param kwargs: The other parameters of the L{BucketIterator}s listing
+        the shards.
+    @ivar shards: The number of shards listed.
+    @ivar pages: The number of pages got, to find the shards or to list
+        them.
+    """
+
+    def __init__(self, client, bucket, prefix=None, delimiter="/", depth=1,
+                 boundaries=None, concurrency=8, ordered=False, **kwargs):
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix
+        self.delimiter = delimiter
+        self.depth = depth
+        self.boundaries = boundaries
+        self.concurrency = concurrency
+        self.ordered = ordered
+        self.kwargs = kwargs
+        self.shards = 0
+        self.pages = 0
+        self._semaphore = defer.DeferredSemaphore(concurrency)
+
+    def _get_iterator(self, **kwargs):
+        kwargs.update(self.kwargs)
+        return BucketIterator(self.client, self.bucket, **kwargs)
+
+    def _split(self, prefix, depth, callback):
+        """
+        Give the keys right under C{prefix} to C{callback}, and find the
+        shards below it.
+
+        @return: A C{Deferred} firing with the sorted prefixes of the
+            shards.
+        """
+        iterator = self._get_iterator(prefix=prefix, delimiter=self.delimiter)
+        prefixes = []
+
+        def collect(listing):
+            if listing is None:
+                self.pages += iterator.pages
+                return None
+            prefixes.extend(listing.common_prefixes)
+            d = defer.maybeDeferred(_give, listing.contents, callback)
+            d.addCallback(lambda ignored: iterator.next_page())
+            return d.addCallback(collect)
+
+        d = self._semaphore.run(
+            lambda: iterator.next_page().addCallback(collect))
+        if depth > 1:
+            d.addCallback(lambda ignored: self._split_all(
+                prefixes, depth - 1, callback))
+        else:
+            d.addCallback(lambda ignored: prefixes)
+        return d
+
+    def _split_all(self, prefixes, depth, callback):
+        d = defer.gatherResults(
+            [self._split(prefix, depth, callback) for prefix in prefixes],
+            consumeErrors=True)
+        d.addErrback(_unwrap_first_error)
+        return d.addCallback(
+            lambda results: [prefix for found in results for prefix in found])
+
+    def _get_shards(self, callback):
+        """
+        Return a C{Deferred} firing with the keyword arguments of the
+        L{BucketIterator}s listing every shard, in key order.
+        """
+        if self.boundaries is not None:
+            boundaries = [None] + sorted(self.boundaries) + [None]
+            return defer.succeed([
+                {"prefix": self.prefix, "marker": marker, "end": end}
+                for marker, end in zip(boundaries, boundaries[1:])])
+        d = self._split(self.prefix, self.depth, callback)
+        return d.addCallback(
+            lambda prefixes: [{"prefix": prefix} for prefix in prefixes])
+
+    def _list_shard(self, shard, callback):
+        self.shards += 1
+        iterator = self._get_iterator(**shard)
+        d = iterator.for_each(callback)
+
+        def listed(result):
+            self.pages += iterator.pages
+            return result
+
+        return d.addBoth(listed)
+
+    def for_each(self, callback):
+        """
+        Call C{callback} with every L{BucketItem} listed. The items of a
+        shard are given in turn, waiting for the C{Deferred} C{callback}
+        returns, if any, before the next one, but those of different shards
+        are given as they come unless C{ordered} is true.
+
+        @return: A C{Deferred} firing with C{None} once every item was given.
+        """
+        if self.ordered:
+            return self._for_each_ordered(callback)
+        d = self._get_shards(callback)
+        d.addCallback(lambda shards: defer.gatherResults(
+            [self._semaphore.run(self._list_shard, shard, callback)
+             for shard in shards], consumeErrors=True))
+        d.addErrback(_unwrap_first_error)
+        return d.addCallback(lambda ignored: None)
+
+    def _for_each_ordered(self, callback):
+        found = []
+        d = self._get_shards(found.append)
+        d.addCallback(self._give_in_order, found, callback)
+        return d.addErrback(_unwrap_first_error)
+
+    def _give_in_order(self, shards, found, callback):
+        # The keys found splitting the bucket fall in none of the shards, and
+        # sort along with their prefixes.
+        segments = []
+        for key, segment in sorted(
+                [(item.key, [item]) for item in found] +
+                [(shard.get("prefix") or "", shard) for shard in shards],
+                key=itemgetter(0)):
+            if (isinstance(segment, list) and segments and
+                    isinstance(segments[-1], list)):
+                segments[-1].extend(segment)
+            else:
+                segments.append(segment)
+        listings = [None] * len(segments)
+
+        def start(index):
+            if index < len(segments):
+                segment = segments[index]
+                if isinstance(segment, list):
+                    listings[index] = (None, segment)
+                else:
+                    items = []
+                    listings[index] = (
+                        self._list_shard(segment, items.append), items)
+
+        def give(ignored, index):
+            while index < len(segments):
+                listed, items = listings[index]
+                listings[index] = None
+                if listed is not None:
+                    listed.addCallback(
+                        lambda ignored, items=items: _give(items, callback))
+                    return listed.addCallback(given, index)
+                d = _give(items, callback)
+                if d is not None:
+                    return d.addCallback(given, index)
+                start(index + self.concurrency)
+                index += 1
+            return None
+
+        def given(ignored, index):
+            start(index + self.concurrency)
+            return give(None, index + 1)
+
+        def failed(failure):
+            # Nobody waits for the shards still being listed anymore.
+            for listing in listings:
+                if listing is not None and listing[0] is not None:
+                    listing[0].addErrback(lambda failure: None)
+            return failure
+
+        for index in range(self.concurrency):
+            start(index)
+        return defer.maybeDeferred(give, None, 0).addErrback(failed)
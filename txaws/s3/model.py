@@ -3,7 +3,19 @@
 # Copyright (C) 2011 Drew Smathers <drew.smathers@gmail.com>
 # Copyright (C) 2012 New Dream Network (DreamHost)
 # Licenced under the txaws licence available at /LICENSE in the txaws source.
-from txaws.util import XML
+from array import array
+from binascii import hexlify, unhexlify
+from datetime import datetime
+import re
+
+from txaws.util import UTC, XML
+
+
+# The ETag of an object, made of the MD5 digest of its data or of its parts.
+_DIGEST_ETAG = re.compile(r'^"([0-9a-f]{32})(?:-(\d+))?"$')
+
+# Sizes don't fit in a C long on every platform.
+_SIZE_TYPECODE = "l" if array("l").itemsize >= 8 else "d"
 
 
 class Bucket(object):
@@ -38,12 +50,151 @@ class BucketItem(object):
         self.owner = owner
 
 
+class _InternedColumn(object):
+    """
+    A column of values which repeat, every one of which is kept once.
+    """
+
+    def __init__(self, values=None, codes=None, indexes=None):
+        self.values = [] if values is None else values
+        self.codes = array("i") if codes is None else codes
+        self._indexes = {} if indexes is None else indexes
+
+    def append(self, key, factory=None):
+        """
+        Append the value for C{key}, made with C{factory} the first time
+        it's seen, or C{key} itself without one.
+        """
+        code = self._indexes.get(key)
+        if code is None:
+            code = self._indexes[key] = len(self.values)
+            self.values.append(key if factory is None else factory(*key))
+        self.codes.append(code)
+
+    def __getitem__(self, index):
+        return self.values[self.codes[index]]
+
+    def slice(self, start, stop):
+        return _InternedColumn(
+            self.values, self.codes[start:stop], self._indexes)
+
+
+def _get_owner(id, display_name):
+    if id is None and display_name is None:
+        return None
+    return ItemOwner(id, display_name)
+
+
+class BucketItemColumns(object):
+    """
+    The items of a bucket listing kept in columns, rather than as a
+    L{BucketItem} per object, which takes several times less memory for big
+    listings. Storage classes and owners, which repeat, are kept once.
+
+    It is a read-only sequence of L{BucketItem}s, made as they're accessed,
+    the C{size} of which is a string, like in the other listings.
+
+    @ivar keys: The keys of the objects.
+    @ivar sizes: The sizes of the objects, in bytes.
+    @ivar timestamps: The modification times of the objects, in seconds
+        since the epoch.
+    """
+
+    def __init__(self):
+        self.keys = []
+        self.sizes = array(_SIZE_TYPECODE)
+        self.timestamps = array("d")
+        # The MD5 digests of the ETags, and their number of parts, 0 for
+        # objects uploaded at once and -1 for ETags kept in _etags instead.
+        self._digests = array("c")
+        self._parts = array("i")
+        self._etags = {}
+        self._storage_classes = _InternedColumn()
+        self._owners = _InternedColumn()
+
+    def append(self, key, timestamp, etag, size, storage_class,
+               owner_id=None, owner_display_name=None):
+        """
+        Append an item.
+
+        @param timestamp: The modification time of the object, in seconds
+            since the epoch.
+        @param size: The size of the object, in bytes.
+        """
+        self.keys.append(key)
+        self.timestamps.append(timestamp)
+        self.sizes.append(size)
+        match = _DIGEST_ETAG.match(etag or "")
+        if match is None:
+            self._digests.fromstring("\0" * 16)
+            self._parts.append(-1)
+            self._etags[len(self.keys) - 1] = etag
+        else:
+            self._digests.fromstring(unhexlify(match.group(1)))
+            self._parts.append(int(match.group(2) or 0))
+        self._storage_classes.append(storage_class)
+        self._owners.append((owner_id, owner_display_name), _get_owner)
+
+    def get_etag(self, index):
+        """Return the I{ETag} of the item at C{index}."""
+        if index < 0:
+            index += len(self.keys)
+        parts = self._parts[index]
+        if parts < 0:
+            return self._etags[index]
+        etag = hexlify(self._digests[index * 16:index * 16 + 16].tostring())
+        if parts:
+            return '"%s-%d"' % (etag, parts)
+        return '"%s"' % (etag,)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __iter__(self):
+        for index in xrange(len(self.keys)):
+            yield self[index]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self.keys))
+            if step != 1:
+                return [self[i] for i in xrange(start, stop, step)]
+            return self._slice(start, max(start, stop))
+        return BucketItem(
+            self.keys[index],
+            datetime.fromtimestamp(self.timestamps[index], UTC),
+            self.get_etag(index), str(self.sizes[index]),
+            self._storage_classes[index], self._owners[index])
+
+    def _slice(self, start, stop):
+        columns = BucketItemColumns()
+        columns.keys = self.keys[start:stop]
+        columns.sizes = self.sizes[start:stop]
+        columns.timestamps = self.timestamps[start:stop]
+        columns._digests = self._digests[start * 16:stop * 16]
+        columns._parts = self._parts[start:stop]
+        columns._etags = dict(
+            (index - start, etag) for index, etag in self._etags.iteritems()
+            if start <= index < stop)
+        columns._storage_classes = self._storage_classes.slice(start, stop)
+        columns._owners = self._owners.slice(start, stop)
+        return columns
+
+
 class BucketListing(object):
     """
     A mapping for the data in a bucket listing.
+
+    The C{contents} of the listing are a C{list} of L{BucketItem}s, or the
+    L{BucketItemColumns} of a columnar listing.
+
+    @ivar next_marker: The marker of the next page of a truncated listing.
+    @ivar next_continuation_token: The continuation token of the next page
+        of a truncated I{ListObjectsV2} listing.
     """
     def __init__(self, name, prefix, marker, max_keys, is_truncated,
-                 contents=None, common_prefixes=None):
+                 contents=None, common_prefixes=None, next_marker=None,
+                 next_continuation_token=None):
         self.name = name
         self.prefix = prefix
         self.marker = marker
@@ -51,6 +202,8 @@ class BucketListing(object):
         self.is_truncated = is_truncated
         self.contents = contents
         self.common_prefixes = common_prefixes
+        self.next_marker = next_marker
+        self.next_continuation_token = next_continuation_token
 
 
 class LifecycleConfiguration(object):
@@ -111,11 +264,109 @@ class VersioningConfiguration(object):
 
 class FileChunk(object):
     """
-    An Amazon S3 file chunk.
+    A part of an object uploaded in several parts.
+
+    @ivar part_number: The number of the part, from 1 to 10000, giving its
+        place in the object.
+    @ivar etag: The I{ETag} S3 gave the part, quotes included.
+    @ivar size: The size of the part in bytes, if known.
+    """
+    def __init__(self, part_number, etag, size=None):
+        self.part_number = part_number
+        self.etag = etag
+        self.size = size
+
 
-    S3 returns file chunks, 10 MB at a time, until the entire file is returned.
-    These chunks need to be assembled once they are all returned.
+class MultipartInitiationResponse(object):
     """
+    The upload of an object in several parts, as initiated by S3.
+    """
+    def __init__(self, bucket, object_name, upload_id):
+        self.bucket = bucket
+        self.object_name = object_name
+        self.upload_id = upload_id
+
+    @classmethod
+    def from_xml(cls, xml_bytes):
+        """
+        Create an instance from an C{InitiateMultipartUploadResult} XML
+        document.
+        """
+        root = XML(xml_bytes)
+        return cls(root.findtext("Bucket"), root.findtext("Key"),
+                   root.findtext("UploadId"))
+
+
+class MultipartUploadItem(object):
+    """
+    An upload of an object in several parts, in progress.
+
+    @ivar initiated: The C{datetime} the upload was initiated at.
+    """
+    def __init__(self, object_name, upload_id, initiated):
+        self.object_name = object_name
+        self.upload_id = upload_id
+        self.initiated = initiated
+
+
+class MultipartCompletionResponse(object):
+    """
+    An object assembled from the parts uploaded for it.
+    """
+    def __init__(self, location, bucket, object_name, etag):
+        self.location = location
+        self.bucket = bucket
+        self.object_name = object_name
+        self.etag = etag
+
+    @classmethod
+    def from_xml(cls, xml_bytes):
+        """
+        Create an instance from a C{CompleteMultipartUploadResult} XML
+        document.
+        """
+        root = XML(xml_bytes)
+        return cls(root.findtext("Location"), root.findtext("Bucket"),
+                   root.findtext("Key"), root.findtext("ETag"))
+
+
+class DeleteError(object):
+    """
+    An object a multi-object delete failed to delete.
+
+    @ivar key: The name of the object.
+    @ivar code: The code of the error, like C{AccessDenied}.
+    @ivar message: The description of the error.
+    """
+    def __init__(self, key, code, message):
+        self.key = key
+        self.code = code
+        self.message = message
+
+
+class DeleteResult(object):
+    """
+    The outcome of a multi-object delete.
+
+    @ivar deleted: The names of the objects deleted, which are left out in
+        quiet mode.
+    @ivar errors: The L{DeleteError}s of the objects not deleted.
+    """
+    def __init__(self, deleted, errors):
+        self.deleted = deleted
+        self.errors = errors
+
+    @classmethod
+    def from_xml(cls, xml_bytes):
+        """
+        Create an instance from a C{DeleteResult} XML document.
+        """
+        root = XML(xml_bytes)
+        return cls(
+            [deleted.findtext("Key") for deleted in root.findall("Deleted")],
+            [DeleteError(error.findtext("Key"), error.findtext("Code"),
+                         error.findtext("Message"))
+             for error in root.findall("Error")])
 
 
 class RequestPayment(object):
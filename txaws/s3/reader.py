@@ -0,0 +1,231 @@
+# Licenced under the txaws licence available at /LICENSE in the txaws source.
+
+"""
+Random access to S3 objects through ranged GETs.
+
+An L{S3File} reads an object like a file, in blocks of C{block_size} bytes
+got as they are needed and kept in a cache, so that seeking around a big
+object only gets the parts of it which are read::
+
+    d = open_object(S3Client(creds), "mybucket", "data.zip")
+    d.addCallback(lambda f: f.seek(-22, os.SEEK_END) or f.read(22))
+
+Reads return a C{Deferred}. The blocks which are missing for a read are got
+in as few requests as possible, and sequential reads get the next blocks
+ahead of time.
+"""
+from collections import OrderedDict
+import os
+
+from twisted.internet import defer
+
+
+__all__ = ["S3File", "open_object"]
+
+
+def open_object(client, bucket, object_name, **kwargs):
+    """
+    Open an object for reading.
+
+    @param client: The L{S3Client} getting the object.
+    @param kwargs: The other parameters of L{S3File}.
+    @return: A C{Deferred} firing with an L{S3File} once the size of the
+        object is known.
+    """
+    d = client.head_object(bucket, object_name)
+    return d.addCallback(
+        lambda headers: S3File(
+            client, bucket, object_name, int(headers["content-length"][0]),
+            headers["etag"][0], **kwargs))
+
+
+class S3File(object):
+    """
+    A read-only file-like object reading an object in blocks, the least
+    recently used of which are dropped once C{cache_size} are kept.
+
+    All of the blocks are got from the version of the object given by
+    C{etag}: reads fail with a C{PreconditionFailed} L{S3Error} once it was
+    replaced.
+
+    @param client: The L{S3Client} getting the object.
+    @param size: The size of the object, in bytes.
+    @param etag: The I{ETag} of the object, if any.
+    @param block_size: The size of the blocks, in bytes.
+    @param cache_size: The number of blocks kept.
+    @param read_ahead: The number of blocks got ahead of reads following
+        each other, C{0} to disable reading ahead.
+    @param max_request_blocks: The largest number of blocks got in a single
+        request.
+    @ivar hits: The number of blocks read from the cache.
+    @ivar misses: The number of blocks read which had to be got, or which
+        were being got already.
+    @ivar prefetched: The number of blocks got ahead of time.
+    @ivar requests: The number of requests sent.
+    @ivar bytes_fetched: The number of bytes got.
+    """
+
+    def __init__(self, client, bucket, object_name, size, etag=None,
+                 block_size=2 ** 20, cache_size=32, read_ahead=4,
+                 max_request_blocks=16):
+        self.client = client
+        self.bucket = bucket
+        self.object_name = object_name
+        self.size = size
+        self.etag = etag
+        self.block_size = block_size
+        self.cache_size = cache_size
+        self.read_ahead = read_ahead
+        self.max_request_blocks = max_request_blocks
+        self.closed = False
+        self.hits = 0
+        self.misses = 0
+        self.prefetched = 0
+        self.requests = 0
+        self.bytes_fetched = 0
+        self._position = 0
+        self._last_read_end = None
+        self._blocks = OrderedDict()
+        # The waiters of every block queued or being got, per index.
+        self._pending = {}
+        self._queued = set()
+
+    def _check_closed(self):
+        if self.closed:
+            raise ValueError("I/O operation on closed file")
+
+    def tell(self):
+        self._check_closed()
+        return self._position
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        self._check_closed()
+        if whence == os.SEEK_CUR:
+            offset += self._position
+        elif whence == os.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise IOError("Invalid offset %d." % (offset,))
+        self._position = offset
+
+    def close(self):
+        self.closed = True
+        self._blocks.clear()
+
+    def read(self, size=-1):
+        """
+        Read up to C{size} bytes, or the rest of the object.
+
+        @return: A C{Deferred} firing with the data, which is shorter than
+            C{size} only at the end of the object.
+        """
+        self._check_closed()
+        start = min(self._position, self.size)
+        if size < 0:
+            end = self.size
+        else:
+            end = min(start + size, self.size)
+        self._position = max(self._position, end)
+        if start == end:
+            return defer.succeed("")
+        sequential = start == self._last_read_end
+        self._last_read_end = end
+        first = start // self.block_size
+        last = (end - 1) // self.block_size
+        blocks = [self._get_block(index) for index in range(first, last + 1)]
+        if sequential:
+            self._read_ahead(last + 1)
+        self._fetch()
+        d = defer.gatherResults(blocks, consumeErrors=True)
+        d.addErrback(lambda failure: failure.value.subFailure
+                     if failure.check(defer.FirstError) else failure)
+        offset = first * self.block_size
+        return d.addCallback(
+            lambda data: "".join(data)[start - offset:end - offset])
+
+    def _get_block(self, index):
+        """
+        Return a C{Deferred} firing with the block at C{index}, queueing it
+        to be got if needed.
+        """
+        data = self._blocks.pop(index, None)
+        if data is not None:
+            # Move it to the most recently used end.
+            self._blocks[index] = data
+            self.hits += 1
+            return defer.succeed(data)
+        self.misses += 1
+        if index not in self._pending:
+            self._pending[index] = []
+            self._queued.add(index)
+        d = defer.Deferred()
+        self._pending[index].append(d)
+        return d
+
+    def _read_ahead(self, index):
+        last = min(index + self.read_ahead,
+                   (self.size - 1) // self.block_size + 1)
+        for index in range(index, last):
+            if index not in self._blocks and index not in self._pending:
+                self._pending[index] = []
+                self._queued.add(index)
+                self.prefetched += 1
+
+    def _fetch(self):
+        """
+        Get the blocks queued, adjacent ones being got in a single request.
+        """
+        runs = []
+        for index in sorted(self._queued):
+            if (runs and runs[-1][-1] == index - 1 and
+                    len(runs[-1]) < self.max_request_blocks):
+                runs[-1].append(index)
+            else:
+                runs.append([index])
+        for run in runs:
+            self._fetch_run(run)
+
+    def _fetch_run(self, run):
+        self._queued.difference_update(run)
+        start = run[0] * self.block_size
+        end = min((run[-1] + 1) * self.block_size, self.size)
+        chunks = []
+        self.requests += 1
+        d = self.client.get_object_stream(
+            self.bucket, self.object_name, chunks.append,
+            byte_range=(start, end - 1), if_match=self.etag)
+        d.addCallbacks(self._fetched, self._fetch_failed,
+                       callbackArgs=(run, chunks), errbackArgs=(run,))
+
+    def _fetched(self, headers, run, chunks):
+        data = "".join(chunks)
+        self.bytes_fetched += len(data)
+        blocks = []
+        for position, index in enumerate(run):
+            block = data[position * self.block_size:
+                         (position + 1) * self.block_size]
+            blocks.append((self._pending.pop(index), block))
+            if not self.closed:
+                self._blocks[index] = block
+        while len(self._blocks) > self.cache_size:
+            self._blocks.popitem(last=False)
+        # Waiters may read further right away: the cache must be settled.
+        for waiters, block in blocks:
+            for waiter in waiters:
+                waiter.callback(block)
+
+    def _fetch_failed(self, failure, run):
+        for index in run:
+            for waiter in self._pending.pop(index):
+                waiter.errback(failure)
+
+    def get_stats(self):
+        """
+        Return a C{dict} with the C{hits}, C{misses}, C{prefetched},
+        C{requests} and C{bytes_fetched} counts, and the number of blocks
+        kept as C{size}.
+        """
+        return {"hits": self.hits, "misses": self.misses,
+                "prefetched": self.prefetched, "requests": self.requests,
+                "bytes_fetched": self.bytes_fetched,
+                "size": len(self._blocks)}
@@ -0,0 +1,569 @@
+# Licenced under the txaws licence available at /LICENSE in the txaws source.
+
+"""
+Synchronization of a directory with the objects of a bucket under a prefix.
+
+A L{Synchronizer} compares the files of a directory with the objects listed
+under a prefix, and transfers only those which differ, one way or the
+other::
+
+    synchronizer = Synchronizer(
+        TransferManager(client), "mybucket", "photos", prefix="photos/",
+        index=HashIndex("photos.index"))
+    d = synchronizer.sync(PUSH)
+
+Files and objects of different sizes differ. Otherwise the MD5 digest of the
+file is checked against the I{ETag} of the object, the L{HashIndex} keeping
+the digest of every file along with its size and modification time, and the
+I{ETag} it was last found to match, so that the files not modified since
+the previous run are never hashed again.
+
+Small files are transferred in batches, one after the other, and big ones
+in parts by the L{TransferManager}, no more than C{concurrency} batches and
+big files at a time.
+"""
+from base64 import b64encode
+from binascii import unhexlify
+import errno
+import json
+import os
+import stat
+
+from twisted.internet import defer
+
+from txaws.client.hashing import get_hashing_service
+from txaws.client.streaming import FileBody
+from txaws.s3.client import _MD5_ETAG
+from txaws.s3.listing import BucketIterator, _give, _unwrap_first_error
+
+
+__all__ = ["HashIndex", "PULL", "PUSH", "SyncItem", "SyncPlan",
+           "Synchronizer"]
+
+
+# The directions of a synchronization: from the directory to the bucket, or
+# the other way round.
+PUSH = "push"
+PULL = "pull"
+
+# The suffix of the files objects are downloaded to, before they replace the
+# files they are synchronized with.
+_PARTIAL_SUFFIX = ".txaws-partial"
+
+
+def _encode(value):
+    if isinstance(value, unicode):
+        return value.encode("utf-8")
+    return value
+
+
+def _is_local_name(name):
+    """
+    Return whether C{name}, the name of an object after the prefix, is the
+    path of a file within the directory.
+
+    Names with an empty, C{.} or C{..} component are not, like the keys
+    ending with a slash which stand for directories.
+    """
+    for component in name.split("/"):
+        if component in ("", ".", "..") or os.sep in component or (
+                os.altsep and os.altsep in component):
+            return False
+    return True
+
+
+class HashIndex(object):
+    """
+    The MD5 digests of the files of a directory, kept in a file between
+    runs.
+
+    Every file is known by its path relative to the directory. Its digest is
+    kept along with the size and the modification time the file had when it
+    was hashed, to be reused only as long as the file has them still, and so
+    is the I{ETag} of the object the file was last found to match, if any.
+
+    The index is read when it is created, and written by L{save}. A missing
+    or unreadable file makes an empty index, which only costs hashing the
+    files again.
+
+    @ivar path: The path of the file the index is kept in.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._entries = {}
+        self._changed = False
+        try:
+            index = open(path, "rb")
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return
+        with index:
+            try:
+                entries = json.load(index)
+            except ValueError:
+                return
+        # Names are byte strings everywhere else.
+        self._entries = dict(
+            (_encode(name), tuple(_encode(value) for value in entry))
+            for name, entry in entries.iteritems())
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, name, size, mtime):
+        """
+        Return the MD5 digest of the file C{name}, in hexadecimal, and the
+        I{ETag} of the object it matches, either being C{None} if it isn't
+        known or if the file doesn't have the given C{size} and C{mtime}
+        anymore.
+        """
+        entry = self._entries.get(name)
+        if entry is None or entry[:2] != (size, mtime):
+            return None, None
+        return entry[2:]
+
+    def update(self, name, size, mtime, md5=None, etag=None):
+        """
+        Record the MD5 digest of the file C{name} of the given C{size} and
+        C{mtime}, or the I{ETag} of the object it matches. Either one which
+        isn't given is kept if the file wasn't modified.
+        """
+        old_md5, old_etag = self.get(name, size, mtime)
+        entry = (size, mtime, md5 or old_md5, etag or old_etag)
+        if self._entries.get(name) != entry:
+            self._entries[name] = entry
+            self._changed = True
+
+    def discard(self, name):
+        """Forget the file C{name}."""
+        if self._entries.pop(name, None) is not None:
+            self._changed = True
+
+    def prune(self, names):
+        """Forget all of the files but C{names}."""
+        for name in set(self._entries) - set(names):
+            self.discard(name)
+
+    def save(self):
+        """Write the index if it changed, replacing its file at once."""
+        if not self._changed:
+            return
+        temporary = self.path + ".tmp"
+        with open(temporary, "wb") as index:
+            json.dump(self._entries, index)
+            index.flush()
+            os.fsync(index.fileno())
+        os.rename(temporary, self.path)
+        self._changed = False
+
+
+class SyncItem(object):
+    """
+    A file or an object to transfer.
+
+    @ivar name: The path of the file relative to the directory, which is
+        the name of the object after the prefix.
+    @ivar size: The size of the file or of the object, in bytes.
+    @ivar mtime: The modification time of the file, when pushing it.
+    @ivar etag: The I{ETag} of the object, when pulling it.
+    """
+
+    def __init__(self, name, size, mtime=None, etag=None):
+        self.name = name
+        self.size = size
+        self.mtime = mtime
+        self.etag = etag
+
+
+class SyncPlan(object):
+    """
+    The work synchronizing a directory with a bucket takes.
+
+    @ivar direction: L{PUSH} or L{PULL}.
+    @ivar transfers: The L{SyncItem}s of the files to upload or of the
+        objects to download, by name.
+    @ivar deletions: The names of the objects or of the files to delete,
+        which are missing on the other side.
+    @ivar unchanged: The number of files matching their object already.
+    @ivar errors: The L{DeleteError}s of the objects which couldn't be
+        deleted, once the plan was carried out.
+    """
+
+    def __init__(self, direction):
+        self.direction = direction
+        self.transfers = []
+        self.deletions = []
+        self.unchanged = 0
+        self.errors = []
+
+    def get_size(self):
+        """Return the number of bytes to transfer."""
+        return sum(item.size for item in self.transfers)
+
+
+class Synchronizer(object):
+    """
+    Synchronize a directory with the objects of a bucket under a prefix.
+
+    The files must not change while they are synchronized.
+
+    @param manager: The L{TransferManager} transferring the files bigger
+        than a part, the client of which makes all of the other requests.
+    @param directory: The path of the directory.
+    @param prefix: The prefix of the names of the objects, which are the
+        paths of the files relative to the directory after it. A C{/} is
+        added to a prefix not ending with one.
+    @param index: The L{HashIndex} of the directory, if any. Without one
+        every file the size of its object is hashed.
+    @param delete: Whether the files or objects missing on the other side
+        are deleted.
+    @param concurrency: The largest number of batches of small files and of
+        big files being transferred, or of files being hashed, at once.
+    @param small_size: The size, in bytes, up to which files are small.
+    @param batch_size: The largest number of small files in a batch.
+    """
+
+    def __init__(self, manager, bucket, directory, prefix=None, index=None,
+                 delete=False, concurrency=8, small_size=2 ** 20,
+                 batch_size=32):
+        self.manager = manager
+        self.client = manager.client
+        self.bucket = bucket
+        self.directory = directory
+        if prefix and not prefix.endswith("/"):
+            prefix += "/"
+        self.prefix = prefix or ""
+        self.index = index
+        self.delete = delete
+        self.concurrency = concurrency
+        self.small_size = small_size
+        self.batch_size = batch_size
+
+    def _get_path(self, name):
+        return os.path.join(self.directory, *name.split("/"))
+
+    def _get_pulled_path(self, name):
+        """
+        Return the path of the file C{name} is pulled to or deleted from.
+
+        @raise ValueError: If a link leads the file out of the directory.
+        """
+        path = self._get_path(name)
+        root = os.path.realpath(self.directory)
+        parent = os.path.realpath(os.path.dirname(path))
+        if parent != root and not parent.startswith(root + os.sep):
+            raise ValueError(
+                "%r is out of the directory %r." % (name, self.directory))
+        return path
+
+    def sync(self, direction, dry_run=False):
+        """
+        Make the bucket like the directory, for L{PUSH}, or the directory
+        like the bucket, for L{PULL}.
+
+        @param dry_run: Whether to only plan the work, without doing it.
+            The digests of the files hashed to plan it are saved still.
+        @return: A C{Deferred} firing with the L{SyncPlan}, once it was
+            carried out unless C{dry_run} is true.
+        """
+        d = self.plan(direction)
+        if not dry_run:
+            d.addCallback(self.run)
+        if self.index is not None:
+            d.addBoth(self._save_index)
+        return d
+
+    def _save_index(self, result):
+        self.index.save()
+        return result
+
+    def plan(self, direction):
+        """
+        Compare the directory with the bucket.
+
+        @return: A C{Deferred} firing with the L{SyncPlan} of the
+            synchronization in C{direction}.
+        """
+        if direction not in (PUSH, PULL):
+            raise ValueError("Unknown direction %r." % (direction,))
+        files = self._scan_directory()
+        if self.index is not None:
+            self.index.prune(files)
+        d = self._list_objects()
+        return d.addCallback(self._compare, files, direction)
+
+    def _scan_directory(self):
+        """
+        Return the size and the modification time of every regular file
+        of the directory, by name.
+        """
+        # The index can be kept in the directory.
+        excluded = set()
+        if self.index is not None:
+            index = os.path.abspath(self.index.path)
+            excluded.update([index, index + ".tmp"])
+        files = {}
+        for root, directories, names in os.walk(self.directory):
+            for name in names:
+                path = os.path.join(root, name)
+                if (name.endswith(_PARTIAL_SUFFIX) or
+                        os.path.abspath(path) in excluded):
+                    continue
+                try:
+                    info = os.stat(path)
+                except OSError:
+                    # A dangling link, or a file deleted meanwhile.
+                    continue
+                if stat.S_ISREG(info.st_mode):
+                    name = os.path.relpath(path, self.directory)
+                    files[name.replace(os.sep, "/")] = (
+                        info.st_size, info.st_mtime)
+        return files
+
+    def _list_objects(self):
+        """
+        Return a C{Deferred} firing with the size and the I{ETag} of every
+        object under the prefix, by name after it.
+        """
+        iterator = BucketIterator(
+            self.client, self.bucket, prefix=self.prefix or None, version=2,
+            columnar=True)
+        objects = {}
+
+        def collect(listing):
+            if listing is None:
+                return objects
+            columns = listing.contents
+            for index, key in enumerate(columns.keys):
+                name = _encode(key)[len(self.prefix):]
+                # The objects which can't be a file of the directory, like
+                # the ones named after one of its parents, are left alone.
+                if _is_local_name(name):
+                    objects[name] = (
+                        columns.sizes[index], columns.get_etag(index))
+            return iterator.next_page().addCallback(collect)
+
+        return iterator.next_page().addCallback(collect)
+
+    def _compare(self, objects, files, direction):
+        plan = SyncPlan(direction)
+        if direction == PUSH:
+            sources, targets = files, objects
+        else:
+            sources, targets = objects, files
+        semaphore = defer.DeferredSemaphore(self.concurrency)
+        checks = []
+
+        def check(matched, name):
+            if matched:
+                plan.unchanged += 1
+            else:
+                plan.transfers.append(get_item(name))
+
+        def get_item(name):
+            if direction == PUSH:
+                size, mtime = files[name]
+                return SyncItem(name, size, mtime=mtime)
+            size, etag = objects[name]
+            return SyncItem(name, size, etag=etag)
+
+        for name in sorted(set(sources) | set(targets)):
+            if name not in sources:
+                if self.delete:
+                    plan.deletions.append(name)
+            elif name not in targets or files[name][0] != objects[name][0]:
+                plan.transfers.append(get_item(name))
+            else:
+                size, mtime = files[name]
+                d = semaphore.run(
+                    self._matches, name, size, mtime, objects[name][1])
+                checks.append(d.addCallback(check, name))
+        d = defer.gatherResults(checks, consumeErrors=True)
+        d.addErrback(_unwrap_first_error)
+
+        def planned(ignored):
+            plan.transfers.sort(key=lambda item: item.name)
+            return plan
+
+        return d.addCallback(planned)
+
+    def _matches(self, name, size, mtime, etag):
+        """
+        Return a C{Deferred} firing with whether the file C{name} matches the
+        I{ETag} of its object, hashing the file only if the index can't
+        tell.
+        """
+        md5 = known_etag = None
+        if self.index is not None:
+            md5, known_etag = self.index.get(name, size, mtime)
+        if known_etag == etag:
+            return defer.succeed(True)
+        expected = etag.strip('"').lower()
+        part_size = self.manager.get_part_size(size)
+        if _MD5_ETAG.match(expected):
+            if md5 is None:
+                d = self._hash(name, size, mtime)
+            else:
+                d = defer.succeed(md5)
+        elif expected.endswith("-%d" % ((size + part_size - 1) // part_size)):
+            # Most likely uploaded in parts of the same size.
+            file = open(self._get_path(name), "rb")
+            d = get_hashing_service(self.client.endpoint).get_multipart_etag(
+                file, part_size, 0, size)
+            d.addBoth(self._close, file)
+            d.addCallback(lambda actual: actual.strip('"'))
+        else:
+            return defer.succeed(False)
+
+        def compare(actual):
+            if actual != expected:
+                return False
+            if self.index is not None:
+                self.index.update(name, size, mtime, etag=etag)
+            return True
+
+        return d.addCallback(compare)
+
+    def _hash(self, name, size, mtime):
+        """
+        Return a C{Deferred} firing with the MD5 digest of the file C{name},
+        in hexadecimal, recorded in the index.
+        """
+        file = open(self._get_path(name), "rb")
+        d = get_hashing_service(self.client.endpoint).hash_file(
+            file, 0, size)
+        d.addBoth(self._close, file)
+
+        def hashed(digest):
+            md5 = digest.hexdigest()
+            if self.index is not None:
+                self.index.update(name, size, mtime, md5=md5)
+            return md5
+
+        return d.addCallback(hashed)
+
+    def _close(self, result, file):
+        file.close()
+        return result
+
+    def get_batches(self, items):
+        """
+        Return the batches C{items} are transferred in: every big file on
+        its own, and small ones up to C{batch_size} at a time.
+        """
+        batches = []
+        batch = []
+        for item in items:
+            if item.size > self.small_size:
+                batches.append([item])
+                continue
+            batch.append(item)
+            if len(batch) == self.batch_size:
+                batches.append(batch)
+                batch = []
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def run(self, plan):
+        """
+        Carry out C{plan}, deleting the files or the objects only once all of
+        the transfers succeeded.
+
+        @return: A C{Deferred} firing with the plan, or failing like the
+            first transfer which failed, the others being finished first.
+        """
+        if plan.direction == PUSH:
+            transfer = self._upload
+        else:
+            transfer = self._download
+        semaphore = defer.DeferredSemaphore(self.concurrency)
+        d = defer.gatherResults(
+            [semaphore.run(defer.maybeDeferred, _give, batch, transfer)
+             for batch in self.get_batches(plan.transfers)],
+            consumeErrors=True)
+        d.addErrback(_unwrap_first_error)
+        d.addCallback(lambda ignored: self._delete(plan))
+        return d.addCallback(lambda ignored: plan)
+
+    def _upload(self, item):
+        path = self._get_path(item.name)
+        key = self.prefix + item.name
+        if item.size > self.manager.part_size:
+            d = self.manager.upload(self.bucket, key, filename=path)
+            d.addCallback(lambda response: (None, response.etag))
+        else:
+            md5 = None
+            if self.index is not None:
+                md5 = self.index.get(item.name, item.size, item.mtime)[0]
+            if md5 is None:
+                d = self._hash(item.name, item.size, item.mtime)
+            else:
+                d = defer.succeed(md5)
+            d.addCallback(self._put, key, path, item.size)
+
+        def uploaded(result):
+            md5, etag = result
+            if self.index is not None:
+                self.index.update(item.name, item.size, item.mtime, md5, etag)
+
+        return d.addCallback(uploaded)
+
+    def _put(self, md5, key, path, size):
+        file = open(path, "rb")
+        body = FileBody(file, 0, size, b64encode(unhexlify(md5)))
+        d = self.client.put_object(self.bucket, key, body)
+        d.addBoth(self._close, file)
+        return d.addCallback(lambda ignored: (md5, '"%s"' % (md5,)))
+
+    def _download(self, item):
+        path = self._get_pulled_path(item.name)
+        partial = path + _PARTIAL_SUFFIX
+        key = self.prefix + item.name
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        if item.size > self.manager.part_size:
+            d = self.manager.download(self.bucket, key, partial)
+        else:
+            file = open(partial, "wb")
+            d = self.client.get_object_stream(
+                self.bucket, key, file, if_match=item.etag)
+            d.addBoth(self._close, file)
+
+        def downloaded(headers):
+            os.rename(partial, path)
+            if self.index is not None:
+                info = os.stat(path)
+                etag = headers["etag"][0]
+                md5 = etag.strip('"').lower()
+                if not _MD5_ETAG.match(md5):
+                    md5 = None
+                self.index.update(
+                    item.name, info.st_size, info.st_mtime, md5, etag)
+
+        def failed(failure):
+            if os.path.exists(partial):
+                os.remove(partial)
+            return failure
+
+        return d.addCallbacks(downloaded, failed)
+
+    def _delete(self, plan):
+        if not plan.deletions:
+            return None
+        if plan.direction == PULL:
+            for name in plan.deletions:
+                os.remove(self._get_pulled_path(name))
+                if self.index is not None:
+                    self.index.discard(name)
+            return None
+        d = self.manager.delete_objects(
+            self.bucket, [self.prefix + name for name in plan.deletions])
+
+        def deleted(result):
+            plan.errors = result.errors
+
+        return d.addCallback(deleted)
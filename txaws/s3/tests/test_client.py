@@ -1,4 +1,14 @@
-from twisted.internet.defer import succeed
+from hashlib import md5
+from StringIO import StringIO
+
+from twisted.internet import reactor
+from twisted.internet.defer import gatherResults, succeed
+from twisted.protocols.policies import WrappingFactory
+from twisted.web import server
+from twisted.web.client import FileBodyProducer
+from twisted.web.resource import Resource
+
+from txaws.client.transport import HTTPTransport
 
 from txaws.credentials import AWSCredentials
 try:
@@ -9,7 +19,8 @@ except ImportError:
 else:
     s3clientSkip = None
 from txaws.s3.acls import AccessControlPolicy
-from txaws.s3.model import RequestPayment
+from txaws.s3.exception import ChecksumError, S3Error
+from txaws.s3.model import BucketItemColumns, FileChunk, RequestPayment
 from txaws.service import AWSServiceEndpoint
 from txaws.testing import payload
 from txaws.testing.base import TXAWSTestCase
@@ -197,6 +208,102 @@ class S3ClientTestCase(TXAWSTestCase):
         d = s3.get_bucket("mybucket")
         return d.addCallback(check_results)
 
+    def test_get_bucket_columnar(self):
+        """
+        Columnar listings give the same items as the others.
+        """
+
+        class StubQuery(client.Query):
+
+            def submit(query, url_context=None):
+                return succeed(payload.sample_get_bucket_result)
+
+        def check((listing, columnar)):
+            self.assertTrue(isinstance(columnar.contents, BucketItemColumns))
+            self.assertEqual(len(listing.contents), len(columnar.contents))
+            for item, view in zip(listing.contents, columnar.contents):
+                for name in ("key", "modification_date", "etag", "size",
+                             "storage_class"):
+                    self.assertEqual(
+                        getattr(item, name), getattr(view, name))
+                self.assertEqual(item.owner.id, view.owner.id)
+                self.assertEqual(
+                    item.owner.display_name, view.owner.display_name)
+                self.assertIdentical(
+                    item.modification_date.tzinfo,
+                    view.modification_date.tzinfo)
+            self.assertIdentical(columnar.contents[0].owner,
+                                 columnar.contents[1].owner)
+
+        creds = AWSCredentials("foo", "bar")
+        s3 = client.S3Client(creds, query_factory=StubQuery)
+        d = gatherResults([s3.get_bucket("mybucket"),
+                           s3.get_bucket("mybucket", columnar=True)])
+        return d.addCallback(check)
+
+    def test_get_bucket_parameters(self):
+        """
+        L{S3Client.get_bucket} passes the parameters of the listing in the
+        query string.
+        """
+
+        class StubQuery(client.Query):
+
+            def __init__(query, action, creds, endpoint, bucket=None,
+                         object_name=None):
+                super(StubQuery, query).__init__(
+                    action=action, creds=creds, bucket=bucket,
+                    object_name=object_name)
+                self.assertEqual(
+                    "?marker=a%2Fb&prefix=a%2F&max-keys=10&delimiter=%2F",
+                    query.object_name)
+                self.assertEqual(
+                    "/mybucket/", query.get_canonicalized_resource())
+
+            def submit(query, url_context=None):
+                return succeed(payload.sample_get_bucket_result)
+
+        creds = AWSCredentials("foo", "bar")
+        s3 = client.S3Client(creds, query_factory=StubQuery)
+        d = s3.get_bucket("mybucket", "a/b", "a/", 10, "/")
+        return d.addCallback(
+            lambda listing: self.assertIdentical(None, listing.next_marker))
+
+    def test_list_objects(self):
+        """
+        L{S3Client.list_objects} lists objects with I{ListObjectsV2}, giving
+        the continuation token of the next page, and items without owners.
+        """
+
+        class StubQuery(client.Query):
+
+            def __init__(query, action, creds, endpoint, bucket=None,
+                         object_name=None):
+                super(StubQuery, query).__init__(
+                    action=action, creds=creds, bucket=bucket,
+                    object_name=object_name)
+                self.assertEqual(
+                    "?list-type=2&continuation-token=abc%3D&prefix=N&"
+                    "delimiter=%2F", query.object_name)
+
+            def submit(query, url_context=None):
+                return succeed(payload.sample_list_objects_v2_result)
+
+        def check_results(listing):
+            self.assertEqual("true", listing.is_truncated)
+            self.assertEqual(
+                "1ueGcxLPRx1Tr/XYExHnhbYLgveDs2J/wm36Hy4vbOwM=",
+                listing.next_continuation_token)
+            self.assertEqual(["Nelson"],
+                             [item.key for item in listing.contents])
+            self.assertIdentical(None, listing.contents[0].owner)
+            self.assertEqual(["Neo/"], listing.common_prefixes)
+
+        creds = AWSCredentials("foo", "bar")
+        s3 = client.S3Client(creds, query_factory=StubQuery)
+        d = s3.list_objects("mybucket", "abc=", "N", delimiter="/")
+        return d.addCallback(check_results)
+
     def test_get_bucket_location(self):
         """
         L{S3Client.get_bucket_location} creates a L{Query} to get a bucket's
@@ -756,6 +863,36 @@ class S3ClientTestCase(TXAWSTestCase):
                              metadata={"key": "some meta data"},
                              amz_headers={"acl": "public-read"})
 
+    def test_complete_multipart_upload(self):
+        """
+        L{S3Client.complete_multipart_upload} lists the parts by number, and
+        fails with the error S3 can send in a successful response.
+        """
+        queries = []
+
+        class StubQuery(client.Query):
+
+            def __init__(query, **kwargs):
+                super(StubQuery, query).__init__(**kwargs)
+                queries.append(query)
+
+            def submit(query):
+                return succeed(payload.sample_s3_signature_mismatch)
+
+        s3 = client.S3Client(AWSCredentials("foo", "bar"),
+                             query_factory=StubQuery)
+        d = s3.complete_multipart_upload(
+            "mybucket", "object", "upload-id",
+            [FileChunk(2, '"b"'), FileChunk(1, '"a"')])
+        self.assertEqual("POST", queries[0].action)
+        self.assertEqual("object?uploadId=upload-id", queries[0].object_name)
+        self.assertEqual(
+            "<CompleteMultipartUpload>"
+            '<Part><PartNumber>1</PartNumber><ETag>"a"</ETag></Part>'
+            '<Part><PartNumber>2</PartNumber><ETag>"b"</ETag></Part>'
+            "</CompleteMultipartUpload>", queries[0].data)
+        return self.assertFailure(d, S3Error)
+
     def test_copy_object(self):
         """
         L{S3Client.copy_object} creates a L{Query} to copy an object from one
@@ -864,6 +1001,50 @@ class S3ClientTestCase(TXAWSTestCase):
         s3 = client.S3Client(creds, query_factory=StubQuery)
         return s3.delete_object("mybucket", "objectname")
 
+    def test_delete_objects(self):
+        """
+        L{S3Client.delete_objects} posts the names of the objects to the
+        C{delete} sub-resource, and parses the objects deleted and the
+        errors.
+        """
+        queries = []
+
+        class StubQuery(client.Query):
+
+            def __init__(query, **kwargs):
+                super(StubQuery, query).__init__(**kwargs)
+                queries.append(query)
+
+            def submit(query):
+                return succeed(payload.sample_delete_objects_result)
+
+        s3 = client.S3Client(AWSCredentials("foo", "bar"),
+                             query_factory=StubQuery)
+        d = s3.delete_objects("mybucket", ["a&b", u"caf\xe9"], quiet=True)
+        self.assertEqual("POST", queries[0].action)
+        self.assertEqual("?delete", queries[0].object_name)
+        self.assertEqual(
+            "<Delete><Quiet>true</Quiet>"
+            "<Object><Key>a&amp;b</Key></Object>"
+            "<Object><Key>caf\xc3\xa9</Key></Object>"
+            "</Delete>", queries[0].data)
+        self.assertIn("Content-MD5", queries[0].get_headers())
+
+        def check(result):
+            self.assertEqual(["sample1.txt"], result.deleted)
+            [error] = result.errors
+            self.assertEqual("sample2.txt", error.key)
+            self.assertEqual("AccessDenied", error.code)
+            self.assertEqual("Access Denied", error.message)
+
+        return d.addCallback(check)
+
+    def test_delete_objects_too_many(self):
+        s3 = client.S3Client(AWSCredentials("foo", "bar"))
+        self.assertRaises(
+            ValueError, s3.delete_objects, "mybucket",
+            ["key"] * (client.MAX_DELETE_KEYS + 1))
+
     def test_put_object_acl(self):
 
         class StubQuery(client.Query):
@@ -1022,6 +1203,17 @@ class QueryTestCase(TXAWSTestCase):
         result = query.get_canonicalized_resource()
         self.assertEquals(result, "/images/advicedog.jpg")
 
+    def test_get_canonicalized_resource_with_parameters(self):
+        """
+        Of the query parameters, only the sub-resources are signed, in
+        order.
+        """
+        query = client.Query(
+            action="GET", bucket="images",
+            object_name="dog.jpg?uploadId=a&max-parts=2&partNumber=1")
+        result = query.get_canonicalized_resource()
+        self.assertEquals(result, "/images/dog.jpg?partNumber=1&uploadId=a")
+
     def test_sign(self):
         query = client.Query(action="PUT", creds=self.creds)
         signed = query.sign({})
@@ -1109,6 +1301,192 @@ class QueryTestCase(TXAWSTestCase):
 QueryTestCase.skip = s3clientSkip
 
 
+class ObjectResource(Resource):
+    """
+    Serve C{data} with the given C{etag}, or an access key error, and keep
+    the body and headers of the last C{PUT}.
+    """
+
+    isLeaf = True
+
+    def __init__(self, data, etag):
+        Resource.__init__(self)
+        self.data = data
+        self.etag = etag
+        self.put = None
+
+    def render_PUT(self, request):
+        self.put = (request.content.read(), request.getAllHeaders())
+        return ""
+
+    def render_GET(self, request):
+        if request.postpath == ["mybucket", "forbidden"]:
+            request.setResponseCode(403)
+            return payload.sample_s3_invalid_access_key_result
+        request.setHeader("etag", '"%s"' % self.etag)
+        return self.data
+
+
+class ObjectStreamTestCase(TXAWSTestCase):
+
+    def setUp(self):
+        super(ObjectStreamTestCase, self).setUp()
+        self.data = "0123456789" * 10000
+        self.resource = ObjectResource(self.data, md5(self.data).hexdigest())
+        self.wrapper = WrappingFactory(
+            server.Site(self.resource, timeout=None))
+        self.port = reactor.listenTCP(0, self.wrapper, interface="127.0.0.1")
+        self.addCleanup(self.port.stopListening)
+        transport = HTTPTransport()
+        self.addCleanup(transport.close)
+        endpoint = AWSServiceEndpoint(
+            "http://127.0.0.1:%d/" % self.port.getHost().port,
+            transport=transport)
+        self.s3 = client.S3Client(
+            AWSCredentials("foo", "bar"), endpoint=endpoint)
+
+
+class GetObjectStreamTestCase(ObjectStreamTestCase):
+
+    def test_get_object_stream(self):
+        output = StringIO()
+        d = self.s3.get_object_stream("mybucket", "object", output)
+
+        def check(headers):
+            self.assertEqual(self.data, output.getvalue())
+            self.assertEqual(
+                ['"%s"' % self.resource.etag], headers["etag"])
+
+        return d.addCallback(check)
+
+    def test_checksum_mismatch(self):
+        self.resource.etag = "0" * 32
+        d = self.s3.get_object_stream("mybucket", "object", lambda data: None)
+        return self.assertFailure(d, ChecksumError)
+
+    def test_multipart_etag(self):
+        """
+        The I{ETag} of an object uploaded in parts isn't its MD5 digest, and
+        isn't checked.
+        """
+        self.resource.etag = "0" * 32 + "-2"
+        chunks = []
+        d = self.s3.get_object_stream("mybucket", "object", chunks.append)
+        return d.addCallback(
+            lambda ignored: self.assertEqual(self.data, "".join(chunks)))
+
+    def test_callback_failure(self):
+        """
+        The failure of the target is the one returned.
+        """
+
+        def fail(data):
+            raise ValueError()
+
+        d = self.s3.get_object_stream("mybucket", "object", fail)
+        return self.assertFailure(d, ValueError)
+
+    def test_error(self):
+        d = self.s3.get_object_stream("mybucket", "forbidden", StringIO())
+        return self.assertFailure(d, S3Error)
+
+GetObjectStreamTestCase.skip = s3clientSkip
+
+
+class PutObjectStreamTestCase(ObjectStreamTestCase):
+
+    def check_put(self, ignored, data=None):
+        if data is None:
+            data = self.data
+        body, headers = self.resource.put
+        self.assertEqual(data, body)
+        self.assertEqual(calculate_md5(data), headers["content-md5"])
+        self.assertEqual(str(len(data)), headers["content-length"])
+
+    def test_put_file(self):
+        """
+        A file is sent from its current position, with its MD5 digest.
+        """
+        data = StringIO("skipped" + self.data)
+        data.seek(7)
+        d = self.s3.put_object("mybucket", "object", data)
+        return d.addCallback(self.check_put)
+
+    def test_put_filename(self):
+        path = self.mktemp()
+        with open(path, "wb") as f:
+            f.write(self.data)
+        d = self.s3.put_object("mybucket", "object", filename=path)
+        return d.addCallback(self.check_put)
+
+    def test_put_empty_file(self):
+        d = self.s3.put_object("mybucket", "object", StringIO())
+        return d.addCallback(self.check_put, "")
+
+    def test_put_producer(self):
+        """
+        A body producer is sent as is, without a C{Content-MD5} header.
+        """
+        d = self.s3.put_object(
+            "mybucket", "object", FileBodyProducer(StringIO(self.data)))
+
+        def check(ignored):
+            body, headers = self.resource.put
+            self.assertEqual(self.data, body)
+            self.assertNotIn("content-md5", headers)
+
+        return d.addCallback(check)
+
+PutObjectStreamTestCase.skip = s3clientSkip
+
+
+class BucketItemColumnsTestCase(TXAWSTestCase):
+
+    def setUp(self):
+        super(BucketItemColumnsTestCase, self).setUp()
+        self.columns = BucketItemColumns()
+        self.etags = ['"%s"' % (md5("a").hexdigest(),),
+                      '"%s-12"' % (md5("b").hexdigest(),), '"kms"', None]
+        for index, etag in enumerate(self.etags):
+            self.columns.append(
+                "key%d" % (index,), 1136116800.5 + index, etag, 2 ** 40,
+                "GLACIER" if index % 2 else "STANDARD",
+                *(("id", "name") if index else ()))
+
+    def test_items(self):
+        self.assertEqual(4, len(self.columns))
+        self.assertEqual(self.etags,
+                         [item.etag for item in self.columns])
+        item = self.columns[-3]
+        self.assertEqual("key1", item.key)
+        self.assertEqual(str(2 ** 40), item.size)
+        self.assertEqual("GLACIER", item.storage_class)
+        self.assertEqual(
+            (2006, 1, 1, 12, 0, 1, 500000),
+            (item.modification_date.year, item.modification_date.month,
+             item.modification_date.day, item.modification_date.hour,
+             item.modification_date.minute, item.modification_date.second,
+             item.modification_date.microsecond))
+        self.assertEqual("UTC", item.modification_date.tzname())
+        self.assertIdentical(None, self.columns[0].owner)
+        self.assertEqual("name", item.owner.display_name)
+        self.assertIdentical(item.owner, self.columns[3].owner)
+
+    def test_slice(self):
+        """
+        Slices of the columns are columns too.
+        """
+        columns = self.columns[1:]
+        self.assertTrue(isinstance(columns, BucketItemColumns))
+        self.assertEqual(["key1", "key2", "key3"], columns.keys)
+        self.assertEqual(self.etags[1:], [item.etag for item in columns])
+        self.assertEqual(["GLACIER", "STANDARD", "GLACIER"],
+                         [item.storage_class for item in columns])
+        self.assertEqual(0, len(self.columns[3:1]))
+        self.assertEqual(["key0", "key2"],
+                         [item.key for item in self.columns[::2]])
+
+
 class MiscellaneousTestCase(TXAWSTestCase):
 
     def test_content_md5(self):
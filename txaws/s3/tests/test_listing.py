@@ -0,0 +1,306 @@
+from twisted.internet import defer, reactor
+from twisted.internet.task import deferLater
+
+from txaws.s3.exception import S3Error
+from txaws.s3.listing import BucketIterator, ShardedLister
+from txaws.testing.s3 import FakeS3TestCase
+
+
+class BucketIteratorTestCase(FakeS3TestCase):
+
+    def setUp(self):
+        super(BucketIteratorTestCase, self).setUp()
+        self.keys = ["a/%d" % (i,) for i in range(5)] + ["b", "c/d", "e"]
+        for key in self.keys:
+            self.resource.buckets["mybucket"][key] = key
+        self.resource.page_size = 2
+
+    def collect(self, iterator):
+        items = []
+        d = iterator.for_each(items.append)
+        return d.addCallback(lambda ignored: items)
+
+    def test_for_each(self):
+        """
+        Every item of the bucket is given in key order, the pages being
+        followed with their markers.
+        """
+        iterator = BucketIterator(self.client, "mybucket")
+        d = self.collect(iterator)
+
+        def check(items):
+            self.assertEqual(sorted(self.keys), [item.key for item in items])
+            self.assertEqual("3", items[3].size)
+            self.assertEqual("owner", items[0].owner.id)
+            self.assertEqual(4, iterator.pages)
+            self.assertEqual(
+                [None, "a/1", "a/3", "b"],
+                [args.get("marker") for args in self.get_requests("GET")])
+
+        return d.addCallback(check)
+
+    def test_version2(self):
+        """
+        I{ListObjectsV2} pages are followed with their continuation tokens,
+        the listing starting after the marker.
+        """
+        iterator = BucketIterator(
+            self.client, "mybucket", marker="a/2", version=2)
+        d = self.collect(iterator)
+
+        def check(items):
+            self.assertEqual(["a/3", "a/4", "b", "c/d", "e"],
+                             [item.key for item in items])
+            self.assertIdentical(None, items[0].owner)
+            requests = self.get_requests("GET")
+            self.assertEqual(
+                [("a/2", None), (None, "a/4"), (None, "c/d")],
+                [(args.get("start-after"), args.get("continuation-token"))
+                 for args in requests])
+
+        return d.addCallback(check)
+
+    def test_columnar(self):
+        """
+        Columnar pages are followed and trimmed at the end like the others.
+        """
+        iterator = BucketIterator(
+            self.client, "mybucket", end="a/2", columnar=True)
+        d = iterator.next_page()
+
+        def check(listing):
+            self.assertEqual(["a/0", "a/1"], listing.contents.keys)
+            return iterator.next_page()
+
+        d.addCallback(check)
+        return d.addCallback(
+            lambda listing: self.assertEqual(["a/2"], listing.contents.keys))
+
+    def test_prefetch(self):
+        """
+        The next page is requested as soon as a page was given, before it
+        is asked for.
+        """
+        iterator = BucketIterator(self.client, "mybucket", prefix="a/")
+        d = iterator.next_page()
+        self.assertRaises(ValueError, iterator.next_page)
+
+        def first(listing):
+            self.assertEqual(["a/0", "a/1"],
+                             [item.key for item in listing.contents])
+            return deferLater(reactor, 0.01, lambda: None)
+
+        def second(ignored):
+            self.assertEqual(2, len(self.resource.requests))
+            return iterator.next_page()
+
+        def third(listing):
+            self.assertEqual(["a/2", "a/3"],
+                             [item.key for item in listing.contents])
+            return iterator.next_page()
+
+        def last(listing):
+            self.assertEqual(["a/4"], [item.key for item in listing.contents])
+            return iterator.next_page()
+
+        d.addCallback(first)
+        d.addCallback(second)
+        d.addCallback(third)
+        d.addCallback(last)
+        d.addCallback(self.assertIdentical, None)
+        return d.addCallback(
+            lambda ignored: self.assertEqual(3, len(self.resource.requests)))
+
+    def test_common_prefixes(self):
+        """
+        Keys are rolled up into common prefixes with a delimiter, the pages
+        being followed with the next marker S3 gives.
+        """
+        iterator = BucketIterator(self.client, "mybucket", delimiter="/")
+        pages = []
+
+        def collect(listing):
+            if listing is not None:
+                pages.append(([item.key for item in listing.contents],
+                              listing.common_prefixes))
+                return iterator.next_page().addCallback(collect)
+
+        d = iterator.next_page().addCallback(collect)
+        return d.addCallback(
+            lambda ignored: self.assertEqual(
+                [(["b"], ["a/"]), (["e"], ["c/"])], pages))
+
+    def test_backpressure(self):
+        """
+        The next item is given once the C{Deferred} returned for the
+        previous one fired.
+        """
+        keys = []
+        pending = []
+
+        def callback(item):
+            self.assertEqual([], pending)
+            keys.append(item.key)
+            pending.append(defer.Deferred())
+            return pending[-1]
+
+        done = []
+        d = BucketIterator(self.client, "mybucket").for_each(callback)
+        d.addCallback(done.append)
+
+        def release():
+            if pending:
+                pending.pop().callback(None)
+            if not done:
+                return deferLater(reactor, 0.001, release)
+
+        d.addCallback(
+            lambda ignored: self.assertEqual(sorted(self.keys), keys))
+        return defer.gatherResults([d, release()])
+
+    def test_fired_deferreds(self):
+        """
+        Any number of items can be given to a callback returning
+        C{Deferred}s which already fired.
+        """
+        for i in range(1500):
+            self.resource.buckets["mybucket"]["f/%04d" % (i,)] = ""
+        self.resource.page_size = 1000
+        keys = []
+
+        def callback(item):
+            keys.append(item.key)
+            return defer.succeed(None)
+
+        d = BucketIterator(self.client, "mybucket").for_each(callback)
+        return d.addCallback(
+            lambda ignored: self.assertEqual(1508, len(keys)))
+
+    def test_failure(self):
+        """
+        A page failing can be asked for again.
+        """
+        iterator = BucketIterator(self.client, "nobucket")
+        d = self.assertFailure(iterator.next_page(), S3Error)
+
+        def retry(ignored):
+            self.resource.buckets["nobucket"] = {"key": "data"}
+            return iterator.next_page()
+
+        d.addCallback(retry)
+        return d.addCallback(
+            lambda listing: self.assertEqual(
+                ["key"], [item.key for item in listing.contents]))
+
+
+class ShardedListerTestCase(FakeS3TestCase):
+
+    def setUp(self):
+        super(ShardedListerTestCase, self).setUp()
+        self.keys = (["a/%d" % (i,) for i in range(3)] +
+                     ["a/b/%d" % (i,) for i in range(3)] +
+                     ["b", "c/0", "c/1", "d/0", "e"])
+        for key in self.keys:
+            self.resource.buckets["mybucket"][key] = key
+        self.resource.page_size = 2
+        self.listings = 0
+        self.most_listings = 0
+        get_bucket = self.client.get_bucket
+
+        def count(*args, **kwargs):
+            self.listings += 1
+            self.most_listings = max(self.most_listings, self.listings)
+            d = get_bucket(*args, **kwargs)
+
+            def done(result):
+                self.listings -= 1
+                return result
+
+            return d.addBoth(done)
+
+        self.client.get_bucket = count
+
+    def collect(self, lister):
+        keys = []
+        d = lister.for_each(lambda item: keys.append(item.key))
+        return d.addCallback(lambda ignored: keys)
+
+    def test_prefixes(self):
+        """
+        The keys are split at the common prefixes of the bucket, the shards
+        being listed concurrently.
+        """
+        lister = ShardedLister(self.client, "mybucket", concurrency=2)
+        d = self.collect(lister)
+
+        def check(keys):
+            self.assertEqual(sorted(self.keys), sorted(keys))
+            self.assertEqual(3, lister.shards)
+            self.assertEqual(2, self.most_listings)
+            self.assertEqual(
+                ["a/", "c/", "d/"],
+                sorted(args["prefix"] for args in self.get_requests("GET")
+                       if "prefix" in args and "marker" not in args))
+
+        return d.addCallback(check)
+
+    def test_depth(self):
+        """
+        Shards are split further at their own common prefixes down to
+        C{depth} levels.
+        """
+        lister = ShardedLister(self.client, "mybucket", depth=2)
+        d = self.collect(lister)
+
+        def check(keys):
+            self.assertEqual(sorted(self.keys), sorted(keys))
+            self.assertEqual(1, lister.shards)
+            self.assertEqual(
+                [None, "a/", "c/", "d/", "a/b/"],
+                [args.get("prefix") for args in self.get_requests("GET")
+                 if "marker" not in args])
+
+        return d.addCallback(check)
+
+    def test_ordered(self):
+        """
+        Items are given in key order when asked to, the keys found while
+        splitting the bucket being given between the shards.
+        """
+        lister = ShardedLister(
+            self.client, "mybucket", concurrency=3, ordered=True)
+        d = self.collect(lister)
+        return d.addCallback(self.assertEqual, sorted(self.keys))
+
+    def test_boundaries(self):
+        """
+        The keys are split at the boundaries given, no key beyond the end
+        of a shard being listed for it.
+        """
+        self.resource.page_size = 3
+        lister = ShardedLister(
+            self.client, "mybucket", boundaries=["c/0", "a/1"],
+            ordered=True, concurrency=2)
+        d = self.collect(lister)
+
+        def check(keys):
+            self.assertEqual(sorted(self.keys), keys)
+            self.assertEqual(3, lister.shards)
+            self.assertEqual(2, self.most_listings)
+            self.assertEqual(
+                [None, "a/1", "a/b/1", "c/0"],
+                sorted([args.get("marker")
+                        for args in self.get_requests("GET")],
+                       key=lambda marker: (marker is not None, marker)))
+
+        return d.addCallback(check)
+
+    def test_failure(self):
+        """
+        Listing fails with the error of the first listing failing.
+        """
+        return defer.gatherResults([
+            self.assertFailure(
+                ShardedLister(self.client, "nobucket", ordered=ordered
+                              ).for_each(lambda item: None), S3Error)
+            for ordered in (False, True)])
@@ -0,0 +1,152 @@
+import os
+
+from twisted.internet import defer
+
+from txaws.s3.exception import S3Error
+from txaws.s3.reader import S3File, open_object
+from txaws.testing.s3 import FakeS3TestCase
+
+
+class S3FileTestCase(FakeS3TestCase):
+
+    def setUp(self):
+        super(S3FileTestCase, self).setUp()
+        self.data = "".join(chr(i) * 10 for i in range(26)) + "tail"
+        self.resource.buckets["mybucket"]["data"] = self.data
+
+    def open(self, **kwargs):
+        kwargs.setdefault("block_size", 10)
+        kwargs.setdefault("read_ahead", 0)
+        return open_object(self.client, "mybucket", "data", **kwargs)
+
+    def test_read(self):
+        """
+        Reads are served from the blocks they span, got in one request.
+        """
+        d = self.open()
+
+        def read(f):
+            self.file = f
+            self.assertEqual(len(self.data), f.size)
+            f.seek(15)
+            return f.read(20)
+
+        def check(data):
+            self.assertEqual(self.data[15:35], data)
+            self.assertEqual(35, self.file.tell())
+            self.assertEqual([("data", 10, 39)], self.resource.ranges)
+            self.assertEqual(30, self.file.bytes_fetched)
+
+        d.addCallback(read)
+        return d.addCallback(check)
+
+    def test_seek(self):
+        """
+        Reads at the end of the object are cut short, and reads beyond it
+        are empty.
+        """
+        d = self.open()
+
+        def read(f):
+            f.seek(-6, os.SEEK_END)
+            first = f.read(100)
+            f.seek(5, os.SEEK_CUR)
+            self.assertRaises(IOError, f.seek, -1)
+            return defer.gatherResults([first, f.read()])
+
+        return d.addCallback(read).addCallback(
+            self.assertEqual, [self.data[-6:], ""])
+
+    def test_cache(self):
+        """
+        Blocks read again are served from the cache, until they are the
+        least recently used ones beyond C{cache_size}.
+        """
+        d = self.open(cache_size=2)
+
+        def read(f):
+            self.file = f
+            d = f.read(5)
+            for offset in (0, 20, 30, 0, 10):
+                d.addCallback(lambda ignored, offset=offset:
+                              f.seek(offset) or f.read(5))
+            return d
+
+        def check(data):
+            self.assertEqual(self.data[10:15], data)
+            self.assertEqual(
+                {"hits": 1, "misses": 5, "prefetched": 0, "requests": 5,
+                 "bytes_fetched": 50, "size": 2},
+                self.file.get_stats())
+
+        d.addCallback(read)
+        return d.addCallback(check)
+
+    def test_read_ahead(self):
+        """
+        Reads following each other get the next blocks ahead of time, in
+        the same request as the blocks they need.
+        """
+        d = self.open(read_ahead=2, max_request_blocks=16)
+
+        def read(f):
+            self.file = f
+            d = f.read(5)
+            d.addCallback(lambda ignored: f.read(10))
+            d.addCallback(lambda ignored: f.read(20))
+            d.addCallback(lambda ignored: f.read())
+            return d
+
+        def check(data):
+            self.assertEqual(self.data[35:], data)
+            self.assertEqual(
+                [("data", 0, 9), ("data", 10, 39), ("data", 40, 59),
+                 ("data", 60, 219), ("data", 220, 263)],
+                self.resource.ranges)
+            self.assertEqual(4, self.file.prefetched)
+            self.assertEqual(5, self.file.hits)
+
+        d.addCallback(read)
+        return d.addCallback(check)
+
+    def test_coalesce_pending(self):
+        """
+        Reads of blocks being got already wait for them rather than getting
+        them again.
+        """
+        d = self.open(max_request_blocks=2)
+
+        def read(f):
+            first = f.read(30)
+            f.seek(5)
+            return defer.gatherResults([first, f.read(10)])
+
+        def check(data):
+            self.assertEqual([self.data[:30], self.data[5:15]], data)
+            self.assertEqual([("data", 0, 19), ("data", 20, 29)],
+                             self.resource.ranges)
+
+        d.addCallback(read)
+        return d.addCallback(check)
+
+    def test_replaced(self):
+        """
+        Reads fail once the object was replaced.
+        """
+        d = self.open()
+
+        def read(f):
+            self.resource.buckets["mybucket"]["data"] = "new"
+            return f.read(5)
+
+        d.addCallback(read)
+        d = self.assertFailure(d, S3Error)
+        return d.addCallback(
+            lambda error: self.assertEqual(
+                "PreconditionFailed", error.get_error_code()))
+
+    def test_closed(self):
+        f = S3File(self.client, "mybucket", "data", len(self.data))
+        f.close()
+        self.assertRaises(ValueError, f.read)
+        self.assertRaises(ValueError, f.seek, 0)
@@ -0,0 +1,248 @@
+import os
+
+from txaws.client.hashing import HashingService
+from txaws.client.retry import RetryPolicy
+from txaws.s3.sync import HashIndex, PULL, PUSH, SyncItem, Synchronizer
+from txaws.s3.transfer import MIN_PART_SIZE, TransferManager
+from txaws.testing.base import TXAWSTestCase
+from txaws.testing.s3 import FakeS3TestCase
+
+
+class HashIndexTestCase(TXAWSTestCase):
+
+    def test_save(self):
+        """
+        Digests are kept for the size and the modification time of their
+        file, along with the I{ETag} the file matches.
+        """
+        path = self.mktemp()
+        index = HashIndex(path)
+        index.update("a/b", 3, 1.5, md5="abc")
+        index.update("a/b", 3, 1.5, etag='"abc"')
+        index.update("c", 4, 2.25, md5="def")
+        index.save()
+        index = HashIndex(path)
+        self.assertEqual(2, len(index))
+        self.assertEqual(("abc", '"abc"'), index.get("a/b", 3, 1.5))
+        self.assertEqual((None, None), index.get("a/b", 3, 1.75))
+        index.update("a/b", 3, 1.75, md5="123")
+        self.assertEqual(("123", None), index.get("a/b", 3, 1.75))
+        index.prune(["a/b"])
+        self.assertEqual(1, len(index))
+
+    def test_unreadable(self):
+        path = self.mktemp()
+        with open(path, "wb") as f:
+            f.write("{")
+        self.assertEqual(0, len(HashIndex(path)))
+
+
+class SynchronizerTestCase(FakeS3TestCase):
+
+    def setUp(self):
+        super(SynchronizerTestCase, self).setUp()
+        self.directory = self.mktemp()
+        os.makedirs(os.path.join(self.directory, "sub"))
+        self.files = {"a": "foo", "sub/b": "barbaz", "sub/c": ""}
+        for name, data in self.files.iteritems():
+            self.write(name, data)
+        self.index = HashIndex(os.path.join(self.directory, ".index"))
+        self.endpoint.hashing_service = HashingService()
+        self.manager = TransferManager(
+            self.client, part_size=MIN_PART_SIZE, concurrency=2,
+            retry_policy=RetryPolicy(base_delay=0, max_delay=0))
+
+    def write(self, name, data):
+        with open(os.path.join(self.directory, name), "wb") as f:
+            f.write(data)
+
+    def read(self, name):
+        with open(os.path.join(self.directory, name), "rb") as f:
+            return f.read()
+
+    def get_synchronizer(self, **kwargs):
+        kwargs.setdefault("index", self.index)
+        return Synchronizer(
+            self.manager, "mybucket", self.directory, prefix="backup",
+            **kwargs)
+
+    def get_objects(self):
+        return dict(
+            (key[len("backup/"):], data) for key, data in
+            self.resource.buckets["mybucket"].iteritems())
+
+    def test_push(self):
+        """
+        Files are uploaded once, the index sparing hashing them again to
+        find they didn't change.
+        """
+        d = self.get_synchronizer().sync(PUSH)
+
+        def pushed(plan):
+            self.assertEqual(["a", "sub/b", "sub/c"],
+                             [item.name for item in plan.transfers])
+            self.assertEqual(9, plan.get_size())
+            self.assertEqual(self.files, self.get_objects())
+            self.resource.requests = []
+            self.endpoint.hashing_service.inline = 0
+            return self.get_synchronizer().sync(PUSH)
+
+        def check(plan):
+            self.assertEqual([], plan.transfers)
+            self.assertEqual(3, plan.unchanged)
+            self.assertEqual([], self.get_requests("PUT"))
+            self.assertEqual(0, self.endpoint.hashing_service.inline)
+
+        d.addCallback(pushed)
+        return d.addCallback(check)
+
+    def test_push_changed(self):
+        """
+        Files of the size of their object are hashed to find whether they
+        changed, and objects missing from the directory are deleted.
+        """
+        buckets = self.resource.buckets["mybucket"]
+        buckets.update({"backup/a": "foo", "backup/sub/b": "BARBAZ",
+                        "backup/old": "data", "other": "data"})
+        d = self.get_synchronizer(delete=True).sync(PUSH)
+
+        def check(plan):
+            self.assertEqual(["sub/b", "sub/c"],
+                             [item.name for item in plan.transfers])
+            self.assertEqual(["old"], plan.deletions)
+            self.assertEqual(1, plan.unchanged)
+            self.assertEqual("barbaz", buckets["backup/sub/b"])
+            self.assertEqual(["backup/a", "backup/sub/b", "backup/sub/c",
+                              "other"], sorted(buckets))
+            self.assertEqual(("acbd18db4cc2f85cedef654fccc4a4d8", '"acbd18db'
+                              '4cc2f85cedef654fccc4a4d8"'),
+                             self.index.get(
+                                 "a", 3, os.path.getmtime(
+                                     os.path.join(self.directory, "a"))))
+
+        return d.addCallback(check)
+
+    def test_push_multipart(self):
+        """
+        The files matching objects uploaded in parts are found unchanged
+        without an index.
+        """
+        self.write("big", "x" * (MIN_PART_SIZE + 1))
+        d = self.get_synchronizer(index=None).sync(PUSH)
+
+        def pushed(plan):
+            self.assertEqual(1, len(self.resource.etags))
+            return self.get_synchronizer(index=None).plan(PUSH)
+
+        def check(plan):
+            self.assertEqual([], plan.transfers)
+            self.assertEqual(4, plan.unchanged)
+
+        d.addCallback(pushed)
+        return d.addCallback(check)
+
+    def test_dry_run(self):
+        d = self.get_synchronizer(delete=True).sync(PUSH, dry_run=True)
+
+        def check(plan):
+            self.assertEqual(3, len(plan.transfers))
+            self.assertEqual({}, self.resource.buckets["mybucket"])
+
+        return d.addCallback(check)
+
+    def test_pull(self):
+        """
+        Objects are downloaded to the files which differ, and files missing
+        from the bucket are deleted.
+        """
+        self.resource.buckets["mybucket"].update({
+            "backup/a": "foo", "backup/sub/b": "BARBAZ",
+            "backup/new/d": "new", "backup/dir/": ""})
+        d = self.get_synchronizer(delete=True).sync(PULL)
+
+        def pulled(plan):
+            self.assertEqual(["new/d", "sub/b"],
+                             [item.name for item in plan.transfers])
+            self.assertEqual(["sub/c"], plan.deletions)
+            self.assertEqual("BARBAZ", self.read("sub/b"))
+            self.assertEqual("new", self.read("new/d"))
+            self.assertFalse(
+                os.path.exists(os.path.join(self.directory, "sub/c")))
+            self.endpoint.hashing_service.inline = 0
+            return self.get_synchronizer().plan(PULL)
+
+        def check(plan):
+            self.assertEqual([], plan.transfers)
+            self.assertEqual(3, plan.unchanged)
+            self.assertEqual(0, self.endpoint.hashing_service.inline)
+
+        d.addCallback(pulled)
+        return d.addCallback(check)
+
+    def test_pull_outside(self):
+        """
+        Objects named after a parent of the directory are never pulled out
+        of it.
+        """
+        self.resource.buckets["mybucket"].update({
+            "backup/../escaped": "evil", "backup/sub/../../escaped": "evil",
+            "backup//escaped": "evil", "backup/new": "new"})
+        d = self.get_synchronizer().sync(PULL)
+
+        def check(plan):
+            self.assertEqual(["new"], [item.name for item in plan.transfers])
+            self.assertEqual("new", self.read("new"))
+            parent = os.path.dirname(os.path.abspath(self.directory))
+            self.assertFalse(
+                os.path.exists(os.path.join(parent, "escaped")))
+            self.assertFalse(
+                os.path.exists(os.path.join(self.directory, "escaped")))
+
+        return d.addCallback(check)
+
+    def test_pull_through_link(self):
+        """
+        Objects are never pulled through a link leading out of the
+        directory.
+        """
+        outside = self.mktemp()
+        os.makedirs(outside)
+        os.symlink(os.path.abspath(outside),
+                   os.path.join(self.directory, "link"))
+        self.resource.buckets["mybucket"]["backup/link/escaped"] = "evil"
+        d = self.get_synchronizer().sync(PULL)
+        self.assertFailure(d, ValueError)
+        d.addCallback(
+            lambda ignored: self.assertEqual([], os.listdir(outside)))
+        return d
+
+    def test_pull_failed(self):
+        """
+        Files are replaced only once their object was downloaded.
+        """
+        self.resource.buckets["mybucket"]["backup/a"] = "bar"
+        self.resource.range_failures[0] = 10
+        synchronizer = self.get_synchronizer(small_size=0)
+        self.manager.part_size = 1
+        d = synchronizer.sync(PULL)
+        self.assertFailure(d, Exception)
+
+        def check(ignored):
+            self.assertEqual("foo", self.read("a"))
+            self.assertEqual(
+                sorted(["a", "sub", ".index"]), sorted(os.listdir(
+                    self.directory)))
+
+        return d.addCallback(check)
+
+    def test_batches(self):
+        """
+        Small files are packed in batches, and big ones are alone.
+        """
+        synchronizer = self.get_synchronizer(small_size=10, batch_size=2)
+        items = [SyncItem(name, size) for name, size in
+                 [("a", 1), ("b", 100), ("c", 10), ("d", 5), ("e", 1)]]
+        self.assertEqual(
+            [["b"], ["a", "c"], ["d", "e"]],
+            [[item.name for item in batch]
+             for batch in synchronizer.get_batches(items)])
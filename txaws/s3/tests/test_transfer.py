@@ -0,0 +1,581 @@
+from datetime import datetime, timedelta
+from hashlib import md5
+import os
+
+from twisted.internet import defer
+
+from txaws.client.retry import RetryPolicy
+from txaws.s3.exception import ChecksumError, S3Error
+from txaws.s3.listing import BucketIterator
+from txaws.s3.model import FileChunk
+from txaws.s3.transfer import (
+    DownloadJournal, MAX_PARTS, MIN_PART_SIZE, TransferManager,
+    UploadJournal)
+from txaws.testing.base import TXAWSTestCase
+from txaws.testing.s3 import FakeS3TestCase
+
+
+class TransferTestCase(FakeS3TestCase):
+
+    def setUp(self):
+        super(TransferTestCase, self).setUp()
+        self.manager = TransferManager(
+            self.client, part_size=MIN_PART_SIZE, concurrency=2,
+            retry_policy=RetryPolicy(base_delay=0, max_delay=0))
+
+    def get_part_requests(self, part_number=None):
+        return [
+            args for args in self.get_requests("PUT") if
+            "partNumber" in args and
+            part_number in (None, int(args["partNumber"]))]
+
+    def get_range_requests(self):
+        return self.get_requests("GET")
+
+    def get_initiation_requests(self):
+        return [args for args in self.get_requests("POST")
+                if "uploads" in args]
+
+
+class TransferManagerTestCase(TransferTestCase):
+
+    def setUp(self):
+        super(TransferManagerTestCase, self).setUp()
+        self.data = "".join(
+            chr(i % 256) * 2 ** 20 for i in range(12)) + "tail"
+
+    def test_part_size(self):
+        """
+        The size of the parts grows for big objects to fit in L{MAX_PARTS}
+        parts.
+        """
+        self.assertEqual(
+            MIN_PART_SIZE, self.manager.get_part_size(10 * MIN_PART_SIZE))
+        self.assertEqual(
+            2 * MIN_PART_SIZE,
+            self.manager.get_part_size(MAX_PARTS * MIN_PART_SIZE + 1))
+        self.assertRaises(ValueError, TransferManager, self.client, 1024)
+
+    def test_upload_small(self):
+        """
+        An object no bigger than a part is put in a single request.
+        """
+        d = self.manager.upload("mybucket", "small", "data")
+
+        def check(result):
+            self.assertIdentical(None, result)
+            self.assertEqual(
+                "data", self.resource.buckets["mybucket"]["small"])
+            self.assertEqual([], self.get_part_requests())
+
+        return d.addCallback(check)
+
+    def test_upload(self):
+        d = self.manager.upload("mybucket", "big", self.data)
+
+        def check(response):
+            self.assertEqual(self.data,
+                             self.resource.buckets["mybucket"]["big"])
+            self.assertTrue(response.etag.endswith('-3"'))
+            self.assertEqual("big", response.object_name)
+            self.assertEqual(3, len(self.get_part_requests()))
+
+        return d.addCallback(check)
+
+    def test_upload_filename(self):
+        path = self.mktemp()
+        with open(path, "wb") as f:
+            f.write(self.data)
+        d = self.manager.upload("mybucket", "big", filename=path)
+        return d.addCallback(
+            lambda ignored: self.assertEqual(
+                self.data, self.resource.buckets["mybucket"]["big"]))
+
+    def test_part_retried(self):
+        """
+        A part failing is uploaded again on its own.
+        """
+        self.resource.part_failures[2] = 1
+        d = self.manager.upload("mybucket", "big", self.data)
+
+        def check(ignored):
+            self.assertEqual(self.data,
+                             self.resource.buckets["mybucket"]["big"])
+            self.assertEqual(2, len(self.get_part_requests(2)))
+            self.assertEqual(1, len(self.get_part_requests(1)))
+
+        return d.addCallback(check)
+
+    def test_part_failed(self):
+        """
+        The upload is aborted once a part failed for good.
+        """
+        self.manager.retry_policy.max_attempts = 2
+        self.resource.part_failures[1] = 2
+        d = self.manager.upload("mybucket", "big", self.data)
+
+        def check(error):
+            self.assertEqual("InternalError", error.get_error_code())
+            self.assertEqual({}, self.resource.uploads)
+            self.assertNotIn("big", self.resource.buckets["mybucket"])
+            self.assertEqual(2, len(self.get_part_requests(1)))
+
+        return self.assertFailure(d, S3Error).addCallback(check)
+
+    def test_part_retried_by_endpoint(self):
+        """
+        A part is only retried by the policy of the endpoint, if it has one,
+        without the manager sending it again on top of it.
+        """
+        policy = RetryPolicy(max_attempts=2, base_delay=0, max_delay=0)
+        self.endpoint.retry_policy = policy
+        self.resource.part_failures[1] = 3
+        manager = TransferManager(self.client, part_size=MIN_PART_SIZE)
+        self.assertIdentical(policy, manager.retry_policy)
+        d = manager.upload("mybucket", "big", self.data)
+
+        def check(error):
+            self.assertEqual(2, len(self.get_part_requests(1)))
+            self.assertEqual(1, policy.get_stats()["total"])
+
+        return self.assertFailure(d, S3Error).addCallback(check)
+
+    def start_upload(self, journal, parts=1):
+        """
+        Initiate the upload of C{self.data} as C{big} and upload its first
+        C{parts} parts, as a process stopped in the middle of the upload
+        would.
+        """
+        d = self.client.init_multipart_upload("mybucket", "big")
+
+        def upload_part(ignored, upload_id, part_number):
+            start = (part_number - 1) * MIN_PART_SIZE
+            d = self.client.upload_part(
+                "mybucket", "big", upload_id, part_number,
+                self.data[start:start + MIN_PART_SIZE])
+            return d.addCallback(journal.add_part)
+
+        def upload_parts(response):
+            journal.start("mybucket", "big", response.upload_id,
+                          len(self.data), MIN_PART_SIZE)
+            d = defer.succeed(None)
+            for part_number in range(1, parts + 1):
+                d.addCallback(upload_part, response.upload_id, part_number)
+            return d
+
+        return d.addCallback(upload_parts)
+
+    def test_resume(self):
+        """
+        An upload recorded by a journal is resumed, only the parts which
+        weren't uploaded yet being sent, and the journal is removed once
+        the object is assembled.
+        """
+        self.resource.page_size = 1
+        journal = UploadJournal(self.mktemp())
+        d = self.start_upload(journal, parts=2)
+        d.addCallback(
+            lambda ignored: self.manager.upload(
+                "mybucket", "big", self.data, journal=journal))
+
+        def check(response):
+            self.assertEqual(self.data,
+                             self.resource.buckets["mybucket"]["big"])
+            self.assertEqual(1, len(self.get_part_requests(1)))
+            self.assertEqual(1, len(self.get_part_requests(2)))
+            self.assertEqual(1, len(self.get_part_requests(3)))
+            self.assertEqual(1, len(self.get_initiation_requests()))
+            self.assertFalse(os.path.exists(journal.path))
+
+        return d.addCallback(check)
+
+    def test_resume_changed_part(self):
+        """
+        A part recorded by a journal is uploaded again if the data changed
+        since.
+        """
+        journal = UploadJournal(self.mktemp())
+        d = self.start_upload(journal)
+
+        def change_data(ignored):
+            self.data = "x" + self.data[1:]
+            return self.manager.upload(
+                "mybucket", "big", self.data, journal=journal)
+
+        d.addCallback(change_data)
+
+        def check(ignored):
+            self.assertEqual(self.data,
+                             self.resource.buckets["mybucket"]["big"])
+            self.assertEqual(2, len(self.get_part_requests(1)))
+
+        return d.addCallback(check)
+
+    def test_resume_unknown_upload(self):
+        """
+        A new upload is initiated if the one recorded by a journal doesn't
+        exist any more.
+        """
+        journal = UploadJournal(self.mktemp())
+        d = self.start_upload(journal)
+        d.addCallback(lambda ignored: self.resource.uploads.clear())
+        d.addCallback(
+            lambda ignored: self.manager.upload(
+                "mybucket", "big", self.data, journal=journal))
+
+        def check(ignored):
+            self.assertEqual(self.data,
+                             self.resource.buckets["mybucket"]["big"])
+            self.assertEqual(2, len(self.get_initiation_requests()))
+
+        return d.addCallback(check)
+
+    def test_journal_kept_on_failure(self):
+        """
+        A journaled upload isn't aborted when a part fails, so that it can
+        be resumed, and the parts uploaded are recorded.
+        """
+        self.manager.retry_policy.max_attempts = 1
+        self.resource.part_failures[3] = 1
+        journal = UploadJournal(self.mktemp())
+        d = self.manager.upload("mybucket", "big", self.data, journal=journal)
+
+        def check(ignored):
+            state = journal.load()
+            self.assertEqual([state["upload_id"]],
+                             self.resource.uploads.keys())
+            self.assertEqual([1, 2], sorted(state["parts"]))
+            self.assertEqual(len(self.data), state["size"])
+
+        return self.assertFailure(d, S3Error).addCallback(check)
+
+    def test_abort_stale_uploads(self):
+        """
+        Only the uploads initiated more than C{max_age} ago are aborted,
+        however many pages listing them take.
+        """
+        self.resource.page_size = 1
+        now = datetime.utcnow()
+        d = self.client.init_multipart_upload("mybucket", "old")
+        d.addCallback(
+            lambda ignored: self.client.init_multipart_upload(
+                "mybucket", "new"))
+
+        def abort(response):
+            for upload in self.resource.uploads.itervalues():
+                if upload["key"] == "old":
+                    upload["initiated"] = now - timedelta(days=2)
+            d = self.manager.abort_stale_uploads(
+                "mybucket", timedelta(days=1), now=now)
+            return d.addCallback(check, response.upload_id)
+
+        def check(uploads, new_upload_id):
+            self.assertEqual(["old"], [upload.object_name
+                                       for upload in uploads])
+            self.assertEqual([new_upload_id], self.resource.uploads.keys())
+
+        return d.addCallback(abort)
+
+    def test_download(self):
+        """
+        An object is downloaded in ranges written to the file at their
+        offsets.
+        """
+        self.resource.buckets["mybucket"]["big"] = self.data
+        path = self.mktemp()
+        d = self.manager.download("mybucket", "big", path)
+
+        def check(headers):
+            self.assertEqual(str(len(self.data)),
+                             headers["content-length"][0])
+            with open(path, "rb") as f:
+                self.assertEqual(self.data, f.read())
+            self.assertEqual(3, len(self.get_range_requests()))
+
+        return d.addCallback(check)
+
+    def test_download_multipart(self):
+        """
+        An object uploaded in parts is checked against its I{ETag} computed
+        from the digests of its parts.
+        """
+        d = self.manager.upload("mybucket", "big", self.data)
+        path = self.mktemp()
+        d.addCallback(
+            lambda ignored: self.manager.download("mybucket", "big", path))
+
+        def check(headers):
+            self.assertTrue(headers["etag"][0].endswith('-3"'))
+            with open(path, "rb") as f:
+                self.assertEqual(self.data, f.read())
+
+        return d.addCallback(check)
+
+    def test_download_empty(self):
+        self.resource.buckets["mybucket"]["empty"] = ""
+        path = self.mktemp()
+        d = self.manager.download("mybucket", "empty", path)
+
+        def check(ignored):
+            with open(path, "rb") as f:
+                self.assertEqual("", f.read())
+            self.assertEqual([], self.get_range_requests())
+
+        return d.addCallback(check)
+
+    def test_download_range_retried(self):
+        """
+        A range failing is got again on its own.
+        """
+        self.resource.buckets["mybucket"]["big"] = self.data
+        self.resource.range_failures[MIN_PART_SIZE] = 1
+        path = self.mktemp()
+        d = self.manager.download("mybucket", "big", path)
+
+        def check(ignored):
+            with open(path, "rb") as f:
+                self.assertEqual(self.data, f.read())
+            self.assertEqual(4, len(self.get_range_requests()))
+
+        return d.addCallback(check)
+
+    def test_download_resume(self):
+        """
+        A download recorded by a journal is resumed, only the ranges which
+        weren't written yet being got, and the journal is removed once the
+        file is checked. No more ranges are got once one failed.
+        """
+        self.manager.retry_policy.max_attempts = 1
+        self.resource.buckets["mybucket"]["big"] = self.data
+        self.resource.range_failures[MIN_PART_SIZE] = 1
+        path = self.mktemp()
+        journal = DownloadJournal(self.mktemp())
+        d = self.manager.download("mybucket", "big", path, journal)
+        self.assertFailure(d, S3Error)
+
+        def resume(ignored):
+            self.assertEqual(set([0]), journal.load()["ranges"])
+            del self.resource.requests[:]
+            return self.manager.download("mybucket", "big", path, journal)
+
+        def check(ignored):
+            with open(path, "rb") as f:
+                self.assertEqual(self.data, f.read())
+            self.assertEqual(2, len(self.get_range_requests()))
+            self.assertIdentical(None, journal.load())
+
+        d.addCallback(resume)
+        return d.addCallback(check)
+
+    def test_download_replaced_object(self):
+        """
+        A journal recorded for another version of the object is ignored.
+        """
+        self.resource.buckets["mybucket"]["big"] = self.data
+        path = self.mktemp()
+        with open(path, "wb") as f:
+            f.write("x" * len(self.data))
+        journal = DownloadJournal(self.mktemp())
+        journal.start("mybucket", "big", '"old"', len(self.data),
+                      MIN_PART_SIZE)
+        journal.add_range(0)
+        d = self.manager.download("mybucket", "big", path, journal)
+
+        def check(ignored):
+            with open(path, "rb") as f:
+                self.assertEqual(self.data, f.read())
+            self.assertEqual(3, len(self.get_range_requests()))
+
+        return d.addCallback(check)
+
+    def test_download_checksum(self):
+        """
+        The download fails if the file doesn't match the I{ETag} of the
+        object, and its journal is removed.
+        """
+        self.resource.buckets["mybucket"]["big"] = self.data
+        path = self.mktemp()
+        with open(path, "wb") as f:
+            f.write("x" * len(self.data))
+        journal = DownloadJournal(self.mktemp())
+        journal.start("mybucket", "big",
+                      '"%s"' % md5(self.data).hexdigest(), len(self.data),
+                      MIN_PART_SIZE)
+        for offset in (0, MIN_PART_SIZE):
+            journal.add_range(offset)
+        d = self.manager.download("mybucket", "big", path, journal)
+
+        def check(ignored):
+            self.assertEqual(1, len(self.get_range_requests()))
+            self.assertIdentical(None, journal.load())
+
+        self.assertFailure(d, ChecksumError)
+        return d.addCallback(check)
+
+
+class DeleteObjectsTestCase(TransferTestCase):
+
+    def setUp(self):
+        super(DeleteObjectsTestCase, self).setUp()
+        self.keys = ["key-%04d" % (i,) for i in range(2500)]
+        for key in self.keys:
+            self.resource.buckets["mybucket"][key] = "data"
+        self.resource.buckets["mybucket"]["other"] = "data"
+
+    def get_delete_requests(self):
+        return [args for args in self.get_requests("POST")
+                if "delete" in args]
+
+    def test_delete_objects(self):
+        """
+        Objects are deleted in batches of a thousand, from any iterable.
+        """
+        d = self.manager.delete_objects("mybucket", iter(self.keys))
+
+        def check(result):
+            self.assertEqual(self.keys, sorted(result.deleted))
+            self.assertEqual([], result.errors)
+            self.assertEqual(3, len(self.get_delete_requests()))
+            self.assertEqual(
+                ["other"], self.resource.buckets["mybucket"].keys())
+
+        return d.addCallback(check)
+
+    def test_delete_listing(self):
+        """
+        The objects of a listing are deleted as it is paged through, its
+        items standing for their keys.
+        """
+        self.resource.page_size = 700
+        listing = BucketIterator(self.client, "mybucket", prefix="key-")
+        d = self.manager.delete_objects("mybucket", listing)
+
+        def check(result):
+            self.assertEqual(2500, len(result.deleted))
+            self.assertEqual(3, len(self.get_delete_requests()))
+            self.assertEqual(4, listing.pages)
+            self.assertEqual(
+                ["other"], self.resource.buckets["mybucket"].keys())
+
+        return d.addCallback(check)
+
+    def test_errors(self):
+        """
+        The objects which couldn't be deleted are reported, and only them in
+        quiet mode.
+        """
+        self.resource.delete_failures.add(("mybucket", "key-0042"))
+        d = self.manager.delete_objects("mybucket", self.keys, quiet=True)
+
+        def check(result):
+            self.assertEqual([], result.deleted)
+            self.assertEqual(["key-0042"],
+                             [error.key for error in result.errors])
+            self.assertEqual("AccessDenied", result.errors[0].code)
+            self.assertEqual(
+                ["key-0042", "other"],
+                sorted(self.resource.buckets["mybucket"].keys()))
+
+        return d.addCallback(check)
+
+    def test_failure(self):
+        """
+        The deletion fails with the first request failing for good.
+        """
+        d = self.manager.delete_objects("missing", self.keys)
+        d = self.assertFailure(d, S3Error)
+
+        def check(error):
+            self.assertEqual("NoSuchBucket", error.get_error_code())
+            self.assertEqual(2, len(self.resource.requests))
+
+        return d.addCallback(check)
+
+
+class UploadJournalTestCase(TXAWSTestCase):
+
+    def test_load_missing(self):
+        self.assertIdentical(None, UploadJournal(self.mktemp()).load())
+
+    def test_load(self):
+        """
+        A journal records the upload and its parts, a line cut short being
+        ignored.
+        """
+        journal = UploadJournal(self.mktemp())
+        journal.start("mybucket", "big", "upload-1", 100, 10)
+        journal.add_part(FileChunk(2, '"etag-2"'))
+        journal.add_part(FileChunk(1, '"etag-1"'))
+        with open(journal.path, "ab") as f:
+            f.write("3 \"eta")
+        self.assertEqual(
+            {"bucket": "mybucket", "object_name": "big",
+             "upload_id": "upload-1", "size": 100, "part_size": 10,
+             "parts": {1: '"etag-1"', 2: '"etag-2"'}},
+            journal.load())
+        journal.remove()
+        self.assertIdentical(None, journal.load())
+        journal.remove()
+
+
+class MultipartWriterTestCase(TransferTestCase):
+
+    def write_all(self, writer, chunks):
+        if not chunks:
+            return writer.close()
+        d = writer.write(chunks.pop(0))
+        return d.addCallback(lambda ignored: self.write_all(writer, chunks))
+
+    def test_write(self):
+        """
+        Parts are uploaded as they fill up, and the rest on close.
+        """
+        chunks = ["%02d" % i * 2 ** 19 for i in range(11)]
+        d = self.manager.open("mybucket", "archive")
+        d.addCallback(self.write_all, list(chunks))
+
+        def check(response):
+            self.assertEqual("".join(chunks),
+                             self.resource.buckets["mybucket"]["archive"])
+            self.assertEqual(3, len(self.get_part_requests()))
+            self.assertTrue(response.etag.endswith('-3"'))
+
+        return d.addCallback(check)
+
+    def test_empty(self):
+        d = self.manager.open("mybucket", "empty")
+        d.addCallback(self.write_all, [])
+        return d.addCallback(
+            lambda ignored: self.assertEqual(
+                "", self.resource.buckets["mybucket"]["empty"]))
+
+    def test_closed(self):
+        d = self.manager.open("mybucket", "empty")
+
+        def close(writer):
+            d = writer.abort()
+            self.assertRaises(ValueError, writer.write, "data")
+            self.assertRaises(ValueError, writer.close)
+            return d
+
+        d.addCallback(close)
+        return d.addCallback(
+            lambda ignored: self.assertEqual({}, self.resource.uploads))
+
+    def test_failure(self):
+        """
+        Closing the writer fails once a part couldn't be uploaded, and
+        aborts the upload.
+        """
+        self.resource.part_failures[1] = 4
+        d = self.manager.open("mybucket", "archive")
+
+        def write(writer):
+            d = writer.write("x" * MIN_PART_SIZE)
+            d.addCallback(lambda ignored: writer.write("rest"))
+            d.addCallback(lambda ignored: writer.close())
+            return self.assertFailure(d, S3Error)
+
+        d.addCallback(write)
+        return d.addCallback(
+            lambda ignored: self.assertEqual({}, self.resource.uploads))
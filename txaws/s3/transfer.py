@@ -0,0 +1,842 @@
+# Licenced under the txaws licence available at /LICENSE in the txaws source.
+
+"""
+Transfers of big objects to S3, in parts uploaded concurrently.
+
+A L{TransferManager} uploads files in parts of C{part_size} bytes, up to
+C{concurrency} of them at a time, every failed part being retried on its
+own::
+
+    manager = TransferManager(S3Client(creds), part_size=16 * 2 ** 20)
+    d = manager.upload("mybucket", "backup.tar", filename="backup.tar")
+
+Data generated on the fly is written to the L{MultipartWriter} given by
+L{TransferManager.open}, which uploads every part as soon as it is full.
+
+Given an L{UploadJournal}, an upload interrupted by the restart of its
+process is resumed where it stopped, the parts already uploaded being only
+checked against the file::
+
+    journal = UploadJournal("backup.tar.journal")
+    d = manager.upload("mybucket", "backup.tar", filename="backup.tar",
+                       journal=journal)
+
+Uploads never completed nor aborted are deleted by
+L{TransferManager.abort_stale_uploads}.
+
+L{TransferManager.download} gets objects the other way round, in ranges
+written to a file at their offsets, and resumes from a L{DownloadJournal}.
+
+L{TransferManager.delete_objects} deletes objects a thousand at a time, for
+instance all of those of a listing::
+
+    d = manager.delete_objects(
+        "mybucket", BucketIterator(client, "mybucket", prefix="logs/"))
+"""
+from StringIO import StringIO
+from base64 import b64decode
+from datetime import datetime, timedelta
+from hashlib import md5
+import errno
+import json
+import os
+
+from twisted.internet import defer
+from twisted.python.failure import Failure
+
+from txaws.client.retry import RetryPolicy, get_retry_policy
+from txaws.client.hashing import get_hashing_service
+from txaws.client.streaming import FileConsumer, get_file_body
+from txaws.s3.client import MAX_DELETE_KEYS, _MD5_ETAG
+from txaws.s3.exception import ChecksumError, S3Error
+from txaws.s3.listing import _give
+from txaws.s3.model import DeleteResult
+
+
+__all__ = ["DownloadJournal", "MAX_PARTS", "MIN_PART_SIZE",
+           "MultipartUpload", "MultipartWriter", "TransferManager",
+           "UploadJournal"]
+
+
+# The smallest size S3 accepts for every part but the last one.
+MIN_PART_SIZE = 5 * 2 ** 20
+# The most parts an object can be uploaded in.
+MAX_PARTS = 10000
+
+
+class TransferManager(object):
+    """
+    Upload objects in parts sent concurrently.
+
+    @param client: The L{S3Client} sending the requests.
+    @param part_size: The size of the parts, in bytes, at least
+        L{MIN_PART_SIZE}. It is doubled as needed for an object to fit in
+        L{MAX_PARTS} parts.
+    @param concurrency: The maximum number of parts of an object being
+        uploaded at once.
+    @param retry_policy: The L{RetryPolicy} retrying the requests the policy
+        of the endpoint of the client doesn't: the ranges of downloads, which
+        are streamed, and every request if the endpoint has no policy. By
+        default the policy of the endpoint, or else a new one.
+    """
+
+    def __init__(self, client, part_size=8 * 2 ** 20, concurrency=4,
+                 retry_policy=None, reactor=None):
+        if part_size < MIN_PART_SIZE:
+            raise ValueError(
+                "Parts must be at least %d bytes long." % MIN_PART_SIZE)
+        if reactor is None:
+            from twisted.internet import reactor
+        if retry_policy is None:
+            retry_policy = get_retry_policy(client.endpoint)
+        if retry_policy is None:
+            retry_policy = RetryPolicy(reactor)
+        self.client = client
+        self.part_size = part_size
+        self.concurrency = concurrency
+        self.retry_policy = retry_policy
+        self.reactor = reactor
+        self.hashing_service = get_hashing_service(client.endpoint)
+
+    def get_part_size(self, size):
+        """Return the size of the parts of an object of C{size} bytes."""
+        part_size = self.part_size
+        while size > part_size * MAX_PARTS:
+            part_size *= 2
+        return part_size
+
+    def upload(self, bucket, object_name, data=None, filename=None,
+               content_type=None, metadata={}, amz_headers={}, journal=None):
+        """
+        Upload a string or a file, from its current position, in parts.
+
+        Objects no bigger than a part are put in a single request instead.
+        The MD5 digest of every part is computed before it is sent, off the
+        reactor thread for big parts, by the L{HashingService} of the
+        endpoint of the client, so the file must not change during the
+        upload.
+
+        @param data: A string or a file object.
+        @param filename: The name of a file to upload, instead of C{data}.
+        @param journal: An L{UploadJournal} recording the parts uploaded,
+            if any. The upload it records is resumed if it is the one of
+            the same object, with the same size, its parts being reused
+            if their ETag still matches the data. A failed upload isn't
+            aborted then, so that it can be resumed later on.
+        @return: A C{Deferred} firing with the L{MultipartCompletionResponse}
+            of the object, or C{None} if it was put in a single request.
+        """
+        if filename is not None:
+            data = open(filename, "rb")
+        elif isinstance(data, str):
+            data = StringIO(data)
+        offset = data.tell()
+        data.seek(0, os.SEEK_END)
+        size = data.tell() - offset
+        data.seek(offset)
+        if size <= self.part_size:
+            d = get_file_body(data, offset, size, self.hashing_service)
+            d.addCallback(
+                lambda body: self.client.put_object(
+                    bucket, object_name, body, content_type, metadata,
+                    amz_headers))
+            d.addCallback(lambda ignored: None)
+        else:
+            d = self._start_upload(
+                bucket, object_name, size, content_type, metadata,
+                amz_headers, journal)
+            d.addCallback(self._upload_parts, data, offset, size)
+        if filename is not None:
+
+            def close(result):
+                data.close()
+                return result
+
+            d.addBoth(close)
+        return d
+
+    def _start_upload(self, bucket, object_name, size, content_type,
+                      metadata, amz_headers, journal):
+        part_size = self.get_part_size(size)
+        if journal is None:
+            d = defer.succeed(None)
+        else:
+            d = self._resume_upload(
+                journal, bucket, object_name, size, part_size)
+
+        def start(upload):
+            if upload is not None:
+                return upload
+            d = self.client.init_multipart_upload(
+                bucket, object_name, content_type, metadata, amz_headers)
+
+            def started(response):
+                if journal is not None:
+                    journal.start(bucket, object_name, response.upload_id,
+                                  size, part_size)
+                return MultipartUpload(
+                    self, bucket, object_name, response.upload_id,
+                    journal=journal)
+
+            return d.addCallback(started)
+
+        return d.addCallback(start)
+
+    def _resume_upload(self, journal, bucket, object_name, size, part_size):
+        state = journal.load()
+        if state is None or (
+                state["bucket"], state["object_name"], state["size"],
+                state["part_size"]) != (bucket, object_name, size, part_size):
+            return defer.succeed(None)
+        upload_id = state["upload_id"]
+        d = self.client.list_parts(bucket, object_name, upload_id)
+
+        def resume(chunks):
+            # Parts listed but missing from the journal may have been
+            # uploaded only partly: they are sent again.
+            existing = dict(
+                (chunk.part_number, chunk) for chunk in chunks
+                if state["parts"].get(chunk.part_number) == chunk.etag)
+            return MultipartUpload(
+                self, bucket, object_name, upload_id, existing, journal)
+
+        def not_found(failure):
+            failure.trap(S3Error)
+            if failure.value.get_error_code() != "NoSuchUpload":
+                return failure
+            # The upload was completed or aborted in the meantime.
+            return None
+
+        return d.addCallbacks(resume, not_found)
+
+    def _upload_parts(self, upload, file, offset, size):
+        part_size = self.get_part_size(size)
+        part_number = 1
+        for start in range(0, size, part_size):
+            length = min(part_size, size - start)
+            upload.add_part(
+                part_number,
+                lambda start=start, length=length: get_file_body(
+                    file, offset + start, length, self.hashing_service))
+            part_number += 1
+        return upload.complete()
+
+    def open(self, bucket, object_name, content_type=None, metadata={},
+             amz_headers={}):
+        """
+        Initiate the upload of an object written in turn.
+
+        @return: A C{Deferred} firing with a L{MultipartWriter}.
+        """
+        d = self.client.init_multipart_upload(
+            bucket, object_name, content_type, metadata, amz_headers)
+        return d.addCallback(
+            lambda response: MultipartWriter(MultipartUpload(
+                self, bucket, object_name, response.upload_id)))
+
+    def upload_part(self, bucket, object_name, upload_id, part_number, data):
+        """
+        Upload a part, retrying it unless S3 refuses it for good.
+
+        @return: A C{Deferred} firing with the L{FileChunk} of the part.
+        """
+        return self._retry(
+            lambda: self.client.upload_part(
+                bucket, object_name, upload_id, part_number, data), "PUT")
+
+    def _retry(self, attempt, method, action=None, streamed=False):
+        """
+        Call C{attempt} until the C{Deferred} it returns succeeds, under our
+        retry policy, unless the policy of the endpoint already retries the
+        request, which it never does for C{streamed} ones.
+        """
+        if not streamed and get_retry_policy(self.client.endpoint):
+            return attempt()
+        return self.retry_policy.run(attempt, method, action)
+
+    def download(self, bucket, object_name, filename, journal=None):
+        """
+        Download an object to a file, in ranges of C{part_size} bytes got
+        up to C{concurrency} at a time, retrying every failed range on its
+        own.
+
+        The file is created with the size of the object first, and every
+        range is written at its offset as it arrives. All of the ranges are
+        got from the version of the object seen first, and the file is
+        checked against its I{ETag} at the end, when it is an MD5 digest or
+        the one of an object uploaded in parts of C{part_size} bytes.
+
+        @param filename: The name of the file, which is overwritten.
+        @param journal: A L{DownloadJournal} recording the ranges written,
+            if any. The download it records is resumed if it is the one of
+            the same version of the object, to the same file. It is kept
+            if the download fails, and removed once it succeeded.
+        @return: A C{Deferred} firing with the headers of the object, or
+            failing like the first range which couldn't be got or with
+            L{ChecksumError} if the file doesn't match the I{ETag}.
+        """
+        d = self.client.head_object(bucket, object_name)
+        return d.addCallback(
+            self._download, bucket, object_name, filename, journal)
+
+    def _download(self, headers, bucket, object_name, filename, journal):
+        size = int(headers["content-length"][0])
+        etag = headers["etag"][0]
+        part_size = self.get_part_size(size)
+        done = set()
+        if journal is not None:
+            state = journal.load()
+            if (state is not None and os.path.exists(filename) and
+                    os.path.getsize(filename) == size and
+                    (state["bucket"], state["object_name"], state["etag"],
+                     state["size"], state["part_size"]) ==
+                    (bucket, object_name, etag, size, part_size)):
+                done = state["ranges"]
+            else:
+                journal.start(bucket, object_name, etag, size, part_size)
+        if done:
+            file = open(filename, "r+b")
+        else:
+            file = open(filename, "w+b")
+            file.truncate(size)
+        failures = []
+        semaphore = defer.DeferredSemaphore(self.concurrency)
+
+        def get_range(offset):
+            if failures:
+                # Another range failed: the download will be resumed.
+                return None
+            length = min(part_size, size - offset)
+            d = self._retry(
+                lambda: self.client.get_object_stream(
+                    bucket, object_name, FileConsumer(file, offset),
+                    byte_range=(offset, offset + length - 1), if_match=etag),
+                "GET", streamed=True)
+            if journal is not None:
+                d.addCallback(lambda ignored: journal.add_range(offset))
+            return d.addErrback(failures.append)
+
+        d = defer.DeferredList([
+            semaphore.run(get_range, offset)
+            for offset in range(0, size, part_size) if offset not in done])
+
+        def verify(ignored):
+            file.flush()
+            if failures:
+                return failures[0]
+            expected = etag.lower()
+            service = self.hashing_service
+            if _MD5_ETAG.match(expected.strip('"')):
+                d = service.hash_file(file, 0, size)
+                d.addCallback(lambda digest: '"%s"' % digest.hexdigest())
+            elif expected.endswith('-%d"' % len(range(0, size, part_size))):
+                # Most likely uploaded in parts of the same size.
+                d = service.get_multipart_etag(file, part_size, 0, size)
+            else:
+                return None
+            return d.addCallback(check, expected)
+
+        def check(actual, expected):
+            if actual != expected:
+                if journal is not None:
+                    # Resuming the download wouldn't fix the file.
+                    journal.remove()
+                raise ChecksumError(
+                    "ETag of %s/%s is %s, not %s." %
+                    (bucket, object_name, actual, expected))
+
+        def close(result):
+            file.close()
+            return result
+
+        d.addCallback(verify)
+        d.addBoth(close)
+        if journal is not None:
+            d.addCallback(lambda ignored: journal.remove())
+        return d.addCallback(lambda ignored: headers)
+
+    def abort_stale_uploads(self, bucket, max_age, prefix=None, now=None):
+        """
+        Abort the uploads of the objects of a bucket initiated more than
+        C{max_age} ago, C{concurrency} of them at a time.
+
+        @param max_age: A C{timedelta}, or a number of seconds.
+        @param prefix: The prefix of the names of the objects, if any.
+        @param now: The current UTC C{datetime}, by default the one of the
+            system clock.
+        @return: A C{Deferred} firing with the L{MultipartUploadItem}s of
+            the uploads aborted.
+        """
+        if not isinstance(max_age, timedelta):
+            max_age = timedelta(seconds=max_age)
+        if now is None:
+            now = datetime.utcnow()
+        semaphore = defer.DeferredSemaphore(self.concurrency)
+
+        def abort(upload):
+            d = self.client.abort_multipart_upload(
+                bucket, upload.object_name, upload.upload_id)
+            d.addCallback(lambda ignored: upload)
+            return d.addErrback(aborted, upload)
+
+        def aborted(failure, upload):
+            failure.trap(S3Error)
+            if failure.value.get_error_code() != "NoSuchUpload":
+                return failure
+            # The upload was completed or aborted in the meantime.
+            return None
+
+        def abort_stale(uploads):
+            stale = [upload for upload in uploads
+                     if now - _to_utc(upload.initiated) > max_age]
+            return defer.gatherResults(
+                [semaphore.run(abort, upload) for upload in stale],
+                consumeErrors=True)
+
+        d = self.client.list_multipart_uploads(bucket, prefix)
+        d.addCallback(abort_stale)
+        d.addErrback(lambda failure: failure.value.subFailure
+                     if failure.check(defer.FirstError) else failure)
+        return d.addCallback(
+            lambda uploads: [upload for upload in uploads
+                             if upload is not None])
+
+    def delete_objects(self, bucket, keys, quiet=False):
+        """
+        Delete any number of objects, in batches of L{MAX_DELETE_KEYS}
+        deleted by a request each, up to C{concurrency} requests at a time,
+        retrying every failed request on its own.
+
+        @param keys: The names of the objects, or their L{BucketItem}s: an
+            iterable, or a listing with a C{for_each} method like a
+            L{BucketIterator} or a L{ShardedLister}. Keys are taken from it
+            as the batches are sent, a listing being paused while
+            C{concurrency} requests are in progress.
+        @param quiet: Whether S3 leaves out the objects deleted from its
+            responses, reporting only the errors.
+        @return: A C{Deferred} firing with the L{DeleteResult} of all of the
+            objects once every request completed, or with the failure of
+            the first request failing for good, after which no more batches
+            are sent.
+        """
+        semaphore = defer.DeferredSemaphore(self.concurrency)
+        result = DeleteResult([], [])
+        batch = []
+        requests = []
+        failures = []
+
+        def add(key):
+            if failures:
+                failures[0].raiseException()
+            batch.append(getattr(key, "key", key))
+            if len(batch) == MAX_DELETE_KEYS:
+                return send()
+            return None
+
+        def send():
+            names = batch[:]
+            del batch[:]
+            return semaphore.acquire().addCallback(delete, names)
+
+        def delete(ignored, names):
+            if failures:
+                semaphore.release()
+                return
+            d = self._retry(
+                lambda: self.client.delete_objects(bucket, names, quiet),
+                "POST", "DeleteObjects")
+            d.addCallbacks(merge, failed)
+            requests.append(d.addBoth(release))
+
+        def merge(page):
+            result.deleted.extend(page.deleted)
+            result.errors.extend(page.errors)
+
+        def failed(failure):
+            failures.append(failure)
+            return failure
+
+        def release(passthrough):
+            semaphore.release()
+            return passthrough
+
+        def flush(ignored):
+            if batch and not failures:
+                return send()
+            return None
+
+        def finish(outcome):
+            d = defer.DeferredList(requests, consumeErrors=True)
+            if isinstance(outcome, Failure):
+                return d.addCallback(lambda ignored: outcome)
+            return d.addCallback(
+                lambda ignored: failures[0] if failures else result)
+
+        for_each = getattr(keys, "for_each", None)
+        if for_each is None:
+            d = defer.maybeDeferred(_give, keys, add)
+        else:
+            d = for_each(add)
+        d.addCallback(flush)
+        return d.addBoth(finish)
+
+
+def _to_utc(date_time):
+    """Return C{date_time} as a naive UTC C{datetime}."""
+    if date_time.tzinfo is None:
+        return date_time
+    return (date_time - date_time.utcoffset()).replace(tzinfo=None)
+
+
+class MultipartUpload(object):
+    """
+    The parts of an object being uploaded, at most C{concurrency} of them at
+    a time.
+
+    @ivar upload_id: The ID of the upload.
+    @ivar chunks: The L{FileChunk}s of the parts uploaded, per part number.
+    @ivar existing: The L{FileChunk}s of the parts uploaded before the upload
+        was resumed, per part number. They are reused rather than sent
+        again if their ETag is the MD5 digest of the data of the part.
+    @ivar journal: The L{UploadJournal} recording the parts uploaded, if
+        any.
+    @ivar failure: The L{Failure} of the first part which couldn't be
+        uploaded, if any, after which no more parts are sent.
+    """
+
+    def __init__(self, manager, bucket, object_name, upload_id,
+                 existing=None, journal=None):
+        self.manager = manager
+        self.bucket = bucket
+        self.object_name = object_name
+        self.upload_id = upload_id
+        self.chunks = {}
+        if existing is None:
+            existing = {}
+        self.existing = existing
+        self.journal = journal
+        self.failure = None
+        self._queue = []
+        self._active = 0
+        self._room_waiters = []
+        self._done_waiters = []
+
+    def add_part(self, part_number, get_data):
+        """
+        Queue the upload of a part.
+
+        @param get_data: A callable returning the data of the part, or a
+            C{Deferred} firing with it, called when the part is sent.
+        """
+        self._queue.append((part_number, get_data))
+        self._pump()
+
+    def _pump(self):
+        while (self._queue and self.failure is None and
+               self._active < self.manager.concurrency):
+            part_number, get_data = self._queue.pop(0)
+            self._active += 1
+            d = defer.maybeDeferred(get_data)
+            d.addCallback(self._send_part, part_number)
+            d.addCallbacks(self._part_uploaded, self._part_failed)
+        self._notify()
+
+    def _send_part(self, data, part_number):
+        chunk = self.existing.pop(part_number, None)
+        if chunk is not None and chunk.etag == _get_etag(data):
+            return chunk
+        d = self.manager.upload_part(
+            self.bucket, self.object_name, self.upload_id, part_number,
+            data)
+        if self.journal is not None:
+            d.addCallback(self._record_part)
+        return d
+
+    def _record_part(self, chunk):
+        self.journal.add_part(chunk)
+        return chunk
+
+    def _part_uploaded(self, chunk):
+        self._active -= 1
+        self.chunks[chunk.part_number] = chunk
+        self._pump()
+
+    def _part_failed(self, failure):
+        self._active -= 1
+        if self.failure is None:
+            self.failure = failure
+        del self._queue[:]
+        self._notify()
+
+    def _notify(self):
+        if self.failure is None and self._queue:
+            return
+        waiters, self._room_waiters = self._room_waiters, []
+        if not self._active:
+            waiters += self._done_waiters
+            self._done_waiters = []
+        for waiter in waiters:
+            if self.failure is not None:
+                waiter.errback(self.failure)
+            else:
+                waiter.callback(None)
+
+    def wait_for_room(self):
+        """
+        Return a C{Deferred} firing once every part queued is being sent,
+        or failing like the upload.
+        """
+        d = defer.Deferred()
+        self._room_waiters.append(d)
+        self._notify()
+        return d
+
+    def wait(self):
+        """
+        Return a C{Deferred} firing once every part queued was uploaded, or
+        failing like the upload once no part is being sent any more.
+        """
+        d = defer.Deferred()
+        self._done_waiters.append(d)
+        self._notify()
+        return d
+
+    def complete(self):
+        """
+        Assemble the object once every part queued was uploaded, or abort
+        the upload if one of them failed, unless it is journaled.
+
+        @return: A C{Deferred} firing with the
+            L{MultipartCompletionResponse}, or failing like the part which
+            couldn't be uploaded.
+        """
+        d = self.wait()
+        d.addCallback(
+            lambda ignored: self.manager.client.complete_multipart_upload(
+                self.bucket, self.object_name, self.upload_id,
+                self.chunks.values()))
+        if self.journal is not None:
+            return d.addCallback(self._completed)
+        return d.addErrback(self._abort)
+
+    def _completed(self, response):
+        self.journal.remove()
+        return response
+
+    def _abort(self, failure):
+        d = self.abort()
+        # The failure of the upload is more telling than the one of its
+        # abortion.
+        return d.addBoth(lambda ignored: failure)
+
+    def abort(self):
+        """Abort the upload, deleting the parts uploaded so far."""
+        del self._queue[:]
+        d = self.manager.client.abort_multipart_upload(
+            self.bucket, self.object_name, self.upload_id)
+        if self.journal is not None:
+            d.addCallback(lambda ignored: self.journal.remove())
+        return d
+
+
+def _get_etag(data):
+    """
+    Return the ETag S3 gives to a part of data C{data}, if it can be told
+    without reading the data.
+    """
+    if isinstance(data, str):
+        return '"%s"' % md5(data).hexdigest()
+    md5_digest = getattr(data, "md5", None)
+    if md5_digest is None:
+        return None
+    return '"%s"' % b64decode(md5_digest).encode("hex")
+
+
+class MultipartWriter(object):
+    """
+    A file-like object uploading the data written to it in parts, each
+    one sent as soon as it is full.
+
+    L{write} returns a C{Deferred} which the writer should wait for before
+    writing more, so that no more than C{concurrency} parts are held in
+    memory.
+
+    @ivar upload: The L{MultipartUpload} of the object.
+    """
+
+    def __init__(self, upload):
+        self.upload = upload
+        self.part_size = upload.manager.part_size
+        self.closed = False
+        self._buffer = []
+        self._buffered = 0
+        self._part_number = 0
+
+    def write(self, data):
+        """
+        Add C{data} to the object.
+
+        @return: A C{Deferred} firing once the writer can take more data, or
+            failing like the upload.
+        """
+        if self.closed:
+            raise ValueError("I/O operation on closed file")
+        self._buffer.append(data)
+        self._buffered += len(data)
+        if self._buffered >= self.part_size:
+            data = "".join(self._buffer)
+            end = len(data) - len(data) % self.part_size
+            for start in range(0, end, self.part_size):
+                self._add_part(data[start:start + self.part_size])
+            self._buffer = [data[end:]]
+            self._buffered = len(data) - end
+        return self.upload.wait_for_room()
+
+    def _add_part(self, data):
+        self._part_number += 1
+        self.upload.add_part(self._part_number, lambda: data)
+
+    def close(self):
+        """
+        Upload what is left of the object and assemble it.
+
+        @return: A C{Deferred} firing with the L{MultipartCompletionResponse}
+            of the object, or failing like the upload, which is then
+            aborted.
+        """
+        if self.closed:
+            raise ValueError("I/O operation on closed file")
+        self.closed = True
+        if self._buffered or not self._part_number:
+            self._add_part("".join(self._buffer))
+        self._buffer = []
+        return self.upload.complete()
+
+    def abort(self):
+        """Abandon the object, deleting the parts uploaded so far."""
+        self.closed = True
+        self._buffer = []
+        return self.upload.abort()
+
+
+class _Journal(object):
+    """
+    A file recording the progress of a transfer, for it to be resumed by
+    the next process if the current one stops before its end.
+
+    The first line of the file describes the transfer, and every following
+    one a step done. Lines are only appended, and synced to disk, so that a
+    step done is never forgotten while the journal stays small to write to;
+    a line cut short by a crash is ignored.
+
+    @ivar path: The path of the file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def _read(self):
+        try:
+            journal = open(self.path, "rb")
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+        with journal:
+            lines = journal.read().split("\n")
+        try:
+            header = json.loads(lines[0])
+        except ValueError:
+            return None
+        # Names are byte strings everywhere else.
+        state = dict(
+            (str(key), value.encode("utf-8")
+             if isinstance(value, unicode) else value)
+            for key, value in header.iteritems())
+        # The last line is empty, unless the process stopped while writing
+        # it.
+        return state, lines[1:-1]
+
+    def _start(self, state):
+        temporary = self.path + ".tmp"
+        self._write(temporary, "wb", json.dumps(state))
+        os.rename(temporary, self.path)
+
+    def _add(self, line):
+        self._write(self.path, "ab", line)
+
+    def _write(self, path, mode, line):
+        with open(path, mode) as journal:
+            journal.write(line + "\n")
+            journal.flush()
+            os.fsync(journal.fileno())
+
+    def remove(self):
+        """Delete the journal, once its transfer is over."""
+        try:
+            os.remove(self.path)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+
+
+class UploadJournal(_Journal):
+    """A journal of the parts uploaded for an object."""
+
+    def load(self):
+        """
+        Read the journal.
+
+        @return: A C{dict} with the C{bucket}, C{object_name}, C{upload_id},
+            C{size} and C{part_size} of the upload, and the ETags of its
+            C{parts} per part number, or C{None} if there is no journal.
+        """
+        journal = self._read()
+        if journal is None:
+            return None
+        state, lines = journal
+        state["parts"] = {}
+        for line in lines:
+            part_number, _, etag = line.partition(" ")
+            state["parts"][int(part_number)] = etag
+        return state
+
+    def start(self, bucket, object_name, upload_id, size, part_size):
+        """Record the start of an upload, replacing any previous one."""
+        self._start({
+            "bucket": bucket, "object_name": object_name,
+            "upload_id": upload_id, "size": size, "part_size": part_size})
+
+    def add_part(self, chunk):
+        """Record the upload of the part described by a L{FileChunk}."""
+        self._add("%d %s" % (chunk.part_number, chunk.etag))
+
+
+class DownloadJournal(_Journal):
+    """A journal of the ranges of an object downloaded to a file."""
+
+    def load(self):
+        """
+        Read the journal.
+
+        @return: A C{dict} with the C{bucket}, C{object_name}, C{etag},
+            C{size} and C{part_size} of the object, and the C{set} of the
+            offsets of the C{ranges} downloaded, or C{None} if there is no
+            journal.
+        """
+        journal = self._read()
+        if journal is None:
+            return None
+        state, lines = journal
+        state["ranges"] = set(int(line) for line in lines)
+        return state
+
+    def start(self, bucket, object_name, etag, size, part_size):
+        """Record the start of a download, replacing any previous one."""
+        self._start({
+            "bucket": bucket, "object_name": object_name, "etag": etag,
+            "size": size, "part_size": part_size})
+
+    def add_range(self, offset):
+        """Record the download of the range starting at C{offset}."""
+        self._add("%d" % (offset,))
@@ -32,6 +32,26 @@ def parse_options(usage):
     parser.add_option(
         "-c", "--content-type", dest="content_type",
         help="content type of the object")
+    parser.add_option(
+        "--max-age", dest="max_age", type="float", default=24,
+        help=("the age in hours after which an upload in progress is "
+              "deemed stale (default: 24)"))
+    parser.add_option(
+        "-p", "--prefix", dest="prefix",
+        help="prefix of the names of the objects")
+    parser.add_option(
+        "--index", dest="index",
+        help=("the path to the file keeping the digests of the files "
+              "synchronized (default: .txaws-index in the directory)"))
+    parser.add_option(
+        "--delete", dest="delete", action="store_true", default=False,
+        help="delete what is missing from the source of a synchronization")
+    parser.add_option(
+        "-n", "--dry-run", dest="dry_run", action="store_true",
+        default=False, help="only show what would be done")
+    parser.add_option(
+        "-j", "--concurrency", dest="concurrency", type="int", default=8,
+        help="the number of transfers in progress at once (default: 8)")
     options, args = parser.parse_args()
     if not (options.access_key and options.secret_key):
         parser.error(
@@ -1,6 +1,5 @@
 from datetime import datetime, timedelta
 from uuid import uuid4
-from dateutil.tz import tzutc
 
 from twisted.python import log
 from twisted.python.reflect import safe_str
@@ -15,6 +14,7 @@ from txaws.server.schema import (
     Schema, Unicode, Integer, Enum, RawStr, Date)
 from txaws.server.exception import APIError
 from txaws.server.call import Call
+from txaws.util import UTC
 
 
 class QueryAPI(Resource):
@@ -159,7 +159,7 @@ class QueryAPI(Resource):
 
     def get_utc_time(self):
         """Return a C{datetime} object with the current time in UTC."""
-        return datetime.now(tzutc())
+        return datetime.now(UTC)
 
     def _validate(self, request):
         """Validate an L{HTTPRequest} before executing it.
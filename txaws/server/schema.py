@@ -1,10 +1,7 @@
-from datetime import datetime
 from operator import itemgetter
 
-from dateutil.tz import tzutc
-from dateutil.parser import parse
-
 from txaws.server.exception import APIError
+from txaws.util import format_iso8601, parse_iso8601
 
 
 class SchemaError(APIError):
@@ -249,15 +246,10 @@ class Date(Parameter):
     kind = "date"
 
     def parse(self, value):
-        return parse(value).replace(tzinfo=tzutc())
+        return parse_iso8601(value)
 
     def format(self, value):
-        # Convert value to UTC.
-        tt = value.utctimetuple()
-        utc_value = datetime(
-            tt.tm_year, tt.tm_mon, tt.tm_mday, tt.tm_hour, tt.tm_min,
-            tt.tm_sec)
-        return datetime.strftime(utc_value, "%Y-%m-%dT%H:%M:%SZ")
+        return format_iso8601(value)
 
 
 class Arguments(object):
@@ -350,6 +350,15 @@ class DateTestCase(TestCase):
         date = datetime(2010, 9, 15, 23, 59, 59, tzinfo=tzutc())
         self.assertEqual(date, parameter.parse("2010-09-15T23:59:59Z"))
 
+    def test_coerce_invalid(self):
+        """Dates with fields out of their range are invalid."""
+        parameter = Date("Test")
+        error = self.assertRaises(
+            APIError, parameter.coerce, "2010-02-30T12:00:00Z")
+        self.assertEqual("InvalidParameterValue", error.code)
+        self.assertEqual("Invalid date value 2010-02-30T12:00:00Z",
+                         error.message)
+
     def test_format(self):
         """
         L{Date.format} returns a string representation of the given datetime
@@ -2,6 +2,9 @@
 # Copyright (C) 2009 Robert Collins <robertc@robertcollins.net>
 # Licenced under the txaws licence available at /LICENSE in the txaws source.
 
+from twisted.internet.defer import gatherResults
+from twisted.python import log
+
 from txaws.credentials import AWSCredentials
 from txaws import regions
 from txaws.util import parse
@@ -25,14 +28,39 @@ class AWSServiceEndpoint(object):
     @param method: The HTTP method used when accessing a service.
     @param ssl_hostname_verification: Whether or not SSL hotname verification
         will be done when connecting to the endpoint.
+    @param transport: An optional L{HTTPTransport} through which queries
+        against this endpoint are sent, reusing persistent connections.
+    @param retry_policy: The L{RetryPolicy} of queries against this endpoint,
+        by default the one of the transport.
+    @param rate_limiter: The L{RateLimiter} of queries against this endpoint,
+        by default the one of the transport.
+    @param single_flight: The L{SingleFlight} coalescing identical read-only
+        queries against this endpoint, by default the one of the transport.
+    @param cache: The L{DescribeCache} answering EC2 queries against this
+        endpoint, if any.
+    @param latency_tracker: The L{LatencyTracker} adapting the timeouts of
+        queries against this endpoint, by default the one of the transport.
+    @param timing_observers: The callables given the L{RequestTiming} of
+        every query against this endpoint, by default the ones of the
+        transport.
     """
 
-    def __init__(self, uri="", method="GET", ssl_hostname_verification=False):
+    def __init__(self, uri="", method="GET", ssl_hostname_verification=False,
+                 transport=None, retry_policy=None, rate_limiter=None,
+                 single_flight=None, cache=None, latency_tracker=None,
+                 timing_observers=None):
         self.host = ""
         self.port = None
         self.path = "/"
         self.method = method
         self.ssl_hostname_verification = ssl_hostname_verification
+        self.transport = transport
+        self.retry_policy = retry_policy
+        self.rate_limiter = rate_limiter
+        self.single_flight = single_flight
+        self.cache = cache
+        self.latency_tracker = latency_tracker
+        self.timing_observers = timing_observers
         self._parse_uri(uri)
         if not self.scheme:
             self.scheme = "http"
@@ -100,11 +128,34 @@ class AWSServiceRegion(object):
     @param uri: an endpoint URI that, if provided, will override the region
         parameter.
     @param method: The method argument forwarded to L{AWSServiceEndpoint}.
+    @param transport: The L{HTTPTransport} shared by the endpoints of the
+        region. By default a new one is created.
+    @param max_persistent_per_host: The maximum number of idle connections
+        the default transport keeps alive for each host.
+    @param preconnect: The number of connections to open to each endpoint of
+        the region when it is created.
+    @param scheduler: The L{RequestScheduler} limiting the concurrency of the
+        default transport.
+    @param retry_policy: The L{RetryPolicy} of the default transport. By
+        default failed requests are retried according to a new
+        L{RetryPolicy}.
+    @param rate_limiter: The L{RateLimiter} of the default transport.
+    @param single_flight: The L{SingleFlight} of the default transport, by
+        default identical queries are not coalesced.
+    @param dns_cache: The L{DNSCache} of the default transport. By default
+        the hosts of the region are resolved through a new L{DNSCache}.
+    @param latency_tracker: The L{LatencyTracker} of the default transport,
+        by default timeouts aren't adapted to latencies.
+    @param timing_observers: The timing observers of the default transport,
+        see L{SlowRequestLog}.
     """
     # XXX update unit test to check for both ec2 and s3 endpoints
     def __init__(self, creds=None, access_key="", secret_key="",
                  region=REGION_US, uri="", ec2_uri="", s3_uri="",
-                 method="GET"):
+                 method="GET", transport=None, max_persistent_per_host=2,
+                 preconnect=0, scheduler=None, retry_policy=None,
+                 rate_limiter=None, single_flight=None, dns_cache=None,
+                 latency_tracker=None, timing_observers=None):
         if not creds:
             creds = AWSCredentials(access_key, secret_key)
         self.creds = creds
@@ -117,10 +168,59 @@ class AWSServiceRegion(object):
             ec2_uri = EC2_ENDPOINT_EU
         if not s3_uri:
             s3_uri = S3_ENDPOINT
+        if transport is None:
+            from txaws.client.dns import DNSCache
+            from txaws.client.retry import RetryPolicy
+            from txaws.client.transport import HTTPTransport
+            if retry_policy is None:
+                retry_policy = RetryPolicy()
+            if dns_cache is None:
+                dns_cache = DNSCache()
+            transport = HTTPTransport(
+                max_persistent_per_host=max_persistent_per_host,
+                scheduler=scheduler, retry_policy=retry_policy,
+                rate_limiter=rate_limiter, single_flight=single_flight,
+                dns_cache=dns_cache, latency_tracker=latency_tracker,
+                timing_observers=timing_observers)
+        self.transport = transport
         self._clients = {}
-        self.ec2_endpoint = AWSServiceEndpoint(uri=ec2_uri, method=method)
-        self.s3_endpoint = AWSServiceEndpoint(uri=s3_uri, method=method)
-        self.sqs_endpoint = AWSServiceEndpoint(uri=SQS_ENDPOINT_US, method=method)
+        self.ec2_endpoint = AWSServiceEndpoint(
+            uri=ec2_uri, method=method, transport=transport)
+        self.s3_endpoint = AWSServiceEndpoint(
+            uri=s3_uri, method=method, transport=transport)
+        self.sqs_endpoint = AWSServiceEndpoint(
+            uri=SQS_ENDPOINT_US, method=method, transport=transport)
+        if preconnect:
+            self.preconnect(preconnect)
+
+    def preconnect(self, count=1):
+        """
+        Open up to C{count} idle connections to each endpoint of the region,
+        so that the first requests don't pay for the connection setup.
+
+        Failures are logged rather than raised.
+
+        @return: A C{Deferred} firing once all the connection attempts are
+            done.
+        """
+        deferreds = []
+        for endpoint, ssl_hostname_verification in [
+            (self.ec2_endpoint, self.ec2_endpoint.ssl_hostname_verification),
+            (self.s3_endpoint, self.s3_endpoint.ssl_hostname_verification),
+            (self.sqs_endpoint, True)]:
+            uri = endpoint.get_uri()
+            d = self.transport.preconnect(
+                uri, count, ssl_hostname_verification)
+            d.addErrback(log.err, "Could not pre-open connections to %s" % uri)
+            deferreds.append(d)
+        return gatherResults(deferreds)
+
+    def get_pool_stats(self):
+        """
+        Return the statistics of the connection pool shared by the clients of
+        the region, see L{ConnectionPool.get_stats}.
+        """
+        return self.transport.get_stats()
 
     def get_client(self, cls, purge_cache=False, *args, **kwds):
         """
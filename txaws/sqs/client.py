@@ -7,7 +7,10 @@ from urllib import quote, quote_plus
 from datetime import datetime
 
 from txaws.util import hmac_sha256, get_utf8_value
-from txaws.client.base import BaseClient, BaseQuery
+from txaws.client.base import BaseClient, get_timing_observers
+from txaws.client.deadline import get_latency_tracker
+from txaws.client.ratelimit import get_rate_limiter
+from txaws.client.retry import get_retry_policy
 from txaws.service import AWSServiceEndpoint
 from txaws.sqs.connection import SQSConnection
 from txaws.sqs.errors import RequestParamError
@@ -22,12 +25,33 @@ from txaws.sqs.parser import (empty_check,
                               parse_queue_attributes)
 
 
-class QuerysSignatureV4(BaseQuery):
+def get_agent(endpoint, agent=None):
+    """
+    Return C{agent} or, failing that, the verifying agent of the transport
+    shared by the endpoint, if any.
+    """
+    if agent is None and getattr(endpoint, "transport", None) is not None:
+        agent = endpoint.transport.get_agent(ssl_hostname_verification=True)
+    return agent
+
+
+def get_scheduler(endpoint):
+    """Return the scheduler of the transport shared by the endpoint, if any."""
+    transport = getattr(endpoint, "transport", None)
+    if transport is not None:
+        return transport.scheduler
+
+
+class QuerysSignatureV4(SQSConnection):
 
     version = '2012-11-05'
 
     def __init__(self, creds, endpoint, agent=None):
-        super(QuerysSignatureV4, self).__init__(endpoint.get_host(), agent)
+        super(QuerysSignatureV4, self).__init__(
+            endpoint.get_host(), get_agent(endpoint, agent),
+            get_scheduler(endpoint), get_retry_policy(endpoint),
+            get_rate_limiter(endpoint), getattr(creds, "access_key", None),
+            get_latency_tracker(endpoint), get_timing_observers(endpoint))
         self.creds = creds
         self.endpoint = endpoint
         self.region = endpoint.get_host().split('.')[1]
@@ -101,20 +125,21 @@ class QuerysSignatureV4(BaseQuery):
                                          params.items(),
                                          dt,
                                          canonical_headers)
-        return self.get_page(
-            url, method='GET', body_producer=self.body_producer,
-            receiver_factory=self.receiver_factory,
-            headers=dict(canonical_headers),
-        )
+        return self.call(url, method='GET', headers=dict(canonical_headers),
+                         action=action)
 
 
-class QuerySignatureV2(BaseQuery):
+class QuerySignatureV2(SQSConnection):
 
     version = '2012-11-05'
     DATE_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
 
     def __init__(self, creds, endpoint, agent=None):
-        super(QuerySignatureV2, self).__init__(endpoint.get_host(), agent)
+        super(QuerySignatureV2, self).__init__(
+            endpoint.get_host(), get_agent(endpoint, agent),
+            get_scheduler(endpoint), get_retry_policy(endpoint),
+            get_rate_limiter(endpoint), getattr(creds, "access_key", None),
+            get_latency_tracker(endpoint), get_timing_observers(endpoint))
         self.creds = creds
         self.endpoint = endpoint
 
@@ -142,10 +167,7 @@ class QuerySignatureV2(BaseQuery):
 
     def submit(self, action, **params):
         url = self._generate_request_url(action, params.items())
-        return self.get_page(
-            url, method='GET', body_producer=self.body_producer,
-            receiver_factory=self.receiver_factory
-        )
+        return self.call(url, method='GET', action=action)
 
 
 class SQSClient(BaseClient):
@@ -156,9 +178,12 @@ class SQSClient(BaseClient):
             - ListQueues.
     """
 
-    def __init__(self, creds=None, endpoint=None, query_factory=None):
-        query_factory = QuerysSignatureV4(creds, endpoint)
-        super(SQSClient, self).__init__(creds, endpoint, query_factory)
+    def __init__(self, creds=None, endpoint=None, query_factory=None,
+                 retry_policy=None, rate_limiter=None):
+        super(SQSClient, self).__init__(
+            creds, endpoint, retry_policy=retry_policy,
+            rate_limiter=rate_limiter)
+        self.query_factory = QuerysSignatureV4(creds, self.endpoint)
 
     def get_queue(self, owner_id, queue):
         """
@@ -168,7 +193,10 @@ class SQSClient(BaseClient):
             request for queue url. You should call this method to get queue
             and make operations on it.
         """
-        endpoint = AWSServiceEndpoint(uri=self.endpoint.get_uri())
+        endpoint = AWSServiceEndpoint(uri=self.endpoint.get_uri(),
+                                      transport=self.endpoint.transport,
+                                      retry_policy=self.endpoint.retry_policy,
+                                      rate_limiter=self.endpoint.rate_limiter)
         endpoint.set_path('/{}/{}/'.format(owner_id, queue))
         query_factory = QuerysSignatureV4(self.creds, endpoint,
                                           self.query_factory.agent)
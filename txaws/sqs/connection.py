@@ -2,11 +2,17 @@
 from cStringIO import StringIO
 
 from twisted.python import log
+from twisted.python.failure import Failure
 from twisted.internet import reactor, ssl, defer, protocol
 from twisted.web.client import Agent, HTTPConnectionPool
 from twisted.web.http_headers import Headers
 
+from txaws.client.base import RequestTiming, attach_timing
+from txaws.client.deadline import (
+    DeadlineExceeded, get_deadline, timeout_deferred)
+from txaws.client.scheduler import get_endpoint_key
 from txaws.client.ssl import VerifyingContextFactory
+from txaws.client.transport import PooledAgent
 from txaws.sqs.errors import ApiError, ResponseError
 
 
@@ -31,7 +37,10 @@ class BodyReceiver(protocol.Protocol):
     def connectionLost(self, reason):
         self.data.seek(0, 0)
         data = self.data.read()
-        if self.code == 200:
+        if self.finished.called:
+            # The call was cancelled.
+            pass
+        elif self.code == 200:
             self.finished.callback(data)
         else:
             error = ResponseError(data, self.code)
@@ -40,8 +49,18 @@ class BodyReceiver(protocol.Protocol):
 
 
 class SQSConnection(object):
+    """
+    @cvar timeout: The number of seconds each attempt of a request is given,
+        once the scheduler lets it go.
+    @cvar service: The name of the service, as given to the timing observers.
+    """
+
+    timeout = 60
+    service = "sqs"
 
-    def __init__(self, host, agent=None):
+    def __init__(self, host, agent=None, scheduler=None, retry_policy=None,
+                 rate_limiter=None, access_key=None, latency_tracker=None,
+                 timing_observers=None):
         if agent is None:
             pool = HTTPConnectionPool(reactor)
             contextFactory = SSLClientContextFactory(host)
@@ -51,19 +70,120 @@ class SQSConnection(object):
                 pool=pool
             )
         self.agent = agent
+        self.scheduler = scheduler
+        self.retry_policy = retry_policy
+        self.rate_limiter = rate_limiter
+        self.access_key = access_key
+        self.latency_tracker = latency_tracker
+        self.timing_observers = timing_observers or []
+        self.reactor = reactor
+
+    def call(self, url, method='GET', headers={}, action=None):
+        """
+        Send the request, through the L{RequestScheduler} if we have one, and
+        retry it according to our L{RetryPolicy}, if any. Every attempt waits
+        for our L{RateLimiter}, if any.
+
+        Within a L{deadline} block, the request fails with L{DeadlineExceeded}
+        if it isn't done by the deadline.
+
+        Our timing observers, if any, are given the L{RequestTiming} of the
+        request.
+        """
+        timing = None
+        if self.timing_observers:
+            timing = RequestTiming(
+                self.service, action, method, url, self.reactor,
+                self.timing_observers)
+        if self.retry_policy is None:
+            d = self._limit(url, method, headers, action, timing)
+        else:
+            d = self.retry_policy.run(
+                lambda: self._limit(url, method, headers, action, timing),
+                method, action)
+        when = get_deadline()
+        if when is not None:
+            d = timeout_deferred(
+                d, self.reactor, when - self.reactor.seconds(),
+                DeadlineExceeded, "%s missed its deadline." % action)
+        if timing is not None:
+            d.addBoth(self._timed, timing)
+        return d
+
+    def _timed(self, result, timing):
+        if isinstance(result, Failure):
+            timing.error = result.type.__name__
+            timing.status = getattr(result.value, "status", None)
+            timing.finish()
+        else:
+            timing.status = "200"
+            result = attach_timing(result, timing)
+        return result
 
-    def call(self, url, method='GET', headers={}):
+    def _limit(self, url, method, headers, action, timing=None):
+        if self.rate_limiter is None:
+            return self._schedule(url, method, headers, action, timing)
+        return self.rate_limiter.limit(
+            self.access_key, action,
+            lambda: self._schedule(url, method, headers, action, timing))
+
+    def _schedule(self, url, method, headers, action, timing=None):
+        if timing is not None:
+            timing.start_attempt()
+        if self.scheduler is None:
+            return self._timeout(url, method, headers, action, timing)
+        queued = self.reactor.seconds()
+
+        def call():
+            if timing is not None:
+                timing.queue = self.reactor.seconds() - queued
+            return self._timeout(url, method, headers, action, timing)
+
+        return self.scheduler.schedule(call, get_endpoint_key(url), action)
+
+    def _timeout(self, url, method, headers, action, timing=None):
+        timeout = self.timeout
+        if self.latency_tracker is not None:
+            timeout = self.latency_tracker.get_timeout(action, timeout)
+        d = self._call(url, method, headers, action, timing)
+        if timeout:
+            d = timeout_deferred(d, self.reactor, timeout)
+        return d
+
+    def _call(self, url, method, headers, action=None, timing=None):
         headers = Headers({
             key: [value] for key, value in headers.items()
         })
-        d = self.agent.request(
-            method, url, headers, None
-        )
-        def cbRequest(response):
-            finished = defer.Deferred()
-            response.deliverBody(
-                BodyReceiver(finished, response)
+        started = self.reactor.seconds()
+        if timing is not None and isinstance(self.agent, PooledAgent):
+            d = self.agent.request(method, url, headers, None, timing=timing)
+        else:
+            d = self.agent.request(
+                method, url, headers, None
             )
+        def cbRequest(response):
+            received = self.reactor.seconds()
+            if timing is not None:
+                timing.ttfb = (received - started - (timing.dns or 0) -
+                               (timing.connect or 0))
+            # Cancelling while the body is received drops the connection.
+            finished = defer.Deferred(
+                lambda ignored: receiver.transport.stopProducing())
+            receiver = BodyReceiver(finished, response)
+            response.deliverBody(receiver)
+            if timing is not None:
+                finished.addCallback(record_body, received)
             return finished
+        def record_body(body, received):
+            timing.body = self.reactor.seconds() - received
+            return body
+        def record(result):
+            self.latency_tracker.record(
+                action, self.reactor.seconds() - started)
+            return result
         d.addCallback(cbRequest)
-        return d
\ No newline at end of file
+        if timing is not None:
+            d.addBoth(timing.count_response)
+        if self.latency_tracker is not None:
+            d.addCallback(record)
+        return d
@@ -22,6 +22,16 @@ class ResponseError(ApiError):
         super(ResponseError, self).__init__(value, code)
         self.set_response_values()
 
+    @property
+    def status(self):
+        """The HTTP status, named like L{TwistedWebError.status}."""
+        return self.code
+
+    @property
+    def response(self):
+        """The response body, named like L{TwistedWebError.response}."""
+        return self.value
+
     def set_response_values(self):
         _type, message =  parse_error_message(self.value)
         self.type = _type
@@ -2,6 +2,7 @@
 import base64
 from collections import namedtuple
 
+from txaws.client.base import timed_parse
 from txaws.util import XML
 
 
@@ -31,24 +32,28 @@ def parse_error_message(data):
     return _type, message
 
 
+@timed_parse
 def parse_change_message_visibility_batch(data):
     return process_batch_result(data,
                                 'ChangeMessageVisibilityBatchResult',
                                 'ChangeMessageVisibilityBatchResultEntry')
 
 
+@timed_parse
 def parse_delete_message_batch(data):
     return process_batch_result(data,
                                 'DeleteMessageBatchResult',
                                 'DeleteMessageBatchResultEntry')
 
 
+@timed_parse
 def parse_send_message_batch(data):
     return process_batch_result(data,
                                 'SendMessageBatchResult',
                                 'SendMessageBatchResultEntry')
 
 
+@timed_parse
 def parse_receive_message(data):
     result = []
     element = XML(data).find('ReceiveMessageResult')
@@ -59,11 +64,13 @@ def parse_receive_message(data):
     return result
 
 
+@timed_parse
 def parse_get_queue_url(data):
     element = XML(data).find('GetQueueUrlResult')
     return element.findtext('QueueUrl').strip()
 
 
+@timed_parse
 def parse_list_queues(data):
     result = []
     element = XML(data).find('ListQueuesResult')
@@ -72,12 +79,14 @@ def parse_list_queues(data):
     return result
 
 
+@timed_parse
 def parse_create_queue(data):
     element = XML(data).find('CreateQueueResult')
     url = element.findtext('QueueUrl').strip()
     return url
 
 
+@timed_parse
 def parse_queue_attributes(data):
     result = {}
     str_attrs = ['Policy', 'QueueArn']
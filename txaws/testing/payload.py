@@ -940,6 +940,46 @@ sample_get_bucket_result = """\
 """ % (version.s3_api,)
 
 
+sample_list_objects_v2_result = """\
+<?xml version="1.0" encoding="UTF-8"?>
+<ListBucketResult xmlns="http://s3.amazonaws.com/doc/%s/">
+  <Name>mybucket</Name>
+  <Prefix>N</Prefix>
+  <KeyCount>2</KeyCount>
+  <MaxKeys>2</MaxKeys>
+  <Delimiter>/</Delimiter>
+  <IsTruncated>true</IsTruncated>
+  <NextContinuationToken>1ueGcxLPRx1Tr/XYExHnhbYLgveDs2J/wm36Hy4vbOwM=\
+</NextContinuationToken>
+  <Contents>
+    <Key>Nelson</Key>
+    <LastModified>2006-01-01T12:00:00.000Z</LastModified>
+    <ETag>&quot;828ef3fdfa96f00ad9f27c383fc9ac7f&quot;</ETag>
+    <Size>5</Size>
+    <StorageClass>STANDARD</StorageClass>
+  </Contents>
+  <CommonPrefixes>
+    <Prefix>Neo/</Prefix>
+  </CommonPrefixes>
+</ListBucketResult>
+""" % (version.s3_api,)
+
+
+sample_delete_objects_result = """\
+<?xml version="1.0" encoding="UTF-8"?>
+<DeleteResult xmlns="http://s3.amazonaws.com/doc/%s/">
+  <Deleted>
+    <Key>sample1.txt</Key>
+  </Deleted>
+  <Error>
+    <Key>sample2.txt</Key>
+    <Code>AccessDenied</Code>
+    <Message>Access Denied</Message>
+  </Error>
+</DeleteResult>
+""" % (version.s3_api,)
+
+
 sample_get_bucket_location_result = """\
 <LocationConstraint xmlns="http://s3.amazonaws.com/doc/2006-03-01/">EU\
 </LocationConstraint>
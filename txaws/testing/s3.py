@@ -0,0 +1,359 @@
+# Licenced under the txaws licence available at /LICENSE in the txaws source.
+
+"""
+An in-memory S3 server, to test clients against over HTTP.
+"""
+from base64 import b64encode
+from datetime import datetime
+from hashlib import md5
+from urllib import unquote
+from xml.sax.saxutils import escape
+
+from twisted.internet import reactor
+from twisted.protocols.policies import WrappingFactory
+from twisted.web import server
+from twisted.web.resource import Resource
+
+from txaws.client.transport import HTTPTransport
+from txaws.credentials import AWSCredentials
+from txaws.s3.client import S3Client
+from txaws.service import AWSServiceEndpoint
+from txaws.testing.base import TXAWSTestCase
+from txaws.util import XML
+
+
+def _error(request, status, code, message="Fake S3 error."):
+    request.setResponseCode(status)
+    return ("<?xml version=\"1.0\" encoding=\"UTF-8\"?>\n"
+            "<Error><Code>%s</Code><Message>%s</Message></Error>" %
+            (code, message))
+
+
+class FakeS3Resource(Resource):
+    """
+    A resource serving the objects of C{buckets}, a C{dict} of C{dict}s
+    mapping the names of the objects of every bucket to their data.
+
+    Requests aren't authenticated. Objects can be uploaded in parts, the
+    uploads in progress being kept in C{uploads}, keyed on their ID, and the
+    I{ETag} of the objects uploaded in parts in C{etags}, keyed on their
+    bucket and name.
+
+    @ivar part_failures: The number of times uploading a part should fail
+        with an C{InternalError}, per part number.
+    @ivar range_failures: The number of times getting a range of an object
+        should fail with an C{InternalError}, per offset of the range.
+    @ivar delete_failures: The bucket and name of the objects multi-object
+        deletes should fail to delete with C{AccessDenied}.
+    @ivar page_size: The maximum number of entries of a listing.
+    @ivar requests: The method, path and arguments of every request.
+    @ivar ranges: The name of the object and the offsets of the first and
+        last bytes of every ranged I{GET}.
+    """
+
+    isLeaf = True
+
+    def __init__(self, buckets=None):
+        Resource.__init__(self)
+        if buckets is None:
+            buckets = {}
+        self.buckets = buckets
+        self.uploads = {}
+        self.etags = {}
+        self.part_failures = {}
+        self.range_failures = {}
+        self.delete_failures = set()
+        self.page_size = 1000
+        self.requests = []
+        self.ranges = []
+        self._upload_ids = 0
+
+    def render(self, request):
+        bucket = request.postpath[0]
+        object_name = "/".join(request.postpath[1:])
+        # Sub-resources like "?uploads" have no value.
+        query = request.uri.partition("?")[2]
+        args = dict(map(unquote, pair.partition("=")[::2])
+                    for pair in query.split("&") if pair)
+        self.requests.append((request.method, bucket, object_name, args))
+        if bucket not in self.buckets:
+            return _error(request, 404, "NoSuchBucket")
+        body = request.content.read()
+        content_md5 = request.getHeader("content-md5")
+        if content_md5 is not None and content_md5 != b64encode(
+                md5(body).digest()):
+            return _error(request, 400, "BadDigest")
+        method = getattr(self, "render_%s" % (request.method,), None)
+        if method is None:
+            return _error(request, 405, "MethodNotAllowed")
+        return method(request, bucket, object_name, args, body)
+
+    def _get_etag(self, bucket, object_name, data):
+        etag = self.etags.get((bucket, object_name))
+        if etag is None:
+            etag = '"%s"' % md5(data).hexdigest()
+        return etag
+
+    def render_GET(self, request, bucket, object_name, args, body):
+        if "uploadId" in args:
+            return self._list_parts(request, args)
+        if "uploads" in args:
+            return self._list_uploads(request, bucket, args)
+        if not object_name:
+            return self._list_objects(bucket, args)
+        data = self.buckets[bucket].get(object_name)
+        if data is None:
+            return _error(request, 404, "NoSuchKey")
+        if_match = request.getHeader("if-match")
+        etag = self._get_etag(bucket, object_name, data)
+        if if_match is not None and if_match != etag:
+            return _error(request, 412, "PreconditionFailed")
+        request.setHeader("etag", etag)
+        byte_range = request.getHeader("range")
+        if byte_range is None:
+            return data
+        first, last = byte_range.partition("=")[2].split("-")
+        first, last = int(first), min(int(last), len(data) - 1)
+        self.ranges.append((object_name, first, last))
+        failures = self.range_failures.get(first)
+        if failures:
+            self.range_failures[first] = failures - 1
+            return _error(request, 500, "InternalError")
+        request.setResponseCode(206)
+        request.setHeader(
+            "content-range", "bytes %d-%d/%d" % (first, last, len(data)))
+        return data[first:last + 1]
+
+    def _list_objects(self, bucket, args):
+        """
+        List the objects of C{bucket} with I{ListObjects}, or with
+        I{ListObjectsV2} for a C{list-type} of C{2}, in which case the
+        continuation tokens are the last key of the previous page.
+        """
+        version2 = args.get("list-type") == "2"
+        prefix = args.get("prefix", "")
+        delimiter = args.get("delimiter")
+        if version2:
+            marker = (args.get("continuation-token") or
+                      args.get("start-after", ""))
+        else:
+            marker = args.get("marker", "")
+        max_keys = min(int(args.get("max-keys", 1000)), self.page_size)
+        entries = []
+        truncated = False
+        for key in sorted(self.buckets[bucket]):
+            if not key.startswith(prefix) or key <= marker:
+                continue
+            common_prefix = None
+            if delimiter:
+                index = key.find(delimiter, len(prefix))
+                if index >= 0:
+                    common_prefix = key[:index + len(delimiter)]
+                    if (common_prefix <= marker or
+                            entries and entries[-1][1] == common_prefix):
+                        continue
+            if len(entries) == max_keys:
+                truncated = True
+                break
+            entries.append((key, common_prefix))
+        owner = not version2 or args.get("fetch-owner") == "true"
+        contents = "".join(
+            "<Contents><Key>%s</Key>"
+            "<LastModified>2006-01-01T12:00:00.000Z</LastModified>"
+            "<ETag>%s</ETag><Size>%d</Size>"
+            "<StorageClass>STANDARD</StorageClass>%s</Contents>" %
+            (escape(key),
+             escape(self._get_etag(bucket, key, self.buckets[bucket][key])),
+             len(self.buckets[bucket][key]),
+             "<Owner><ID>owner</ID><DisplayName>Owner</DisplayName></Owner>"
+             if owner else "")
+            for key, common_prefix in entries if common_prefix is None)
+        common_prefixes = "".join(
+            "<CommonPrefixes><Prefix>%s</Prefix></CommonPrefixes>" %
+            (escape(common_prefix),)
+            for key, common_prefix in entries if common_prefix is not None)
+        next_page = ""
+        if truncated:
+            last = entries[-1][1] or entries[-1][0]
+            if version2:
+                next_page = ("<NextContinuationToken>%s"
+                             "</NextContinuationToken>" % (escape(last),))
+            elif delimiter:
+                next_page = "<NextMarker>%s</NextMarker>" % (escape(last),)
+        return ("<ListBucketResult><Name>%s</Name><Prefix>%s</Prefix>"
+                "<MaxKeys>%d</MaxKeys><IsTruncated>%s</IsTruncated>%s%s%s"
+                "</ListBucketResult>" %
+                (bucket, escape(prefix), max_keys, str(truncated).lower(),
+                 next_page, contents, common_prefixes))
+
+    def _list_parts(self, request, args):
+        upload = self.uploads.get(args["uploadId"])
+        if upload is None:
+            return _error(request, 404, "NoSuchUpload")
+        marker = int(args.get("part-number-marker", 0))
+        numbers = sorted(
+            number for number in upload["parts"] if number > marker)
+        page = numbers[:self.page_size]
+        truncated = len(numbers) > len(page)
+        parts = "".join(
+            "<Part><PartNumber>%d</PartNumber><ETag>\"%s\"</ETag>"
+            "<Size>%d</Size></Part>" %
+            (number, md5(upload["parts"][number]).hexdigest(),
+             len(upload["parts"][number]))
+            for number in page)
+        return ("<ListPartsResult><IsTruncated>%s</IsTruncated>"
+                "<NextPartNumberMarker>%s</NextPartNumberMarker>%s"
+                "</ListPartsResult>" %
+                (str(truncated).lower(), page[-1] if page else 0, parts))
+
+    def _list_uploads(self, request, bucket, args):
+        prefix = args.get("prefix", "")
+        marker = (args.get("key-marker", ""), args.get("upload-id-marker", ""))
+        uploads = sorted(
+            (upload["key"], upload_id, upload["initiated"])
+            for upload_id, upload in self.uploads.iteritems()
+            if upload["bucket"] == bucket and
+            upload["key"].startswith(prefix) and
+            (upload["key"], upload_id) > marker)
+        page = uploads[:self.page_size]
+        truncated = len(uploads) > len(page)
+        next_key, next_upload_id = page[-1][:2] if page else ("", "")
+        entries = "".join(
+            "<Upload><Key>%s</Key><UploadId>%s</UploadId>"
+            "<Initiated>%s</Initiated></Upload>" %
+            (key, upload_id, initiated.strftime("%Y-%m-%dT%H:%M:%S.000Z"))
+            for key, upload_id, initiated in page)
+        return ("<ListMultipartUploadsResult>"
+                "<IsTruncated>%s</IsTruncated>"
+                "<NextKeyMarker>%s</NextKeyMarker>"
+                "<NextUploadIdMarker>%s</NextUploadIdMarker>%s"
+                "</ListMultipartUploadsResult>" %
+                (str(truncated).lower(), next_key, next_upload_id, entries))
+
+    def render_HEAD(self, request, bucket, object_name, args, body):
+        data = self.buckets[bucket].get(object_name)
+        if data is None:
+            request.setResponseCode(404)
+            return ""
+        request.setHeader("etag", self._get_etag(bucket, object_name, data))
+        request.setHeader("content-length", str(len(data)))
+        return ""
+
+    def render_PUT(self, request, bucket, object_name, args, body):
+        if "uploadId" in args:
+            upload = self.uploads.get(args["uploadId"])
+            if upload is None:
+                return _error(request, 404, "NoSuchUpload")
+            part_number = int(args["partNumber"])
+            failures = self.part_failures.get(part_number)
+            if failures:
+                self.part_failures[part_number] = failures - 1
+                return _error(request, 500, "InternalError")
+            upload["parts"][part_number] = body
+        else:
+            self.buckets[bucket][object_name] = body
+            self.etags.pop((bucket, object_name), None)
+        request.setHeader("etag", '"%s"' % md5(body).hexdigest())
+        return ""
+
+    def render_POST(self, request, bucket, object_name, args, body):
+        if "delete" in args:
+            return self._delete_objects(request, bucket, body)
+        if "uploads" in args:
+            self._upload_ids += 1
+            upload_id = "upload-%d" % (self._upload_ids,)
+            self.uploads[upload_id] = {
+                "bucket": bucket, "key": object_name, "parts": {},
+                "initiated": datetime.utcnow()}
+            return ("<InitiateMultipartUploadResult>"
+                    "<Bucket>%s</Bucket><Key>%s</Key>"
+                    "<UploadId>%s</UploadId>"
+                    "</InitiateMultipartUploadResult>" %
+                    (bucket, object_name, upload_id))
+        upload_id = args.get("uploadId")
+        upload = self.uploads.get(upload_id)
+        if upload is None:
+            return _error(request, 404, "NoSuchUpload")
+        data = []
+        digests = []
+        for part in XML(body).findall("Part"):
+            part_data = upload["parts"].get(int(part.findtext("PartNumber")))
+            digest = md5(part_data or "")
+            if (part_data is None or
+                    part.findtext("ETag") != '"%s"' % digest.hexdigest()):
+                return _error(request, 400, "InvalidPart")
+            data.append(part_data)
+            digests.append(digest.digest())
+        del self.uploads[upload_id]
+        etag = '"%s-%d"' % (md5("".join(digests)).hexdigest(), len(digests))
+        self.buckets[bucket][object_name] = "".join(data)
+        self.etags[bucket, object_name] = etag
+        return ("<CompleteMultipartUploadResult>"
+                "<Location>/%s/%s</Location>"
+                "<Bucket>%s</Bucket><Key>%s</Key>"
+                "<ETag>%s</ETag>"
+                "</CompleteMultipartUploadResult>" %
+                (bucket, object_name, bucket, object_name, etag))
+
+    def _delete_objects(self, request, bucket, body):
+        if request.getHeader("content-md5") is None:
+            return _error(request, 400, "InvalidRequest")
+        root = XML(body)
+        # The names of the objects are kept encoded, as in their path.
+        keys = [obj.findtext("Key").encode("utf-8")
+                for obj in root.findall("Object")]
+        if not 0 < len(keys) <= 1000:
+            return _error(request, 400, "MalformedXML")
+        quiet = root.findtext("Quiet") == "true"
+        results = []
+        for key in keys:
+            if (bucket, key) in self.delete_failures:
+                results.append(
+                    "<Error><Key>%s</Key><Code>AccessDenied</Code>"
+                    "<Message>Access Denied</Message></Error>" %
+                    escape(key))
+                continue
+            self.buckets[bucket].pop(key, None)
+            self.etags.pop((bucket, key), None)
+            if not quiet:
+                results.append("<Deleted><Key>%s</Key></Deleted>" %
+                               escape(key))
+        return ("<?xml version=\"1.0\" encoding=\"UTF-8\"?>\n"
+                "<DeleteResult>%s</DeleteResult>" % "".join(results))
+
+    def render_DELETE(self, request, bucket, object_name, args, body):
+        if "uploadId" in args:
+            if self.uploads.pop(args["uploadId"], None) is None:
+                return _error(request, 404, "NoSuchUpload")
+        else:
+            self.buckets[bucket].pop(object_name, None)
+            self.etags.pop((bucket, object_name), None)
+        request.setResponseCode(204)
+        return ""
+
+
+class FakeS3TestCase(TXAWSTestCase):
+    """
+    Run a L{FakeS3Resource} with a C{mybucket} bucket, and an L{S3Client}
+    talking to it.
+    """
+
+    def setUp(self):
+        super(FakeS3TestCase, self).setUp()
+        self.resource = FakeS3Resource({"mybucket": {}})
+        self.wrapper = WrappingFactory(
+            server.Site(self.resource, timeout=None))
+        self.port = reactor.listenTCP(0, self.wrapper, interface="127.0.0.1")
+        self.addCleanup(self.port.stopListening)
+        transport = HTTPTransport()
+        self.addCleanup(transport.close)
+        self.endpoint = AWSServiceEndpoint(
+            "http://127.0.0.1:%d/" % self.port.getHost().port,
+            transport=transport)
+        self.client = S3Client(
+            AWSCredentials("foo", "bar"), endpoint=self.endpoint)
+
+    def get_requests(self, method):
+        """Return the arguments of the requests made with C{method}."""
+        return [args for request_method, bucket, object_name, args in
+                self.resource.requests if request_method == method]
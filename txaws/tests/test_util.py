@@ -1,8 +1,15 @@
+from collections import OrderedDict
+from datetime import datetime, timedelta
 from urlparse import urlparse
 
+from dateutil.tz import tzoffset, tzutc
+
 from twisted.trial.unittest import TestCase
 
-from txaws.util import hmac_sha1, iso8601time, parse
+from txaws import util
+from txaws.util import (
+    UTC, format_iso8601, hmac_sha1, iso8601time, parse, parse_iso8601,
+    parse_iso8601_timestamp)
 
 
 class MiscellaneousTestCase(TestCase):
@@ -24,6 +31,80 @@ class MiscellaneousTestCase(TestCase):
         self.assertEqual("2006-07-07T15:04:56Z",
                          iso8601time((2006, 7, 7, 15, 4, 56, 0, 0, 0)))
 
+    def test_parse_iso8601(self):
+        """
+        The dates AWS uses are parsed into C{datetime}s in UTC, dates without
+        time zones being taken as UTC.
+        """
+        expected = datetime(2006, 1, 1, 12, 0, 0, tzinfo=tzutc())
+        for text in ("2006-01-01T12:00:00Z", "2006-01-01T12:00:00.000Z",
+                     "20060101T120000Z", "2006-01-01T14:30:00+02:30",
+                     "2006-01-01T09:00:00-0300", "2006-01-01T12:00:00"):
+            self.assertEqual(expected, parse_iso8601(text))
+            self.assertIdentical(UTC, parse_iso8601(text).tzinfo)
+        self.assertEqual(
+            expected + timedelta(microseconds=250000),
+            parse_iso8601("2006-01-01T12:00:00.25Z"))
+
+    def test_parse_iso8601_fallback(self):
+        """
+        Other dates are parsed by C{dateutil}.
+        """
+        self.assertEqual(
+            datetime(2006, 1, 1, 12, 0, 0, tzinfo=tzutc()),
+            parse_iso8601("Sun, 01 Jan 2006 14:00:00 +0200"))
+        self.assertRaises(ValueError, parse_iso8601, "yesterday")
+
+    def test_parse_iso8601_invalid(self):
+        """
+        Dates in the usual formats with fields out of their range are
+        rejected, rather than rolled over.
+        """
+        for text in ["2006-02-30T12:00:00Z", "2006-01-01T25:00:00Z",
+                     "2006-01-01T12:61:00Z", "2006-01-01T12:00:60Z",
+                     "2006-13-01T12:00:00Z", "2006-01-01T12:00:00+99:99",
+                     "2006-01-01T12:00:00+02:60"]:
+            self.assertRaises(ValueError, parse_iso8601, text)
+            self.assertRaises(ValueError, parse_iso8601_timestamp, text)
+
+    def test_parse_iso8601_cache(self):
+        """
+        The dates parsed recently are given again, the least recently used
+        one being dropped once the cache is full.
+        """
+        self.patch(util, "_parsed_dates", OrderedDict())
+        self.patch(util, "_PARSED_DATES_SIZE", 2)
+        first = parse_iso8601("2006-01-01T12:00:00Z")
+        second = parse_iso8601("2006-01-01T12:00:01Z")
+        self.assertIdentical(first, parse_iso8601("2006-01-01T12:00:00Z"))
+        parse_iso8601("2006-01-01T12:00:02Z")
+        self.assertEqual(2, len(util._parsed_dates))
+        self.assertIdentical(first, parse_iso8601("2006-01-01T12:00:00Z"))
+        self.assertNotIdentical(
+            second, parse_iso8601("2006-01-01T12:00:01Z"))
+
+    def test_parse_iso8601_timestamp(self):
+        self.assertEqual(
+            1136116800.25,
+            parse_iso8601_timestamp("2006-01-01T12:00:00.250Z"))
+        self.assertEqual(
+            1136116800, parse_iso8601_timestamp("2006-01-01T14:00:00+02:00"))
+        self.assertEqual(
+            1136116800,
+            parse_iso8601_timestamp("Sun, 01 Jan 2006 12:00:00 GMT"))
+
+    def test_format_iso8601(self):
+        """
+        Dates are formatted in UTC, to the second or to the millisecond.
+        """
+        date = datetime(2006, 1, 1, 14, 0, 0, 250999,
+                        tzinfo=tzoffset(None, 7200))
+        self.assertEqual("2006-01-01T12:00:00Z", format_iso8601(date))
+        self.assertEqual("2006-01-01T12:00:00.250Z",
+                         format_iso8601(date, microseconds=True))
+        self.assertEqual("2006-01-01T14:00:00Z",
+                         format_iso8601(date.replace(tzinfo=None)))
+
 
 class ParseUrlTestCase(TestCase):
     """
@@ -4,8 +4,12 @@ New things in this module should be of relevance to more than one of Amazon's
 services.
 """
 from base64 import b64encode
+from calendar import timegm
+from collections import OrderedDict
+from datetime import datetime, timedelta, tzinfo
 from hashlib import sha1, md5, sha256
 import hmac
+import re
 from urlparse import urlparse, urlunparse
 import time
 
@@ -17,7 +21,9 @@ except ImportError:
     from elementtree.ElementTree import XMLTreeBuilder
 
 
-__all__ = ["hmac_sha1", "hmac_sha256", "iso8601time", "calculate_md5", "XML"]
+__all__ = ["hmac_sha1", "hmac_sha256", "iso8601time", "calculate_md5", "XML",
+           "format_iso8601", "parse_iso8601", "parse_iso8601_timestamp",
+           "UTC"]
 
 
 def get_utf8_value(value):
@@ -55,6 +61,129 @@ def iso8601time(time_tuple):
         return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
 
 
+# The dates AWS gives and takes: 2006-01-01T12:00:00.000Z, with an offset
+# instead of the Z at times, or without separators, like 20060101T120000Z.
+_ISO8601 = re.compile(
+    r"^(\d{4})-?(\d\d)-?(\d\d)T(\d\d):?(\d\d):?(\d\d)(\.\d{1,6})?"
+    r"(?:Z|([+-])(\d\d):?(\d\d))?$")
+
+
+class _UTCZone(tzinfo):
+    """The UTC time zone, without depending on C{dateutil}."""
+
+    def utcoffset(self, date):
+        return timedelta(0)
+
+    def dst(self, date):
+        return timedelta(0)
+
+    def tzname(self, date):
+        return "UTC"
+
+    def __repr__(self):
+        return "_UTCZone()"
+
+
+# The tzinfo of the dates parsed and built by txAWS.
+UTC = _UTCZone()
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=UTC)
+
+# The dates parsed last, which repeat in listings and requests, the least
+# recently used first.
+_parsed_dates = OrderedDict()
+_PARSED_DATES_SIZE = 1024
+
+
+def _parse_iso8601(text):
+    """
+    Return the UTC time of C{text} as a C{(seconds, microseconds)} tuple,
+    or C{None} if it isn't in one of the usual formats.
+
+    @raise ValueError: If a field of the date is out of its range.
+    """
+    match = _ISO8601.match(text)
+    if match is None:
+        return None
+    (year, month, day, hour, minute, second, fraction, sign, offset_hours,
+     offset_minutes) = match.groups()
+    # Unlike timegm, datetime checks the ranges of the fields.
+    date = datetime(int(year), int(month), int(day), int(hour), int(minute),
+                    int(second))
+    seconds = timegm(date.timetuple())
+    if sign is not None:
+        if int(offset_hours) > 23 or int(offset_minutes) > 59:
+            raise ValueError("Invalid time zone offset in %r." % (text,))
+        offset = int(offset_hours) * 3600 + int(offset_minutes) * 60
+        seconds += -offset if sign == "+" else offset
+    microseconds = 0
+    if fraction:
+        microseconds = int(fraction[1:].ljust(6, "0"))
+    return seconds, microseconds
+
+
+def parse_iso8601(text):
+    """
+    Parse an ISO 8601 date, as given by AWS.
+
+    The formats AWS uses are parsed right away, the others with
+    C{dateutil}, which is only needed for them. Dates without a time zone
+    are taken as UTC.
+
+    @return: A C{datetime} in UTC, which is the same object for the dates
+        parsed recently.
+    @raise ValueError: If C{text} isn't a date.
+    """
+    date = _parsed_dates.pop(text, None)
+    if date is not None:
+        _parsed_dates[text] = date
+        return date
+    parsed = _parse_iso8601(text)
+    if parsed is None:
+        from dateutil.parser import parse as parse_date
+        date = parse_date(text)
+        if date.tzinfo is None:
+            date = date.replace(tzinfo=UTC)
+        else:
+            date = date.astimezone(UTC)
+    else:
+        seconds, microseconds = parsed
+        date = _EPOCH + timedelta(seconds=seconds, microseconds=microseconds)
+    if len(_parsed_dates) >= _PARSED_DATES_SIZE:
+        _parsed_dates.popitem(last=False)
+    _parsed_dates[text] = date
+    return date
+
+
+def parse_iso8601_timestamp(text):
+    """
+    Parse an ISO 8601 date, like L{parse_iso8601}, into the number of
+    seconds since the epoch, which is cheaper than making a C{datetime}.
+    """
+    parsed = _parse_iso8601(text)
+    if parsed is None:
+        date = parse_iso8601(text)
+        return timegm(date.utctimetuple()) + date.microsecond / 1e6
+    seconds, microseconds = parsed
+    return seconds + microseconds / 1e6
+
+
+def format_iso8601(date, microseconds=False):
+    """
+    Format a C{datetime} as an ISO 8601 date in UTC, like
+    C{2006-01-01T12:00:00Z}, or C{2006-01-01T12:00:00.000Z} with
+    C{microseconds}, which are then given to the millisecond like AWS does.
+    Dates without a time zone are taken as UTC.
+    """
+    if date.tzinfo is not None:
+        date = date.astimezone(UTC)
+    text = "%04d-%02d-%02dT%02d:%02d:%02d" % (
+        date.year, date.month, date.day, date.hour, date.minute, date.second)
+    if microseconds:
+        text += ".%03d" % (date.microsecond // 1000,)
+    return text + "Z"
+
+
 class NamespaceFixXmlTreeBuilder(XMLTreeBuilder):
 
     def _fixname(self, key):
@@ -63,10 +192,20 @@ class NamespaceFixXmlTreeBuilder(XMLTreeBuilder):
         return key
 
 
+# Callables given the number of seconds each call to XML() takes, see
+# txaws.client.base.timed_parse.
+xml_timers = []
+
+
 def XML(text):
+    if xml_timers:
+        started = time.time()
     parser = NamespaceFixXmlTreeBuilder()
     parser.feed(text)
-    return parser.close()
+    root = parser.close()
+    if xml_timers:
+        xml_timers[-1](time.time() - started)
+    return root
 
 
 def parse(url, defaultPort=True):